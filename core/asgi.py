@@ -2,18 +2,26 @@ import os
 from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
-import users.routing # We will create this file in a later step
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
-# This is the default application for standard HTTP requests
+# This is the default application for standard HTTP requests.
+# It sets up Django, so it must be created before the routing modules import models.
 django_asgi_app = get_asgi_application()
 
+import users.routing
+import nlp_services.routing
+from users.middleware import JWTAuthMiddleware
+
 application = ProtocolTypeRouter({
     "http": django_asgi_app,
     "websocket": AuthMiddlewareStack(
-        URLRouter(
-            users.routing.websocket_urlpatterns
+        # Token authentication for API clients, on top of the session user
+        JWTAuthMiddleware(
+            URLRouter(
+                users.routing.websocket_urlpatterns
+                + nlp_services.routing.websocket_urlpatterns
+            )
         )
     ),
 })
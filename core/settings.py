@@ -3,6 +3,8 @@ import os
 import textwrap
 from pathlib import Path
 
+from celery.schedules import crontab
+
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -29,6 +31,7 @@ ALLOWED_HOSTS = []
 # Application definition
 
 INSTALLED_APPS = [
+    'daphne', # Must be first so that `runserver` serves the project over ASGI
     'django.contrib.admin',
     'django.contrib.auth',
     'django.contrib.contenttypes',
@@ -37,6 +40,7 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     # Third-party apps
     'rest_framework',
+    'adrf', # Async APIView support for the NLP endpoints
     'rest_framework_simplejwt', # Ensure this is present
     'rest_framework_simplejwt.token_blacklist', # IMPORTANT: Add this for token blacklisting to work
     'drf_spectacular',
@@ -131,6 +135,54 @@ CELERY_RESULT_BACKEND = 'redis://redis:6379/0'
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
+# NLP jobs run for seconds to minutes, so a worker only reserves the job it is running.
+# This keeps queued jobs available to idle workers and to the high priority queue.
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# Usage quota (see nlp_services/quota.py): free users are charged atomically in Redis,
+# and the consumed counts are written back to the database every NLP_QUOTA_FLUSH_INTERVAL
+# seconds by Celery beat (celery -A core beat). A balance cached in Redis is re-read
+# from the database after each flush of the user, or after NLP_QUOTA_TTL seconds.
+NLP_QUOTA_FLUSH_INTERVAL = 30
+NLP_QUOTA_TTL = 60 * 60
+
+# History rows are queued in Redis and saved in bulk every NLP_HISTORY_FLUSH_INTERVAL
+# seconds (see nlp_services/history_buffer.py). Set NLP_HISTORY_WRITE_BEHIND = False
+# to save them in the request instead.
+NLP_HISTORY_WRITE_BEHIND = True
+NLP_HISTORY_FLUSH_INTERVAL = 5
+NLP_HISTORY_FLUSH_BATCH_SIZE = 500
+
+# History retention (see nlp_services/archival.py): rows older than the retention period
+# of their owner's tier are moved nightly to gzip-compressed JSONL files under
+# NLP_ARCHIVE_DIR, one directory per month. None keeps the rows of a tier forever.
+NLP_HISTORY_RETENTION_DAYS = {
+    'free': 90,
+    'pro': 365,
+}
+NLP_ARCHIVE_DIR = os.environ.get('NLP_ARCHIVE_DIR', BASE_DIR / 'archive')
+NLP_ARCHIVE_BATCH_SIZE = 1000
+
+# Summarization and aggregate inputs of at least NLP_BLOB_MIN_SIZE bytes are stored once,
+# compressed, in the blob store (see nlp_services/blob_store.py). Zstandard is used when the
+# optional 'zstandard' package is installed, zlib otherwise.
+NLP_BLOB_MIN_SIZE = 1024
+NLP_COMPRESSION_CODEC = 'zstd'
+
+CELERY_BEAT_SCHEDULE = {
+    'flush-usage-quota': {
+        'task': 'nlp_services.tasks.flush_usage_quota',
+        'schedule': NLP_QUOTA_FLUSH_INTERVAL,
+    },
+    'flush-history-buffer': {
+        'task': 'nlp_services.tasks.flush_history_buffer',
+        'schedule': NLP_HISTORY_FLUSH_INTERVAL,
+    },
+    'archive-history': {
+        'task': 'nlp_services.tasks.archive_history',
+        'schedule': crontab(hour=3, minute=0),
+    },
+}
 
 
 # Caching with Redis
@@ -156,6 +208,161 @@ CACHES = {
     }
 }
 
+# --- NLP Service Configuration ---
+# Maximum number of LLM calls a single request may have in flight at the same time.
+NLP_LLM_CONCURRENCY = int(os.environ.get('NLP_LLM_CONCURRENCY', 5))
+
+# Pooled HTTP transport of the LLM providers (see nlp_services/processors/transport.py):
+# one keep-alive connection pool per event loop, with at most NLP_LLM_MAX_CONNECTIONS connections.
+# HTTP/2 needs the h2 package. GEMINI_API_BASE_URL can point at `python manage.py llm_stub_server`.
+GEMINI_API_BASE_URL = os.environ.get('GEMINI_API_BASE_URL', 'https://generativelanguage.googleapis.com')
+NLP_LLM_MAX_CONNECTIONS = int(os.environ.get('NLP_LLM_MAX_CONNECTIONS', 100))
+NLP_LLM_MAX_KEEPALIVE_CONNECTIONS = 20
+NLP_LLM_KEEPALIVE_EXPIRY = 30.0
+NLP_LLM_TIMEOUT = 60.0
+NLP_LLM_CONNECT_TIMEOUT = 10.0
+NLP_LLM_HTTP2 = os.environ.get('NLP_LLM_HTTP2', 'False') == 'True'
+
+# Admission control of the upstream calls, shared by all workers through Redis (see
+# nlp_services/processors/rate_limit.py): a token bucket of `requests_per_second` with `burst`,
+# and a concurrency limit that adapts (AIMD) between `min_concurrency` and `max_concurrency`.
+# Limits of a provider (e.g. 'gemini') override 'default'. A call waits at most
+# NLP_LLM_QUEUE_TIMEOUT seconds for admission and is retried NLP_LLM_RATE_LIMIT_RETRIES times
+# after a 429 before the client gets a 429 with Retry-After.
+NLP_LLM_RATE_LIMITS = {
+    'default': {
+        'requests_per_second': 10,
+        'burst': 20,
+        'initial_concurrency': 8,
+        'min_concurrency': 1,
+        'max_concurrency': 64,
+    },
+}
+NLP_LLM_QUEUE_TIMEOUT = 30
+NLP_LLM_RATE_LIMIT_RETRIES = 2
+
+# Backends the LLM calls are routed between (see nlp_services/processors/routing.py). Each has a
+# provider ('gemini', 'mock' or 'internal'), a model, a tier, optionally the tasks it serves and the longest input
+# it takes (`max_chars`), and its cost per 1000 input characters. NLP_LLM_PROVIDER=gemini routes between
+# a fast, cheap Gemini model and a large one (needs GEMINI_API_KEY); the default is the mock processor.
+NLP_LLM_PROVIDER = os.environ.get('NLP_LLM_PROVIDER', 'mock')
+if NLP_LLM_PROVIDER == 'gemini':
+    NLP_LLM_BACKENDS = [
+        {'name': 'gemini-flash', 'provider': 'gemini', 'model': 'gemini-1.5-flash-latest', 'tier': 'fast', 'cost_per_1k_chars': 0.02},
+        {'name': 'gemini-pro', 'provider': 'gemini', 'model': 'gemini-1.5-pro-latest', 'tier': 'large', 'cost_per_1k_chars': 0.3},
+    ]
+else:
+    NLP_LLM_BACKENDS = [
+        {'name': 'mock', 'provider': 'mock', 'tier': 'fast'},
+    ]
+
+# The internal CPU model (see nlp_services/processors/internal_model.py, needs numpy) answers
+# short sentiment texts itself and escalates those it is not sure about to the LLM backends.
+# Opt-in: another backend changes the router identity, so the cached and stored results of the
+# current configuration are not reused (run warm_nlp_cache after enabling it).
+if os.environ.get('NLP_INTERNAL_MODEL_ENABLED', 'False') == 'True':
+    NLP_LLM_BACKENDS.append(
+        {'name': 'internal', 'provider': 'internal', 'tier': 'local', 'tasks': ['sentiment'], 'max_chars': 280},
+    )
+
+# Answers of the internal model below `confidence_threshold` (0 to 1) are escalated. A text needs
+# `min_evidence` sentiment words for full confidence; `intensity` is the weight of intensifiers
+# such as «خیلی». `lexicon_path` adds or overrides lexicon entries ("<word>\t<weight>" per line).
+NLP_INTERNAL_MODEL = {
+    'confidence_threshold': float(os.environ.get('NLP_INTERNAL_CONFIDENCE_THRESHOLD', 0.6)),
+    'min_evidence': 1,
+    'intensity': 1.5,
+    'lexicon_path': os.environ.get('NLP_INTERNAL_LEXICON_PATH') or None,
+}
+
+# How a call picks its backend: `routes` maps a task and its input length (characters) to the
+# preferred tier, the first matching entry wins. Backends with an error rate (EWMA) above
+# `unhealthy_error_rate` are tried last, the others by latency (EWMA). A tier that spent its
+# `budgets` entry (in the unit of cost_per_1k_chars, per clock hour) takes no more calls that hour.
+NLP_LLM_ROUTING = {
+    'routes': {
+        'sentiment': [(280, 'local'), (1000, 'fast'), (None, 'large')],
+        'summarization': [(4000, 'fast'), (None, 'large')],
+        'aggregate': [(20000, 'fast'), (None, 'large')],
+    },
+    'budgets': {
+        'large': float(os.environ.get('NLP_LLM_LARGE_TIER_BUDGET', 50.0)),
+    },
+    'ewma_alpha': 0.2,
+    'unhealthy_error_rate': 0.5,
+}
+
+# Retries, hedging and circuit breaker of the LLM calls (see nlp_services/processors/resilience.py).
+# Timeouts, outages and unparsable answers are retried `max_retries` times after a jittered
+# exponential backoff. With `hedge`, a call slower than the `hedge_percentile` latency of recent
+# calls gets a second request. When `failure_threshold` (and `failure_rate`) of the last
+# `failure_window` calls were outages, calls fail fast for `reset_timeout` seconds and earlier
+# (stale) results are served where there is one.
+NLP_LLM_RESILIENCE = {
+    'max_retries': 2,
+    'backoff_base': 0.5,
+    'backoff_cap': 8.0,
+    'attempt_timeout': 60.0,
+    'hedge': os.environ.get('NLP_LLM_HEDGE', 'False') == 'True',
+    'hedge_percentile': 0.95,
+    'hedge_min_samples': 20,
+    'failure_threshold': 5,
+    'failure_rate': 0.5,
+    'failure_window': 20,
+    'reset_timeout': 30.0,
+}
+
+# Micro-batching of sentiment texts: a batch is sent when it holds NLP_BATCH_MAX_SIZE texts
+# or NLP_BATCH_MAX_WAIT seconds after its first text arrived.
+NLP_BATCH_MAX_SIZE = 16
+NLP_BATCH_MAX_WAIT = 0.02
+
+# Map-reduce aggregate analysis: inputs are split into chunks of at most NLP_AGGREGATE_CHUNK_TOKENS
+# estimated tokens and about NLP_AGGREGATE_CHUNK_TEXTS texts, analyzed concurrently and merged.
+NLP_AGGREGATE_CHUNK_TOKENS = 8000
+NLP_AGGREGATE_CHUNK_TEXTS = 25
+
+# Single-flight coalescing of identical LLM calls across workers (seconds).
+# The lock must outlive the slowest LLM call; waiters give up and call upstream after the wait timeout.
+NLP_SINGLE_FLIGHT_LOCK_TIMEOUT = 60
+NLP_SINGLE_FLIGHT_WAIT_TIMEOUT = 60
+
+# In-process (L0) result cache in front of Redis. Entries live at most NLP_LOCAL_CACHE_TTL seconds,
+# and changed keys are evicted in every worker through the Redis pub/sub channel below.
+NLP_LOCAL_CACHE_MAX_ENTRIES = 2048
+NLP_LOCAL_CACHE_TTL = 60
+NLP_CACHE_INVALIDATION_CHANNEL = 'nlp_results_cache:invalidate'
+
+# Results are stored in Redis as bytes encoded by this codec (see nlp_services/cache_codec.py):
+# msgpack, compressed from compress_min_size bytes on. Compare the codecs with
+# `python manage.py benchmark_cache_codec`.
+NLP_CACHE_CODEC = 'nlp_services.cache_codec.BinaryResultCodec'
+NLP_CACHE_CODEC_OPTIONS = {
+    'serializer': 'msgpack',
+    'compress_min_size': 1024,
+}
+
+# Asynchronous analysis jobs (POST /api/nlp/jobs/). Each priority has its own Celery queue, e.g.
+#   celery -A core worker -Q nlp_high                      (reserved for urgent jobs)
+#   celery -A core worker -Q nlp_high,nlp_default,nlp_low,celery
+# Failed jobs are retried NLP_JOB_MAX_RETRIES times, waiting NLP_JOB_RETRY_BACKOFF seconds
+# before the first retry and twice as long before each following one.
+NLP_JOB_QUEUES = {
+    'high': 'nlp_high',
+    'default': 'nlp_default',
+    'low': 'nlp_low',
+}
+NLP_JOB_MAX_RETRIES = 3
+NLP_JOB_RETRY_BACKOFF = 5
+# Maximum number of texts in one sentiment or aggregate job.
+NLP_JOB_MAX_TEXTS = 1000
+
+# Bulk NDJSON uploads (POST /api/nlp/sentiment/bulk/) are scored in windows of this many lines:
+# one quota update, one result store query and one bulk insert per window.
+# The resume cursor of an upload_id is kept for NLP_BULK_CURSOR_TIMEOUT seconds.
+NLP_BULK_WINDOW_SIZE = 200
+NLP_BULK_CURSOR_TIMEOUT = 60 * 60 * 24
+
 # Password validation
 # https://docs.djangoproject.com/en/5.0/ref/settings/#auth-password-validators
 
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import AnalysisHistory, SummarizationHistory, AggregateAnalysisHistory
+from .models import AnalysisHistory, SummarizationHistory, AggregateAnalysisHistory, StoredResult, TextBlob, AnalysisJob
 
 
 @admin.register(AnalysisHistory)
@@ -7,7 +7,7 @@ class AnalysisHistoryAdmin(admin.ModelAdmin):
     list_display = ('user', 'analysis_source', 'timestamp')
     list_filter = ('analysis_source', 'timestamp')
     search_fields = ('user__username', 'text_input')
-    readonly_fields = ('user', 'text_input', 'analysis_result', 'analysis_source', 'analysis_type', 'timestamp') # These fields should be read-only
+    readonly_fields = ('user', 'text_input', 'stored_result', 'analysis_result', 'analysis_source', 'analysis_type', 'timestamp') # These fields should be read-only
 
     def has_add_permission(self, request):
         # Prevent manual creation of history records from the admin panel
@@ -19,7 +19,7 @@ class SummarizationHistoryAdmin(admin.ModelAdmin):
     list_display = ('user', 'summarization_source', 'timestamp')
     list_filter = ('summarization_source', 'timestamp')
     search_fields = ('user__username', 'text_input', 'summarized_text')
-    readonly_fields = ('user', 'text_input', 'summarized_text', 'summarization_source', 'max_words_summarization', 'timestamp') # These fields should be read-only
+    readonly_fields = ('user', 'text_input', 'input_blob', 'stored_result', 'summarized_text', 'summarization_source', 'max_words_summarization', 'timestamp') # These fields should be read-only
 
     def has_add_permission(self, request):
         # Prevent manual creation of history records from the admin panel
@@ -38,3 +38,43 @@ class AggregateAnalysisHistoryAdmin(admin.ModelAdmin):
     def has_add_permission(self, request):
         # Prevent manual creation of history records from the admin panel
         return False
+
+
+@admin.register(StoredResult)
+class StoredResultAdmin(admin.ModelAdmin):
+    list_display = ('task', 'source', 'model_name', 'prompt_version', 'created_at')
+    list_filter = ('task', 'source', 'model_name', 'prompt_version')
+    search_fields = ('result_key', 'text_hash')
+
+    # Stored results are shared by all users, so they are read-only in the admin panel
+    readonly_fields = [field.name for field in StoredResult._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
+
+
+@admin.register(TextBlob)
+class TextBlobAdmin(admin.ModelAdmin):
+    list_display = ('content_hash', 'codec', 'size', 'created_at')
+    list_filter = ('codec',)
+    search_fields = ('content_hash',)
+    # The compressed data is not shown; blobs are shared by all users, so they are read-only.
+    exclude = ('data',)
+    readonly_fields = ('content_hash', 'codec', 'size', 'created_at')
+
+    def has_add_permission(self, request):
+        return False
+
+
+
+@admin.register(AnalysisJob)
+class AnalysisJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'user', 'job_type', 'priority', 'status', 'attempts', 'created_at', 'finished_at')
+    list_filter = ('job_type', 'priority', 'status', 'created_at')
+    search_fields = ('id', 'user__username')
+
+    # Jobs are created through the API and updated by the workers
+    readonly_fields = [field.name for field in AnalysisJob._meta.fields]
+
+    def has_add_permission(self, request):
+        return False
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class NlpServicesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'nlp_services'
+
+    def ready(self):
+        """
+        Import signals when the app is ready.
+        """
+        import nlp_services.signals
@@ -0,0 +1,153 @@
+"""
+Retention and archival of the history tables.
+
+History rows older than the retention period of their owner's tier
+(NLP_HISTORY_RETENTION_DAYS) are cold: archive_history() copies them to
+gzip-compressed JSONL files and deletes them, so the hot tables and their
+indexes only hold recent rows.
+
+Archives roll over by month, like time-based partitions:
+
+    <NLP_ARCHIVE_DIR>/<kind>/<YYYY-MM>/<first id>-<last id>.jsonl.gz
+
+Each line is one row with its columns, plus its result and input when the row
+references the shared result store or the blob store, so an archive can be
+read without the database. A file is written to a temporary name, synced and
+renamed before its rows are deleted. A run that crashed in between rewrites the
+same file on the next run.
+
+Archived aggregate rows can no longer answer repeated aggregate requests (see
+services.run_aggregate_analysis); such a request is analyzed again.
+"""
+import gzip
+import json
+import os
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from nlp_services import blob_store
+from nlp_services.models import AnalysisHistory, SummarizationHistory, AggregateAnalysisHistory
+
+
+ARCHIVED_MODELS = {
+    'sentiment': AnalysisHistory,
+    'summarization': SummarizationHistory,
+    'aggregate': AggregateAnalysisHistory,
+}
+
+
+def retention_days() -> dict:
+    """
+    Returns the retention period of each tier in days. None keeps rows forever.
+    """
+    return getattr(settings, 'NLP_HISTORY_RETENTION_DAYS', {'free': 90, 'pro': 365})
+
+
+def cold_rows_filter(now=None):
+    """
+    Returns a Q object matching the history rows past the retention period of their owner's tier,
+    or None when every tier keeps its rows forever.
+    """
+    now = now or timezone.now()
+    cold = None
+    for tier, is_pro in (('free', False), ('pro', True)):
+        days = retention_days().get(tier)
+        if days is not None:
+            condition = Q(user__is_pro=is_pro, timestamp__lt=now - timedelta(days=days))
+            cold = condition if cold is None else cold | condition
+    return cold
+
+
+def archive_record(row) -> dict:
+    """
+    Returns the archived form of a history row: its columns and its resolved result.
+    """
+    record = {field.attname: getattr(row, field.attname) for field in row._meta.concrete_fields}
+    if getattr(row, 'stored_result_id', None):
+        record['result'] = row.stored_result.result
+    if getattr(row, 'input_blob_id', None):
+        field, _ = blob_store.INPUT_FIELDS[type(row)]
+        record[field] = row.input_blob.value
+    return record
+
+
+def _write_archive(path, records):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written under a temporary name and renamed, so an archive file is always complete.
+    temporary_path = f"{path}.tmp"
+    with gzip.open(temporary_path, 'wt', encoding='utf-8') as archive_file:
+        for record in records:
+            archive_file.write(json.dumps(record, cls=DjangoJSONEncoder, ensure_ascii=False) + "\n")
+    with open(temporary_path, 'rb') as archive_file:
+        os.fsync(archive_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def archive_batch(kind: str, rows: list, archive_dir: str) -> list:
+    """
+    Writes a batch of cold rows to their monthly archive files and returns the paths written.
+    """
+    by_month = defaultdict(list)
+    for row in rows:
+        by_month[row.timestamp.strftime('%Y-%m')].append(archive_record(row))
+
+    paths = []
+    for month, records in by_month.items():
+        path = os.path.join(archive_dir, kind, month, f"{records[0]['id']}-{records[-1]['id']}.jsonl.gz")
+        _write_archive(path, records)
+        paths.append(path)
+    return paths
+
+
+def archive_history(kinds=None, batch_size: int = None, dry_run: bool = False, now=None) -> dict:
+    """
+    Archives and deletes the cold rows of the given history kinds (all by default).
+    Returns the number of rows archived per kind; with dry_run, the number that would be.
+    """
+    archive_dir = str(getattr(settings, 'NLP_ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archive')))
+    batch_size = batch_size or getattr(settings, 'NLP_ARCHIVE_BATCH_SIZE', 1000)
+    cold = cold_rows_filter(now)
+
+    archived = {}
+    for kind in kinds or ARCHIVED_MODELS:
+        model = ARCHIVED_MODELS[kind]
+        if cold is None:
+            archived[kind] = 0
+            continue
+
+        queryset = model.objects.filter(cold)
+        if dry_run:
+            archived[kind] = queryset.count()
+            continue
+
+        related = [name for name in ('stored_result', 'input_blob') if hasattr(model, name)]
+        queryset = queryset.select_related(*related)
+
+        archived[kind] = 0
+        while True:
+            # Ids grow with time, so the oldest (cold) rows are read first through the primary key.
+            rows = list(queryset.order_by('id')[:batch_size])
+            if not rows:
+                break
+            archive_batch(kind, rows, archive_dir)
+            with transaction.atomic():
+                model.objects.filter(pk__in=[row.pk for row in rows]).delete()
+                # Blobs only used by the archived rows are not needed any more.
+                blob_store.delete_unreferenced({row.input_blob_id for row in rows if getattr(row, 'input_blob_id', None)})
+            archived[kind] += len(rows)
+    return archived
+
+
+def iter_archive(path):
+    """
+    Yields the records of an archive file.
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as archive_file:
+        for line in archive_file:
+            yield json.loads(line)
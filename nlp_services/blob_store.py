@@ -0,0 +1,79 @@
+"""
+Deduplicated, compressed storage of large history inputs.
+
+Inputs of at least NLP_BLOB_MIN_SIZE bytes (as JSON) are stored once in a
+TextBlob keyed by their SHA-256 and compressed (see nlp_services.compression);
+history rows reference the blob instead of holding a copy. Smaller inputs stay
+inline, where a blob would save nothing. The models decompress transparently
+through SummarizationHistory.input_text and AggregateAnalysisHistory.texts.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+
+from nlp_services.compression import compress
+from nlp_services.models import SummarizationHistory, AggregateAnalysisHistory, TextBlob
+
+
+# The inline input field of each model that can reference a blob, and its value once moved to the blob.
+INPUT_FIELDS = {
+    SummarizationHistory: ('text_input', ''),
+    AggregateAnalysisHistory: ('input_texts', None),
+}
+
+
+def encode_value(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def move_inputs_to_blobs(rows):
+    """
+    Moves the large inputs of unsaved history rows to the blob store, creating
+    the missing blobs with one bulk insert. Rows of other models are left alone.
+    """
+    min_size = getattr(settings, 'NLP_BLOB_MIN_SIZE', 1024)
+    pending = []
+    for row in rows:
+        if type(row) not in INPUT_FIELDS or row.input_blob_id:
+            continue
+        field, _ = INPUT_FIELDS[type(row)]
+        value = getattr(row, field)
+        if value is None:
+            continue
+        raw = encode_value(value)
+        if len(raw) >= min_size:
+            pending.append((row, hashlib.sha256(raw).hexdigest(), raw))
+
+    if not pending:
+        return
+
+    blob_ids = dict(TextBlob.objects.filter(
+        content_hash__in={content_hash for _, content_hash, _ in pending}
+    ).values_list('content_hash', 'pk'))
+
+    new_blobs = {}
+    for _, content_hash, raw in pending:
+        if content_hash not in blob_ids and content_hash not in new_blobs:
+            codec, data = compress(raw)
+            new_blobs[content_hash] = TextBlob(content_hash=content_hash, codec=codec, data=data, size=len(raw))
+    if new_blobs:
+        # ignore_conflicts keeps a blob stored in the meantime by another writer.
+        TextBlob.objects.bulk_create(new_blobs.values(), ignore_conflicts=True)
+        blob_ids.update(TextBlob.objects.filter(content_hash__in=new_blobs).values_list('content_hash', 'pk'))
+
+    for row, content_hash, _ in pending:
+        field, moved_value = INPUT_FIELDS[type(row)]
+        row.input_blob_id = blob_ids[content_hash]
+        setattr(row, field, moved_value)
+
+
+def delete_unreferenced(blob_ids):
+    """
+    Deletes the given blobs that no history row references any more.
+    """
+    return TextBlob.objects.filter(
+        pk__in=blob_ids,
+        summarization_history__isnull=True,
+        aggregate_history__isnull=True,
+    ).delete()[0]
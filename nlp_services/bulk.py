@@ -0,0 +1,267 @@
+"""
+Bulk sentiment scoring of NDJSON uploads.
+
+The upload is read (and gunzipped) block by block and scored in windows of
+NLP_BULK_WINDOW_SIZE lines, so memory use does not grow with the size of the
+upload. For every window the usage quota is deducted once (and refunded for
+the texts that failed), texts that already have a stored result are answered
+from the result store with one query, and the rest are analyzed concurrently
+through the processor's batching layer.
+
+Results are yielded as they finish, so they are not in input order; every
+result carries its line number. After each window a checkpoint with the next
+cursor is yielded: an interrupted upload is resumed by sending it again with
+that cursor (or with the same upload_id, whose cursor is kept in the cache).
+"""
+import json
+import zlib
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from nlp_services import services
+from nlp_services.cache_keys import sentiment_result_key
+from nlp_services.models import AnalysisHistory, StoredResult
+
+
+READ_BLOCK_SIZE = 64 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+
+# A line longer than this cannot hold a valid record (texts are limited to MAX_TEXT_LENGTH characters).
+MAX_LINE_BYTES = 1024 * 1024
+MAX_TEXT_LENGTH = 5000
+
+
+class BulkInputError(Exception):
+    """
+    Raised when the upload cannot be read any further.
+    """
+
+
+def iter_lines(stream, block_size: int = READ_BLOCK_SIZE):
+    """
+    Yields the lines (as bytes) of a plain or gzip-compressed byte stream.
+    Compression is detected from the gzip magic number, and the stream is
+    decompressed incrementally.
+    """
+    decompressor = None
+    buffer = b''
+    first_block = True
+
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        if first_block:
+            first_block = False
+            if block.startswith(GZIP_MAGIC):
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decompressor:
+            try:
+                block = decompressor.decompress(block)
+            except zlib.error as e:
+                raise BulkInputError(f"Invalid gzip data: {e}")
+
+        buffer += block
+        *lines, buffer = buffer.split(b'\n')
+        yield from lines
+        if len(buffer) > MAX_LINE_BYTES:
+            raise BulkInputError(f"A line is longer than {MAX_LINE_BYTES} bytes.")
+
+    if decompressor:
+        buffer += decompressor.flush()
+        *lines, buffer = buffer.split(b'\n')
+        yield from lines
+    if buffer:
+        yield buffer
+
+
+def parse_record(raw_line: bytes) -> tuple:
+    """
+    Returns the (id, text) of one NDJSON line. A line is either an object with
+    a "text" and an optional "id", or a bare JSON string.
+    """
+    try:
+        record = json.loads(raw_line)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise ValueError(f"Invalid JSON: {e}")
+
+    if isinstance(record, str):
+        record_id, text = None, record
+    elif isinstance(record, dict):
+        record_id, text = record.get('id'), record.get('text')
+    else:
+        raise ValueError("A line must be a JSON object or string.")
+
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError("The 'text' field must be a non-empty string.")
+    if len(text) > MAX_TEXT_LENGTH:
+        raise ValueError(f"The text is longer than {MAX_TEXT_LENGTH} characters.")
+    return record_id, text
+
+
+def iter_windows(lines, start_line: int, window_size: int):
+    """
+    Groups the non-empty lines from `start_line` on into windows of (line number, line) pairs.
+    Line numbers count every line of the upload, so cursors stay valid across resumptions.
+    """
+    window = []
+    for line_number, raw_line in enumerate(lines):
+        if line_number < start_line or not raw_line.strip():
+            continue
+        window.append((line_number, raw_line))
+        if len(window) >= window_size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def cursor_cache_key(user, upload_id: str) -> str:
+    return f"bulk_upload_cursor:{user.pk}:{upload_id}"
+
+
+async def get_saved_cursor(user, upload_id: str) -> int:
+    return await cache.aget(cursor_cache_key(user, upload_id), 0)
+
+
+def _save_new_results(user, new_results: list, analysis_type: str):
+    """
+    Stores the new results of a window and their history rows with bulk inserts.
+    `new_results` holds (result_key, normalized_text, result, served) tuples, where
+    `served` is the (provider, model) that produced the result.
+    """
+    with transaction.atomic():
+        # ignore_conflicts keeps results stored in the meantime by another request.
+        StoredResult.objects.bulk_create([
+            StoredResult(
+                result_key=key.store_key,
+                task=key.task,
+                text_hash=key.content_hash,
+                params=key.params,
+                result=result,
+                source=served[0],
+                model_name=served[1],
+                prompt_version=key.prompt_version,
+            )
+            for key, _, result, served in new_results
+        ], ignore_conflicts=True)
+
+        stored_ids = dict(StoredResult.objects.filter(
+            result_key__in={key.store_key for key, _, _, _ in new_results}
+        ).values_list('result_key', 'pk'))
+
+        AnalysisHistory.objects.bulk_create([
+            AnalysisHistory(
+                user=user,
+                text_input=normalized_text,
+                stored_result_id=stored_ids[key.store_key],
+                analysis_source=served[0],
+                analysis_type=analysis_type,
+            )
+            for key, normalized_text, _, served in new_results
+        ])
+
+
+async def _stored_results(result_keys) -> dict:
+    store_keys = {key.store_key for key in result_keys}
+    rows = StoredResult.objects.filter(result_key__in=store_keys).only('result_key', 'result')
+    return {row.result_key: row.result async for row in rows}
+
+
+async def score_window(user, window: list, analysis_type: str, stats: dict, concurrency: int = None):
+    """
+    Scores one window of lines and yields an output record per line as soon as it is known.
+    At most `concurrency` texts are analyzed at the same time (see services.analyze_texts_as_completed).
+    """
+    processor = services.processor
+    entries = []
+    for line_number, raw_line in window:
+        try:
+            record_id, text = parse_record(raw_line)
+        except ValueError as e:
+            stats['errors'] += 1
+            yield {"line": line_number, "error": str(e)}
+            continue
+        normalized_text = services.normalize_text_simple(text)
+        entries.append((line_number, record_id, normalized_text, sentiment_result_key(processor, normalized_text, analysis_type)))
+
+    if not entries:
+        return
+
+    # Bulk uploads are charged per text, like the sentiment endpoint, but once per window.
+    await services.acheck_and_deduct_usage(user, len(entries))
+
+    def output(entry, result, cached):
+        line_number, record_id, _, _ = entry
+        return {"line": line_number, "id": record_id, "cached": cached, **result}
+
+    stored = await _stored_results(entry[3] for entry in entries)
+
+    # Duplicate texts in the window are only analyzed once.
+    misses = {}
+    for entry in entries:
+        store_key = entry[3].store_key
+        if store_key in stored:
+            stats['cached'] += 1
+            yield output(entry, services.build_sentiment_result(entry[2], stored[store_key]), cached=True)
+        else:
+            misses.setdefault(store_key, []).append(entry)
+
+    if not misses:
+        return
+
+    miss_entries = list(misses.values())
+    miss_texts = [same_text[0][2] for same_text in miss_entries]
+    new_results = []
+    failed = 0
+
+    async for position, outcome, served in services.analyze_texts_as_completed(miss_texts, analysis_type, concurrency):
+        same_text = miss_entries[position]
+        normalized_text = miss_texts[position]
+        if isinstance(outcome, Exception):
+            result = services.build_sentiment_error(normalized_text, outcome)
+            stats['errors'] += len(same_text)
+            failed += len(same_text)
+        else:
+            new_results.append((same_text[0][3], normalized_text, outcome, served))
+            result = services.build_sentiment_result(normalized_text, outcome)
+            stats['analyzed'] += len(same_text)
+        for entry in same_text:
+            yield output(entry, result, cached=False)
+
+    if new_results:
+        await sync_to_async(_save_new_results)(user, new_results, analysis_type)
+    # Texts whose analysis failed are not charged.
+    await services.arefund_usage(user, failed)
+
+
+async def score_upload(user, stream, analysis_type: str, cursor: int = 0, upload_id: str = None):
+    """
+    Scores an NDJSON upload from `cursor` on and yields the output records:
+    one per line, a {"checkpoint": <next cursor>} after every window and a
+    final summary. Errors that stop the upload are yielded with the cursor to
+    resume from.
+    """
+    window_size = getattr(settings, 'NLP_BULK_WINDOW_SIZE', 200)
+    cursor_timeout = getattr(settings, 'NLP_BULK_CURSOR_TIMEOUT', 60 * 60 * 24)
+    stats = {'analyzed': 0, 'cached': 0, 'errors': 0}
+    next_cursor = cursor
+
+    try:
+        for window in iter_windows(iter_lines(stream), cursor, window_size):
+            async for record in score_window(user, window, analysis_type, stats):
+                yield record
+
+            next_cursor = window[-1][0] + 1
+            if upload_id:
+                await cache.aset(cursor_cache_key(user, upload_id), next_cursor, timeout=cursor_timeout)
+            yield {"checkpoint": next_cursor}
+
+    except (BulkInputError, services.UsageLimitExceeded) as e:
+        yield {"error": str(e), "next_cursor": next_cursor, **stats}
+        return
+
+    yield {"done": True, "next_cursor": next_cursor, **stats}
@@ -0,0 +1,108 @@
+"""
+Codecs for the NLP results kept in the shared cache.
+
+Results are cached as the Python values the pipelines return (a dict for
+sentiment and aggregate analysis, a string for summaries); the codec turns
+them into compact bytes for Redis and back. The in-process L0 cache keeps the
+decoded values, so only L1 lookups pay for decoding.
+
+An encoded entry starts with a three byte header: the format version, the
+serializer and the compression. Entries with another version, or written
+before the codec existed, are not decoded and count as misses, so changing the
+format never serves a value in the wrong shape.
+
+The codec is chosen with NLP_CACHE_CODEC (a dotted path) and configured with
+NLP_CACHE_CODEC_OPTIONS. `python manage.py benchmark_cache_codec` compares
+the codecs on representative results.
+"""
+import json
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from nlp_services import compression
+
+try:
+    import msgpack
+except ImportError:
+    # Optional dependency: without it results are serialized as JSON.
+    msgpack = None
+
+
+FORMAT_VERSION = 1
+
+SERIALIZER_IDS = {'json': b'j', 'msgpack': b'm'}
+COMPRESSION_IDS = {None: b'-', 'zlib': b'z', 'zstd': b's'}
+COMPRESSION_CODECS = {code: name for name, code in COMPRESSION_IDS.items()}
+
+
+class CacheCodec:
+    """
+    Encodes cached values to bytes and back. decode() returns None for entries it cannot read.
+    """
+
+    def encode(self, value) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, data):
+        raise NotImplementedError
+
+
+class BinaryResultCodec(CacheCodec):
+    """
+    Serializes with msgpack (JSON when msgpack is not installed) and compresses
+    the payload when it is at least `compress_min_size` bytes.
+    """
+
+    def __init__(self, serializer: str = 'msgpack', compress_min_size: int = 1024, compression_codec: str = None):
+        if serializer == 'msgpack' and msgpack is None:
+            serializer = 'json'
+        self.serializer = serializer
+        self.compress_min_size = compress_min_size
+        self.compression_codec = compression_codec
+
+    def _serialize(self, value) -> bytes:
+        if self.serializer == 'msgpack':
+            return msgpack.packb(value, use_bin_type=True)
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+    def _deserialize(self, payload: bytes, serializer_id: bytes):
+        if serializer_id == SERIALIZER_IDS['msgpack']:
+            return msgpack.unpackb(payload, raw=False)
+        return json.loads(payload)
+
+    def encode(self, value) -> bytes:
+        payload = self._serialize(value)
+        codec = None
+        if self.compress_min_size is not None and len(payload) >= self.compress_min_size:
+            codec, compressed = compression.compress(payload, self.compression_codec)
+            # Data that does not shrink is kept uncompressed.
+            if len(compressed) < len(payload):
+                payload = compressed
+            else:
+                codec = None
+        header = bytes([FORMAT_VERSION]) + SERIALIZER_IDS[self.serializer] + COMPRESSION_IDS[codec]
+        return header + payload
+
+    def decode(self, data):
+        if not isinstance(data, (bytes, bytearray)) or len(data) < 3 or data[0] != FORMAT_VERSION:
+            return None
+        serializer_id, compression_id, payload = data[1:2], data[2:3], bytes(data[3:])
+        # Entries written by an unknown (e.g. newer) serializer or compression are misses, never guessed at.
+        if serializer_id not in SERIALIZER_IDS.values() or compression_id not in COMPRESSION_CODECS:
+            return None
+        if serializer_id == SERIALIZER_IDS['msgpack'] and msgpack is None:
+            return None
+        try:
+            codec = COMPRESSION_CODECS[compression_id]
+            if codec is not None:
+                payload = compression.decompress(payload, codec)
+            return self._deserialize(payload, serializer_id)
+        except Exception as e:
+            print(f"Could not decode a cached value: {e}. Treating it as a miss.")
+            return None
+
+
+def get_cache_codec() -> CacheCodec:
+    codec_class = import_string(getattr(settings, 'NLP_CACHE_CODEC', 'nlp_services.cache_codec.BinaryResultCodec'))
+    return codec_class(**getattr(settings, 'NLP_CACHE_CODEC_OPTIONS', {}))
@@ -0,0 +1,95 @@
+"""
+Deterministic cache keys for NLP results.
+
+Keys are built from SHA-256 digests (never the built-in `hash()`, which is
+salted per process), so every worker and every restart computes the same key
+for the same input. Each key also carries the provider, the model name and the
+prompt version that produced the result, so switching any of them never serves
+an answer produced by another configuration.
+"""
+import hashlib
+import unicodedata
+from typing import NamedTuple
+
+
+# Bump this when the layout of the keys or of the cached values changes.
+CACHE_KEY_VERSION = 2
+
+# How long a result stays in the Redis (L1) cache.
+RESULT_CACHE_TIMEOUT = 60 * 60 * 24
+
+
+def text_fingerprint(text: str) -> str:
+    """
+    Returns the SHA-256 hex digest of a (normalized) text.
+    The text is hashed in Unicode NFC form, so composed and decomposed spellings
+    of the same characters (e.g. "آ" and "ا" + madda) share a fingerprint.
+    """
+    return hashlib.sha256(unicodedata.normalize('NFC', text).encode('utf-8')).hexdigest()
+
+
+def texts_fingerprint(normalized_texts) -> str:
+    """
+    Returns the order-independent fingerprint of a list of normalized texts.
+    This is the value stored in AggregateAnalysisHistory.input_fingerprint.
+    """
+    content_string = "".join(sorted(normalized_texts))
+    return text_fingerprint(content_string)
+
+
+def processor_identity(processor) -> tuple:
+    """
+    Returns the (provider, model, prompt version) triple that identifies
+    which configuration produced a result.
+    """
+    return (
+        processor.provider_name,
+        getattr(processor, 'default_model', None) or processor.provider_name,
+        processor.prompt_version,
+    )
+
+
+class ResultKey(NamedTuple):
+    """
+    Everything that identifies one task result.
+    `cache_key` is the versioned Redis (L1) key and `store_key` is the
+    unique key of the shared StoredResult (L2) row.
+    """
+    task: str
+    content_hash: str
+    params: dict
+    provider: str
+    model: str
+    prompt_version: str
+
+    @property
+    def identity(self) -> str:
+        params_part = ",".join(f"{name}={self.params[name]}" for name in sorted(self.params))
+        return f"{self.provider}:{self.model}:{self.prompt_version}:{params_part}:{self.content_hash}"
+
+    @property
+    def cache_key(self) -> str:
+        # e.g. "sentiment_cache:v2:gemini:gemini-1.5-pro-latest:v1:analysis_type=business_intent:<sha256>"
+        return f"{self.task}_cache:v{CACHE_KEY_VERSION}:{self.identity}"
+
+    @property
+    def store_key(self) -> str:
+        # The store key does not include CACHE_KEY_VERSION: stored rows outlive cache layout changes.
+        return text_fingerprint(f"{self.task}:{self.identity}")
+
+
+def result_key(task: str, content_hash: str, params: dict, processor) -> ResultKey:
+    provider, model, prompt_version = processor_identity(processor)
+    return ResultKey(task, content_hash, params, provider, model, prompt_version)
+
+
+def sentiment_result_key(processor, normalized_text: str, analysis_type: str) -> ResultKey:
+    return result_key('sentiment', text_fingerprint(normalized_text), {'analysis_type': analysis_type}, processor)
+
+
+def summarization_result_key(processor, normalized_text: str, max_words: int) -> ResultKey:
+    return result_key('summarization', text_fingerprint(normalized_text), {'max_words': max_words}, processor)
+
+
+def aggregate_result_key(processor, fingerprint: str, analysis_type: str) -> ResultKey:
+    return result_key('aggregate', fingerprint, {'analysis_type': analysis_type}, processor)
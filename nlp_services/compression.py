@@ -0,0 +1,53 @@
+"""
+Compression codecs for stored data.
+
+zlib is always available. Zstandard compresses faster and smaller and is
+used when the optional `zstandard` package is installed. Data is always
+decompressed with the codec recorded next to it, so both kinds can be read
+whatever the current preference is.
+"""
+import zlib
+
+from django.conf import settings
+
+try:
+    import zstandard
+except ImportError:
+    # Optional dependency: without it everything is compressed with zlib.
+    zstandard = None
+
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def default_codec() -> str:
+    """
+    Returns the codec new data is compressed with: NLP_COMPRESSION_CODEC when it is available, zlib otherwise.
+    """
+    codec = getattr(settings, 'NLP_COMPRESSION_CODEC', 'zstd')
+    if codec == 'zstd' and zstandard is None:
+        return 'zlib'
+    return codec
+
+
+def compress(data: bytes, codec: str = None) -> tuple:
+    """
+    Compresses `data` and returns (codec, compressed data).
+    """
+    codec = codec or default_codec()
+    if codec == 'zstd':
+        return codec, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    if codec == 'zlib':
+        return codec, zlib.compress(data, ZLIB_LEVEL)
+    raise ValueError(f"Unknown compression codec '{codec}'.")
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("The 'zstandard' package is needed to read zstd-compressed data.")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    raise ValueError(f"Unknown compression codec '{codec}'.")
@@ -0,0 +1,48 @@
+import json
+from channels.generic.websocket import AsyncWebsocketConsumer
+
+from nlp_services.job_events import job_group_name
+
+
+class JobProgressConsumer(AsyncWebsocketConsumer):
+    """
+    A consumer that streams the updates of the connected user's analysis jobs:
+    status changes, per-item results as they finish and progress percentages.
+    Connect with ws://<host>/ws/nlp/jobs/?token=<JWT access token>.
+    """
+    async def connect(self):
+        """
+        Called when the websocket is handshaking as part of connection.
+        Only authenticated users with a verified email are accepted, like the REST API.
+        """
+        user = self.scope.get('user')
+        if not user or not user.is_authenticated or not user.is_email_verified:
+            # Closing before accept() rejects the handshake.
+            await self.close()
+            return
+
+        # Each user has their own group, so a socket only receives its owner's jobs.
+        self.group_name = job_group_name(user.pk)
+        await self.channel_layer.group_add(
+            self.group_name,
+            self.channel_name
+        )
+        await self.accept()
+
+    async def disconnect(self, close_code):
+        """
+        Called when the WebSocket closes for any reason.
+        """
+        if hasattr(self, 'group_name'):
+            await self.channel_layer.group_discard(
+                self.group_name,
+                self.channel_name
+            )
+
+    # --- Custom event handlers ---
+
+    async def job_update(self, event):
+        """
+        Handler for the 'job_update' event sent by the job tasks.
+        """
+        await self.send(text_data=json.dumps(event['message']))
@@ -0,0 +1,182 @@
+"""
+Write-behind buffer for history rows.
+
+Saving a history row is not needed to answer a request, so the pipelines only
+append the row to a Redis list and return. The flush_history_buffer Celery
+beat task drains the list every NLP_HISTORY_FLUSH_INTERVAL seconds and saves
+the rows with one bulk_create per model and batch, so history pages lag behind
+by at most that interval.
+
+Flushing is crash-safe: a batch is moved atomically to a processing list before
+it is written and only deleted once the insert committed. A flush that died
+half-way leaves its batch in the processing list, where the next flush picks it
+up again. Every row carries a unique write_id, so a batch that was committed
+but not yet deleted is not inserted twice.
+
+When the cache backend is not Redis, or the list cannot be reached, rows are
+saved right away as before.
+"""
+import json
+import uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import DataError, IntegrityError, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django_redis import get_redis_connection
+
+from nlp_services import blob_store
+from nlp_services.models import AnalysisHistory, SummarizationHistory, AggregateAnalysisHistory, StoredResult
+
+
+PENDING_KEY = 'nlp_history:pending'
+PROCESSING_KEY = 'nlp_history:processing'
+FLUSH_LOCK_KEY = 'nlp_history:flush_lock'
+
+HISTORY_MODELS = {
+    'sentiment': AnalysisHistory,
+    'summarization': SummarizationHistory,
+    'aggregate': AggregateAnalysisHistory,
+}
+
+
+def _redis():
+    if not getattr(settings, 'NLP_HISTORY_WRITE_BEHIND', True):
+        return None
+    try:
+        return get_redis_connection('default')
+    except NotImplementedError:
+        # The configured cache backend is not Redis (e.g. local memory in development).
+        return None
+
+
+def _build_row(kind, write_id, fields):
+    return HISTORY_MODELS[kind](write_id=write_id, **fields)
+
+
+# --- Queueing ---
+
+def enqueue(kind: str, **fields):
+    """
+    Queues a history row of the given kind ('sentiment', 'summarization' or
+    'aggregate'). `fields` are model fields, with foreign keys given by id.
+    """
+    fields.setdefault('timestamp', timezone.now())
+    write_id = uuid.uuid4()
+
+    connection = _redis()
+    if connection is not None:
+        record = {
+            'kind': kind,
+            'write_id': str(write_id),
+            'fields': dict(fields, timestamp=fields['timestamp'].isoformat()),
+        }
+        try:
+            connection.rpush(PENDING_KEY, json.dumps(record))
+            return
+        except Exception as e:
+            print(f"Could not queue a {kind} history row: {e}. Saving it directly.")
+
+    row = _build_row(kind, write_id, fields)
+    blob_store.move_inputs_to_blobs([row])
+    row.save()
+
+
+async def aenqueue(kind: str, **fields):
+    await sync_to_async(enqueue)(kind, **fields)
+
+
+# --- Flushing ---
+
+def _claim_batch(connection, batch_size):
+    """
+    Moves up to `batch_size` rows from the pending list to the processing list in one transaction.
+    """
+    pipeline = connection.pipeline(transaction=True)
+    for _ in range(batch_size):
+        pipeline.lmove(PENDING_KEY, PROCESSING_KEY, 'LEFT', 'RIGHT')
+    return [raw for raw in pipeline.execute() if raw is not None]
+
+
+def _write_batch(raw_records) -> int:
+    """
+    Saves a batch of queued rows and returns the number of rows in it.
+    Rows of deleted users (or results) and unreadable records are dropped.
+    """
+    rows_by_kind = {kind: [] for kind in HISTORY_MODELS}
+    for raw in raw_records:
+        try:
+            record = json.loads(raw)
+            fields = record['fields']
+            fields['timestamp'] = parse_datetime(fields['timestamp'])
+            rows_by_kind[record['kind']].append(_build_row(record['kind'], record['write_id'], fields))
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"Dropping an unreadable history record: {e}")
+
+    rows = [row for kind_rows in rows_by_kind.values() for row in kind_rows]
+    existing_users = set(get_user_model().objects.filter(
+        pk__in={row.user_id for row in rows}
+    ).values_list('pk', flat=True))
+    existing_results = set(StoredResult.objects.filter(
+        pk__in={row.stored_result_id for row in rows if getattr(row, 'stored_result_id', None)}
+    ).values_list('pk', flat=True))
+
+    def exists(row):
+        stored_result_id = getattr(row, 'stored_result_id', None)
+        return row.user_id in existing_users and (stored_result_id is None or stored_result_id in existing_results)
+
+    rows_by_kind = {kind: [row for row in kind_rows if exists(row)] for kind, kind_rows in rows_by_kind.items()}
+    blob_store.move_inputs_to_blobs(row for kind_rows in rows_by_kind.values() for row in kind_rows)
+    try:
+        with transaction.atomic():
+            for kind, kind_rows in rows_by_kind.items():
+                # ignore_conflicts skips the rows of a batch that was already written before a crash.
+                HISTORY_MODELS[kind].objects.bulk_create(kind_rows, ignore_conflicts=True)
+    except (IntegrityError, DataError) as e:
+        # One invalid row must not block the queue: the rows are saved one by one and invalid ones dropped.
+        print(f"Could not bulk write a history batch: {e}. Saving its rows one by one.")
+        for row in (row for kind_rows in rows_by_kind.values() for row in kind_rows):
+            try:
+                with transaction.atomic():
+                    row.save()
+            except (IntegrityError, DataError) as e:
+                print(f"Dropping history row {row.write_id}: {e}")
+    return len(raw_records)
+
+
+def flush(batch_size: int = None) -> int:
+    """
+    Saves the queued history rows in batches and returns how many were written.
+    Only one flush runs at a time; a batch that fails stays queued for the next flush.
+    """
+    connection = _redis()
+    if connection is None:
+        return 0
+
+    batch_size = batch_size or getattr(settings, 'NLP_HISTORY_FLUSH_BATCH_SIZE', 500)
+    lock = connection.lock(FLUSH_LOCK_KEY, timeout=getattr(settings, 'NLP_HISTORY_FLUSH_LOCK_TIMEOUT', 300))
+    if not lock.acquire(blocking=False):
+        return 0
+
+    written = 0
+    try:
+        while True:
+            # A batch left by a flush that died is written again first.
+            batch = connection.lrange(PROCESSING_KEY, 0, -1) or _claim_batch(connection, batch_size)
+            if not batch:
+                break
+            try:
+                written += _write_batch(batch)
+            except Exception as e:
+                print(f"Could not write {len(batch)} history rows: {e}. Keeping them for the next flush.")
+                break
+            connection.delete(PROCESSING_KEY)
+    finally:
+        try:
+            lock.release()
+        except Exception:
+            # The lock expired while a large backlog was written.
+            pass
+    return written
@@ -0,0 +1,46 @@
+"""
+Real-time job updates over the Channels layer.
+
+Every user has a group that their `ws/nlp/jobs/` sockets join (see
+nlp_services.consumers.JobProgressConsumer). The job task publishes status
+changes, per-item results and progress percentages to it.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+
+def job_group_name(user_id) -> str:
+    return f"nlp_jobs_user_{user_id}"
+
+
+async def apublish_job_event(job, event: str, **data):
+    """
+    Sends an event about a job to the sockets of its owner.
+    Updates are best effort: a job never fails because the channel layer is unavailable.
+    """
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return
+
+    message = {
+        'event': event,
+        'job_id': str(job.id),
+        'job_type': job.job_type,
+        'status': job.status,
+        'progress': job.progress,
+        **data,
+    }
+    try:
+        await channel_layer.group_send(
+            job_group_name(job.user_id),
+            {
+                'type': 'job.update', # This corresponds to the method name in the consumer
+                'message': message
+            }
+        )
+    except Exception as e:
+        print(f"Could not publish the '{event}' event of job {job.id}: {e}")
+
+
+def publish_job_event(job, event: str, **data):
+    async_to_sync(apublish_job_event)(job, event, **data)
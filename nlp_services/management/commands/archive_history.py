@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from nlp_services.archival import ARCHIVED_MODELS, archive_history, retention_days
+
+
+class Command(BaseCommand):
+    """
+    Moves the history rows past their tier's retention period to compressed
+    monthly JSONL archives (see nlp_services.archival). The same job runs
+    nightly from Celery beat; this command runs it by hand.
+    """
+    help = "Archive and delete history rows past their retention period."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', action='append', choices=list(ARCHIVED_MODELS),
+                            help="History to archive; may be repeated. All kinds by default.")
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Number of rows written per archive file and deleted per transaction.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only count the rows that would be archived.")
+
+    def handle(self, *args, **options):
+        self.stdout.write(f"Retention in days per tier: {retention_days()}")
+        archived = archive_history(kinds=options['kind'], batch_size=options['batch_size'], dry_run=options['dry_run'])
+
+        verb = "Would archive" if options['dry_run'] else "Archived"
+        for kind, count in archived.items():
+            self.stdout.write(f"{verb} {count} {kind} history rows.")
+        self.stdout.write(self.style.SUCCESS(f"{verb} {sum(archived.values())} rows in total."))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from nlp_services import blob_store
+
+
+class Command(BaseCommand):
+    """
+    Moves the large inputs of existing summarization and aggregate history rows
+    into the compressed, deduplicated blob store (see nlp_services.blob_store).
+    New rows are stored this way when they are written; inputs below
+    NLP_BLOB_MIN_SIZE stay inline.
+    """
+    help = "Move large history inputs into the compressed blob store."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of history rows processed per transaction.")
+
+    def handle(self, *args, **options):
+        for model, (field, _) in blob_store.INPUT_FIELDS.items():
+            moved = self._backfill(model, field, options['batch_size'])
+            self.stdout.write(f"Moved the input of {moved} {model.__name__} rows to the blob store.")
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    def _backfill(self, model, field, batch_size):
+        """
+        Processes the rows without a blob in primary key order and returns the number of rows moved.
+        Small inputs are left inline, so the loop continues after the last key instead of re-reading the queryset.
+        """
+        queryset = model.objects.filter(input_blob__isnull=True).only('pk', field, 'input_blob')
+        moved = 0
+        last_pk = 0
+        while True:
+            rows = list(queryset.filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+            if not rows:
+                return moved
+            last_pk = rows[-1].pk
+
+            with transaction.atomic():
+                blob_store.move_inputs_to_blobs(rows)
+                rows = [row for row in rows if row.input_blob_id]
+                model.objects.bulk_update(rows, [field, 'input_blob'])
+            moved += len(rows)
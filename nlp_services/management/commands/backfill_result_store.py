@@ -0,0 +1,94 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from nlp_services.cache_keys import sentiment_result_key, summarization_result_key
+from nlp_services.models import AnalysisHistory, SummarizationHistory, StoredResult
+from nlp_services.processors.llm_processor import processor_instance
+
+
+class Command(BaseCommand):
+    """
+    Moves the results of legacy history rows into the shared StoredResult table.
+
+    Each legacy row gets its StoredResult (created once per unique input), is linked
+    to it and has its copied result cleared. History rows only record the provider,
+    so only rows produced by the active provider are migrated and they are assumed
+    to match its current model and prompt version.
+    """
+    help = "Move legacy history results into the shared result store."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of history rows migrated per transaction.")
+
+    def handle(self, *args, **options):
+        processor = processor_instance
+        batch_size = options['batch_size']
+
+        sentiment_total = self._backfill(
+            AnalysisHistory.objects.filter(
+                stored_result__isnull=True,
+                analysis_result__isnull=False,
+                analysis_source=processor.provider_name,
+            ),
+            batch_size,
+            build_key=lambda row: sentiment_result_key(processor, row.text_input, row.analysis_type),
+            get_result=lambda row: row.analysis_result,
+            clear_fields={'analysis_result': None},
+        )
+
+        summary_total = self._backfill(
+            SummarizationHistory.objects.filter(
+                stored_result__isnull=True,
+                summarization_source=processor.provider_name,
+            ).exclude(summarized_text=''),
+            batch_size,
+            build_key=lambda row: summarization_result_key(processor, row.input_text, row.max_words_summarization),
+            get_result=lambda row: row.summarized_text,
+            clear_fields={'summarized_text': ''},
+        )
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Linked {sentiment_total} sentiment and {summary_total} summarization history rows to the result store."
+        ))
+
+    def _backfill(self, queryset, batch_size, build_key, get_result, clear_fields):
+        """
+        Migrates `queryset` batch by batch and returns the number of linked rows.
+        Every batch is removed from the queryset once linked, so the loop always
+        reads the first remaining batch.
+        """
+        total = 0
+        while True:
+            rows = list(queryset.order_by('pk')[:batch_size])
+            if not rows:
+                return total
+
+            keys = {row.pk: build_key(row) for row in rows}
+            with transaction.atomic():
+                # ignore_conflicts keeps rows that are already in the store.
+                StoredResult.objects.bulk_create([
+                    StoredResult(
+                        result_key=key.store_key,
+                        task=key.task,
+                        text_hash=key.content_hash,
+                        params=key.params,
+                        result=get_result(row),
+                        source=key.provider,
+                        model_name=key.model,
+                        prompt_version=key.prompt_version,
+                    )
+                    for row, key in ((row, keys[row.pk]) for row in rows)
+                ], ignore_conflicts=True)
+
+                stored_ids = dict(StoredResult.objects.filter(
+                    result_key__in={key.store_key for key in keys.values()}
+                ).values_list('result_key', 'pk'))
+
+                for row in rows:
+                    row.stored_result_id = stored_ids[keys[row.pk].store_key]
+                    for field, value in clear_fields.items():
+                        setattr(row, field, value)
+                queryset.model.objects.bulk_update(rows, ['stored_result', *clear_fields])
+
+            total += len(rows)
@@ -0,0 +1,90 @@
+import json
+import pickle
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from nlp_services import compression
+from nlp_services.cache_codec import BinaryResultCodec, msgpack
+
+
+def sample_results() -> dict:
+    """
+    Representative cached values of the three endpoints.
+    """
+    sentiment = {
+        "sentiment": "POSITIVE",
+        "score": 0.98,
+        "notes": "The customer is satisfied with the product quality and the shipping speed.",
+    }
+    summary = (
+        "کیفیت محصول از نظر بیشتر مشتریان عالی است و ارسال سریع انجام شده است، "
+        "اما چند مشتری از بسته‌بندی آسیب‌دیده و تأخیر در تحویل گلایه کرده‌اند. "
+    ) * 3
+    aggregate = {
+        "overall_sentiment": "POSITIVE",
+        "satisfaction_score": 82,
+        "key_positives": [f"Positive point number {i} about quality, price and delivery." for i in range(10)],
+        "key_negatives": [f"Negative point number {i} about packaging and late shipments." for i in range(10)],
+        "summary": "Overall, 82% of the comments were evaluated as positive. " * 8,
+    }
+    return {'sentiment': sentiment, 'summarization': summary, 'aggregate': aggregate}
+
+
+def legacy_encode(kind, value) -> bytes:
+    # Before the codec: sentiment results were cached as JSON strings, the others as
+    # Python values; django-redis pickles both.
+    if kind == 'sentiment':
+        value = json.dumps(value)
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+
+def legacy_decode(kind, data):
+    value = pickle.loads(data)
+    return json.loads(value) if kind == 'sentiment' else value
+
+
+class Command(BaseCommand):
+    """
+    Compares the size of cached results in Redis and the CPU time to encode and
+    decode them, for the format used before the cache codec and for the codec
+    variants. Sizes include the pickling django-redis applies to every value.
+    """
+    help = "Benchmark the cache codecs on representative NLP results."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000,
+                            help="Number of encode/decode rounds timed per value and codec.")
+
+    def handle(self, *args, **options):
+        iterations = options['iterations']
+
+        variants = {'legacy (json/pickle)': None, 'json': BinaryResultCodec('json', compress_min_size=None)}
+        if msgpack is not None:
+            variants['msgpack'] = BinaryResultCodec('msgpack', compress_min_size=None)
+        serializer = 'msgpack' if msgpack is not None else 'json'
+        variants[f'{serializer} + zlib >= 1 KB'] = BinaryResultCodec(serializer, compress_min_size=1024, compression_codec='zlib')
+        if compression.zstandard is not None:
+            variants[f'{serializer} + zstd >= 1 KB'] = BinaryResultCodec(serializer, compress_min_size=1024, compression_codec='zstd')
+
+        self.stdout.write(f"{'value':<14} {'codec':<30} {'bytes':>7} {'saved':>7} {'encode us':>10} {'decode us':>10}")
+        for kind, value in sample_results().items():
+            legacy_size = None
+            for name, codec in variants.items():
+                if codec is None:
+                    encode = lambda: legacy_encode(kind, value)
+                    stored = encode()
+                    decode = lambda: legacy_decode(kind, stored)
+                else:
+                    encode = lambda: pickle.dumps(codec.encode(value), pickle.HIGHEST_PROTOCOL)
+                    stored = encode()
+                    decode = lambda: codec.decode(pickle.loads(stored))
+                assert decode() == value, f"{name} does not round-trip the {kind} value"
+
+                size = len(stored)
+                legacy_size = legacy_size or size
+                encode_us = timeit.timeit(encode, number=iterations) / iterations * 1e6
+                decode_us = timeit.timeit(decode, number=iterations) / iterations * 1e6
+                self.stdout.write(
+                    f"{kind:<14} {name:<30} {size:>7} {1 - size / legacy_size:>7.1%} {encode_us:>10.2f} {decode_us:>10.2f}"
+                )
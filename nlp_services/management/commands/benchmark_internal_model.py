@@ -0,0 +1,63 @@
+import random
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand, CommandError
+
+from nlp_services.processors.internal_model import InternalSentimentModel, internal_model_settings, np
+
+
+SAMPLE_TEXTS = [
+    "کیفیت محصول عالی بود و خیلی راضی هستم",
+    "ارسال سریع بود، ممنون از فروشگاه خوبتون",
+    "اصلا خوب نیست، بعد از یک هفته خراب شد",
+    "بسته‌بندی افتضاح بود و کالا شکسته رسید",
+    "بدون مشکل به دستم رسید، پیشنهاد میکنم",
+    "قیمتش گران است ولی کیفیتش خوبه",
+    "آیا این مدل رنگ مشکی هم دارد؟",
+    "سفارش را دیروز ثبت کردم",
+    "دوست ندارم، با عکس فرق داشت",
+    "The product is great, thanks!",
+]
+
+
+class Command(BaseCommand):
+    """
+    Scores representative short Persian comments with the internal sentiment
+    model, a batch at a time, and reports the throughput and the share of texts
+    that would be escalated to the LLM at the configured confidence threshold.
+    """
+    help = "Benchmark the throughput of the internal sentiment model."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--texts', type=int, default=100000, help="Number of texts scored.")
+        parser.add_argument('--batch-size', type=int, default=256)
+        parser.add_argument('--analysis-type', choices=['general_sentiment', 'business_intent'], default='general_sentiment')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if np is None:
+            raise CommandError("numpy is not installed: the internal model is not available.")
+        model = InternalSentimentModel.from_settings()
+        threshold = internal_model_settings()['confidence_threshold']
+        rng = random.Random(options['seed'])
+        texts = [rng.choice(SAMPLE_TEXTS) for _ in range(options['texts'])]
+        batch_size = max(options['batch_size'], 1)
+
+        labels = Counter()
+        escalated = 0
+        started = time.perf_counter()
+        for start in range(0, len(texts), batch_size):
+            for result, confidence in model.predict(texts[start:start + batch_size], options['analysis_type']):
+                labels[result['sentiment']] += 1
+                escalated += confidence < threshold
+        seconds = time.perf_counter() - started
+
+        self.stdout.write(f"Model '{model.name}', {len(texts)} texts in batches of {batch_size}.")
+        self.stdout.write(f"Scored in {seconds:.3f}s: {len(texts) / max(seconds, 1e-9):,.0f} texts/s.")
+        self.stdout.write(f"Labels: {dict(labels)}")
+        self.stdout.write(
+            f"Escalated to the LLM (confidence < {threshold}): {escalated} ({escalated / max(len(texts), 1):.1%})"
+        )
+        for text, (result, confidence) in zip(SAMPLE_TEXTS, model.predict(SAMPLE_TEXTS, options['analysis_type'])):
+            self.stdout.write(f"  {result['sentiment']:<12} {confidence:.2f}  {text}")
@@ -0,0 +1,89 @@
+import asyncio
+import ssl
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from nlp_services.processors.stub_provider import StubGeminiServer
+from nlp_services.processors.transport import PooledTransport, httpx
+
+
+class Command(BaseCommand):
+    """
+    Sends the same calls to a local Gemini stub twice: with a new client per
+    call (a new connection each time) and through the pooled transport. The
+    connections the stub accepted show how many connection setups the pool
+    saves; with --tls-cert the setups include a TLS handshake, as with the real API.
+    """
+    help = "Benchmark connection reuse of the pooled LLM transport against a local stub."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--max-connections', type=int, default=20,
+                            help="Pool size of the pooled transport.")
+        parser.add_argument('--latency', type=float, default=0.01,
+                            help="Seconds the stub waits before answering a call.")
+        parser.add_argument('--http2', action='store_true',
+                            help="Let the pooled transport use HTTP/2 (the stub only speaks HTTP/1.1, so this only checks negotiation).")
+        parser.add_argument('--tls-cert', help="Certificate file; the stub serves HTTPS together with --tls-key.")
+        parser.add_argument('--tls-key', help="Private key file of --tls-cert.")
+
+    def handle(self, *args, **options):
+        if httpx is None:
+            raise CommandError("The pooled transport needs the httpx package.")
+        asyncio.run(self._run(options))
+
+    async def _run(self, options):
+        ssl_context = None
+        if options['tls_cert']:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(options['tls_cert'], options['tls_key'])
+
+        server = StubGeminiServer(latency=options['latency'], ssl_context=ssl_context)
+        await server.start()
+        url = f"{server.url}/v1beta/models/stub:generateContent"
+        body = {"contents": [{"role": "user", "parts": [{"text": "Text to analyze: \"benchmark\""}]}]}
+        # The stub uses a self-signed certificate.
+        verify = ssl_context is None
+
+        async def new_client_call():
+            async with httpx.AsyncClient(verify=verify) as client:
+                response = await client.post(url, json=body)
+                response.raise_for_status()
+
+        transport = PooledTransport(max_connections=options['max_connections'],
+                                    max_keepalive_connections=options['max_connections'],
+                                    http2=options['http2'], verify=verify)
+
+        async def pooled_call():
+            response = await transport.request("POST", url, json=body)
+            response.raise_for_status()
+
+        self.stdout.write(
+            f"{options['requests']} calls, {options['concurrency']} concurrent, {options['latency'] * 1000:.0f} ms stub latency"
+        )
+        self.stdout.write(f"{'client':<22} {'seconds':>8} {'calls/s':>9} {'connections':>12}")
+        try:
+            for name, call in (('new client per call', new_client_call), ('pooled transport', pooled_call)):
+                connections_before = server.connections
+                seconds = await self._timed(call, options['requests'], options['concurrency'])
+                connections = server.connections - connections_before
+                self.stdout.write(
+                    f"{name:<22} {seconds:>8.2f} {options['requests'] / seconds:>9.0f} {connections:>12}"
+                )
+            self.stdout.write(f"Pool metrics: {transport.metrics()}")
+        finally:
+            await transport.aclose()
+            await server.close()
+
+    async def _timed(self, call, requests, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited():
+            async with semaphore:
+                await call()
+
+        started = time.monotonic()
+        await asyncio.gather(*(limited() for _ in range(requests)))
+        return time.monotonic() - started
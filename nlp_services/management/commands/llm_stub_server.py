@@ -0,0 +1,36 @@
+import asyncio
+import ssl
+
+from django.core.management.base import BaseCommand
+
+from nlp_services.processors.stub_provider import StubGeminiServer
+
+
+class Command(BaseCommand):
+    """
+    Serves a local stand-in for the Gemini REST API (see
+    nlp_services.processors.stub_provider). Point GEMINI_API_BASE_URL at it to
+    run the service without network access or an API key.
+    """
+    help = "Run a local stub of the Gemini API."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help="Seconds the stub waits before answering a call.")
+        parser.add_argument('--tls-cert', help="Certificate file; serves HTTPS together with --tls-key.")
+        parser.add_argument('--tls-key', help="Private key file of --tls-cert.")
+
+    def handle(self, *args, **options):
+        ssl_context = None
+        if options['tls_cert']:
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(options['tls_cert'], options['tls_key'])
+
+        server = StubGeminiServer(options['host'], options['port'], options['latency'], ssl_context)
+        self.stdout.write(f"Serving the Gemini stub on {server.url} (Ctrl+C to stop).")
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            self.stdout.write(f"Served {server.requests} requests over {server.connections} connections.")
@@ -0,0 +1,160 @@
+import asyncio
+import csv
+import json
+import os
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+
+from nlp_services import bulk
+from nlp_services.services import UsageLimitExceeded
+
+
+class Command(BaseCommand):
+    """
+    Scores a CSV or JSONL file offline with the same processor, normalization,
+    result store and history as the API (see nlp_services.bulk).
+
+    The input is streamed (plain or gzip) and scored in windows. After every
+    window the results are appended to the output JSONL file and a checkpoint
+    with the next input line and the output size is written, so a run that
+    crashed resumes where it stopped: the output is cut back to the checkpoint
+    and the input is read from the checkpointed line on.
+    """
+    help = "Score a CSV/JSONL file of texts offline, with checkpointing."
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="Input file: JSONL (one {\"id\", \"text\"} object or string per line) or CSV, optionally gzipped.")
+        parser.add_argument('output', help="Output JSONL file; one result per input line, in completion order.")
+        parser.add_argument('--user', required=True,
+                            help="Username or email of the account the history and usage are recorded for.")
+        parser.add_argument('--analysis-type', default='general_sentiment',
+                            choices=['general_sentiment', 'business_intent'])
+        parser.add_argument('--format', choices=['jsonl', 'csv'], default=None,
+                            help="Input format. Detected from the file name by default.")
+        parser.add_argument('--text-column', default='text', help="CSV column holding the text.")
+        parser.add_argument('--id-column', default='id', help="CSV column holding the record id, if any.")
+        parser.add_argument('--window-size', type=int, default=getattr(settings, 'NLP_BULK_WINDOW_SIZE', 200),
+                            help="Number of lines scored (and checkpointed) together.")
+        parser.add_argument('--concurrency', type=int, default=None,
+                            help="Maximum number of texts analyzed at the same time. Defaults to the whole window "
+                                 "when the processor batches texts, NLP_LLM_CONCURRENCY otherwise.")
+        parser.add_argument('--checkpoint', default=None,
+                            help="Checkpoint file. Defaults to <output>.checkpoint.")
+        parser.add_argument('--restart', action='store_true',
+                            help="Ignore an existing checkpoint and start from the first line.")
+
+    def handle(self, *args, **options):
+        user = get_user_model().objects.filter(Q(username=options['user']) | Q(email=options['user'])).first()
+        if user is None:
+            raise CommandError(f"User '{options['user']}' does not exist.")
+
+        input_path = options['input']
+        if not os.path.exists(input_path):
+            raise CommandError(f"Input file '{input_path}' does not exist.")
+
+        input_format = options['format'] or ('csv' if '.csv' in os.path.basename(input_path) else 'jsonl')
+        checkpoint_path = options['checkpoint'] or f"{options['output']}.checkpoint"
+
+        checkpoint = self._load_checkpoint(checkpoint_path, input_path, options)
+        if checkpoint['cursor']:
+            self.stdout.write(f"Resuming from line {checkpoint['cursor']} of {input_path}.")
+
+        asyncio.run(self._run(user, input_path, input_format, checkpoint_path, checkpoint, options))
+
+    # --- Checkpoints ---
+
+    def _load_checkpoint(self, checkpoint_path, input_path, options):
+        empty = {
+            'input': os.path.abspath(input_path),
+            'analysis_type': options['analysis_type'],
+            'cursor': 0,
+            'output_offset': 0,
+            'stats': {'analyzed': 0, 'cached': 0, 'errors': 0},
+        }
+        if options['restart'] or not os.path.exists(checkpoint_path):
+            return empty
+
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        if checkpoint['input'] != empty['input'] or checkpoint['analysis_type'] != empty['analysis_type']:
+            raise CommandError(
+                f"The checkpoint {checkpoint_path} belongs to another input or analysis type. Use --restart to discard it."
+            )
+        return checkpoint
+
+    def _save_checkpoint(self, checkpoint_path, checkpoint):
+        # Written to a temporary file and renamed, so a crash never leaves a half-written checkpoint.
+        temporary_path = f"{checkpoint_path}.tmp"
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+            checkpoint_file.flush()
+            os.fsync(checkpoint_file.fileno())
+        os.replace(temporary_path, checkpoint_path)
+
+    # --- Input ---
+
+    def _records(self, input_file, input_format, options):
+        """
+        Yields the input records as NDJSON lines, the format nlp_services.bulk parses.
+        """
+        lines = bulk.iter_lines(input_file)
+        if input_format == 'jsonl':
+            yield from lines
+            return
+
+        # The csv module needs the line endings to keep newlines inside quoted fields.
+        rows = csv.DictReader(line.decode('utf-8-sig') + '\n' for line in lines)
+        if options['text_column'] not in (rows.fieldnames or []):
+            raise CommandError(f"The CSV file has no '{options['text_column']}' column.")
+        for row in rows:
+            yield json.dumps({
+                'id': row.get(options['id_column']),
+                'text': row[options['text_column']] or '',
+            }).encode()
+
+    # --- Scoring ---
+
+    async def _run(self, user, input_path, input_format, checkpoint_path, checkpoint, options):
+        stats = checkpoint['stats']
+        started_at = time.monotonic()
+        lines_done = 0
+
+        output_mode = 'r+b' if os.path.exists(options['output']) and checkpoint['output_offset'] else 'wb'
+        with open(input_path, 'rb') as input_file, open(options['output'], output_mode) as output_file:
+            # Results written after the last checkpoint are scored again, so they are cut off.
+            output_file.seek(checkpoint['output_offset'])
+            output_file.truncate()
+
+            windows = bulk.iter_windows(self._records(input_file, input_format, options), checkpoint['cursor'], options['window_size'])
+            try:
+                for window in windows:
+                    window_started_at = time.monotonic()
+                    async for record in bulk.score_window(user, window, options['analysis_type'], stats, options['concurrency']):
+                        output_file.write(json.dumps(record, ensure_ascii=False).encode() + b"\n")
+                    output_file.flush()
+                    os.fsync(output_file.fileno())
+
+                    checkpoint['cursor'] = window[-1][0] + 1
+                    checkpoint['output_offset'] = output_file.tell()
+                    self._save_checkpoint(checkpoint_path, checkpoint)
+
+                    lines_done += len(window)
+                    window_seconds = time.monotonic() - window_started_at
+                    self.stdout.write(
+                        f"Line {checkpoint['cursor']}: {len(window)} lines in {window_seconds:.2f}s "
+                        f"({len(window) / window_seconds:.1f} lines/s); "
+                        f"analyzed {stats['analyzed']}, cached {stats['cached']}, errors {stats['errors']}."
+                    )
+            except (bulk.BulkInputError, UsageLimitExceeded) as e:
+                raise CommandError(f"Stopped at line {checkpoint['cursor']}: {e}")
+
+        elapsed = time.monotonic() - started_at
+        self.stdout.write(self.style.SUCCESS(
+            f"Scored {lines_done} lines in {elapsed:.2f}s ({lines_done / elapsed if elapsed else 0:.1f} lines/s). "
+            f"Totals: analyzed {stats['analyzed']}, cached {stats['cached']}, errors {stats['errors']}. "
+            f"Next line: {checkpoint['cursor']}."
+        ))
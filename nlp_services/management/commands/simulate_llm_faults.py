@@ -0,0 +1,108 @@
+import asyncio
+import contextlib
+import io
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+
+from nlp_services.processors.llm_processor import FlakyMockProcessor, OutageMockProcessor, SlowMockProcessor
+from nlp_services.processors.resilience import ResiliencePolicy
+
+
+FAULT_PROCESSORS = {
+    'flaky': FlakyMockProcessor,
+    'slow': SlowMockProcessor,
+    'outage': OutageMockProcessor,
+}
+
+
+class Command(BaseCommand):
+    """
+    Sends sentiment calls to a fault-injecting mock processor through a
+    ResiliencePolicy and reports how the retries, hedged requests and the
+    circuit breaker dealt with the faults:
+
+    - flaky: a share of the calls fails with a retryable error.
+    - slow: a share of the calls stalls (compare with and without --hedge).
+    - outage: every call fails for --outage-seconds, so the circuit opens and
+      closes again once a probe call succeeds.
+    """
+    help = "Simulate upstream LLM faults against the retry, hedging and circuit breaker policy."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fault', choices=sorted(FAULT_PROCESSORS), default='flaky')
+        parser.add_argument('--calls', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=20)
+        parser.add_argument('--interval', type=float, default=0.0,
+                            help="Seconds between the starts of consecutive calls (0 sends them all at once).")
+        parser.add_argument('--seed', type=int, default=None, help="Seed of the injected faults.")
+        parser.add_argument('--error-rate', type=float, default=0.3, help="flaky: share of the calls that fail.")
+        parser.add_argument('--slow-rate', type=float, default=0.1, help="slow: share of the calls that stall.")
+        parser.add_argument('--slow-delay', type=float, default=5.0, help="slow: seconds a stalled call takes longer.")
+        parser.add_argument('--outage-seconds', type=float, default=3.0, help="outage: how long every call fails.")
+        parser.add_argument('--hedge', action='store_true', help="Hedge calls slower than the recent p95.")
+        parser.add_argument('--max-retries', type=int, default=None)
+        parser.add_argument('--reset-timeout', type=float, default=1.0,
+                            help="Seconds the circuit stays open before a probe call.")
+
+    def handle(self, *args, **options):
+        asyncio.run(self._run(options))
+
+    async def _run(self, options):
+        processor = FAULT_PROCESSORS[options['fault']](
+            seed=options['seed'],
+            error_rate=options['error_rate'],
+            slow_rate=options['slow_rate'],
+            slow_delay=options['slow_delay'],
+        )
+        policy_options = {
+            'hedge': options['hedge'],
+            'reset_timeout': options['reset_timeout'],
+            # Enough samples for a p95 early in the run.
+            'hedge_min_samples': min(20, max(options['calls'] // 10, 1)),
+        }
+        if options['max_retries'] is not None:
+            policy_options['max_retries'] = options['max_retries']
+        policy = ResiliencePolicy(f"{options['fault']} mock", policy_options)
+        if options['fault'] == 'outage':
+            processor.start_outage(options['outage_seconds'])
+
+        semaphore = asyncio.Semaphore(options['concurrency'])
+        outcomes = Counter()
+        latencies = []
+
+        async def one_call(number):
+            await asyncio.sleep(number * options['interval'])
+            async with semaphore:
+                started = time.monotonic()
+                try:
+                    await policy.call('sentiment', lambda: processor.analyze_sentiment(f"Simulated text {number}"))
+                    outcomes['success'] += 1
+                except Exception as e:
+                    outcomes[type(e).__name__] += 1
+                latencies.append(time.monotonic() - started)
+
+        self.stdout.write(
+            f"{options['calls']} calls, {options['concurrency']} concurrent, fault '{options['fault']}'"
+            f"{', hedged' if options['hedge'] else ''}"
+        )
+        started = time.monotonic()
+        # The mock processors print every call; only the report is of interest here.
+        with contextlib.redirect_stdout(io.StringIO()):
+            await asyncio.gather(*(one_call(number) for number in range(options['calls'])))
+        seconds = time.monotonic() - started
+
+        latencies.sort()
+        state = policy.state()
+        self.stdout.write(f"Finished in {seconds:.2f}s.")
+        self.stdout.write(f"Outcomes: {dict(outcomes)}")
+        self.stdout.write(f"Upstream calls: {processor.calls} (faults injected: {processor.faults})")
+        self.stdout.write(
+            f"Retries: {state['retries']}, hedged: {state['hedged']}, hedges won: {state['hedge_wins']}"
+        )
+        self.stdout.write(f"Circuit: {state['circuit']}")
+        if latencies:
+            p50 = latencies[len(latencies) // 2]
+            p95 = latencies[min(int(0.95 * len(latencies)), len(latencies) - 1)]
+            self.stdout.write(f"Latency p50: {p50:.2f}s, p95: {p95:.2f}s, max: {latencies[-1]:.2f}s")
@@ -0,0 +1,114 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from django.utils import timezone
+
+from nlp_services.cache_keys import (
+    RESULT_CACHE_TIMEOUT,
+    ResultKey,
+    aggregate_result_key,
+    processor_identity,
+)
+from nlp_services.models import AggregateAnalysisHistory, StoredResult
+from nlp_services.result_cache import result_cache
+from nlp_services.processors.llm_processor import processor_instance
+from nlp_services.processors.routing import served_identities
+
+
+class Command(BaseCommand):
+    """
+    Pre-seeds the versioned L1 cache keys from the shared result store and
+    the aggregate history.
+
+    Only results produced by the active backends (provider and model) and prompt
+    version are used. Run `backfill_result_store` first to move legacy history rows into the store.
+    Aggregate history rows only record the provider, so they are assumed to match
+    the current model and prompt version.
+    """
+    help = "Warm the Redis result cache from stored analysis results."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help="Only use results from the last N days.")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of keys written per set_many() call.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Count the keys that would be written without touching the cache.")
+
+    def handle(self, *args, **options):
+        processor = processor_instance
+        self.batch_size = options['batch_size']
+        self.dry_run = options['dry_run']
+
+        since = None
+        if options['days'] is not None:
+            since = timezone.now() - timedelta(days=options['days'])
+
+        provider, model, prompt_version = processor_identity(processor)
+        # With several backends, a result is stored with the backend that produced it.
+        identities = served_identities(processor)
+        produced_by = Q()
+        for source, model_name in identities:
+            produced_by |= Q(source=source, model_name=model_name)
+        stored_results = StoredResult.objects.filter(
+            produced_by, prompt_version=prompt_version
+        ).order_by('-created_at')
+        if since:
+            stored_results = stored_results.filter(created_at__gte=since)
+
+        def stored_entry(row):
+            task, text_hash, params, result = row
+            key = ResultKey(task, text_hash, params, provider, model, prompt_version)
+            return key.cache_key, result
+
+        values = ('task', 'text_hash', 'params', 'result')
+        sentiment_total = self._warm(stored_results.filter(task='sentiment').values_list(*values), stored_entry)
+        summary_total = self._warm(stored_results.filter(task='summarization').values_list(*values), stored_entry)
+
+        # The newest row wins when several rows share a key, so rows are read newest first
+        # and only the first value seen for each key is kept.
+        aggregate_rows = AggregateAnalysisHistory.objects.filter(
+            analysis_source__in={source for source, _ in identities}
+        ).order_by('-timestamp')
+        if since:
+            aggregate_rows = aggregate_rows.filter(timestamp__gte=since)
+        aggregate_total = self._warm(
+            aggregate_rows.values_list('input_fingerprint', 'analysis_type', 'analysis_result'),
+            lambda row: (aggregate_result_key(processor, row[0], row[1]).cache_key, row[2]),
+        )
+
+        action = "Would write" if self.dry_run else "Wrote"
+        self.stdout.write(self.style.SUCCESS(
+            f"{action} {sentiment_total} sentiment, {summary_total} summarization "
+            f"and {aggregate_total} aggregate cache keys."
+        ))
+
+    def _warm(self, rows, build_entry):
+        """
+        Writes the cache entries built from `rows` in batches and returns how many were written.
+        """
+        seen_keys = set()
+        batch = {}
+        total = 0
+
+        for row in rows.iterator(chunk_size=self.batch_size):
+            key, value = build_entry(row)
+            if key in seen_keys:
+                continue
+            seen_keys.add(key)
+            batch[key] = value
+
+            if len(batch) >= self.batch_size:
+                total += self._flush(batch)
+                batch = {}
+
+        if batch:
+            total += self._flush(batch)
+        return total
+
+    def _flush(self, batch):
+        if not self.dry_run:
+            # Encoded with the cache codec, like the entries the pipelines write.
+            result_cache.set_many(batch, timeout=RESULT_CACHE_TIMEOUT)
+        return len(batch)
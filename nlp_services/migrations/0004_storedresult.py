@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nlp_services', '0003_aggregateanalysishistory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('result_key', models.CharField(max_length=64, unique=True)),
+                ('task', models.CharField(choices=[('sentiment', 'Sentiment Analysis'), ('summarization', 'Summarization')], max_length=20)),
+                ('text_hash', models.CharField(db_index=True, max_length=64)),
+                ('params', models.JSONField(default=dict)),
+                ('result', models.JSONField()),
+                ('source', models.CharField(max_length=20)),
+                ('model_name', models.CharField(max_length=100)),
+                ('prompt_version', models.CharField(max_length=20)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Stored Result',
+                'verbose_name_plural': 'Stored Results',
+            },
+        ),
+        migrations.AlterField(
+            model_name='analysishistory',
+            name='analysis_result',
+            field=models.JSONField(blank=True, null=True, verbose_name='Analysis Result'),
+        ),
+        migrations.AlterField(
+            model_name='summarizationhistory',
+            name='summarized_text',
+            field=models.TextField(blank=True, verbose_name='Summarized Text'),
+        ),
+        migrations.AddField(
+            model_name='analysishistory',
+            name='stored_result',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='analysis_history', to='nlp_services.storedresult', verbose_name='Stored Result'),
+        ),
+        migrations.AddField(
+            model_name='summarizationhistory',
+            name='stored_result',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='summarization_history', to='nlp_services.storedresult', verbose_name='Stored Result'),
+        ),
+    ]
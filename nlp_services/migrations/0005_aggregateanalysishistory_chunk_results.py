@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nlp_services', '0004_storedresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aggregateanalysishistory',
+            name='chunk_results',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:45
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nlp_services', '0007_analysisjob_progress'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aggregateanalysishistory',
+            name='write_id',
+            field=models.UUIDField(blank=True, editable=False, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='analysishistory',
+            name='write_id',
+            field=models.UUIDField(blank=True, editable=False, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='summarizationhistory',
+            name='write_id',
+            field=models.UUIDField(blank=True, editable=False, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='aggregateanalysishistory',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='analysishistory',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Timestamp'),
+        ),
+        migrations.AlterField(
+            model_name='summarizationhistory',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False, verbose_name='Timestamp'),
+        ),
+    ]
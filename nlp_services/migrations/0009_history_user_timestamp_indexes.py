@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:47
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nlp_services', '0008_history_write_behind'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='aggregateanalysishistory',
+            index=models.Index(fields=['user', '-timestamp', '-id'], name='nlp_service_user_id_410c3f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='analysishistory',
+            index=models.Index(fields=['user', '-timestamp', '-id'], name='nlp_service_user_id_a7274f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='summarizationhistory',
+            index=models.Index(fields=['user', '-timestamp', '-id'], name='nlp_service_user_id_38ebc8_idx'),
+        ),
+    ]
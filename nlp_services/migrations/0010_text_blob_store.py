@@ -0,0 +1,49 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:50
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nlp_services', '0009_history_user_timestamp_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TextBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content_hash', models.CharField(max_length=64, unique=True)),
+                ('codec', models.CharField(choices=[('zlib', 'zlib'), ('zstd', 'Zstandard')], max_length=10)),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Text Blob',
+                'verbose_name_plural': 'Text Blobs',
+            },
+        ),
+        migrations.AlterField(
+            model_name='aggregateanalysishistory',
+            name='input_texts',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='summarizationhistory',
+            name='text_input',
+            field=models.TextField(blank=True, verbose_name='Input Text'),
+        ),
+        migrations.AddField(
+            model_name='aggregateanalysishistory',
+            name='input_blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='aggregate_history', to='nlp_services.textblob'),
+        ),
+        migrations.AddField(
+            model_name='summarizationhistory',
+            name='input_blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='summarization_history', to='nlp_services.textblob', verbose_name='Input Blob'),
+        ),
+    ]
@@ -1,5 +1,78 @@
+import json
+import uuid
+
 from django.db import models
 from django.conf import settings # To access the CustomUser model
+from django.utils import timezone
+
+from nlp_services.compression import decompress
+
+
+class StoredResult(models.Model):
+    """
+    Content-addressed store of NLP results, shared by all users.
+    A row is identified by the hash of its input text, task, parameters, model and
+    prompt version (see nlp_services.cache_keys.ResultKey), so an identical request
+    from any user reuses it. History rows reference it instead of copying the result.
+    """
+    TASK_CHOICES = [
+        ('sentiment', 'Sentiment Analysis'),
+        ('summarization', 'Summarization'),
+    ]
+
+    # SHA-256 of the full result identity. The unique index makes lookups O(log n).
+    result_key = models.CharField(max_length=64, unique=True)
+    task = models.CharField(max_length=20, choices=TASK_CHOICES)
+    # SHA-256 of the normalized input text.
+    text_hash = models.CharField(max_length=64, db_index=True)
+    params = models.JSONField(default=dict)
+    # The task output: a JSON object for sentiment, a string for summarization.
+    result = models.JSONField()
+    source = models.CharField(max_length=20)
+    model_name = models.CharField(max_length=100)
+    prompt_version = models.CharField(max_length=20)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Stored Result"
+        verbose_name_plural = "Stored Results"
+
+    def __str__(self):
+        return f"{self.task} result {self.result_key[:12]} ({self.source}/{self.model_name})"
+
+
+class TextBlob(models.Model):
+    """
+    Content-addressed, compressed store of large history inputs, shared by all
+    users. A row holds one JSON value (a text or a list of texts) compressed with
+    the codec it names; see nlp_services.blob_store.
+    """
+    CODEC_CHOICES = [
+        ('zlib', 'zlib'),
+        ('zstd', 'Zstandard'),
+    ]
+
+    # SHA-256 of the uncompressed JSON value.
+    content_hash = models.CharField(max_length=64, unique=True)
+    codec = models.CharField(max_length=10, choices=CODEC_CHOICES)
+    data = models.BinaryField()
+    # Size of the uncompressed value in bytes.
+    size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = "Text Blob"
+        verbose_name_plural = "Text Blobs"
+
+    def __str__(self):
+        return f"{self.codec} blob {self.content_hash[:12]} ({self.size} bytes)"
+
+    @property
+    def value(self):
+        """
+        The stored value, decompressed.
+        """
+        return json.loads(decompress(bytes(self.data), self.codec))
 
 
 class AnalysisHistory(models.Model):
@@ -20,7 +93,16 @@ class AnalysisHistory(models.Model):
         verbose_name="User" # English verbose name
     )
     text_input = models.TextField(verbose_name="Input Text") # English verbose name
-    analysis_result = models.JSONField(verbose_name="Analysis Result") # To store complex results (sentiment, score, business insights)
+    # New rows reference the shared result; analysis_result is only filled on legacy rows.
+    stored_result = models.ForeignKey(
+        StoredResult,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='analysis_history',
+        verbose_name="Stored Result"
+    )
+    analysis_result = models.JSONField(null=True, blank=True, verbose_name="Analysis Result") # To store complex results (sentiment, score, business insights)
     analysis_source = models.CharField(
         max_length=20,
         choices=ANALYSIS_SOURCE_CHOICES,
@@ -30,16 +112,32 @@ class AnalysisHistory(models.Model):
 
     analysis_type = models.CharField(max_length=50, default='general_sentiment')
 
-    timestamp = models.DateTimeField(auto_now_add=True, verbose_name="Timestamp") # English verbose name
+    # Set when the analysis ran, not when the row is written (see nlp_services.history_buffer).
+    timestamp = models.DateTimeField(default=timezone.now, editable=False, verbose_name="Timestamp") # English verbose name
+    # Identifies a row queued in the write-behind buffer, so it is never inserted twice.
+    write_id = models.UUIDField(null=True, blank=True, unique=True, editable=False)
 
     class Meta:
         verbose_name = "Sentiment Analysis History" # English verbose name
         verbose_name_plural = "Sentiment Analysis Histories" # English verbose name
         ordering = ['-timestamp'] # Order by timestamp, newest first
+        indexes = [
+            # Serves the history pages of a user (see HistoryCursorPagination).
+            models.Index(fields=['user', '-timestamp', '-id']),
+        ]
 
     def __str__(self):
         return f"Analysis for {self.user.username} at {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
 
+    @property
+    def result(self):
+        """
+        The analysis result, read from the shared store when the row references it.
+        """
+        if self.stored_result_id:
+            return self.stored_result.result
+        return self.analysis_result
+
 
 class SummarizationHistory(models.Model):
     """
@@ -58,8 +156,26 @@ class SummarizationHistory(models.Model):
         related_name='summarization_history',
         verbose_name="User" # English verbose name
     )
-    text_input = models.TextField(verbose_name="Input Text") # English verbose name
-    summarized_text = models.TextField(verbose_name="Summarized Text") # English verbose name
+    # Large inputs are stored compressed in input_blob and leave text_input empty.
+    text_input = models.TextField(blank=True, verbose_name="Input Text") # English verbose name
+    input_blob = models.ForeignKey(
+        TextBlob,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='summarization_history',
+        verbose_name="Input Blob"
+    )
+    # New rows reference the shared result; summarized_text is only filled on legacy rows.
+    stored_result = models.ForeignKey(
+        StoredResult,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='summarization_history',
+        verbose_name="Stored Result"
+    )
+    summarized_text = models.TextField(blank=True, verbose_name="Summarized Text") # English verbose name
     summarization_source = models.CharField(
         max_length=20,
         choices=SUMMARIZATION_SOURCE_CHOICES,
@@ -69,16 +185,41 @@ class SummarizationHistory(models.Model):
 
     max_words_summarization = models.IntegerField(default=50)
 
-    timestamp = models.DateTimeField(auto_now_add=True, verbose_name="Timestamp") # English verbose name
+    # Set when the analysis ran, not when the row is written (see nlp_services.history_buffer).
+    timestamp = models.DateTimeField(default=timezone.now, editable=False, verbose_name="Timestamp") # English verbose name
+    # Identifies a row queued in the write-behind buffer, so it is never inserted twice.
+    write_id = models.UUIDField(null=True, blank=True, unique=True, editable=False)
 
     class Meta:
         verbose_name = "Summarization History" # English verbose name
         verbose_name_plural = "Summarization Histories" # English verbose name
         ordering = ['-timestamp']
+        indexes = [
+            # Serves the history pages of a user (see HistoryCursorPagination).
+            models.Index(fields=['user', '-timestamp', '-id']),
+        ]
 
     def __str__(self):
         return f"Summarization for {self.user.username} at {self.timestamp.strftime('%Y-%m-%d %H:%M')}"
 
+    @property
+    def input_text(self):
+        """
+        The input text, decompressed from the blob store when the row references it.
+        """
+        if self.input_blob_id:
+            return self.input_blob.value
+        return self.text_input
+
+    @property
+    def summary(self):
+        """
+        The summarized text, read from the shared store when the row references it.
+        """
+        if self.stored_result_id:
+            return self.stored_result.result
+        return self.summarized_text
+
 
 class AggregateAnalysisHistory(models.Model):
     """
@@ -96,20 +237,127 @@ class AggregateAnalysisHistory(models.Model):
     input_fingerprint = models.CharField(max_length=64, db_index=True)
     
     # Stores the original, untouched list of texts provided by the user.
-    input_texts = models.JSONField()
+    # Large lists are stored compressed in input_blob and leave input_texts empty.
+    input_texts = models.JSONField(null=True, blank=True)
+    input_blob = models.ForeignKey(
+        TextBlob,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='aggregate_history'
+    )
 
     # Stores the full JSON result from the aggregate analysis.
     analysis_result = models.JSONField()
+
+    # Per-chunk contributions: [{"fingerprints": [<text fingerprint>, ...], "result": {...}}, ...].
+    # A forced re-analysis of the same URL reuses every chunk whose texts are all still present.
+    chunk_results = models.JSONField(null=True, blank=True)
     
     analysis_source = models.CharField(max_length=20)
     analysis_type = models.CharField(max_length=50)
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Set when the analysis ran, not when the row is written (see nlp_services.history_buffer).
+    timestamp = models.DateTimeField(default=timezone.now, editable=False)
+    # Identifies a row queued in the write-behind buffer, so it is never inserted twice.
+    write_id = models.UUIDField(null=True, blank=True, unique=True, editable=False)
 
     class Meta:
         verbose_name = "Aggregate Analysis History"
         verbose_name_plural = "Aggregate Analysis Histories"
         ordering = ['-timestamp']
+        indexes = [
+            # Serves the history pages of a user (see HistoryCursorPagination).
+            models.Index(fields=['user', '-timestamp', '-id']),
+        ]
 
     def __str__(self):
         source = self.url if self.url else "Direct Input"
-        return f"Aggregate analysis for {self.user.username} from {source} at {self.timestamp.strftime('%Y-%m-%d')}"
\ No newline at end of file
+        return f"Aggregate analysis for {self.user.username} from {source} at {self.timestamp.strftime('%Y-%m-%d')}"
+
+    @property
+    def texts(self):
+        """
+        The input texts, decompressed from the blob store when the row references it.
+        """
+        if self.input_blob_id:
+            return self.input_blob.value
+        return self.input_texts
+
+
+class AnalysisJob(models.Model):
+    """
+    An analysis submitted through the job API and run by a Celery worker.
+    The job stores its own input and, once finished, the same result body that
+    the matching synchronous endpoint would have returned.
+    """
+    JOB_TYPE_CHOICES = [
+        ('sentiment', 'Sentiment Analysis'),
+        ('summarization', 'Summarization'),
+        ('aggregate', 'Aggregate Analysis'),
+    ]
+    PRIORITY_CHOICES = [
+        ('high', 'High'),
+        ('default', 'Default'),
+        ('low', 'Low'),
+    ]
+    STATUS_PENDING = 'pending'
+    STATUS_RUNNING = 'running'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_RUNNING, 'Running'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        on_delete=models.CASCADE,
+        related_name='analysis_jobs'
+    )
+    job_type = models.CharField(max_length=20, choices=JOB_TYPE_CHOICES)
+    priority = models.CharField(max_length=10, choices=PRIORITY_CHOICES, default='default')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING, db_index=True)
+
+    # The validated request body of the job.
+    input_data = models.JSONField()
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    # Number of times a worker started the job (retries included).
+    attempts = models.PositiveIntegerField(default=0)
+
+    # Progress of the running attempt: texts for sentiment jobs, chunks for aggregate jobs.
+    total_items = models.PositiveIntegerField(default=0)
+    processed_items = models.PositiveIntegerField(default=0)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = "Analysis Job"
+        verbose_name_plural = "Analysis Jobs"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['user', '-created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.job_type} job {self.id} for {self.user.username} ({self.status})"
+
+    @property
+    def is_finished(self):
+        return self.status in (self.STATUS_SUCCEEDED, self.STATUS_FAILED)
+
+    @property
+    def progress(self):
+        """
+        Completion percentage of the job.
+        """
+        if self.status == self.STATUS_SUCCEEDED:
+            return 100
+        if not self.total_items:
+            return 0
+        return min(100, self.processed_items * 100 // self.total_items)
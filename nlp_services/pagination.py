@@ -1,4 +1,7 @@
-from rest_framework.pagination import LimitOffsetPagination
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, LimitOffsetPagination
 
 
 class StandardLimitOffsetPagination(LimitOffsetPagination):
@@ -12,4 +15,79 @@ class StandardLimitOffsetPagination(LimitOffsetPagination):
     offset_query_param = 'offset'
     
     # max_limit: The maximum number of items the frontend can request (to prevent abuse).
-    max_limit = 10
\ No newline at end of file
+    max_limit = 10
+
+
+class HistoryCursorPagination(CursorPagination):
+    """
+    Keyset pagination for the history endpoints. The next page is found through
+    the (user, timestamp, id) index from the position of the last row, so deep
+    pages are as fast as the first one, unlike OFFSET.
+
+    CursorPagination only keeps the first ordering field in the cursor and falls
+    back to an offset for rows that share it, which shifts the pages when a row
+    is added while paging through rows saved in the same instant (e.g. a bulk
+    request). Here the position is the (timestamp, id) pair, so it is unique.
+    """
+    # id breaks ties between rows saved in the same instant.
+    ordering = ('-timestamp', '-id')
+
+    # page_size: The number of items to show per page (scroll).
+    page_size = 10
+
+    # The frontend can ask for a different page size with ?limit=, up to max_page_size.
+    page_size_query_param = 'limit'
+    max_page_size = 50
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # As CursorPagination.paginate_queryset, with the position filtered on both ordering fields.
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.cursor = self.decode_cursor(request)
+        offset, reverse, current_position = self.cursor or (0, False, None)
+
+        if reverse:
+            queryset = queryset.order_by('timestamp', 'id')
+        else:
+            queryset = queryset.order_by(*self.ordering)
+        if current_position is not None:
+            queryset = queryset.filter(self._after_position(self.cursor))
+
+        # One extra row tells whether a page follows.
+        results = list(queryset[offset:offset + self.page_size + 1])
+        self.page = results[:self.page_size]
+        following_position = (
+            self._get_position_from_instance(results[-1], self.ordering) if len(results) > len(self.page) else None
+        )
+
+        if reverse:
+            self.page.reverse()
+            self.has_next = current_position is not None or offset > 0
+            self.has_previous = following_position is not None
+            self.next_position, self.previous_position = current_position, following_position
+        else:
+            self.has_next = following_position is not None
+            self.has_previous = current_position is not None or offset > 0
+            self.next_position, self.previous_position = following_position, current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+        return self.page
+
+    def _after_position(self, cursor):
+        """
+        Returns the filter of the rows after the position of `cursor` in the (reversed, for a previous page) ordering.
+        """
+        timestamp, _, pk = cursor.position.rpartition('|')
+        timestamp = parse_datetime(timestamp)
+        if timestamp is None or not pk.isdigit():
+            raise NotFound(self.invalid_cursor_message)
+        lookup = 'gt' if cursor.reverse else 'lt'
+        return Q(**{f'timestamp__{lookup}': timestamp}) | Q(timestamp=timestamp, **{f'id__{lookup}': int(pk)})
+
+    def _get_position_from_instance(self, instance, ordering):
+        return f"{instance.timestamp.isoformat()}|{instance.pk}"
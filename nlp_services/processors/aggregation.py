@@ -0,0 +1,102 @@
+"""
+Helpers for map-reduce aggregate sentiment analysis.
+
+Large comment sets are split into token-budgeted chunks (map), each chunk is
+analyzed on its own, and the partial results are merged (reduce) without
+another LLM call.
+"""
+from collections import Counter
+
+from nlp_services.cache_keys import text_fingerprint
+
+
+# Number of key positives/negatives kept in a merged result.
+MAX_KEY_POINTS = 5
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    A cheap, conservative token estimate (about 3 characters per token for Persian text).
+    """
+    return len(text) // 3 + 1
+
+
+def split_into_chunks(texts: list, max_tokens: int, target_chunk_texts: int) -> list:
+    """
+    Splits texts into chunks of at most `max_tokens` estimated tokens and about
+    `target_chunk_texts` texts each.
+
+    Chunk boundaries are content-defined: texts are ordered by their hash and a
+    chunk ends after any text whose hash is divisible by `target_chunk_texts`
+    (once the chunk holds a quarter of the target, to avoid tiny chunks).
+    Adding or removing a few texts therefore only changes the chunks they fall
+    into, and every other chunk (and its cached result) stays the same.
+    """
+    ordered = sorted(texts, key=text_fingerprint)
+    min_chunk_texts = max(1, target_chunk_texts // 4)
+
+    chunks = []
+    current, current_tokens = [], 0
+    for text in ordered:
+        tokens = estimate_tokens(text)
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(current)
+            current, current_tokens = [], 0
+
+        current.append(text)
+        current_tokens += tokens
+
+        if len(current) >= min_chunk_texts and int(text_fingerprint(text)[:8], 16) % target_chunk_texts == 0:
+            chunks.append(current)
+            current, current_tokens = [], 0
+
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _sentiment_from_score(score: int) -> str:
+    if score >= 70:
+        return "POSITIVE"
+    if score <= 40:
+        return "NEGATIVE"
+    return "MIXED"
+
+
+def merge_aggregate_results(partials: list) -> dict:
+    """
+    Merges partial aggregate results into one result.
+    `partials` is a list of (result, weight) pairs, where weight is the number of texts
+    the result covers. Scores are averaged by weight and key points are ranked by how
+    many texts they were reported for.
+    """
+    total_weight = sum(weight for _, weight in partials) or 1
+
+    satisfaction_score = round(
+        sum(result.get('satisfaction_score', 0) * weight for result, weight in partials) / total_weight
+    )
+
+    positives, negatives = Counter(), Counter()
+    for result, weight in partials:
+        for point in result.get('key_positives', []):
+            positives[point] += weight
+        for point in result.get('key_negatives', []):
+            negatives[point] += weight
+
+    sentiments = {result.get('overall_sentiment') for result, _ in partials}
+    overall_sentiment = sentiments.pop() if len(sentiments) == 1 else _sentiment_from_score(satisfaction_score)
+
+    # Keep the summaries of the largest chunks, without repeating identical ones.
+    summaries = []
+    for result, _ in sorted(partials, key=lambda partial: partial[1], reverse=True):
+        summary = result.get('summary', '').strip()
+        if summary and summary not in summaries:
+            summaries.append(summary)
+
+    return {
+        "overall_sentiment": overall_sentiment,
+        "satisfaction_score": satisfaction_score,
+        "key_positives": [point for point, _ in positives.most_common(MAX_KEY_POINTS)],
+        "key_negatives": [point for point, _ in negatives.most_common(MAX_KEY_POINTS)],
+        "summary": " ".join(summaries[:3]),
+    }
@@ -0,0 +1,141 @@
+"""
+Errors of the upstream LLM calls.
+
+Providers raise (or convert their client's exceptions to) one of these classes,
+so the processor layers can tell failures apart without knowing the provider:
+
+    ProviderError               any failed call; not retried
+        ProviderBadRequest      the provider refused the request (4xx); not retried
+        ProviderResponseError   the answer could not be parsed; retried, another answer may parse
+        ProviderUnavailable     the provider could not be reached or failed (5xx); retried
+            ProviderTimeout     the call took too long; retried
+            CircuitOpen         not sent: the provider is considered down (see resilience.py)
+        ProviderRateLimited     rejected by the provider's rate limit (see rate_limit.py)
+        LowConfidence           a local model is not sure of its answer; escalated to the next backend
+        UnsupportedTask         the backend does not offer this kind of call; sent to the next backend
+"""
+import asyncio
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    from google.api_core import exceptions as google_exceptions
+except ImportError:
+    google_exceptions = None
+
+
+class ProviderError(Exception):
+    """
+    Raised when an upstream call failed. `retryable` tells whether sending the same call again may succeed.
+    """
+    retryable = False
+
+    def __init__(self, message: str = "The AI provider call failed.", retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ProviderBadRequest(ProviderError):
+    retryable = False
+
+
+class ProviderResponseError(ProviderError):
+    retryable = True
+
+
+class ProviderUnavailable(ProviderError):
+    retryable = True
+
+
+class ProviderTimeout(ProviderUnavailable):
+    retryable = True
+
+
+class CircuitOpen(ProviderUnavailable):
+    # Failing fast is the point: the call is not retried until the breaker lets calls through again.
+    retryable = False
+
+
+class ProviderRateLimited(ProviderError):
+    """
+    Raised when a call was rejected by the provider's rate limit, or could not
+    be admitted before its deadline. `retry_after` is a hint in seconds, or None.
+    Retries are left to the admission control, which knows when calls are accepted again.
+    """
+    retryable = False
+
+    def __init__(self, message: str = "The AI provider is rate limiting requests. Please retry later.", retry_after: float = None):
+        super().__init__(message, retry_after=retry_after)
+
+
+class LowConfidence(ProviderError):
+    """
+    Raised by a local model (see InternalProcessor) when its confidence in an answer
+    is below the threshold. `result` holds that answer; the router sends the call
+    on to the next backend and only falls back to `result` when none can answer.
+    """
+    retryable = False
+
+    def __init__(self, message: str = "The internal model is not confident about this text.", result: dict = None):
+        super().__init__(message)
+        self.result = result
+
+
+class UnsupportedTask(ProviderError):
+    """
+    Raised by a backend asked for a call it does not offer (e.g. a summary from
+    a sentiment-only model). Unlike ProviderBadRequest it says nothing about the
+    request itself, so the router sends the call on to the next backend.
+    """
+    retryable = False
+
+
+# By name, e.g. to raise an error again in another process.
+PROVIDER_ERRORS = {
+    error_class.__name__: error_class
+    for error_class in (
+        ProviderError, ProviderBadRequest, ProviderResponseError, ProviderUnavailable,
+        ProviderTimeout, CircuitOpen, ProviderRateLimited, LowConfidence, UnsupportedTask,
+    )
+}
+
+
+def classify_error(error: Exception, message: str = None) -> ProviderError:
+    """
+    Returns the ProviderError matching an exception raised by a provider's client.
+    ProviderErrors are returned as they are.
+    """
+    if isinstance(error, ProviderError):
+        return error
+    message = message or str(error)
+
+    if isinstance(error, asyncio.TimeoutError):
+        return ProviderTimeout(message)
+    if isinstance(error, ConnectionError):
+        return ProviderUnavailable(message)
+
+    if httpx is not None:
+        if isinstance(error, httpx.TimeoutException):
+            return ProviderTimeout(message)
+        if isinstance(error, httpx.TransportError):
+            return ProviderUnavailable(message)
+        if isinstance(error, httpx.HTTPStatusError):
+            if error.response.status_code >= 500:
+                return ProviderUnavailable(message)
+            return ProviderBadRequest(message)
+
+    if google_exceptions is not None:
+        if isinstance(error, google_exceptions.DeadlineExceeded):
+            return ProviderTimeout(message)
+        if isinstance(error, google_exceptions.ServerError):
+            return ProviderUnavailable(message)
+        if isinstance(error, google_exceptions.ClientError):
+            return ProviderBadRequest(message)
+
+    # Includes json.JSONDecodeError: the model did not answer in the expected format.
+    if isinstance(error, (ValueError, KeyError, TypeError)):
+        return ProviderResponseError(message)
+    return ProviderError(message)
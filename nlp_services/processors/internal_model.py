@@ -0,0 +1,239 @@
+"""
+A small CPU sentiment model for short Persian texts.
+
+Texts are normalized (Arabic letter forms, diacritics, digits and half-spaces)
+and split into tokens. Every token the lexicon knows has a weight; a negation
+flips the weights of the tokens around it (e.g. «خوب نیست», «بدون مشکل») and an
+intensifier («خیلی», «واقعا») strengthens the next token.
+
+A batch of texts is scored at once with NumPy: the tokens of all texts are
+mapped to lexicon indices in one flat array, the negations and intensifiers
+are applied as vectorized multipliers and the weights are summed per text with
+np.bincount. The score of a text is tanh(sum / sqrt(tokens)). Its confidence
+is the strength of that score, scaled down when the text has fewer sentiment
+words than `min_evidence`; InternalProcessor leaves texts below its confidence
+threshold to an LLM backend.
+
+Extra or corrected lexicon entries can be loaded from a file with one
+"<word>\\t<weight>" per line (NLP_INTERNAL_MODEL['lexicon_path']).
+"""
+import hashlib
+import itertools
+import re
+
+from django.conf import settings
+
+try:
+    import numpy as np
+except ImportError:
+    # Optional dependency: without it the internal model backend is not available.
+    np = None
+
+
+DEFAULT_INTERNAL_MODEL = {
+    'confidence_threshold': 0.6,
+    'min_evidence': 1,
+    'intensity': 1.5,
+    'lexicon_path': None,
+}
+
+POSITIVE_WORDS = {
+    # Strong
+    'عالی': 2.0, 'عالیه': 2.0, 'عالیست': 2.0, 'فوقالعاده': 2.0, 'محشر': 2.0, 'بینظیر': 2.0,
+    'بهترین': 2.0, 'عاشق': 2.0, 'عاشقشم': 2.0, 'معرکه': 2.0, 'درجهیک': 2.0, 'perfect': 2.0, 'excellent': 2.0,
+    # Mild
+    'خوب': 1.0, 'خوبه': 1.0, 'خوبی': 1.0, 'بهتر': 1.0, 'راضی': 1.5, 'رضایت': 1.5, 'ممنون': 1.0,
+    'ممنونم': 1.0, 'مرسی': 1.0, 'سپاس': 1.0, 'متشکرم': 1.0, 'دوست': 1.0, 'زیبا': 1.0, 'قشنگ': 1.0,
+    'قشنگه': 1.0, 'سریع': 1.0, 'باکیفیت': 1.5, 'ارزان': 1.0, 'ارزون': 1.0, 'ارزش': 1.0, 'پیشنهاد': 1.0,
+    'توصیه': 1.0, 'خوشحال': 1.5, 'لذت': 1.5, 'شیک': 1.0, 'مناسب': 1.0, 'راحت': 1.0, 'تمیز': 1.0,
+    'سالم': 1.0, 'اصل': 1.0, 'بهموقع': 1.0, 'دقیق': 1.0, 'مفید': 1.0, 'حرفهای': 1.0, 'خوشمزه': 1.5,
+    'good': 1.0, 'great': 1.5, 'love': 1.5, 'like': 1.0, 'nice': 1.0, 'thanks': 1.0,
+}
+
+NEGATIVE_WORDS = {
+    # Strong
+    'افتضاح': -2.0, 'افتضاحه': -2.0, 'بدترین': -2.0, 'مزخرف': -2.0, 'آشغال': -2.0, 'داغون': -2.0,
+    'کلاهبرداری': -2.0, 'کلاهبردار': -2.0, 'تقلبی': -2.0, 'فاجعه': -2.0, 'terrible': -2.0, 'awful': -2.0,
+    # Mild
+    'بد': -1.0, 'بده': -1.0, 'بدی': -1.0, 'بدتر': -1.0, 'ضعیف': -1.0, 'خراب': -1.5, 'خرابه': -1.5,
+    'ناراضی': -1.5, 'کند': -1.0, 'دیر': -1.0, 'گران': -1.0, 'گرون': -1.0, 'کثیف': -1.5, 'شکسته': -1.5,
+    'معیوب': -1.5, 'مشکل': -1.0, 'ایراد': -1.0, 'متاسفانه': -1.0, 'نامناسب': -1.0, 'زشت': -1.0,
+    'ناامید': -1.5, 'پشیمان': -1.5, 'پشیمونم': -1.5, 'بیکیفیت': -1.5, 'بیارزش': -1.5, 'ناقص': -1.0,
+    'تاخیر': -1.0, 'عصبانی': -1.5, 'شکایت': -1.0, 'ضرر': -1.0, 'بدقول': -1.5, 'bad': -1.0, 'poor': -1.0,
+    'broken': -1.5, 'slow': -1.0,
+}
+
+# «خوب نیست», «دوست ندارم»: flip the tokens before them.
+NEGATE_PREVIOUS_WORDS = {
+    'نیست', 'نیستم', 'نیستن', 'نبود', 'نبودن', 'ندارد', 'نداره', 'ندارم', 'نداشت', 'نداشتم', 'نشد',
+    'نشده', 'نکرد', 'نکرده', 'نمیشه', 'نمیکنه', 'نمیکنم',
+}
+# «نه خوب», «بدون مشکل», and English negations («not good»): flip the tokens after them.
+# Contractions are split by the tokenizer («isn't» is «isn», «t»), so their first part is listed.
+NEGATE_NEXT_WORDS = {
+    'نه', 'هیچ', 'بدون', 'بی', 'no', 'not', 'never', 'nothing', 'without',
+    'don', 'doesn', 'didn', 'isn', 'wasn', 'aren', 'weren', 'won', 'cannot',
+}
+INTENSIFIER_WORDS = {'خیلی', 'بسیار', 'واقعا', 'کاملا', 'اصلا', 'بینهایت', 'very', 'really'}
+QUESTION_TOKENS = {'?', '؟', 'آیا', 'چرا', 'چطور', 'چگونه', 'کی', 'کجا'}
+
+# How many tokens before or after a negation it flips.
+NEGATION_WINDOW = 2
+
+# Token kinds, besides the lexicon weight of a token.
+PLAIN, NEGATE_PREVIOUS, NEGATE_NEXT, INTENSIFIER, QUESTION = range(5)
+
+CHARACTER_MAP = str.maketrans({
+    'ي': 'ی', 'ى': 'ی', 'ئ': 'ی', 'ك': 'ک', 'ة': 'ه', 'ؤ': 'و', 'أ': 'ا', 'إ': 'ا', 'ٱ': 'ا',
+    **{chr(0x06F0 + digit): str(digit) for digit in range(10)},
+    **{chr(0x0660 + digit): str(digit) for digit in range(10)},
+    # Half-spaces are dropped, so «فوق‌العاده» and «فوقالعاده» are the same token.
+    '‌': None, '‏': None, 'ـ': None,
+})
+DIACRITICS_PATTERN = re.compile(r'[ً-ٰٟ]')
+TOKEN_PATTERN = re.compile(r'\w+|[?؟]')
+
+
+def internal_model_settings() -> dict:
+    return {**DEFAULT_INTERNAL_MODEL, **getattr(settings, 'NLP_INTERNAL_MODEL', {})}
+
+
+def normalize_persian(text: str) -> str:
+    return DIACRITICS_PATTERN.sub('', text.translate(CHARACTER_MAP)).lower()
+
+
+def tokenize(text: str) -> list:
+    return TOKEN_PATTERN.findall(normalize_persian(text))
+
+
+def load_lexicon(path: str) -> dict:
+    """
+    Reads "<word>\\t<weight>" lines; empty lines and lines starting with # are skipped.
+    """
+    lexicon = {}
+    with open(path, encoding='utf-8') as lexicon_file:
+        for line in lexicon_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            word, weight = line.rsplit('\t', 1)
+            lexicon[word] = float(weight)
+    return lexicon
+
+
+class InternalSentimentModel:
+    """
+    Lexicon model with negation and intensifiers, scored a batch at a time with NumPy.
+    """
+
+    def __init__(self, lexicon: dict = None, intensity: float = 1.5, min_evidence: float = 1):
+        if np is None:
+            raise ImportError("The internal sentiment model needs the numpy package.")
+        lexicon = {**POSITIVE_WORDS, **NEGATIVE_WORDS, **(lexicon or {})}
+        self.intensity = intensity
+        self.min_evidence = min_evidence
+
+        # Index 0 stands for every unknown token.
+        self.index = {}
+        weights, kinds = [0.0], [PLAIN]
+        entries = [(word, weight, PLAIN) for word, weight in lexicon.items()]
+        entries += [(word, 0.0, NEGATE_PREVIOUS) for word in NEGATE_PREVIOUS_WORDS]
+        entries += [(word, 0.0, NEGATE_NEXT) for word in NEGATE_NEXT_WORDS]
+        entries += [(word, 0.0, INTENSIFIER) for word in INTENSIFIER_WORDS]
+        entries += [(word, 0.0, QUESTION) for word in QUESTION_TOKENS]
+        for word, weight, kind in entries:
+            word = normalize_persian(word)
+            if word not in self.index:
+                self.index[word] = len(weights)
+                weights.append(weight)
+                kinds.append(kind)
+            else:
+                weights[self.index[word]] = weight or weights[self.index[word]]
+        self.weights = np.array(weights, dtype=np.float64)
+        self.kinds = np.array(kinds, dtype=np.int8)
+
+        digest = hashlib.sha256(repr(sorted(lexicon.items())).encode('utf-8')).hexdigest()
+        # Part of the cache keys: another lexicon is another model.
+        self.name = f"lexicon-{digest[:8]}"
+
+    @classmethod
+    def from_settings(cls):
+        options = internal_model_settings()
+        lexicon = load_lexicon(options['lexicon_path']) if options['lexicon_path'] else None
+        return cls(lexicon, intensity=options['intensity'], min_evidence=options['min_evidence'])
+
+    def _token_ids(self, text: str) -> list:
+        index = self.index
+        ids = []
+        for token in tokenize(text):
+            token_id = index.get(token, 0)
+            if token_id == 0 and token.startswith('نمی'):
+                # Negated present tense verbs («نمیخرم», «نمیارزه»).
+                token_id = index['نمیشه']
+            ids.append(token_id)
+        return ids
+
+    def score(self, texts: list) -> tuple:
+        """
+        Scores a batch of texts and returns the arrays (scores, confidence, evidence, questions):
+        the score in [-1, 1], the confidence in [0, 1], and the numbers of sentiment words
+        and question marks or words of each text.
+        """
+        token_ids = [self._token_ids(text) for text in texts]
+        lengths = np.fromiter((len(ids) for ids in token_ids), dtype=np.int64, count=len(texts))
+        flat = np.fromiter(itertools.chain.from_iterable(token_ids), dtype=np.int64, count=int(lengths.sum()))
+        # The position in `texts` of every token.
+        owner = np.repeat(np.arange(len(texts)), lengths)
+
+        weights = self.weights[flat]
+        kinds = self.kinds[flat]
+        factors = np.ones_like(weights)
+        modifiers = (
+            (NEGATE_PREVIOUS, range(-NEGATION_WINDOW, 0), -1.0),
+            (NEGATE_NEXT, range(1, NEGATION_WINDOW + 1), -1.0),
+            (INTENSIFIER, (1,), self.intensity),
+        )
+        for kind, offsets, factor in modifiers:
+            positions = np.flatnonzero(kinds == kind)
+            for offset in offsets:
+                targets = positions + offset
+                # Only tokens of the same text are modified.
+                inside = (targets >= 0) & (targets < len(flat))
+                inside[inside] &= owner[targets[inside]] == owner[positions[inside]]
+                np.multiply.at(factors, targets[inside], factor)
+
+        totals = np.bincount(owner, weights=weights * factors, minlength=len(texts))
+        evidence = np.bincount(owner, weights=weights != 0, minlength=len(texts))
+        questions = np.bincount(owner, weights=kinds == QUESTION, minlength=len(texts))
+
+        scores = np.tanh(totals / np.sqrt(np.maximum(lengths, 1)))
+        confidence = np.abs(scores) * np.minimum(evidence / self.min_evidence, 1.0)
+        return scores, confidence, evidence, questions
+
+    def predict(self, texts: list, analysis_type: str = 'general_sentiment') -> list:
+        """
+        Returns a (result, confidence) pair per text, where the result has the
+        format of the LLM answers: {"sentiment", "score", "notes"}.
+        """
+        if not texts:
+            return []
+        scores, confidence, evidence, questions = self.score(texts)
+        labels = np.where(scores > 0, 'POSITIVE', np.where(scores < 0, 'NEGATIVE', 'NEUTRAL'))
+
+        if analysis_type == 'business_intent':
+            labels = np.select(
+                [questions > 0, labels == 'POSITIVE', labels == 'NEGATIVE'],
+                ['INQUIRY', 'SATISFIED', 'DISSATISFIED'],
+                default='OTHER',
+            )
+            # A question with a strong sentiment may as well be a complaint.
+            confidence = np.where(questions > 0, 1.0 - np.abs(scores), confidence)
+
+        return [
+            ({
+                "sentiment": str(label),
+                "score": round(float(text_confidence), 2),
+                "notes": f"Scored by the internal model from {int(words)} sentiment word(s).",
+            }, float(text_confidence))
+            for label, text_confidence, words in zip(labels, confidence, evidence)
+        ]
@@ -1,20 +1,58 @@
 import os
 import json
+import random
+import time
+import uuid
+import weakref
 from abc import ABC, abstractmethod 
 import google.generativeai as genai # Only Google's library is needed now
+from google.api_core import exceptions as google_exceptions
 from django.conf import settings 
+from django.core.cache import cache
 import asyncio 
-from .prompts import GEMINI_PROMPTS # Import only the Gemini prompts
+from .prompts import GEMINI_PROMPTS, GEMINI_PROMPTS_AGGREGATE, PROMPT_VERSION # Import only the Gemini prompts
+from .aggregation import split_into_chunks, merge_aggregate_results
+from .transport import get_transport, httpx
+from .errors import (
+    PROVIDER_ERRORS, LowConfidence, ProviderError, ProviderBadRequest, ProviderRateLimited, ProviderResponseError,
+    ProviderTimeout, ProviderUnavailable, UnsupportedTask, classify_error,
+)
+from .internal_model import InternalSentimentModel, internal_model_settings, np
+from .rate_limit import UpstreamLimiter, RATE_LIMIT_STATUSES, UNAVAILABLE_STATUSES, parse_retry_after
+from .resilience import ResiliencePolicy
+from .routing import Backend, CostBudget, preferred_tier, record_served, routing_fingerprint, routing_settings
+from nlp_services.cache_keys import (
+    processor_identity,
+    text_fingerprint,
+    sentiment_result_key,
+    summarization_result_key,
+    aggregate_result_key,
+    texts_fingerprint,
+    RESULT_CACHE_TIMEOUT,
+)
+from nlp_services.result_cache import result_cache
 
 
 # --- 1. Base Class (Your original structure, UNCHANGED for future use) ---
 class BaseLLMProcessor(ABC): 
     _instances = {} 
 
+    # Identifies the prompt templates used by this processor (part of the cache keys).
+    prompt_version = PROMPT_VERSION
+
+    # True when sentiment calls are packed into batched upstream calls (see MicroBatchingProcessor).
+    batches_sentiment = False
+
     def __new__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = super().__new__(cls)
-        return cls._instances[cls]
+        key = cls._instance_key(*args, **kwargs)
+        if key not in cls._instances:
+            cls._instances[key] = super().__new__(cls)
+        return cls._instances[key]
+
+    @classmethod
+    def _instance_key(cls, *args, **kwargs):
+        # One instance per class.
+        return cls
 
     @abstractmethod
     def __init__(self, api_key: str): 
@@ -32,10 +70,29 @@ class BaseLLMProcessor(ABC):
     async def analyze_sentiment(self, text: str, analysis_type: str) -> dict:
         pass
 
+    async def analyze_sentiment_batch(self, texts: list, analysis_type: str) -> list:
+        """
+        Analyzes several texts and returns one result per text, in input order.
+        An item is the raised exception instead of a result when that text failed.
+        This default makes one call per text; providers can override it with a batched prompt.
+        """
+        return await asyncio.gather(
+            *(self.analyze_sentiment(text, analysis_type) for text in texts),
+            return_exceptions=True
+        )
+
     @abstractmethod
     async def summarize_text(self, text: str, max_words: int) -> str:
         pass
 
+    async def stream_summarize_text(self, text: str, max_words: int):
+        """
+        Yields the summary in pieces as the model generates them.
+        This default yields the complete summary at once; providers with a
+        streaming API override it.
+        """
+        yield await self.summarize_text(text, max_words)
+
     @abstractmethod
     async def analyze_aggregate_sentiment(self, texts: list, analysis_type: str) -> dict:
         pass
@@ -44,20 +101,129 @@ class BaseLLMProcessor(ABC):
 # --- 2. Concrete Class for Google Gemini ---
 
 class GeminiProcessor(BaseLLMProcessor):
+    """
+    Calls the Gemini REST API through the pooled transport (see transport.py).
+    Without httpx installed, the google-generativeai client is used instead.
+    """
     _initialized_concrete = False
 
+    @classmethod
+    def _instance_key(cls, api_key: str = None, model_name: str = "gemini-1.5-pro-latest"):
+        # One instance per model, so that calls can be routed between several models.
+        return (cls, model_name)
+
     def __init__(self, api_key: str, model_name: str = "gemini-1.5-pro-latest"):
         # This method initializes the Gemini client.
-        if not GeminiProcessor._initialized_concrete:
+        if not self._initialized_concrete:
             if not api_key:
                 raise ValueError("API key must be provided for GeminiProcessor.")
-            
-            genai.configure(api_key=api_key)
-            self.model = genai.GenerativeModel(model_name)
+
+            self.api_key = api_key
+            self.base_url = getattr(settings, 'GEMINI_API_BASE_URL', 'https://generativelanguage.googleapis.com').rstrip('/')
+            if httpx is not None:
+                self.transport = get_transport()
+                self.model = None
+            else:
+                self.transport = None
+                genai.configure(api_key=api_key)
+                self.model = genai.GenerativeModel(model_name)
             self.provider_name = "gemini"
             self.default_model = model_name
-            GeminiProcessor._initialized_concrete = True
-            print("GeminiProcessor client initialized successfully.")
+            self._initialized_concrete = True
+            print(f"GeminiProcessor client for {model_name} initialized successfully.")
+
+    # --- Transport ---
+
+    def _endpoint(self, method: str) -> str:
+        return f"{self.base_url}/v1beta/models/{self.default_model}:{method}"
+
+    @staticmethod
+    def _request_body(prompt: str) -> dict:
+        return {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+
+    @staticmethod
+    def _candidate_text(data: dict) -> str:
+        candidates = data.get("candidates") or []
+        if not candidates:
+            reason = (data.get("promptFeedback") or {}).get("blockReason", "no candidates returned")
+            raise ProviderBadRequest(f"Gemini returned no answer: {reason}")
+        parts = (candidates[0].get("content") or {}).get("parts") or []
+        return "".join(part.get("text", "") for part in parts)
+
+    @staticmethod
+    def _raise_for_status(response):
+        """
+        Raises ProviderRateLimited for rate limit rejections, ProviderUnavailable for
+        outages (both with the provider's retry delay) and httpx.HTTPStatusError for other errors.
+        """
+        if response.status_code in RATE_LIMIT_STATUSES + UNAVAILABLE_STATUSES:
+            retry_after = parse_retry_after(response.headers.get("retry-after"))
+            if retry_after is None:
+                # Gemini sends the delay in the RetryInfo detail of the error body, e.g. "retryDelay": "13s".
+                try:
+                    details = response.json().get("error", {}).get("details", [])
+                    delays = [detail["retryDelay"] for detail in details if "retryDelay" in detail]
+                    retry_after = parse_retry_after(delays[0].rstrip("s")) if delays else None
+                except (ValueError, AttributeError, TypeError):
+                    pass
+            message = f"Gemini API returned HTTP {response.status_code}."
+            if response.status_code in UNAVAILABLE_STATUSES:
+                raise ProviderUnavailable(message, retry_after=retry_after)
+            raise ProviderRateLimited(message, retry_after=retry_after)
+        response.raise_for_status()
+
+    async def _generate(self, prompt: str) -> str:
+        """
+        Sends one prompt and returns the text of the answer.
+        """
+        if self.transport is None:
+            try:
+                response = await self.model.generate_content_async(prompt)
+            except google_exceptions.ResourceExhausted as e:
+                raise ProviderRateLimited(str(e)) from e
+            except google_exceptions.ServiceUnavailable as e:
+                raise ProviderUnavailable(str(e)) from e
+            return response.text
+
+        response = await self.transport.request(
+            "POST", self._endpoint("generateContent"),
+            headers={"x-goog-api-key": self.api_key},
+            json=self._request_body(prompt),
+        )
+        self._raise_for_status(response)
+        return self._candidate_text(response.json())
+
+    async def _stream_generate(self, prompt: str):
+        """
+        Sends one prompt and yields the text of the answer as it is generated.
+        """
+        if self.transport is None:
+            try:
+                response = await self.model.generate_content_async(prompt, stream=True)
+            except google_exceptions.ResourceExhausted as e:
+                raise ProviderRateLimited(str(e)) from e
+            except google_exceptions.ServiceUnavailable as e:
+                raise ProviderUnavailable(str(e)) from e
+            async for chunk in response:
+                if chunk.text:
+                    yield chunk.text
+            return
+
+        async with self.transport.stream(
+            "POST", self._endpoint("streamGenerateContent"),
+            params={"alt": "sse"},
+            headers={"x-goog-api-key": self.api_key},
+            json=self._request_body(prompt),
+        ) as response:
+            if response.is_error:
+                await response.aread()
+                self._raise_for_status(response)
+            async for line in response.aiter_lines():
+                # Server-sent events: every 'data:' line holds one partial answer.
+                if line.startswith("data:"):
+                    text = self._candidate_text(json.loads(line[len("data:"):]))
+                    if text:
+                        yield text
 
     async def analyze_sentiment(self, text: str, analysis_type: str = "general_sentiment") -> dict:
         # --- LOGIC TO CHOOSE PROMPT BASED ON analysis_type ---
@@ -69,19 +235,55 @@ class GeminiProcessor(BaseLLMProcessor):
         final_prompt = prompt_template.format(text=text)
         
         try:
-            response = await self.model.generate_content_async(final_prompt)
-            response_text = response.text.strip()
+            response_text = await self._generate(final_prompt)
+            result = self._parse_json_response(response_text)
+            return result
 
+        except ProviderError:
+            raise
 
-            if response_text.startswith("```json"):
-                response_text = response_text.strip("```json").strip("```").strip()
+        except Exception as e:
+            print(f"Error calling Gemini API for sentiment analysis: {e}")
+            raise classify_error(e, f"Gemini API sentiment analysis call failed: {e}") from e
 
-            result = json.loads(response_text)
-            return result
+    async def analyze_sentiment_batch(self, texts: list, analysis_type: str = "general_sentiment") -> list:
+        """
+        Analyzes all texts with one prompt that returns a JSON array.
+        If the reply cannot be parsed into one result per text, falls back to one call per text.
+        """
+        if analysis_type == 'business_intent':
+            prompt_template = GEMINI_PROMPTS["sentiment_batch_template_business"]
+        else:
+            prompt_template = GEMINI_PROMPTS["sentiment_batch_template_general"]
+
+        final_prompt = prompt_template.format(count=len(texts), texts=json.dumps(texts, ensure_ascii=False))
 
+        try:
+            response_text = await self._generate(final_prompt)
+        except ProviderError:
+            raise
         except Exception as e:
-            print(f"Error calling Gemini API for sentiment analysis: {e}")
-            raise Exception(f"Gemini API sentiment analysis call failed: {e}")
+            print(f"Error calling Gemini API for batched sentiment analysis: {e}")
+            raise classify_error(e, f"Gemini API sentiment analysis call failed: {e}") from e
+
+        try:
+            results = self._parse_json_response(response_text)
+            if not isinstance(results, list) or len(results) != len(texts):
+                raise ValueError(f"expected a JSON array of {len(texts)} results")
+            if not all(isinstance(result, dict) and 'sentiment' in result for result in results):
+                raise ValueError("every result must be an object with a 'sentiment' field")
+            return results
+        except ValueError as e: # json.JSONDecodeError is a ValueError too
+            print(f"Could not parse batched sentiment response ({e}). Falling back to one call per text.")
+            return await super().analyze_sentiment_batch(texts, analysis_type)
+
+    def _parse_json_response(self, response_text: str):
+        response_text = response_text.strip()
+
+        if response_text.startswith("```json"):
+            response_text = response_text.strip("```json").strip("```").strip()
+
+        return json.loads(response_text)
 
     async def summarize_text(self, text: str, max_words: int) -> str:
         # This method also reads its prompt from your prompts.py file.
@@ -89,11 +291,47 @@ class GeminiProcessor(BaseLLMProcessor):
         final_prompt = prompt_template.format(text=text, max_words=max_words)
         
         try:
-            response = await self.model.generate_content_async(final_prompt)
-            return response.text.strip()
+            response_text = await self._generate(final_prompt)
+            return response_text.strip()
+        except ProviderError:
+            raise
         except Exception as e:
             print(f"Error calling Gemini API for summarization: {e}")
-            raise Exception(f"Gemini API summarization call failed: {e}")
+            raise classify_error(e, f"Gemini API summarization call failed: {e}") from e
+
+    async def stream_summarize_text(self, text: str, max_words: int):
+        """
+        Yields the summary text as Gemini streams it.
+        """
+        prompt_template = GEMINI_PROMPTS["summarization_template"]
+        final_prompt = prompt_template.format(text=text, max_words=max_words)
+
+        try:
+            async for text in self._stream_generate(final_prompt):
+                yield text
+        except ProviderError:
+            raise
+        except Exception as e:
+            print(f"Error calling Gemini API for streaming summarization: {e}")
+            raise classify_error(e, f"Gemini API summarization call failed: {e}") from e
+
+    async def analyze_aggregate_sentiment(self, texts: list, analysis_type: str) -> dict:
+        if analysis_type == 'business_intent':
+            prompt_template = GEMINI_PROMPTS_AGGREGATE["aggregate_sentiment_business"]
+        else:
+            prompt_template = GEMINI_PROMPTS_AGGREGATE["aggregate_sentiment_general"]
+
+        comments = "\n".join(f"{number}. {text}" for number, text in enumerate(texts, start=1))
+        final_prompt = prompt_template.format(texts=comments)
+
+        try:
+            response_text = await self._generate(final_prompt)
+            return self._parse_json_response(response_text)
+        except ProviderError:
+            raise
+        except Exception as e:
+            print(f"Error calling Gemini API for aggregate sentiment analysis: {e}")
+            raise classify_error(e, f"Gemini API aggregate sentiment analysis call failed: {e}") from e
 
 
 class MockProcessor(BaseLLMProcessor):
@@ -107,6 +345,7 @@ class MockProcessor(BaseLLMProcessor):
         # The init method for the mock processor doesn't need to do much.
         if not MockProcessor._initialized_concrete:
             self.provider_name = "mock"
+            self.default_model = "mock"
             MockProcessor._initialized_concrete = True
             print("MockProcessor client initialized successfully.")
 
@@ -133,6 +372,27 @@ class MockProcessor(BaseLLMProcessor):
                 "notes": "This is a mock response for a general sentiment analysis."
             }
 
+    async def analyze_sentiment_batch(self, texts: list, analysis_type: str = "general_sentiment") -> list:
+        """
+        Simulates a batched sentiment call: one delay for the whole batch.
+        """
+        print(f"--- MOCK: Analyzing sentiment for a batch of {len(texts)} texts with type: {analysis_type} ---")
+        await asyncio.sleep(0.5)
+
+        if analysis_type == 'business_intent':
+            result = {
+                "sentiment": "SATISFIED",
+                "score": 0.95,
+                "notes": "This is a mock response for a business intent analysis."
+            }
+        else:
+            result = {
+                "sentiment": "POSITIVE",
+                "score": 0.98,
+                "notes": "This is a mock response for a general sentiment analysis."
+            }
+        return [dict(result) for _ in texts]
+
     async def summarize_text(self, text: str, max_words: int) -> str:
         """
         Simulates a successful summarization API call.
@@ -144,6 +404,17 @@ class MockProcessor(BaseLLMProcessor):
         
         return f"This is a mock summary for the input text with a length of about {max_words} words."
 
+    async def stream_summarize_text(self, text: str, max_words: int):
+        """
+        Simulates a streamed summarization: the mock summary is yielded word by word.
+        """
+        print(f"--- MOCK: Streaming summary of text: '{text[:30]}...' ---")
+        summary = f"This is a mock summary for the input text with a length of about {max_words} words."
+        words = summary.split(" ")
+        for position, word in enumerate(words):
+            await asyncio.sleep(0.05)
+            yield word if position == len(words) - 1 else word + " "
+
     # --- ADD THIS NEW METHOD IMPLEMENTATION ---
     async def analyze_aggregate_sentiment(self, texts: list, analysis_type: str) -> dict:
         """
@@ -171,10 +442,836 @@ class MockProcessor(BaseLLMProcessor):
                 "summary": "Overall, 82% of the comments were evaluated as positive."
             }
 
-# --- Instance Creation (Directly creates the Gemini processor) ---
-# gemini_api_key = os.environ.get("GEMINI_API_KEY") or getattr(settings, 'GEMINI_API_KEY', None)
-# if not gemini_api_key:
-#     raise ValueError("Google Gemini API key (GEMINI_API_KEY) not found.")
 
-# Activate the mock processor
-processor_instance = MockProcessor(api_key="mock_key")
\ No newline at end of file
+# --- Fault-injecting mock processors ---
+# Drop-in replacements for MockProcessor that fail or stall some calls, to
+# exercise the resilience layers without a real provider
+# (see `python manage.py simulate_llm_faults`).
+
+class FaultInjectingMockProcessor(MockProcessor):
+    """
+    Base class of the fault-injecting mocks. `inject_fault(kind)` runs before
+    every call (and before the first piece of a stream) and may raise or stall.
+    """
+    _initialized_concrete = False
+
+    def __init__(self, api_key: str = "mock_key", seed: int = None, **options):
+        if not type(self)._initialized_concrete:
+            self.provider_name = "mock"
+            self.default_model = "mock"
+            self.random = random.Random(seed)
+            self.calls = 0
+            self.faults = 0
+            for name, value in options.items():
+                setattr(self, name, value)
+            type(self)._initialized_concrete = True
+            print(f"{type(self).__name__} client initialized successfully.")
+
+    async def inject_fault(self, kind: str):
+        pass
+
+    async def _before_call(self, kind: str):
+        self.calls += 1
+        await self.inject_fault(kind)
+
+    async def analyze_sentiment(self, text: str, analysis_type: str = "general_sentiment") -> dict:
+        await self._before_call('sentiment')
+        return await super().analyze_sentiment(text, analysis_type)
+
+    async def analyze_sentiment_batch(self, texts: list, analysis_type: str = "general_sentiment") -> list:
+        await self._before_call('sentiment_batch')
+        return await super().analyze_sentiment_batch(texts, analysis_type)
+
+    async def summarize_text(self, text: str, max_words: int) -> str:
+        await self._before_call('summarization')
+        return await super().summarize_text(text, max_words)
+
+    async def stream_summarize_text(self, text: str, max_words: int):
+        await self._before_call('summarization_stream')
+        async for piece in super().stream_summarize_text(text, max_words):
+            yield piece
+
+    async def analyze_aggregate_sentiment(self, texts: list, analysis_type: str) -> dict:
+        await self._before_call('aggregate')
+        return await super().analyze_aggregate_sentiment(texts, analysis_type)
+
+
+class FlakyMockProcessor(FaultInjectingMockProcessor):
+    """
+    Fails a share (`error_rate`) of the calls with a random retryable error.
+    """
+    _initialized_concrete = False
+    error_rate = 0.3
+
+    async def inject_fault(self, kind: str):
+        if self.random.random() < self.error_rate:
+            self.faults += 1
+            # Like a real provider error, the failure comes after about the latency of a call.
+            await asyncio.sleep(self.random.uniform(0.25, 0.75))
+            error = self.random.choice([ProviderUnavailable, ProviderTimeout, ProviderResponseError])
+            raise error(f"Injected {error.__name__} in a {kind} call.")
+
+
+class SlowMockProcessor(FaultInjectingMockProcessor):
+    """
+    Stalls a share (`slow_rate`) of the calls for `slow_delay` extra seconds (a long latency tail).
+    """
+    _initialized_concrete = False
+    slow_rate = 0.1
+    slow_delay = 5.0
+
+    async def inject_fault(self, kind: str):
+        if self.random.random() < self.slow_rate:
+            self.faults += 1
+            await asyncio.sleep(self.slow_delay)
+
+
+class OutageMockProcessor(FaultInjectingMockProcessor):
+    """
+    Fails every call with ProviderUnavailable while an outage started by start_outage() lasts.
+    """
+    _initialized_concrete = False
+    outage_until = 0.0
+
+    def start_outage(self, seconds: float):
+        self.outage_until = time.monotonic() + seconds
+
+    async def inject_fault(self, kind: str):
+        if time.monotonic() < self.outage_until:
+            self.faults += 1
+            raise ProviderUnavailable(f"Injected outage: the {kind} call could not connect.")
+
+
+# --- Internal model ---
+
+class InternalProcessor(BaseLLMProcessor):
+    """
+    Analyzes sentiment in-process with the lexicon model of internal_model.py,
+    without any network call, so short texts can be answered without the LLM.
+
+    Answers whose confidence is below NLP_INTERNAL_MODEL['confidence_threshold']
+    are raised as LowConfidence; the router then sends the text to the next
+    backend. Summaries and aggregates are left to the LLM backends: Backend.tasks
+    keeps them from being routed here, and a call that still arrives fails with
+    UnsupportedTask, which the router handles like any other backend's failure.
+    """
+    _initialized_concrete = False
+
+    def __init__(self, api_key: str = None):
+        if not InternalProcessor._initialized_concrete:
+            self.model = InternalSentimentModel.from_settings()
+            self.confidence_threshold = internal_model_settings()['confidence_threshold']
+            self.provider_name = "internal"
+            self.default_model = self.model.name
+            InternalProcessor._initialized_concrete = True
+            print(f"InternalProcessor initialized with model '{self.model.name}'.")
+
+    async def analyze_sentiment(self, text: str, analysis_type: str = "general_sentiment") -> dict:
+        result = (await self.analyze_sentiment_batch([text], analysis_type))[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    async def analyze_sentiment_batch(self, texts: list, analysis_type: str = "general_sentiment") -> list:
+        """
+        Scores the whole batch in one vectorized pass. Texts the model is not sure
+        about are LowConfidence items, carrying the model's answer.
+        """
+        return [
+            result if confidence >= self.confidence_threshold else LowConfidence(result=result)
+            for result, confidence in self.model.predict(texts, analysis_type)
+        ]
+
+    async def summarize_text(self, text: str, max_words: int) -> str:
+        raise UnsupportedTask("The internal model only analyzes sentiment.")
+
+    async def analyze_aggregate_sentiment(self, texts: list, analysis_type: str) -> dict:
+        raise UnsupportedTask("The internal model only analyzes sentiment.")
+
+
+# --- 3. Processor layers ---
+
+class ProcessorWrapper(BaseLLMProcessor):
+    """
+    Base class for layers that add behaviour around another processor.
+    Calls and attributes that a layer does not override go to the wrapped processor.
+    """
+
+    @classmethod
+    def _instance_key(cls, processor: BaseLLMProcessor, *args, **kwargs):
+        # One layer of each kind per wrapped processor, so that every backend has its own layers.
+        return (cls, processor)
+
+    def __init__(self, processor: BaseLLMProcessor):
+        self.processor = processor
+
+    def __getattr__(self, name):
+        # Expose provider_name, default_model, etc. of the wrapped processor.
+        if name == 'processor':
+            raise AttributeError(name)
+        return getattr(self.processor, name)
+
+    # Class attributes of BaseLLMProcessor would hide the wrapped values from __getattr__.
+    @property
+    def prompt_version(self):
+        return self.processor.prompt_version
+
+    @property
+    def batches_sentiment(self):
+        return self.processor.batches_sentiment
+
+    async def analyze_sentiment(self, text: str, analysis_type: str = "general_sentiment") -> dict:
+        return await self.processor.analyze_sentiment(text, analysis_type)
+
+    async def analyze_sentiment_batch(self, texts: list, analysis_type: str = "general_sentiment") -> list:
+        return await self.processor.analyze_sentiment_batch(texts, analysis_type)
+
+    async def summarize_text(self, text: str, max_words: int) -> str:
+        return await self.processor.summarize_text(text, max_words)
+
+    def stream_summarize_text(self, text: str, max_words: int):
+        # Streams are passed through as they are: they cannot be shared or batched.
+        return self.processor.stream_summarize_text(text, max_words)
+
+    async def analyze_aggregate_sentiment(self, texts: list, analysis_type: str) -> dict:
+        return await self.processor.analyze_aggregate_sentiment(texts, analysis_type)
+
+
+class MicroBatchingProcessor(ProcessorWrapper):
+    """
+    Collects the sentiment calls of concurrent requests for a short window and
+    sends them to the wrapped processor as one analyze_sentiment_batch() call.
+
+    A batch is sent when it holds NLP_BATCH_MAX_SIZE texts or when its first text
+    has waited NLP_BATCH_MAX_WAIT seconds, whichever comes first. Each caller gets
+    back only the result (or the error) for its own text.
+    """
+    _initialized_concrete = False
+    batches_sentiment = True
+
+    def __init__(self, processor: BaseLLMProcessor):
+        if not self._initialized_concrete:
+            super().__init__(processor)
+            self.max_batch_size = getattr(settings, 'NLP_BATCH_MAX_SIZE', 16)
+            self.max_wait = getattr(settings, 'NLP_BATCH_MAX_WAIT', 0.02)
+            # Open batches per event loop and analysis type: {loop: {analysis_type: [(text, future), ...]}}
+            self._pending = weakref.WeakKeyDictionary()
+            # Keeps references to running batch tasks so they are not garbage collected.
+            self._running = set()
+            self._initialized_concrete = True
+
+    async def analyze_sentiment(self, text: str, analysis_type: str = "general_sentiment") -> dict:
+        loop = asyncio.get_running_loop()
+        open_batches = self._pending.setdefault(loop, {})
+
+        batch = open_batches.get(analysis_type)
+        if batch is None:
+            batch = open_batches[analysis_type] = []
+            loop.call_later(self.max_wait, self._flush, loop, analysis_type, batch)
+
+        future = loop.create_future()
+        batch.append((text, future))
+        if len(batch) >= self.max_batch_size:
+            self._flush(loop, analysis_type, batch)
+
+        return await future
+
+    def _flush(self, loop, analysis_type: str, batch: list):
+        open_batches = self._pending.get(loop, {})
+        if open_batches.get(analysis_type) is not batch:
+            return # Already sent because it was full.
+        del open_batches[analysis_type]
+
+        task = loop.create_task(self._run_batch(analysis_type, batch))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, analysis_type: str, batch: list):
+        texts = [text for text, _ in batch]
+        try:
+            if len(texts) == 1:
+                results = [await self.processor.analyze_sentiment(texts[0], analysis_type)]
+            else:
+                print(f"Sending a batch of {len(texts)} sentiment texts upstream.")
+                results = await self.processor.analyze_sentiment_batch(texts, analysis_type)
+        except Exception as e:
+            results = [e] * len(texts)
+
+        for (_, future), result in zip(batch, results):
+            if future.done(): # The caller was cancelled.
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+
+class ResilientProcessor(ProcessorWrapper):
+    """
+    Runs every call to the wrapped processor through a ResiliencePolicy (see
+    resilience.py): classified retries with jittered backoff, optional hedged
+    requests and a circuit breaker that fails fast while the provider is down.
+    """
+    _initialized_concrete = False
+
+    def __init__(self, processor: BaseLLMProcessor):
+        if not self._initialized_concrete:
+            super().__init__(processor)
+            provider, model, _ = processor_identity(processor)
+            # Named after the model too: every routed model has its own circuit.
+            self.policy = ResiliencePolicy(provider if model == provider else f"{provider}/{model}")
+            self._initialized_concrete = True
+
+    def resilience_state(self) -> dict:
+        return self.policy.state()
+
+    async def analyze_sentiment(self, text: str, analysis_type: str = "general_sentiment") -> dict:
+        return await self.policy.call('sentiment', lambda: self.processor.analyze_sentiment(text, analysis_type))
+
+    async def analyze_sentiment_batch(self, texts: list, analysis_type: str = "general_sentiment") -> list:
+        return await self.policy.call('sentiment_batch', lambda: self.processor.analyze_sentiment_batch(texts, analysis_type))
+
+    async def summarize_text(self, text: str, max_words: int) -> str:
+        return await self.policy.call('summarization', lambda: self.processor.summarize_text(text, max_words))
+
+    def stream_summarize_text(self, text: str, max_words: int):
+        return self.policy.stream('summarization_stream', lambda: self.processor.stream_summarize_text(text, max_words))
+
+    async def analyze_aggregate_sentiment(self, texts: list, analysis_type: str) -> dict:
+        return await self.policy.call('aggregate', lambda: self.processor.analyze_aggregate_sentiment(texts, analysis_type))
+
+
+class RateLimitedProcessor(ProcessorWrapper):
+    """
+    Sends every call to the wrapped provider through its shared admission control
+    (token bucket and AIMD concurrency limit, see rate_limit.py).
+
+    A call waits for admission for at most NLP_LLM_QUEUE_TIMEOUT seconds. A call
+    rejected by the provider's rate limit is retried after its Retry-After, up to
+    NLP_LLM_RATE_LIMIT_RETRIES times while the deadline allows it; otherwise the
+    caller gets ProviderRateLimited. An unavailable provider also lowers the limit
+    (and holds calls back for its Retry-After), but is raised at once: outages are
+    retried by the resilience layer around this one.
+    """
+    _initialized_concrete = False
+
+    # Wait after a rejection that came without a Retry-After.
+    DEFAULT_RETRY_AFTER = 1.0
+
+    def __init__(self, processor: BaseLLMProcessor):
+        if not self._initialized_concrete:
+            super().__init__(processor)
+            self.limiter = UpstreamLimiter(processor.provider_name)
+            self.queue_timeout = getattr(settings, 'NLP_LLM_QUEUE_TIMEOUT', 30)
+            self.max_retries = getattr(settings, 'NLP_LLM_RATE_LIMIT_RETRIES', 2)
+            self._initialized_concrete = True
+
+    def limiter_state(self) -> dict:
+        return self.limiter.state()
+
+    async def analyze_sentiment(self, text: str, analysis_type: str = "general_sentiment") -> dict:
+        return await self._admitted(lambda: self.processor.analyze_sentiment(text, analysis_type))
+
+    async def analyze_sentiment_batch(self, texts: list, analysis_type: str = "general_sentiment") -> list:
+        return await self._admitted(lambda: self.processor.analyze_sentiment_batch(texts, analysis_type))
+
+    async def summarize_text(self, text: str, max_words: int) -> str:
+        return await self._admitted(lambda: self.processor.summarize_text(text, max_words))
+
+    async def analyze_aggregate_sentiment(self, texts: list, analysis_type: str) -> dict:
+        return await self._admitted(lambda: self.processor.analyze_aggregate_sentiment(texts, analysis_type))
+
+    def _retry_delay(self, error: ProviderRateLimited, attempt: int, deadline: float):
+        """
+        Returns how long to wait before retrying a rejected call, or None to give up.
+        """
+        delay = error.retry_after if error.retry_after is not None else self.DEFAULT_RETRY_AFTER
+        if attempt >= self.max_retries or time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    async def _admitted(self, call):
+        deadline = time.monotonic() + self.queue_timeout
+        attempt = 0
+        while True:
+            lease = await self.limiter.acquire(deadline)
+            try:
+                result = await call()
+            except ProviderRateLimited as e:
+                await self.limiter.release(lease, 'overloaded', e.retry_after)
+                delay = self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                print(f"Rate limited by '{self.limiter.provider}'. Retrying in {delay:.1f}s (attempt {attempt}).")
+                # Admission waits for the Retry-After of the provider as well, so only the default wait is slept here.
+                if e.retry_after is None:
+                    await asyncio.sleep(delay)
+                continue
+            except ProviderUnavailable as e:
+                await self.limiter.release(lease, 'overloaded', e.retry_after)
+                raise
+            except BaseException:
+                await self.limiter.release(lease, 'error')
+                raise
+            await self.limiter.release(lease, 'ok')
+            return result
+
+    async def stream_summarize_text(self, text: str, max_words: int):
+        deadline = time.monotonic() + self.queue_timeout
+        attempt = 0
+        while True:
+            lease = await self.limiter.acquire(deadline)
+            started = False
+            try:
+                async for piece in self.processor.stream_summarize_text(text, max_words):
+                    started = True
+                    yield piece
+            except ProviderRateLimited as e:
+                await self.limiter.release(lease, 'overloaded', e.retry_after)
+                # A stream that already sent pieces cannot be restarted.
+                delay = None if started else self._retry_delay(e, attempt, deadline)
+                if delay is None:
+                    raise
+                attempt += 1
+                if e.retry_after is None:
+                    await asyncio.sleep(delay)
+                continue
+            except ProviderUnavailable as e:
+                await self.limiter.release(lease, 'overloaded', e.retry_after)
+                raise
+            except BaseException:
+                await self.limiter.release(lease, 'error')
+                raise
+            await self.limiter.release(lease, 'ok')
+            return
+
+
+class ChunkedAggregationProcessor(ProcessorWrapper):
+    """
+    Runs large aggregate analyses as map-reduce instead of one huge prompt.
+
+    Texts are split into token-budgeted, content-defined chunks (NLP_AGGREGATE_CHUNK_TOKENS,
+    NLP_AGGREGATE_CHUNK_TEXTS), the chunks are analyzed concurrently and the partial
+    results are merged. A chunk result is cached under the aggregate cache key of
+    the chunk's own texts, so a re-submission that adds a few comments only
+    re-analyzes the chunks those comments fall into.
+
+    analyze_aggregate_chunks() also returns the per-chunk contributions, which the
+    aggregate history stores so that a later re-analysis of the same source can
+    reuse them (incremental mode).
+    """
+    _initialized_concrete = False
+
+    def __init__(self, processor: BaseLLMProcessor):
+        if not self._initialized_concrete:
+            super().__init__(processor)
+            self.max_chunk_tokens = getattr(settings, 'NLP_AGGREGATE_CHUNK_TOKENS', 8000)
+            self.target_chunk_texts = getattr(settings, 'NLP_AGGREGATE_CHUNK_TEXTS', 25)
+            self.concurrency = getattr(settings, 'NLP_LLM_CONCURRENCY', 5)
+            self._initialized_concrete = True
+
+    async def analyze_aggregate_sentiment(self, texts: list, analysis_type: str) -> dict:
+        result, _ = await self.analyze_aggregate_chunks(texts, analysis_type)
+        return result
+
+    async def analyze_aggregate_chunks(self, texts: list, analysis_type: str, previous_chunks: list = None, on_chunk=None) -> tuple:
+        """
+        Returns (result, chunk_records), where each record is
+        {"fingerprints": [<text fingerprint>, ...], "result": {...}}.
+
+        Records in `previous_chunks` whose texts are all still present are reused
+        without an LLM call; only the remaining texts are chunked and analyzed.
+        `on_chunk(record, done, total)` is awaited as each chunk is finished
+        (reused chunks first), so callers can report progress.
+        """
+        present = {text_fingerprint(text) for text in texts}
+
+        reused, covered = [], set()
+        for record in previous_chunks or []:
+            fingerprints = set(record['fingerprints'])
+            if fingerprints and fingerprints <= present and not fingerprints & covered:
+                reused.append(record)
+                covered |= fingerprints
+
+        pending = [text for text in texts if text_fingerprint(text) not in covered]
+        chunks = split_into_chunks(pending, self.max_chunk_tokens, self.target_chunk_texts) if pending else []
+
+        if not reused and len(chunks) <= 1:
+            result = await self.processor.analyze_aggregate_sentiment(texts, analysis_type)
+            records = [{"fingerprints": [text_fingerprint(text) for text in texts], "result": result}]
+            if on_chunk:
+                await on_chunk(records[0], 1, 1)
+            return result, records
+
+        if reused:
+            print(f"Reusing {len(reused)} chunk(s) of a previous analysis; {len(pending)} text(s) left to analyze.")
+        if chunks:
+            print(f"Running aggregate analysis of {len(pending)} texts as {len(chunks)} chunks.")
+
+        total = len(reused) + len(chunks)
+        done = 0
+        if on_chunk:
+            for record in reused:
+                done += 1
+                await on_chunk(record, done, total)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def analyze_chunk(chunk):
+            nonlocal done
+            async with semaphore:
+                result = await self.analyze_chunk(chunk, analysis_type)
+            record = {"fingerprints": [text_fingerprint(text) for text in chunk], "result": result}
+            if on_chunk:
+                done += 1
+                await on_chunk(record, done, total)
+            return record
+
+        records = reused + list(await asyncio.gather(*(analyze_chunk(chunk) for chunk in chunks)))
+
+        if len(records) == 1:
+            return records[0]['result'], records
+        merged = merge_aggregate_results([(record['result'], len(record['fingerprints'])) for record in records])
+        return merged, records
+
+    async def analyze_chunk(self, chunk: list, analysis_type: str) -> dict:
+        """
+        Returns the aggregate result of one chunk, from the cache when possible.
+        """
+        cache_key = aggregate_result_key(self.processor, texts_fingerprint(chunk), analysis_type).cache_key
+        result = await result_cache.aget(cache_key)
+        if result is None:
+            result = await self.processor.analyze_aggregate_sentiment(chunk, analysis_type)
+            await result_cache.aset(cache_key, result, timeout=RESULT_CACHE_TIMEOUT)
+        return result
+
+
+class SingleFlightProcessor(ProcessorWrapper):
+    """
+    Wraps another processor so that identical calls that are in flight at the
+    same time share a single upstream request (protection against cache stampedes).
+
+    Inside a process, concurrent callers await one shared future. Across workers,
+    the first caller takes a short-lived Redis lock keyed by the content fingerprint
+    and the others wait for the result it publishes.
+    """
+    _initialized_concrete = False
+
+    # How long a published result (or error) stays available to waiting workers.
+    RESULT_TTL = 10
+    ERROR_TTL = 2
+
+    def __init__(self, processor: BaseLLMProcessor):
+        if not self._initialized_concrete:
+            super().__init__(processor)
+            # The lock must outlive the slowest upstream call, otherwise a second worker takes over.
+            self.lock_timeout = getattr(settings, 'NLP_SINGLE_FLIGHT_LOCK_TIMEOUT', 60)
+            self.wait_timeout = getattr(settings, 'NLP_SINGLE_FLIGHT_WAIT_TIMEOUT', 60)
+            self.poll_interval = getattr(settings, 'NLP_SINGLE_FLIGHT_POLL_INTERVAL', 0.05)
+            # In-flight futures per event loop: a future can only be awaited on the loop that created it.
+            self._in_flight = weakref.WeakKeyDictionary()
+            self._initialized_concrete = True
+
+    async def analyze_sentiment(self, text: str, analysis_type: str = "general_sentiment") -> dict:
+        key = sentiment_result_key(self.processor, text, analysis_type)
+        return await self._single_flight(key.cache_key, lambda: self.processor.analyze_sentiment(text, analysis_type))
+
+    async def summarize_text(self, text: str, max_words: int) -> str:
+        key = summarization_result_key(self.processor, text, max_words)
+        return await self._single_flight(key.cache_key, lambda: self.processor.summarize_text(text, max_words))
+
+    async def analyze_aggregate_sentiment(self, texts: list, analysis_type: str) -> dict:
+        key = aggregate_result_key(self.processor, texts_fingerprint(texts), analysis_type)
+        return await self._single_flight(key.cache_key, lambda: self.processor.analyze_aggregate_sentiment(texts, analysis_type))
+
+    async def _single_flight(self, key: str, call):
+        """
+        Runs `call()` once per key within this process; concurrent callers share its outcome.
+        """
+        loop = asyncio.get_running_loop()
+        in_flight = self._in_flight.setdefault(loop, {})
+
+        future = in_flight.get(key)
+        if future is not None:
+            # shield() keeps a cancelled follower from cancelling the shared call.
+            return await asyncio.shield(future)
+
+        future = loop.create_future()
+        in_flight[key] = future
+        try:
+            result = await self._coalesce_across_workers(key, call)
+        except BaseException as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody else was waiting for it.
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            in_flight.pop(key, None)
+
+    async def _coalesce_across_workers(self, key: str, call):
+        """
+        Uses a Redis lock so that only one worker calls upstream for `key`.
+        The other workers poll for the published outcome and take over the lock
+        if the owner disappears; if waiting times out they call upstream themselves.
+        """
+        lock_key = f"single_flight:lock:{key}"
+        outcome_key = f"single_flight:outcome:{key}"
+        token = uuid.uuid4().hex
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+        while loop.time() < deadline:
+            outcome = await cache.aget(outcome_key)
+            if outcome is not None:
+                if 'error' in outcome:
+                    # Re-raised as the leader's class, so e.g. rate limits and outages are answered alike.
+                    error_class = PROVIDER_ERRORS.get(outcome.get('error_type'), ProviderError)
+                    raise error_class(outcome['error'], retry_after=outcome.get('retry_after'))
+                return outcome['result']
+
+            if await cache.aadd(lock_key, token, timeout=self.lock_timeout):
+                return await self._lead(call, lock_key, outcome_key, token)
+
+            await asyncio.sleep(self.poll_interval)
+
+        print(f"Single-flight wait timed out for '{key[:60]}...'. Calling upstream directly.")
+        return await call()
+
+    async def _lead(self, call, lock_key: str, outcome_key: str, token: str):
+        try:
+            result = await call()
+        except Exception as e:
+            error = classify_error(e)
+            await cache.aset(outcome_key, {
+                'error': str(e),
+                'error_type': type(error).__name__,
+                'retry_after': error.retry_after,
+            }, timeout=self.ERROR_TTL)
+            raise
+        else:
+            await cache.aset(outcome_key, {'result': result}, timeout=self.RESULT_TTL)
+            return result
+        finally:
+            # Only release the lock if it still belongs to this call (it may have expired and been re-taken).
+            if await cache.aget(lock_key) == token:
+                await cache.adelete(lock_key)
+
+
+class RoutingProcessor(BaseLLMProcessor):
+    """
+    Sends every call to one of several backends (see routing.py): by task type and
+    input length to a preferred tier, then by observed latency and error rate,
+    within the cost budgets of the tiers. A failed call is sent to the next backend.
+
+    Results are cached for the router as a whole: a router with a single backend
+    has the identity of that backend, one with several is identified by the set
+    of its backends. served_by() tells which backend answered a call.
+    """
+    _initialized_concrete = False
+
+    @classmethod
+    def _instance_key(cls, backends: list, *args, **kwargs):
+        # One router per list of backends.
+        return (cls, tuple(backends))
+
+    def __init__(self, backends: list):
+        if not self._initialized_concrete:
+            if not backends:
+                raise ValueError("RoutingProcessor needs at least one backend (NLP_LLM_BACKENDS).")
+            self.backends = backends
+            options = routing_settings()
+            self.routes = options['routes']
+            self.unhealthy_error_rate = options['unhealthy_error_rate']
+            self.budget = CostBudget(options['budgets'])
+            if len(backends) == 1:
+                self.provider_name, self.default_model = backends[0].identity
+            else:
+                self.provider_name = "router"
+                self.default_model = f"routed-{routing_fingerprint(backends)}"
+            self._initialized_concrete = True
+            print(f"RoutingProcessor initialized with backends: {', '.join(backend.name for backend in backends)}.")
+
+    @property
+    def prompt_version(self):
+        return self.backends[0].processor.prompt_version
+
+    @property
+    def batches_sentiment(self):
+        return any(backend.processor.batches_sentiment for backend in self.backends)
+
+    async def candidates(self, task: str, size: int) -> list:
+        """
+        Returns the backends that may take a call, in the order they are tried.
+        """
+        tier = preferred_tier(self.routes, task, size)
+        exhausted = await self.budget.exhausted()
+        candidates = [
+            backend for backend in self.backends
+            if backend.serves(task, size) and backend.tier not in exhausted
+        ]
+        if not candidates:
+            raise ProviderUnavailable(f"No AI backend can take a {task} call of {size} characters within its cost budget.")
+        return sorted(candidates, key=lambda backend: (
+            backend.tier != tier,
+            backend.stats.error_rate >= self.unhealthy_error_rate,
+            backend.stats.expected_latency(),
+        ))
+
+    async def _served(self, backend: Backend, size: int, started: float):
+        backend.stats.record(time.monotonic() - started, failed=False)
+        await self.budget.charge(backend.tier, backend.cost(size))
+        record_served(backend.identity)
+
+    def _failed(self, backend: Backend, task: str, error: Exception, started: float) -> ProviderError:
+        error = classify_error(error)
+        if isinstance(error, LowConfidence):
+            # Not a failure: the backend answered, but leaves the text to a stronger one.
+            backend.stats.record(time.monotonic() - started, failed=False)
+            print(f"Backend '{backend.name}' is not confident about a {task} call. Escalating to the next backend.")
+            return error
+        backend.stats.record(time.monotonic() - started, failed=True)
+        if not isinstance(error, ProviderBadRequest):
+            # Another backend will not accept an invalid request either.
+            print(f"{task} call to backend '{backend.name}' failed ({error}). Trying the next backend.")
+        return error
+
+    async def _routed(self, task: str, size: int, call):
+        """
+        Awaits `call(processor)` on the best backend, then on the next ones while it fails.
+        When no backend answers, an answer a backend was not confident about is returned.
+        """
+        last_error = None
+        uncertain = None
+        for backend in await self.candidates(task, size):
+            started = time.monotonic()
+            try:
+                result = await call(backend.processor)
+            except Exception as e:
+                error = self._failed(backend, task, e, started)
+                if isinstance(error, ProviderBadRequest):
+                    raise
+                if isinstance(error, LowConfidence) and uncertain is None:
+                    uncertain = (backend, error.result)
+                last_error = (error, e)
+                continue
+            await self._served(backend, size, started)
+            return result
+
+        if uncertain is not None:
+            backend, result = uncertain
+            print(f"No backend could take the {task} call further. Using the answer of '{backend.name}'.")
+            record_served(backend.identity)
+            return result
+
+        error, original = last_error
+        if error is original:
+            raise error
+        raise error from original
+
+    async def analyze_sentiment(self, text: str, analysis_type: str = "general_sentiment") -> dict:
+        return await self._routed('sentiment', len(text), lambda processor: processor.analyze_sentiment(text, analysis_type))
+
+    async def analyze_sentiment_batch(self, texts: list, analysis_type: str = "general_sentiment") -> list:
+        size = max((len(text) for text in texts), default=0)
+        return await self._routed('sentiment', size, lambda processor: processor.analyze_sentiment_batch(texts, analysis_type))
+
+    async def summarize_text(self, text: str, max_words: int) -> str:
+        return await self._routed('summarization', len(text), lambda processor: processor.summarize_text(text, max_words))
+
+    async def stream_summarize_text(self, text: str, max_words: int):
+        # A stream can only move to another backend before its first piece was sent.
+        size = len(text)
+        last_error = None
+        for backend in await self.candidates('summarization', size):
+            started = time.monotonic()
+            streaming = False
+            try:
+                async for piece in backend.processor.stream_summarize_text(text, max_words):
+                    streaming = True
+                    yield piece
+            except Exception as e:
+                error = self._failed(backend, 'summarization', e, started)
+                if streaming or isinstance(error, ProviderBadRequest):
+                    raise
+                last_error = (error, e)
+                continue
+            await self._served(backend, size, started)
+            return
+
+        error, original = last_error
+        if error is original:
+            raise error
+        raise error from original
+
+    async def analyze_aggregate_sentiment(self, texts: list, analysis_type: str) -> dict:
+        size = sum(len(text) for text in texts)
+        return await self._routed('aggregate', size, lambda processor: processor.analyze_aggregate_sentiment(texts, analysis_type))
+
+    async def analyze_aggregate_chunks(self, texts: list, analysis_type: str, previous_chunks: list = None, on_chunk=None) -> tuple:
+        size = sum(len(text) for text in texts)
+        return await self._routed('aggregate', size, lambda processor: processor.analyze_aggregate_chunks(
+            texts, analysis_type, previous_chunks=previous_chunks, on_chunk=on_chunk
+        ))
+
+    def routing_state(self) -> dict:
+        return {
+            'backends': [backend.state() for backend in self.backends],
+            'budgets': self.budget.state(),
+        }
+
+
+# --- Instance Creation ---
+# The backends are configured in NLP_LLM_BACKENDS; each one gets its own
+# rate limiting, resilience, micro-batching, single-flight and chunked aggregation layers.
+# The internal model makes no upstream calls and only gets micro-batching, so that the
+# texts of concurrent requests are scored in one vectorized pass.
+
+def build_provider(config: dict) -> BaseLLMProcessor:
+    provider = config['provider']
+    if provider == 'gemini':
+        gemini_api_key = os.environ.get("GEMINI_API_KEY") or getattr(settings, 'GEMINI_API_KEY', None)
+        if not gemini_api_key:
+            raise ValueError("Google Gemini API key (GEMINI_API_KEY) not found.")
+        return GeminiProcessor(api_key=gemini_api_key, model_name=config.get('model', "gemini-1.5-pro-latest"))
+    if provider == 'mock':
+        return MockProcessor(api_key="mock_key")
+    if provider == 'internal':
+        return InternalProcessor()
+    raise ValueError(f"Unknown LLM provider '{provider}' in NLP_LLM_BACKENDS.")
+
+
+def build_backend(config: dict) -> Backend:
+    if config['provider'] == 'internal':
+        processor = MicroBatchingProcessor(build_provider(config))
+    else:
+        processor = ChunkedAggregationProcessor(
+            SingleFlightProcessor(MicroBatchingProcessor(ResilientProcessor(RateLimitedProcessor(build_provider(config)))))
+        )
+    return Backend(
+        config['name'],
+        processor,
+        tier=config.get('tier', 'default'),
+        tasks=config.get('tasks'),
+        max_chars=config.get('max_chars'),
+        cost_per_1k_chars=config.get('cost_per_1k_chars', 0.0),
+        alpha=routing_settings()['ewma_alpha'],
+    )
+
+
+def build_backends(configs: list) -> list:
+    backends = []
+    for config in configs:
+        if config['provider'] == 'internal' and np is None:
+            print(f"numpy is not installed. Backend '{config['name']}' (internal model) is disabled.")
+            continue
+        backends.append(build_backend(config))
+    return backends
+
+
+processor_instance = RoutingProcessor(build_backends(
+    getattr(settings, 'NLP_LLM_BACKENDS', [{'name': 'mock', 'provider': 'mock', 'tier': 'fast'}])
+))
@@ -1,5 +1,9 @@
 # This file stores all customizable LLM prompts.
 
+# Version of the prompt templates below. It is part of every result cache key,
+# so bump it whenever a prompt changes in a way that affects the answers.
+PROMPT_VERSION = "v1"
+
 # --- Prompts for Gemini ---
 # Gemini works with a single prompt template instead of system/user pairs.
 GEMINI_PROMPTS = {
@@ -7,7 +11,7 @@ GEMINI_PROMPTS = {
         "You are a highly accurate sentiment analysis AI. Analyze the sentiment of the following Persian text. "
         "Categorize it as 'POSITIVE', 'NEGATIVE', or 'NEUTRAL'. "
         "Return ONLY a valid JSON object in the format: "
-        "'{ \"sentiment\": \"CATEGORY\", \"score\": 0.95, \"notes\": \"A brief note about the analysis.\" }'.\n\n"
+        "'{{ \"sentiment\": \"CATEGORY\", \"score\": 0.95, \"notes\": \"A brief note about the analysis.\" }}'.\n\n"
         "Text to analyze: \"{text}\""
     ),
 
@@ -15,10 +19,27 @@ GEMINI_PROMPTS = {
         "You are an AI specialized in analyzing customer feedback for business insights. For the following Persian text, "
         "determine the customer's intent. Categorize it as 'SATISFIED', 'DISSATISFIED', 'INQUIRY', or 'OTHER'. "
         "Return ONLY a valid JSON object in the format: "
-        "'{ \"sentiment\": \"CATEGORY\", \"score\": 0.90, \"notes\": \"Customer is happy with the delivery speed.\" }'.\n\n"
+        "'{{ \"sentiment\": \"CATEGORY\", \"score\": 0.90, \"notes\": \"Customer is happy with the delivery speed.\" }}'.\n\n"
         "Text to analyze: \"{text}\""
     ),
 
+    # Batched variants: several texts in one call (see MicroBatchingProcessor).
+    "sentiment_batch_template_general": (
+        "You are a highly accurate sentiment analysis AI. Analyze the sentiment of each of the following {count} Persian texts independently. "
+        "Categorize each one as 'POSITIVE', 'NEGATIVE', or 'NEUTRAL'. "
+        "Return ONLY a valid JSON array with exactly {count} objects, in the same order as the input texts, each in the format: "
+        "'{{ \"sentiment\": \"CATEGORY\", \"score\": 0.95, \"notes\": \"A brief note about the analysis.\" }}'.\n\n"
+        "Texts to analyze (JSON array): {texts}"
+    ),
+
+    "sentiment_batch_template_business": (
+        "You are an AI specialized in analyzing customer feedback for business insights. For each of the following {count} Persian texts, "
+        "independently determine the customer's intent. Categorize each one as 'SATISFIED', 'DISSATISFIED', 'INQUIRY', or 'OTHER'. "
+        "Return ONLY a valid JSON array with exactly {count} objects, in the same order as the input texts, each in the format: "
+        "'{{ \"sentiment\": \"CATEGORY\", \"score\": 0.90, \"notes\": \"Customer is happy with the delivery speed.\" }}'.\n\n"
+        "Texts to analyze (JSON array): {texts}"
+    ),
+
     "summarization_template": (
         "You are a professional text summarizer. Summarize the following Persian text "
         "in approximately {max_words} words. Respond ONLY with the summarized Persian text "
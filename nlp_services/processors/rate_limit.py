@@ -0,0 +1,343 @@
+"""
+Admission control for the upstream LLM calls.
+
+Every call to a provider needs a token from a token bucket (a sustained rate
+with bursts) and a slot under a concurrency limit. The limit adapts with AIMD:
+each successful call raises it by 1/limit (about one slot per round of calls),
+while a call rejected by the provider (HTTP 429) or failed because it is
+unavailable (e.g. HTTP 503) halves it, at most once per `decrease_cooldown`
+seconds. A Retry-After sent with the failure holds back every call to that
+provider until it has passed. Rate limit rejections are retried here; outages
+are left to the retries and circuit breaker of resilience.py.
+
+The state is kept in Redis and changed by Lua scripts, so all workers share one
+bucket and one limit per provider:
+
+    nlp_llm:<provider>:bucket          tokens and time of the last refill
+    nlp_llm:<provider>:limit           current concurrency limit
+    nlp_llm:<provider>:leases          calls in flight (expire after `lease_timeout`, e.g. when a worker died)
+    nlp_llm:<provider>:blocked_until   end of the provider's Retry-After
+    nlp_llm:<provider>:queue           calls waiting for admission
+
+Calls wait for admission until their deadline (NLP_LLM_QUEUE_TIMEOUT) and then
+fail with ProviderRateLimited, which the views answer with 429 and Retry-After.
+When the cache backend is not Redis the state is kept per process.
+
+Limits are configured per provider in NLP_LLM_RATE_LIMITS.
+"""
+import asyncio
+import threading
+import time
+import uuid
+from email.utils import parsedate_to_datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from .errors import ProviderRateLimited
+
+
+KEY_PREFIX = 'nlp_llm'
+
+DEFAULT_LIMITS = {
+    'requests_per_second': 10,
+    'burst': 20,
+    'initial_concurrency': 8,
+    'min_concurrency': 1,
+    'max_concurrency': 64,
+    'decrease_factor': 0.5,
+    'decrease_cooldown': 1.0,
+    'lease_timeout': 120,
+}
+
+# Rejections that mean "send less", as opposed to errors of a single call.
+RATE_LIMIT_STATUSES = (429,)
+# The provider is down or overloaded: raised as ProviderUnavailable, so the circuit breaker sees it.
+UNAVAILABLE_STATUSES = (503,)
+
+
+def parse_retry_after(value) -> float:
+    """
+    Returns the seconds to wait from a Retry-After header (seconds or an HTTP date), or None.
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def provider_limits(provider: str) -> dict:
+    configured = getattr(settings, 'NLP_LLM_RATE_LIMITS', {})
+    return {**DEFAULT_LIMITS, **configured.get('default', {}), **configured.get(provider, {})}
+
+
+# Redis server time, so that workers with skewed clocks agree.
+NOW = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+"""
+
+# KEYS: bucket, limit, leases, blocked_until. ARGV: rate, burst, initial limit, lease id, lease timeout.
+# Returns {1, ''} when admitted, else {0, <seconds to wait, or -1 to wait for a free slot>}.
+ACQUIRE_SCRIPT = NOW + """
+local blocked_until = tonumber(redis.call('GET', KEYS[4]) or '0')
+if blocked_until > now then
+    return {0, tostring(blocked_until - now)}
+end
+
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+local limit = tonumber(redis.call('GET', KEYS[2]) or ARGV[3])
+if redis.call('ZCARD', KEYS[3]) >= math.floor(limit) then
+    return {0, '-1'}
+end
+
+local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1] or ARGV[2])
+local updated = tonumber(bucket[2] or now)
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+if tokens < 1 then
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    return {0, tostring((1 - tokens) / rate)}
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens - 1), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], 3600)
+redis.call('ZADD', KEYS[3], now + tonumber(ARGV[5]), ARGV[4])
+redis.call('EXPIRE', KEYS[3], ARGV[5])
+return {1, ''}
+"""
+
+# KEYS: limit, leases, blocked_until, decreased_at. ARGV: lease id, outcome ('ok', 'overloaded' or
+# 'error'), initial limit, min limit, max limit, decrease factor, decrease cooldown, retry after.
+# Returns the new limit.
+RELEASE_SCRIPT = NOW + """
+redis.call('ZREM', KEYS[2], ARGV[1])
+local limit = tonumber(redis.call('GET', KEYS[1]) or ARGV[3])
+if ARGV[2] == 'ok' then
+    limit = math.min(tonumber(ARGV[5]), limit + 1 / limit)
+elseif ARGV[2] == 'overloaded' then
+    local decreased_at = tonumber(redis.call('GET', KEYS[4]) or '0')
+    if now - decreased_at >= tonumber(ARGV[7]) then
+        limit = math.max(tonumber(ARGV[4]), limit * tonumber(ARGV[6]))
+        redis.call('SET', KEYS[4], tostring(now), 'EX', 3600)
+    end
+    local retry_after = tonumber(ARGV[8])
+    if retry_after > 0 and now + retry_after > tonumber(redis.call('GET', KEYS[3]) or '0') then
+        redis.call('SET', KEYS[3], tostring(now + retry_after), 'EX', math.ceil(retry_after) + 1)
+    end
+end
+redis.call('SET', KEYS[1], tostring(limit), 'EX', 86400)
+return tostring(limit)
+"""
+
+
+class LocalLimiterState:
+    """
+    The same bucket and limit as the Lua scripts, kept in this process.
+    """
+
+    def __init__(self, limits: dict):
+        self.limits = limits
+        self._lock = threading.Lock()
+        self.tokens = float(limits['burst'])
+        self.updated = time.monotonic()
+        self.limit = float(limits['initial_concurrency'])
+        self.leases = {}
+        self.blocked_until = 0.0
+        self.decreased_at = 0.0
+
+    def acquire(self, lease_id):
+        with self._lock:
+            now = time.monotonic()
+            if self.blocked_until > now:
+                return False, self.blocked_until - now
+            self.leases = {lease: expiry for lease, expiry in self.leases.items() if expiry > now}
+            if len(self.leases) >= int(self.limit):
+                return False, -1
+            rate = self.limits['requests_per_second']
+            self.tokens = min(self.limits['burst'], self.tokens + (now - self.updated) * rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False, (1 - self.tokens) / rate
+            self.tokens -= 1
+            self.leases[lease_id] = now + self.limits['lease_timeout']
+            return True, 0
+
+    def release(self, lease_id, outcome, retry_after):
+        with self._lock:
+            now = time.monotonic()
+            self.leases.pop(lease_id, None)
+            if outcome == 'ok':
+                self.limit = min(self.limits['max_concurrency'], self.limit + 1 / self.limit)
+            elif outcome == 'overloaded':
+                if now - self.decreased_at >= self.limits['decrease_cooldown']:
+                    self.limit = max(self.limits['min_concurrency'], self.limit * self.limits['decrease_factor'])
+                    self.decreased_at = now
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, now + retry_after)
+            return self.limit
+
+    def state(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                'concurrency_limit': int(self.limit),
+                'in_flight': sum(1 for expiry in self.leases.values() if expiry > now),
+                'tokens': min(self.limits['burst'], self.tokens + (now - self.updated) * self.limits['requests_per_second']),
+                'blocked_for': max(self.blocked_until - now, 0.0),
+            }
+
+
+class UpstreamLimiter:
+    """
+    Token bucket and AIMD concurrency limit of one provider, shared through Redis.
+    """
+
+    def __init__(self, provider: str, limits: dict = None, poll_interval: float = 0.05):
+        self.provider = provider
+        self.limits = limits or provider_limits(provider)
+        self.poll_interval = poll_interval
+        self.prefix = f'{KEY_PREFIX}:{provider}'
+        self.local = LocalLimiterState(self.limits)
+        # Calls of this process waiting for admission.
+        self.waiting = 0
+        self._scripts = None
+
+    def _redis(self):
+        try:
+            return get_redis_connection('default')
+        except NotImplementedError:
+            # The configured cache backend is not Redis (e.g. local memory in development).
+            return None
+
+    def _script(self, connection, name):
+        if self._scripts is None:
+            self._scripts = {
+                'acquire': connection.register_script(ACQUIRE_SCRIPT),
+                'release': connection.register_script(RELEASE_SCRIPT),
+            }
+        return self._scripts[name]
+
+    def _key(self, name):
+        return f'{self.prefix}:{name}'
+
+    # --- Synchronous steps (run in a thread from the async API) ---
+
+    def _try_acquire(self, lease_id):
+        connection = self._redis()
+        if connection is None:
+            return self.local.acquire(lease_id)
+        admitted, wait = self._script(connection, 'acquire')(
+            keys=[self._key('bucket'), self._key('limit'), self._key('leases'), self._key('blocked_until')],
+            args=[self.limits['requests_per_second'], self.limits['burst'], self.limits['initial_concurrency'],
+                  lease_id, self.limits['lease_timeout']],
+        )
+        return bool(admitted), float(wait or 0)
+
+    def _release(self, lease_id, outcome, retry_after):
+        connection = self._redis()
+        if connection is None:
+            return self.local.release(lease_id, outcome, retry_after)
+        return float(self._script(connection, 'release')(
+            keys=[self._key('limit'), self._key('leases'), self._key('blocked_until'), self._key('decreased_at')],
+            args=[lease_id, outcome, self.limits['initial_concurrency'], self.limits['min_concurrency'],
+                  self.limits['max_concurrency'], self.limits['decrease_factor'], self.limits['decrease_cooldown'],
+                  retry_after or 0],
+        ))
+
+    def _change_queue(self, delta):
+        connection = self._redis()
+        if connection is not None:
+            pipeline = connection.pipeline()
+            pipeline.incrby(self._key('queue'), delta)
+            # Counts left behind by a worker that died expire.
+            pipeline.expire(self._key('queue'), 60)
+            pipeline.execute()
+
+    # --- Async API ---
+
+    async def acquire(self, deadline: float) -> str:
+        """
+        Waits until a call may be sent and returns its lease id. Raises
+        ProviderRateLimited when the call is not admitted before `deadline`
+        (a time.monotonic() value).
+        """
+        lease_id = uuid.uuid4().hex
+        # Not thread-sensitive: admission checks of concurrent calls must not queue behind each other.
+        try_acquire = sync_to_async(self._try_acquire, thread_sensitive=False)
+
+        admitted, wait = await try_acquire(lease_id)
+        if admitted:
+            return lease_id
+
+        self.waiting += 1
+        await sync_to_async(self._change_queue, thread_sensitive=False)(1)
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ProviderRateLimited(
+                        "The AI provider is busy. Please retry later.",
+                        retry_after=wait if wait > 0 else self.poll_interval,
+                    )
+                await asyncio.sleep(min(wait if wait > 0 else self.poll_interval, remaining))
+                admitted, wait = await try_acquire(lease_id)
+                if admitted:
+                    return lease_id
+        finally:
+            self.waiting -= 1
+            await sync_to_async(self._change_queue, thread_sensitive=False)(-1)
+
+    async def release(self, lease_id: str, outcome: str = 'ok', retry_after: float = None):
+        """
+        Frees the slot of a call. `outcome` is 'ok', 'overloaded' (rejected by
+        the provider's rate limit, or the provider is unavailable) or 'error' (any other failure).
+        """
+        try:
+            await sync_to_async(self._release, thread_sensitive=False)(lease_id, outcome, retry_after)
+        except Exception as e:
+            # The lease expires on its own.
+            print(f"Could not release an upstream lease of '{self.provider}': {e}")
+
+    def state(self) -> dict:
+        """
+        Returns the current limits, calls in flight and queue depth of the provider.
+        """
+        configured = {
+            'requests_per_second': self.limits['requests_per_second'],
+            'burst': self.limits['burst'],
+            'min_concurrency': self.limits['min_concurrency'],
+            'max_concurrency': self.limits['max_concurrency'],
+        }
+        connection = self._redis()
+        if connection is None:
+            return {'provider': self.provider, 'shared': False, **configured, **self.local.state(), 'queue_depth': self.waiting}
+
+        pipeline = connection.pipeline()
+        pipeline.get(self._key('limit'))
+        pipeline.zcard(self._key('leases'))
+        pipeline.hget(self._key('bucket'), 'tokens')
+        pipeline.get(self._key('blocked_until'))
+        pipeline.get(self._key('queue'))
+        pipeline.time()
+        limit, in_flight, tokens, blocked_until, queue, (seconds, microseconds) = pipeline.execute()
+        now = seconds + microseconds / 1e6
+        return {
+            'provider': self.provider,
+            'shared': True,
+            **configured,
+            'concurrency_limit': int(float(limit or self.limits['initial_concurrency'])),
+            'in_flight': in_flight,
+            'tokens': float(tokens) if tokens is not None else float(self.limits['burst']),
+            'blocked_for': max(float(blocked_until or 0) - now, 0.0),
+            'queue_depth': max(int(queue or 0), 0),
+            'local_queue_depth': self.waiting,
+        }
@@ -0,0 +1,315 @@
+"""
+Retries, hedged requests and a circuit breaker for the upstream LLM calls.
+
+ResiliencePolicy runs one processor call:
+
+- Failures are classified (see errors.py). Retryable ones (timeouts, unavailable
+  provider, unparsable answers) are sent again up to `max_retries` times, after
+  an exponential backoff with full jitter, so retries of many requests do not
+  arrive at the provider at the same moment.
+- With `hedge` enabled, a call still running after the `hedge_percentile`
+  latency of recent calls of the same kind gets a second, identical request;
+  the first answer wins and the other request is cancelled. This cuts the tail
+  latency at the cost of a few extra calls.
+- A circuit breaker watches the outcomes of the last `failure_window` calls.
+  When at least `failure_threshold` of them were timeouts or outages, and they
+  make up `failure_rate` of the window, the circuit opens: calls fail at once with
+  CircuitOpen for `reset_timeout` seconds, then a single probe call decides
+  whether it closes again. The pipelines answer such failures with stale
+  results where they have one (see services.py).
+
+The breaker and the latency statistics are kept per process. Settings come from
+NLP_LLM_RESILIENCE. `python manage.py simulate_llm_faults` runs the policy
+against the fault-injecting mock processors.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+from .errors import CircuitOpen, ProviderTimeout, ProviderUnavailable, classify_error
+
+
+DEFAULT_RESILIENCE = {
+    'max_retries': 2,
+    'backoff_base': 0.5,
+    'backoff_cap': 8.0,
+    'attempt_timeout': 60.0,
+    'hedge': False,
+    'hedge_percentile': 0.95,
+    'hedge_min_samples': 20,
+    'failure_threshold': 5,
+    'failure_rate': 0.5,
+    'failure_window': 20,
+    'reset_timeout': 30.0,
+}
+
+
+def resilience_settings() -> dict:
+    return {**DEFAULT_RESILIENCE, **getattr(settings, 'NLP_LLM_RESILIENCE', {})}
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    Returns the wait before retry number `attempt` (from 0): exponential, with full jitter.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LatencyTracker:
+    """
+    Durations of the recent successful calls of one kind.
+    """
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, fraction: float, min_samples: int = 1):
+        if len(self.samples) < max(min_samples, 1):
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class CircuitBreaker:
+    """
+    Opens when the recent calls failed too often (an outage rather than the odd
+    error of a flaky provider) and lets a single probe call through
+    `reset_timeout` seconds later.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name: str, failure_threshold: int = 5, failure_rate: float = 0.5,
+                 failure_window: int = 20, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.failure_rate = failure_rate
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        # True for each failed call among the last ones.
+        self.outcomes = deque(maxlen=failure_window)
+        self.opened_at = 0.0
+        self.probing = False
+        self.rejected = 0
+
+    def before_call(self):
+        """
+        Raises CircuitOpen when the call must not be sent.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            remaining = self.opened_at + self.reset_timeout - time.monotonic()
+            if self.state == self.OPEN and remaining <= 0:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self.probing:
+                # This call is the probe.
+                self.probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpen(
+            f"The AI provider '{self.name}' is unavailable. Please retry later.",
+            retry_after=max(remaining, 1.0),
+        )
+
+    def record_success(self):
+        with self._lock:
+            if self.state != self.CLOSED:
+                print(f"Circuit of '{self.name}' closed: the provider answers again.")
+                self.outcomes.clear()
+            self.state = self.CLOSED
+            self.outcomes.append(False)
+            self.probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.outcomes.append(True)
+            failures = sum(self.outcomes)
+            too_many = failures >= self.failure_threshold and failures >= self.failure_rate * len(self.outcomes)
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and too_many):
+                print(f"Circuit of '{self.name}' opened after {failures} of the last {len(self.outcomes)} calls failed.")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+            self.probing = False
+
+    def record_neutral(self):
+        # A call that failed for another reason (e.g. a bad request) says nothing about an outage.
+        with self._lock:
+            self.probing = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'recent_failures': sum(self.outcomes),
+                'recent_calls': len(self.outcomes),
+                'open_for': max(self.opened_at + self.reset_timeout - time.monotonic(), 0.0) if self.state == self.OPEN else 0.0,
+                'rejected_calls': self.rejected,
+            }
+
+
+class ResiliencePolicy:
+    """
+    Runs processor calls with retries, optional hedging and a circuit breaker.
+    """
+
+    def __init__(self, name: str, options: dict = None):
+        self.name = name
+        self.options = {**resilience_settings(), **(options or {})}
+        self.breaker = CircuitBreaker(
+            name,
+            failure_threshold=self.options['failure_threshold'],
+            failure_rate=self.options['failure_rate'],
+            failure_window=self.options['failure_window'],
+            reset_timeout=self.options['reset_timeout'],
+        )
+        self.latency = {}
+        self.counters = {'calls': 0, 'retries': 0, 'hedged': 0, 'hedge_wins': 0, 'failures': 0}
+
+    def _tracker(self, kind: str) -> LatencyTracker:
+        return self.latency.setdefault(kind, LatencyTracker())
+
+    def hedge_delay(self, kind: str):
+        """
+        Returns how long a call of this kind may run before it is hedged, or None to not hedge.
+        """
+        if not self.options['hedge']:
+            return None
+        return self._tracker(kind).percentile(self.options['hedge_percentile'], self.options['hedge_min_samples'])
+
+    def _record_outcome(self, error):
+        if error is None:
+            self.breaker.record_success()
+        elif isinstance(error, ProviderUnavailable) and not isinstance(error, CircuitOpen):
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_neutral()
+
+    async def call(self, kind: str, call):
+        """
+        Awaits `call()` (a function returning a new coroutine each time) with retries,
+        hedging and the circuit breaker. Failures are raised as ProviderErrors.
+        """
+        self.counters['calls'] += 1
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                result = await self._attempt(kind, call)
+            except Exception as e:
+                error = classify_error(e)
+                self._record_outcome(error)
+                if not error.retryable or attempt >= self.options['max_retries']:
+                    self.counters['failures'] += 1
+                    if error is e:
+                        raise
+                    raise error from e
+                delay = backoff_delay(attempt, self.options['backoff_base'], self.options['backoff_cap'])
+                attempt += 1
+                self.counters['retries'] += 1
+                print(f"{kind} call to '{self.name}' failed ({error}). Retry {attempt} in {delay:.2f}s.")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled: a probe that never finished must not keep the circuit half open.
+                self.breaker.record_neutral()
+                raise
+            self._record_outcome(None)
+            return result
+
+    async def _attempt(self, kind: str, call):
+        started = time.monotonic()
+        delay = self.hedge_delay(kind)
+        if delay is None:
+            coroutine = call()
+        else:
+            coroutine = self._hedged(call, delay)
+        try:
+            result = await asyncio.wait_for(coroutine, self.options['attempt_timeout'])
+        except asyncio.TimeoutError as e:
+            raise ProviderTimeout(f"No answer within {self.options['attempt_timeout']}s.") from e
+        self._tracker(kind).record(time.monotonic() - started)
+        return result
+
+    async def _hedged(self, call, delay: float):
+        first = asyncio.ensure_future(call())
+        running = {first}
+        try:
+            done, _ = await asyncio.wait(running, timeout=delay)
+            if done:
+                return first.result()
+
+            self.counters['hedged'] += 1
+            second = asyncio.ensure_future(call())
+            running.add(second)
+            error = None
+            while running:
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.counters['hedge_wins'] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # The slower request (or both, when the attempt timed out) is not needed any more.
+            for task in running:
+                task.cancel()
+
+    async def stream(self, kind: str, stream_factory):
+        """
+        Yields the pieces of `stream_factory()` (a function returning a new async
+        iterator each time). A stream that fails before its first piece is retried
+        like a call; once pieces were sent it cannot be restarted.
+        """
+        self.counters['calls'] += 1
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            started = False
+            try:
+                async for piece in stream_factory():
+                    if not started:
+                        started = True
+                        # The provider answers: a failure later in the stream is not an outage.
+                        self._record_outcome(None)
+                    yield piece
+            except Exception as e:
+                error = classify_error(e)
+                if not started:
+                    self._record_outcome(error)
+                if started or not error.retryable or attempt >= self.options['max_retries']:
+                    self.counters['failures'] += 1
+                    if error is e:
+                        raise
+                    raise error from e
+                delay = backoff_delay(attempt, self.options['backoff_base'], self.options['backoff_cap'])
+                attempt += 1
+                self.counters['retries'] += 1
+                print(f"{kind} stream from '{self.name}' failed ({error}). Retry {attempt} in {delay:.2f}s.")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.breaker.record_neutral()
+                raise
+            if not started:
+                self._record_outcome(None)
+            return
+
+    def state(self) -> dict:
+        return {
+            'provider': self.name,
+            'circuit': self.breaker.snapshot(),
+            **self.counters,
+            'hedge': self.options['hedge'],
+            # Current hedge delay per kind of call, once enough calls were measured.
+            'hedge_delays': {kind: self.hedge_delay(kind) for kind in self.latency} if self.options['hedge'] else {},
+        }
@@ -0,0 +1,250 @@
+"""
+Routing of the LLM calls between several backends.
+
+A backend is one provider and model (e.g. a fast, cheap Gemini model and a
+large one) behind its own processor layers. RoutingProcessor picks a backend
+for every call:
+
+1. Candidates are the backends that serve the task, accept an input of its
+   length (`max_chars`) and whose tier has not used up its cost budget.
+2. NLP_LLM_ROUTING['routes'] maps the task and the input length to a preferred
+   tier, e.g. short sentiment texts to 'fast' and long aggregates to 'large'.
+   Backends of that tier come first.
+3. Within that order, backends whose recent error rate is above
+   `unhealthy_error_rate` come last, and the others are ordered by expected
+   latency: the EWMA of their call durations divided by their success rate.
+4. A call that fails (other than a bad request) is sent to the next candidate.
+
+The budgets are per tier and per clock hour, in the unit of the backends'
+`cost_per_1k_chars` (estimated from the input length). They are shared by all
+workers through Redis; the latency and error statistics are kept per process.
+
+The backend that answered is recorded for the current context (see served_by()),
+so the pipelines can record the actual provider of a result.
+"""
+import contextvars
+import hashlib
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django_redis import get_redis_connection
+
+from nlp_services.cache_keys import processor_identity
+
+
+KEY_PREFIX = 'nlp_llm:budget'
+
+DEFAULT_ROUTING = {
+    # task: [(longest input in characters or None, preferred tier), ...]; the first match wins.
+    'routes': {
+        'sentiment': [(1000, 'fast'), (None, 'large')],
+        'summarization': [(4000, 'fast'), (None, 'large')],
+        'aggregate': [(20000, 'fast'), (None, 'large')],
+    },
+    # tier: cost per clock hour; tiers without a budget are not limited.
+    'budgets': {},
+    'ewma_alpha': 0.2,
+    'unhealthy_error_rate': 0.5,
+}
+
+TASKS = ('sentiment', 'summarization', 'aggregate')
+
+
+def routing_settings() -> dict:
+    return {**DEFAULT_ROUTING, **getattr(settings, 'NLP_LLM_ROUTING', {})}
+
+
+def preferred_tier(routes: dict, task: str, size: int):
+    for max_chars, tier in routes.get(task, []):
+        if max_chars is None or size <= max_chars:
+            return tier
+    return None
+
+
+# The (provider, model) of the backend that answered the latest routed call of this context.
+_served_by = contextvars.ContextVar('nlp_llm_served_by', default=None)
+
+
+def record_served(identity: tuple):
+    _served_by.set(identity)
+
+
+def served_by(processor) -> tuple:
+    """
+    Returns the (provider, model) that answered the latest call made through
+    `processor` in the current task, or the identity of `processor` itself.
+    Must be read right after the call, in the task that awaited it.
+    """
+    served = _served_by.get()
+    if served is not None:
+        return served
+    provider, model, _ = processor_identity(processor)
+    return provider, model
+
+
+def served_identities(processor) -> list:
+    """
+    Returns the (provider, model) pairs that may have produced the results of `processor`.
+    """
+    backends = getattr(processor, 'backends', None)
+    if backends:
+        return [backend.identity for backend in backends]
+    provider, model, _ = processor_identity(processor)
+    return [(provider, model)]
+
+
+class BackendStats:
+    """
+    Exponentially weighted moving averages of the latency and error rate of one backend.
+    """
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.calls = 0
+        self.failures = 0
+
+    def record(self, seconds: float, failed: bool):
+        self.calls += 1
+        if failed:
+            self.failures += 1
+        else:
+            # Failures often return early, so only successful calls measure the latency.
+            self.latency = seconds if self.latency is None else self.alpha * seconds + (1 - self.alpha) * self.latency
+        self.error_rate = self.alpha * failed + (1 - self.alpha) * self.error_rate
+
+    def expected_latency(self) -> float:
+        # Backends without measurements yet are tried as if they were fast.
+        return (self.latency or 0.0) / max(1.0 - self.error_rate, 0.1)
+
+
+class Backend:
+    """
+    One provider and model the calls can be routed to, behind its own processor layers.
+    """
+
+    def __init__(self, name: str, processor, tier: str = 'default', tasks=None, max_chars: int = None,
+                 cost_per_1k_chars: float = 0.0, alpha: float = 0.2):
+        self.name = name
+        self.processor = processor
+        self.tier = tier
+        self.tasks = tuple(tasks or TASKS)
+        self.max_chars = max_chars
+        self.cost_per_1k_chars = cost_per_1k_chars
+        self.stats = BackendStats(alpha)
+
+    @property
+    def identity(self) -> tuple:
+        provider, model, _ = processor_identity(self.processor)
+        return provider, model
+
+    def serves(self, task: str, size: int) -> bool:
+        return task in self.tasks and (self.max_chars is None or size <= self.max_chars)
+
+    def cost(self, size: int) -> float:
+        return self.cost_per_1k_chars * size / 1000
+
+    def state(self) -> dict:
+        provider, model = self.identity
+        state = {
+            'name': self.name,
+            'provider': provider,
+            'model': model,
+            'tier': self.tier,
+            'tasks': list(self.tasks),
+            'latency_ewma': self.stats.latency,
+            'error_rate': self.stats.error_rate,
+            'calls': self.stats.calls,
+            'failures': self.stats.failures,
+        }
+        # The processor layers of the backend (see llm_processor.py), when it has them.
+        for name, method in (('limits', 'limiter_state'), ('resilience', 'resilience_state')):
+            try:
+                state[name] = getattr(self.processor, method)()
+            except AttributeError:
+                pass
+        return state
+
+
+def routing_fingerprint(backends) -> str:
+    """
+    Identifies a set of backends, so that results cached for one routing configuration
+    are not served by another.
+    """
+    identities = sorted(f"{backend.name}={':'.join(backend.identity)}" for backend in backends)
+    return hashlib.sha256(",".join(identities).encode('utf-8')).hexdigest()[:12]
+
+
+class CostBudget:
+    """
+    The cost spent per tier in the current clock hour, shared through Redis.
+    """
+
+    def __init__(self, budgets: dict):
+        self.budgets = {tier: budget for tier, budget in budgets.items() if budget is not None}
+        self._lock = threading.Lock()
+        # Per-process fallback: {(tier, hour): spent}.
+        self.local = {}
+
+    def _redis(self):
+        try:
+            return get_redis_connection('default')
+        except NotImplementedError:
+            # The configured cache backend is not Redis (e.g. local memory in development).
+            return None
+
+    @staticmethod
+    def _hour() -> int:
+        return int(time.time() // 3600)
+
+    def _key(self, tier: str, hour: int) -> str:
+        return f'{KEY_PREFIX}:{tier}:{hour}'
+
+    def _spent(self) -> dict:
+        hour = self._hour()
+        tiers = list(self.budgets)
+        connection = self._redis()
+        if connection is None:
+            with self._lock:
+                return {tier: self.local.get((tier, hour), 0.0) for tier in tiers}
+        values = connection.mget([self._key(tier, hour) for tier in tiers])
+        return {tier: float(value or 0) for tier, value in zip(tiers, values)}
+
+    def _charge(self, tier: str, cost: float):
+        hour = self._hour()
+        connection = self._redis()
+        if connection is None:
+            with self._lock:
+                self.local[(tier, hour)] = self.local.get((tier, hour), 0.0) + cost
+                # Earlier hours are not needed any more.
+                for key in [key for key in self.local if key[1] < hour]:
+                    del self.local[key]
+            return
+        pipeline = connection.pipeline()
+        pipeline.incrbyfloat(self._key(tier, hour), cost)
+        pipeline.expire(self._key(tier, hour), 2 * 3600)
+        pipeline.execute()
+
+    async def exhausted(self) -> set:
+        """
+        Returns the tiers that have used up their budget for the current hour.
+        """
+        if not self.budgets:
+            return set()
+        spent = await sync_to_async(self._spent, thread_sensitive=False)()
+        return {tier for tier, budget in self.budgets.items() if spent[tier] >= budget}
+
+    async def charge(self, tier: str, cost: float):
+        if tier not in self.budgets or cost <= 0:
+            return
+        try:
+            await sync_to_async(self._charge, thread_sensitive=False)(tier, cost)
+        except Exception as e:
+            print(f"Could not record the cost of a call on tier '{tier}': {e}")
+
+    def state(self) -> dict:
+        spent = self._spent() if self.budgets else {}
+        return {tier: {'budget': budget, 'spent': spent[tier]} for tier, budget in self.budgets.items()}
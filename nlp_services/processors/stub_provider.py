@@ -0,0 +1,149 @@
+"""
+A local stand-in for the Gemini REST API.
+
+StubGeminiServer answers generateContent and streamGenerateContent calls with
+canned answers in the shapes the processors expect, after a configurable
+latency. It speaks HTTP/1.1 with keep-alive (optionally over TLS) and counts
+the connections it accepts, so connection reuse can be measured without
+network access or an API key:
+
+    python manage.py llm_stub_server --port 8765
+    GEMINI_API_BASE_URL=http://127.0.0.1:8765 (and a GeminiProcessor)
+
+benchmark_llm_transport starts one in-process.
+"""
+import asyncio
+import json
+import re
+
+
+BATCH_TEXTS_PATTERN = re.compile(r"\(JSON array\): (\[.*\])\s*$", re.DOTALL)
+ENDPOINT_PATTERN = re.compile(r"^/v1beta/models/[^/:]+:(generateContent|streamGenerateContent)$")
+
+
+def stub_answer(prompt: str) -> str:
+    """
+    Returns a plausible answer to one of the prompts in prompts.py.
+    """
+    sentiment = {"sentiment": "POSITIVE", "score": 0.98, "notes": "This is a stub response."}
+    batch = BATCH_TEXTS_PATTERN.search(prompt)
+    if batch:
+        try:
+            count = len(json.loads(batch.group(1)))
+        except ValueError:
+            count = 1
+        return json.dumps([sentiment] * count)
+    if "overall_sentiment" in prompt:
+        return json.dumps({
+            "overall_sentiment": "POSITIVE",
+            "satisfaction_score": 82,
+            "key_positives": [],
+            "key_negatives": [],
+            "summary": "This is a stub response.",
+        })
+    if "summarizer" in prompt:
+        return "This is a stub summary of the input text."
+    return json.dumps(sentiment)
+
+
+def _candidate(text: str) -> bytes:
+    return json.dumps({"candidates": [{"content": {"role": "model", "parts": [{"text": text}]}}]}).encode()
+
+
+class StubGeminiServer:
+    """
+    Serves the stub API on host:port (port 0 picks a free port, see `url`).
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.05, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.ssl_context = ssl_context
+        self.connections = 0
+        self.requests = 0
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        scheme = 'https' if self.ssl_context else 'http'
+        return f"{scheme}://{self.host}:{self.port}"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port, ssl=self.ssl_context)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def serve_forever(self):
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle_connection(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                self.requests += 1
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, method, target, body, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, method, target, body, keep_alive):
+        path = target.partition('?')[0]
+        endpoint = ENDPOINT_PATTERN.match(path)
+        connection_header = b"Connection: keep-alive\r\n" if keep_alive else b"Connection: close\r\n"
+
+        if method != 'POST' or endpoint is None:
+            payload = b'{"error": {"code": 404, "message": "Not found."}}'
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Type: application/json\r\n" + connection_header
+                         + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+            await writer.drain()
+            return
+
+        try:
+            prompt = json.loads(body)["contents"][0]["parts"][0]["text"]
+        except (ValueError, KeyError, IndexError, TypeError):
+            prompt = ""
+        answer = stub_answer(prompt)
+        await asyncio.sleep(self.latency)
+
+        if endpoint.group(1) == 'generateContent':
+            payload = _candidate(answer)
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n" + connection_header
+                         + f"Content-Length: {len(payload)}\r\n\r\n".encode() + payload)
+            await writer.drain()
+            return
+
+        # streamGenerateContent?alt=sse: the answer is sent word by word as server-sent events.
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n" + connection_header
+                     + b"Transfer-Encoding: chunked\r\n\r\n")
+        words = answer.split(" ")
+        for position, word in enumerate(words):
+            event = b"data: " + _candidate(word if position == len(words) - 1 else word + " ") + b"\r\n\r\n"
+            writer.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
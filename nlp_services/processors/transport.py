@@ -0,0 +1,246 @@
+"""
+Pooled HTTP transport for the LLM providers.
+
+Every upstream call used to go through a client that opened its own connection,
+so each call paid for DNS, TCP and TLS setup. PooledTransport keeps one
+long-lived httpx.AsyncClient per event loop instead: connections stay open
+between calls (keep-alive) and are shared by the concurrent calls of that loop,
+up to NLP_LLM_MAX_CONNECTIONS. With NLP_LLM_HTTP2 (and the `h2` package
+installed) the calls of a loop are multiplexed over a few HTTP/2 connections.
+
+A client is bound to the event loop it was created in, so a process that starts
+a new loop for every call would still set up a connection per call. Celery
+tasks therefore run their coroutines with run_on_worker_loop(), which reuses
+one loop per worker process for its whole lifetime.
+
+metrics() reports the requests made, the connections and TLS handshakes they
+needed and the state of the pools, e.g. to check that connections are reused.
+`python manage.py benchmark_llm_transport` measures the reuse against a local
+stub of the provider (see stub_provider.py).
+"""
+import asyncio
+import os
+import threading
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+from django.conf import settings
+
+try:
+    import httpx
+except ImportError:
+    # Optional dependency: without it the providers use their own SDK clients.
+    httpx = None
+
+try:
+    import h2
+except ImportError:
+    # Optional dependency of httpx for HTTP/2.
+    h2 = None
+
+
+class PoolMetrics:
+    """
+    Counters of the requests sent through a transport, shared by the pools of all loops.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.failures = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.connections_opened = 0
+            self.tls_handshakes = 0
+            self.total_seconds = 0.0
+
+    def request_started(self):
+        with self._lock:
+            self.requests += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def request_finished(self, seconds: float, failed: bool):
+        with self._lock:
+            self.in_flight -= 1
+            self.total_seconds += seconds
+            if failed:
+                self.failures += 1
+
+    def connection_event(self, event: str):
+        with self._lock:
+            if event == 'connection.connect_tcp.complete':
+                self.connections_opened += 1
+            elif event == 'connection.start_tls.complete':
+                self.tls_handshakes += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'failures': self.failures,
+                'in_flight': self.in_flight,
+                'max_in_flight': self.max_in_flight,
+                'connections_opened': self.connections_opened,
+                'tls_handshakes': self.tls_handshakes,
+                # Share of the requests that were sent over an already open connection.
+                'reuse_ratio': 1 - self.connections_opened / self.requests if self.requests else 0.0,
+                'average_seconds': self.total_seconds / self.requests if self.requests else 0.0,
+            }
+
+
+class PooledTransport:
+    """
+    Sends HTTP requests through one pooled, keep-alive httpx.AsyncClient per event loop.
+    """
+
+    def __init__(self, max_connections: int = 100, max_keepalive_connections: int = 20,
+                 keepalive_expiry: float = 30.0, timeout: float = 60.0, connect_timeout: float = 10.0,
+                 http2: bool = False, verify=True):
+        if httpx is None:
+            raise ImportError("PooledTransport needs the httpx package.")
+        if http2 and h2 is None:
+            print("NLP_LLM_HTTP2 is enabled but the h2 package is not installed. Using HTTP/1.1.")
+            http2 = False
+
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.http2 = http2
+        self.verify = verify
+        self.stats = PoolMetrics()
+        # One client per loop; a client is dropped with the loop it belongs to.
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        loop = asyncio.get_running_loop()
+        client = self._clients.get(loop)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2, verify=self.verify)
+            self._clients[loop] = client
+        return client
+
+    async def _trace(self, event: str, info: dict):
+        # httpcore reports the connection lifecycle through the 'trace' request extension.
+        self.stats.connection_event(event)
+
+    async def request(self, method: str, url: str, **kwargs):
+        """
+        Sends a request and returns the complete httpx.Response. HTTP error statuses are not raised.
+        """
+        self.stats.request_started()
+        started = time.monotonic()
+        failed = True
+        try:
+            response = await self._client().request(method, url, extensions={'trace': self._trace}, **kwargs)
+            failed = response.is_error
+            return response
+        finally:
+            self.stats.request_finished(time.monotonic() - started, failed)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, **kwargs):
+        """
+        Sends a request and yields the httpx.Response while its body is still being received.
+        The connection goes back to the pool when the block exits.
+        """
+        self.stats.request_started()
+        started = time.monotonic()
+        failed = True
+        try:
+            async with self._client().stream(method, url, extensions={'trace': self._trace}, **kwargs) as response:
+                failed = response.is_error
+                yield response
+        finally:
+            self.stats.request_finished(time.monotonic() - started, failed)
+
+    def pool_state(self) -> dict:
+        """
+        Returns the open and idle connections of the pools of all live loops.
+        """
+        state = {'clients': 0, 'open_connections': 0, 'idle_connections': 0}
+        for client in list(self._clients.values()):
+            if client.is_closed:
+                continue
+            state['clients'] += 1
+            # Read from httpcore's pool, which httpx does not expose publicly.
+            pool = getattr(getattr(client, '_transport', None), '_pool', None)
+            for connection in getattr(pool, 'connections', []):
+                state['open_connections'] += 1
+                if connection.is_idle():
+                    state['idle_connections'] += 1
+        return state
+
+    def metrics(self) -> dict:
+        return {
+            **self.stats.snapshot(),
+            **self.pool_state(),
+            'max_connections': self.limits.max_connections,
+            'http2': self.http2,
+        }
+
+    async def aclose(self):
+        """
+        Closes the client of the running loop and its connections.
+        """
+        client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> PooledTransport:
+    """
+    Returns the process-wide transport configured from the NLP_LLM_* settings.
+    """
+    global _transport
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                _transport = PooledTransport(
+                    max_connections=getattr(settings, 'NLP_LLM_MAX_CONNECTIONS', 100),
+                    max_keepalive_connections=getattr(settings, 'NLP_LLM_MAX_KEEPALIVE_CONNECTIONS', 20),
+                    keepalive_expiry=getattr(settings, 'NLP_LLM_KEEPALIVE_EXPIRY', 30.0),
+                    timeout=getattr(settings, 'NLP_LLM_TIMEOUT', 60.0),
+                    connect_timeout=getattr(settings, 'NLP_LLM_CONNECT_TIMEOUT', 10.0),
+                    http2=getattr(settings, 'NLP_LLM_HTTP2', False),
+                )
+    return _transport
+
+
+# --- Worker loop ---
+
+_worker_loop = None
+_worker_loop_pid = None
+_worker_loop_lock = threading.Lock()
+
+
+def _get_worker_loop():
+    global _worker_loop, _worker_loop_pid
+    with _worker_loop_lock:
+        # A forked worker process does not inherit the thread running its parent's loop.
+        if _worker_loop is None or _worker_loop_pid != os.getpid():
+            _worker_loop = asyncio.new_event_loop()
+            _worker_loop_pid = os.getpid()
+            threading.Thread(target=_worker_loop.run_forever, name='nlp-worker-loop', daemon=True).start()
+        return _worker_loop
+
+
+def run_on_worker_loop(coroutine):
+    """
+    Runs a coroutine on the long-lived event loop of this process and returns its result.
+    Unlike asyncio.run() or async_to_sync(), the loop (and the connection pools bound to it)
+    outlives the call. Must be called from synchronous code, e.g. a Celery task.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_worker_loop()).result()
@@ -0,0 +1,274 @@
+"""
+Usage quota engine.
+
+Free users spend one unit of `free_analysis_count` per analyzed text. Instead
+of locking the user row on every request, the balance is kept in Redis and
+checked-and-decremented atomically by a Lua script:
+
+    nlp_quota:remaining:<user id>   units left (seeded from the database, expires after NLP_QUOTA_TTL)
+    nlp_quota:consumed:<user id>    units spent (or refunded, when negative) since the last flush
+    nlp_quota:inflight:<user id>    units a running flush is writing to the database
+    nlp_quota:generation:<user id>  number of flushes settled for the user
+    nlp_quota:dirty                 ids of the users with a pending consumed count
+
+flush_usage() (run periodically by the flush_usage_quota Celery task) writes
+the consumed counts back to `free_analysis_count`, so the database lags
+behind by at most NLP_QUOTA_FLUSH_INTERVAL seconds. Pro users are never
+charged and cost no round trip at all. When the cache backend is not Redis
+(e.g. local memory in development) the engine falls back to row locks.
+
+The balance is seeded from a fresh read of the database, minus the units
+charged but not yet written there (consumed and in-flight). A flush settles
+by dropping the cached balance and bumping the user's generation; a seed whose
+database read may predate the settled flush sees another generation and reads
+again, so units are never granted twice.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django_redis import get_redis_connection
+
+
+User = get_user_model()
+
+KEY_PREFIX = 'nlp_quota'
+DIRTY_USERS_KEY = f'{KEY_PREFIX}:dirty'
+
+
+class UsageLimitExceeded(Exception):
+    """
+    Raised when a free user does not have enough analyses left for a request.
+    """
+
+
+# Returned by the deduct script when the balance must be (re)read from the database.
+NOT_SEEDED = -2
+
+# How often a charge re-reads the balance while flushes keep settling, before it locks the row instead.
+SEED_ATTEMPTS = 3
+
+# KEYS: remaining, consumed, dirty set, in-flight, generation.
+# ARGV: amount, user id, ttl, and to seed the balance: the balance in the database and
+# the generation read before it. The balance is seeded from the database minus what
+# was charged but not written there yet.
+DEDUCT_SCRIPT = """
+local remaining = redis.call('GET', KEYS[1])
+if remaining then
+    remaining = tonumber(remaining)
+else
+    if not ARGV[4] or (redis.call('GET', KEYS[5]) or '0') ~= ARGV[5] then
+        return -2
+    end
+    remaining = tonumber(ARGV[4]) - tonumber(redis.call('GET', KEYS[2]) or '0')
+        - tonumber(redis.call('GET', KEYS[4]) or '0')
+    redis.call('SET', KEYS[1], remaining, 'EX', ARGV[3])
+end
+local amount = tonumber(ARGV[1])
+if remaining < amount then
+    return -1
+end
+redis.call('DECRBY', KEYS[1], amount)
+redis.call('INCRBY', KEYS[2], amount)
+redis.call('SADD', KEYS[3], ARGV[2])
+return remaining - amount
+"""
+
+# KEYS: remaining, consumed, dirty set. ARGV: amount, user id.
+REFUND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+redis.call('DECRBY', KEYS[2], ARGV[1])
+redis.call('SADD', KEYS[3], ARGV[2])
+return 1
+"""
+
+# KEYS: consumed, in-flight. Moves the pending count to in-flight, where it still counts
+# against the balance until the flush settles. An in-flight count left by a flush that
+# died may already be in the database, so it is replaced rather than charged twice.
+TAKE_CONSUMED_SCRIPT = """
+local consumed = tonumber(redis.call('GET', KEYS[1]) or '0')
+redis.call('DEL', KEYS[1])
+if consumed == 0 then
+    redis.call('DEL', KEYS[2])
+else
+    redis.call('SET', KEYS[2], consumed)
+end
+return consumed
+"""
+
+# KEYS: consumed, in-flight, dirty set. ARGV: user id. Puts back a count whose flush failed.
+RESTORE_CONSUMED_SCRIPT = """
+redis.call('INCRBY', KEYS[1], redis.call('GET', KEYS[2]) or '0')
+redis.call('DEL', KEYS[2])
+redis.call('SADD', KEYS[3], ARGV[1])
+return 1
+"""
+
+# KEYS: in-flight, generation, remaining. ARGV: ttl. The count is in the database now:
+# the next charge seeds the balance again, from a read made after this flush.
+SETTLE_SCRIPT = """
+redis.call('DEL', KEYS[1])
+redis.call('INCR', KEYS[2])
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+redis.call('DEL', KEYS[3])
+return 1
+"""
+
+
+class UsageQuota:
+    """
+    Atomic check-and-decrement of the free usage quota.
+    """
+
+    def __init__(self, ttl: int = 3600):
+        self.ttl = ttl
+        self._scripts = None
+
+    def _redis(self):
+        try:
+            return get_redis_connection('default')
+        except NotImplementedError:
+            # The configured cache backend is not Redis (e.g. local memory in development).
+            return None
+
+    def _script(self, connection, name):
+        if self._scripts is None:
+            self._scripts = {
+                'deduct': connection.register_script(DEDUCT_SCRIPT),
+                'refund': connection.register_script(REFUND_SCRIPT),
+                'take': connection.register_script(TAKE_CONSUMED_SCRIPT),
+                'restore': connection.register_script(RESTORE_CONSUMED_SCRIPT),
+                'settle': connection.register_script(SETTLE_SCRIPT),
+            }
+        return self._scripts[name]
+
+    def _keys(self, user_id):
+        return f'{KEY_PREFIX}:remaining:{user_id}', f'{KEY_PREFIX}:consumed:{user_id}'
+
+    def _flush_keys(self, user_id):
+        return f'{KEY_PREFIX}:inflight:{user_id}', f'{KEY_PREFIX}:generation:{user_id}'
+
+    def _balance(self, user_id) -> int:
+        # Read at the moment of seeding: the user loaded by the request may predate a flush.
+        return User.objects.filter(pk=user_id).values_list('free_analysis_count', flat=True).first() or 0
+
+    def _write_consumed(self, user_id, consumed: int):
+        User.objects.filter(pk=user_id).update(
+            free_analysis_count=Greatest(F('free_analysis_count') - consumed, 0)
+        )
+
+    # --- Charging ---
+
+    def deduct(self, user, amount: int = 1):
+        """
+        Charges `amount` units to a free user, or raises UsageLimitExceeded.
+        """
+        if user.is_pro or amount <= 0:
+            return
+
+        connection = self._redis()
+        if connection is None:
+            return self._deduct_with_row_lock(user, amount)
+
+        remaining_key, consumed_key = self._keys(user.pk)
+        inflight_key, generation_key = self._flush_keys(user.pk)
+        keys = [remaining_key, consumed_key, DIRTY_USERS_KEY, inflight_key, generation_key]
+        deduct = self._script(connection, 'deduct')
+        remaining = deduct(keys=keys, args=[amount, user.pk, self.ttl])
+        for _ in range(SEED_ATTEMPTS):
+            if remaining != NOT_SEEDED:
+                break
+            generation = int(connection.get(generation_key) or 0)
+            remaining = deduct(keys=keys, args=[amount, user.pk, self.ttl, self._balance(user.pk), generation])
+        if remaining == NOT_SEEDED:
+            # Flushes kept settling while the balance was read: the row lock is always right.
+            return self._deduct_with_row_lock(user, amount)
+        if remaining < 0:
+            raise UsageLimitExceeded("Free usage limit exceeded. Please upgrade your plan.")
+
+    def refund(self, user, amount: int = 1):
+        """
+        Gives back units charged for work that failed.
+        """
+        if user.is_pro or amount <= 0:
+            return
+
+        connection = self._redis()
+        if connection is None:
+            User.objects.filter(pk=user.pk).update(free_analysis_count=F('free_analysis_count') + amount)
+            return
+
+        remaining_key, consumed_key = self._keys(user.pk)
+        self._script(connection, 'refund')(
+            keys=[remaining_key, consumed_key, DIRTY_USERS_KEY],
+            args=[amount, user.pk],
+        )
+
+    async def adeduct(self, user, amount: int = 1):
+        if user.is_pro or amount <= 0:
+            return
+        await sync_to_async(self.deduct)(user, amount)
+
+    async def arefund(self, user, amount: int = 1):
+        if user.is_pro or amount <= 0:
+            return
+        await sync_to_async(self.refund)(user, amount)
+
+    def reset(self, user_id):
+        """
+        Drops the cached balance of a user, e.g. after an admin changed it in the database.
+        The next charge seeds it again from the database.
+        """
+        connection = self._redis()
+        if connection is not None:
+            connection.delete(self._keys(user_id)[0])
+
+    # This is a synchronous method: the row lock needs a real transaction.
+    def _deduct_with_row_lock(self, user, amount):
+        with transaction.atomic():
+            user_instance = User.objects.select_for_update().get(pk=user.pk)
+            if user_instance.free_analysis_count >= amount:
+                user_instance.free_analysis_count -= amount
+                user_instance.save(update_fields=['free_analysis_count'])
+            else:
+                raise UsageLimitExceeded("Free usage limit exceeded. Please upgrade your plan.")
+
+    # --- Flushing ---
+
+    def flush_usage(self) -> int:
+        """
+        Writes the consumed counts back to free_analysis_count and returns the
+        number of users updated. A count whose database update fails is put back
+        for the next flush.
+        """
+        connection = self._redis()
+        if connection is None:
+            return 0
+
+        flushed = 0
+        for raw_user_id in connection.smembers(DIRTY_USERS_KEY):
+            user_id = int(raw_user_id)
+            # Removed before taking the count: a charge made in between adds the user back.
+            connection.srem(DIRTY_USERS_KEY, raw_user_id)
+            remaining_key, consumed_key = self._keys(user_id)
+            inflight_key, generation_key = self._flush_keys(user_id)
+            consumed = self._script(connection, 'take')(keys=[consumed_key, inflight_key])
+            if not consumed:
+                continue
+
+            try:
+                self._write_consumed(user_id, consumed)
+            except Exception as e:
+                print(f"Could not flush the usage of user {user_id}: {e}. Keeping it for the next flush.")
+                self._script(connection, 'restore')(keys=[consumed_key, inflight_key, DIRTY_USERS_KEY], args=[user_id])
+                continue
+            self._script(connection, 'settle')(keys=[inflight_key, generation_key, remaining_key], args=[self.ttl])
+            flushed += 1
+        return flushed
+
+
+usage_quota = UsageQuota(ttl=getattr(settings, 'NLP_QUOTA_TTL', 3600))
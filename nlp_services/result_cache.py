@@ -0,0 +1,226 @@
+"""
+Two-tier cache for NLP results.
+
+L0 is a small, bounded in-process LRU cache with a TTL, so repeated lookups of
+hot keys never leave the worker. L1 is Django's default cache (Redis), shared
+by all workers. Writes and deletes are broadcast over Redis pub/sub so that the
+other workers drop their L0 copy of a key that changed.
+
+Values are stored in L1 as bytes encoded by the cache codec (see
+nlp_services.cache_codec); L0 keeps the decoded values.
+
+Values returned from L0 are shared between callers and must be treated as read-only.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+from nlp_services.cache_codec import get_cache_codec
+
+
+class LocalLRUCache:
+    """
+    A thread-safe LRU cache with a per-entry TTL and hit/miss counters.
+    """
+    _MISSING = object()
+
+    def __init__(self, max_entries: int = 2048, ttl: float = 60):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict() # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key, self._MISSING)
+            if entry is self._MISSING or entry[0] <= now:
+                if entry is not self._MISSING:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class TieredResultCache:
+    """
+    The L0 (in-process) + L1 (Redis) result cache used by the NLP views.
+    It exposes the subset of Django's cache API that the views need.
+    """
+
+    def __init__(self, backend=cache, max_entries: int = 2048, ttl: float = 60, channel: str = None, codec=None):
+        self.backend = backend
+        self.codec = codec or get_cache_codec()
+        self.local = LocalLRUCache(max_entries=max_entries, ttl=ttl)
+        self.channel = channel
+        self.remote_hits = 0
+        self.remote_misses = 0
+        # Identifies this process, so it can ignore its own invalidation messages.
+        self._origin = uuid.uuid4().hex
+        self._listener_pid = None
+        self._listener_lock = threading.Lock()
+
+    # --- Lookups ---
+
+    def get(self, key, default=None):
+        self._ensure_listener()
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        return self._get_remote(key, default)
+
+    async def aget(self, key, default=None):
+        self._ensure_listener()
+        # L0 hits are answered on the event loop without a thread hop.
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        return await sync_to_async(self._get_remote)(key, default)
+
+    def _get_remote(self, key, default=None):
+        data = self.backend.get(key)
+        # Entries in another format (or an older codec version) count as misses.
+        value = self.codec.decode(data) if data is not None else None
+        if value is None:
+            self.remote_misses += 1
+            return default
+        self.remote_hits += 1
+        self.local.set(key, value)
+        return value
+
+    # --- Writes ---
+
+    def set(self, key, value, timeout=None):
+        self._ensure_listener()
+        self.backend.set(key, self.codec.encode(value), timeout=timeout)
+        self.local.set(key, value, ttl=timeout)
+        self._publish_invalidation(key)
+
+    async def aset(self, key, value, timeout=None):
+        await sync_to_async(self.set)(key, value, timeout)
+
+    def set_many(self, mapping: dict, timeout=None):
+        """
+        Writes many entries to L1 at once, e.g. to warm the cache. Other workers
+        are not notified; their L0 copies expire within the L0 TTL.
+        """
+        self.backend.set_many({key: self.codec.encode(value) for key, value in mapping.items()}, timeout=timeout)
+        for key in mapping:
+            self.local.delete(key)
+
+    def delete(self, key):
+        self._ensure_listener()
+        self.backend.delete(key)
+        self.local.delete(key)
+        self._publish_invalidation(key)
+
+    async def adelete(self, key):
+        await sync_to_async(self.delete)(key)
+
+    def stats(self) -> dict:
+        remote_lookups = self.remote_hits + self.remote_misses
+        return {
+            'local': self.local.stats(),
+            'remote': {
+                'hits': self.remote_hits,
+                'misses': self.remote_misses,
+                'hit_rate': round(self.remote_hits / remote_lookups, 4) if remote_lookups else 0.0,
+            },
+        }
+
+    # --- Invalidation over Redis pub/sub ---
+
+    def _redis(self):
+        try:
+            return get_redis_connection('default')
+        except NotImplementedError:
+            # The configured cache backend is not Redis (e.g. local memory in development).
+            return None
+
+    def _publish_invalidation(self, key):
+        if not self.channel:
+            return
+        connection = self._redis()
+        if connection is not None:
+            connection.publish(self.channel, json.dumps({'origin': self._origin, 'key': key}))
+
+    def _ensure_listener(self):
+        """
+        Starts the invalidation listener thread once per process (again after a fork).
+        """
+        if not self.channel or self._listener_pid == os.getpid():
+            return
+        with self._listener_lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._listener_pid = os.getpid()
+            # A forked child gets its own origin and must not reuse entries that the
+            # parent may have missed invalidations for.
+            self._origin = uuid.uuid4().hex
+            self.local.clear()
+            if self._redis() is not None:
+                threading.Thread(target=self._listen, name='nlp-cache-invalidation', daemon=True).start()
+
+    def _listen(self):
+        while True:
+            try:
+                pubsub = self._redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                for message in pubsub.listen():
+                    payload = json.loads(message['data'])
+                    if payload.get('origin') != self._origin:
+                        self.local.delete(payload['key'])
+            except Exception as e:
+                # Entries may have changed while disconnected, so start from an empty L0.
+                print(f"Cache invalidation listener error: {e}. Reconnecting.")
+                self.local.clear()
+                time.sleep(1)
+
+
+result_cache = TieredResultCache(
+    max_entries=getattr(settings, 'NLP_LOCAL_CACHE_MAX_ENTRIES', 2048),
+    ttl=getattr(settings, 'NLP_LOCAL_CACHE_TTL', 60),
+    channel=getattr(settings, 'NLP_CACHE_INVALIDATION_CHANNEL', 'nlp_results_cache:invalidate'),
+)
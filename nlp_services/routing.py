@@ -0,0 +1,8 @@
+from django.urls import path
+from . import consumers
+
+
+websocket_urlpatterns = [
+    # Real-time progress and results of the user's analysis jobs
+    path('ws/nlp/jobs/', consumers.JobProgressConsumer.as_asgi(), name='nlp_job_updates'),
+]
@@ -1,5 +1,6 @@
+from django.conf import settings
 from rest_framework import serializers
-from nlp_services.models import AnalysisHistory, SummarizationHistory, AggregateAnalysisHistory
+from nlp_services.models import AnalysisHistory, SummarizationHistory, AggregateAnalysisHistory, AnalysisJob
 
 
 class SentimentAnalysisRequestSerializer(serializers.Serializer):
@@ -21,6 +22,19 @@ class SentimentAnalysisRequestSerializer(serializers.Serializer):
         return value
 
 
+class SentimentBulkRequestSerializer(SentimentAnalysisRequestSerializer):
+    """
+    Serializer for the query parameters of a bulk NDJSON upload.
+    The texts themselves are read from the request body.
+    """
+    texts = None
+    analysis_type = serializers.CharField(default='general_sentiment', max_length=50)
+    # Number of the first line to score; lines before it were scored by an earlier, interrupted upload.
+    cursor = serializers.IntegerField(min_value=0, required=False)
+    # Client-chosen name of the upload. Its cursor is remembered, so a retry without 'cursor' resumes.
+    upload_id = serializers.SlugField(max_length=64, required=False)
+
+
 class SentimentAnalysisResultSerializer(serializers.Serializer):
     """
     Serializer for displaying a single sentiment analysis result to the user.
@@ -30,14 +44,34 @@ class SentimentAnalysisResultSerializer(serializers.Serializer):
     sentiment_type = serializers.CharField() 
     score = serializers.FloatField()
     notes = serializers.CharField(allow_blank=True, required=False) 
+    # Only present (and true) when an earlier result was served because the AI provider is unavailable.
+    stale = serializers.BooleanField(required=False)
+
 
+class OptionalInputFieldsMixin:
+    """
+    Leaves out the (possibly large) input fields listed in `input_fields` when
+    the view sets include_input=False in the serializer context.
+    """
+    input_fields = ()
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if not self.context.get('include_input', True):
+            for name in self.input_fields:
+                fields.pop(name, None)
+        return fields
 
-class AnalysisHistorySerializer(serializers.ModelSerializer):
+
+class AnalysisHistorySerializer(OptionalInputFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the AnalysisHistory model.
     Displays the model name (analysis_source) and the full JSON result.
     """
     timestamp = serializers.DateTimeField(format="%Y-%m-%d", read_only=True)
+    # Read through the model property so rows that reference the shared result store work too.
+    analysis_result = serializers.JSONField(source='result', read_only=True)
+    input_fields = ('text_input',)
 
     class Meta:
         model = AnalysisHistory
@@ -66,13 +100,19 @@ class SummarizationResultSerializer(serializers.Serializer):
     """
     original_text = serializers.CharField()
     summarized_text = serializers.CharField()
+    # Only present (and true) when an earlier summary was served because the AI provider is unavailable.
+    stale = serializers.BooleanField(required=False)
 
 
-class SummarizationHistorySerializer(serializers.ModelSerializer):
+class SummarizationHistorySerializer(OptionalInputFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the SummarizationHistory model.
     """
     timestamp = serializers.DateTimeField(format="%Y-%m-%d", read_only=True)
+    summarized_text = serializers.CharField(source='summary', read_only=True)
+    # Read through the model property so inputs kept in the blob store are decompressed.
+    text_input = serializers.CharField(source='input_text', read_only=True)
+    input_fields = ('text_input',)
 
     class Meta:
         model = SummarizationHistory
@@ -124,11 +164,14 @@ class AggregateAnalysisResultSerializer(serializers.Serializer):
     summary = serializers.CharField()
 
 
-class AggregateAnalysisHistorySerializer(serializers.ModelSerializer):
+class AggregateAnalysisHistorySerializer(OptionalInputFieldsMixin, serializers.ModelSerializer):
     """
     Serializer for the AggregateAnalysisHistory model to display the user's history.
     """
     timestamp = serializers.DateTimeField(format="%Y-%m-%d", read_only=True)
+    # Read through the model property so inputs kept in the blob store are decompressed.
+    input_texts = serializers.JSONField(source='texts', read_only=True)
+    input_fields = ('input_texts',)
 
     class Meta:
         model = AggregateAnalysisHistory
@@ -140,4 +183,73 @@ class AggregateAnalysisHistorySerializer(serializers.ModelSerializer):
             'analysis_source',
             'analysis_type',
             'timestamp',
-        ]
\ No newline at end of file
+        ]
+
+
+# -- Analysis Job Serializers --
+
+class SentimentJobInputSerializer(SentimentAnalysisRequestSerializer):
+    """
+    The input of a sentiment job. Jobs accept many more texts than the synchronous endpoint.
+    """
+    texts = serializers.ListField(
+        child=serializers.CharField(max_length=5000),
+        min_length=1,
+        max_length=getattr(settings, 'NLP_JOB_MAX_TEXTS', 1000)
+    )
+
+
+class AggregateJobInputSerializer(AggregateAnalysisRequestSerializer):
+    """
+    The input of an aggregate job. Large inputs are analyzed chunk by chunk by the worker.
+    """
+    texts = serializers.ListField(
+        child=serializers.CharField(max_length=5000),
+        required=False,
+        max_length=getattr(settings, 'NLP_JOB_MAX_TEXTS', 1000)
+    )
+
+
+class AnalysisJobRequestSerializer(serializers.Serializer):
+    """
+    Serializer for submitting an analysis job.
+    Besides 'job_type' and 'priority', the request holds the same fields as the
+    synchronous endpoint of the job type; they are validated by its serializer.
+    """
+    INPUT_SERIALIZERS = {
+        'sentiment': SentimentJobInputSerializer,
+        'summarization': SummarizationRequestSerializer,
+        'aggregate': AggregateJobInputSerializer,
+    }
+
+    job_type = serializers.ChoiceField(choices=AnalysisJob.JOB_TYPE_CHOICES)
+    priority = serializers.ChoiceField(choices=AnalysisJob.PRIORITY_CHOICES, default='default')
+
+    def validate(self, data):
+        input_serializer = self.INPUT_SERIALIZERS[data['job_type']](data=self.initial_data)
+        input_serializer.is_valid(raise_exception=True)
+        data['input_data'] = input_serializer.validated_data
+        return data
+
+
+class AnalysisJobSerializer(serializers.ModelSerializer):
+    """
+    Serializer for displaying the status and, once finished, the result of a job.
+    """
+    progress = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = AnalysisJob
+        fields = [
+            'id',
+            'job_type',
+            'priority',
+            'status',
+            'attempts',
+            'progress',
+            'result',
+            'error',
+            'created_at',
+            'started_at',
+            'finished_at',
+        ]
@@ -0,0 +1,521 @@
+"""
+The NLP analysis pipelines shared by the HTTP views and the Celery job tasks.
+
+Each pipeline runs the multi-level lookup (L1 Redis cache, L2 result store or
+history, external API) for one task and saves the history of the given user.
+Usage quota is deducted by the callers, except for aggregate analysis, which is
+only charged when the result is not found in any cache. Quota charged for work
+that failed upstream is refunded.
+"""
+import asyncio
+
+from django.conf import settings
+
+from nlp_services.processors.llm_processor import processor_instance
+from nlp_services.processors.errors import ProviderRateLimited, ProviderUnavailable
+from nlp_services.processors.routing import served_by
+from nlp_services.result_cache import result_cache
+from nlp_services.quota import usage_quota, UsageLimitExceeded
+from nlp_services import history_buffer
+from nlp_services.cache_keys import (
+    RESULT_CACHE_TIMEOUT,
+    sentiment_result_key,
+    summarization_result_key,
+    aggregate_result_key,
+    text_fingerprint,
+    texts_fingerprint,
+)
+from nlp_services.models import AggregateAnalysisHistory, StoredResult
+
+processor = processor_instance
+
+
+def normalize_text_simple(text: str) -> str:
+    """
+    A simple normalization function for Persian text.
+    It removes extra whitespace and trailing periods.
+    """
+    if not isinstance(text, str):
+        return ""
+
+    # 1. Remove leading/trailing whitespace
+    text = text.strip()
+
+    # 2. Collapse multiple spaces/tabs/newlines in the middle of the text into a single space
+    text = ' '.join(text.split())
+
+    # 3. Remove all trailing periods from the end of the string
+    text = text.strip('.')
+
+    return text
+
+
+# --- Usage quota ---
+# Charged and refunded atomically in Redis; see nlp_services.quota.
+
+def check_and_deduct_usage(user, num_items: int = 1):
+    usage_quota.deduct(user, num_items)
+
+
+async def acheck_and_deduct_usage(user, num_items: int = 1):
+    await usage_quota.adeduct(user, num_items)
+
+
+def refund_usage(user, num_items: int = 1):
+    """
+    Gives back the quota charged for texts whose analysis failed.
+    """
+    usage_quota.refund(user, num_items)
+
+
+async def arefund_usage(user, num_items: int = 1):
+    await usage_quota.arefund(user, num_items)
+
+
+def count_failed(results) -> int:
+    """
+    Returns the number of ERROR results in the output of run_sentiment_analysis().
+    """
+    return sum(1 for result in results if result['sentiment_type'] == 'ERROR')
+
+
+# --- Result store and history ---
+
+async def get_stored_result(result_key):
+    """
+    Looks up a result in the shared store (L2 Cache) by its unique key.
+    """
+    return await StoredResult.objects.filter(result_key=result_key.store_key).afirst()
+
+
+async def get_stale_result(result_key):
+    """
+    Returns the latest stored result for the same task, input and parameters that
+    was produced by another configuration (provider, model or prompt version), or None.
+    Served while the provider is unavailable, instead of an error.
+    """
+    return await StoredResult.objects.filter(
+        task=result_key.task, text_hash=result_key.content_hash, params=result_key.params
+    ).exclude(result_key=result_key.store_key).order_by('-created_at').afirst()
+
+
+async def store_result(result_key, result, served=None):
+    """
+    Saves a result to the shared store. If another request stored the same
+    result first, that row is returned instead.
+    `served` is the (provider, model) that produced the result, when the key's
+    processor routes between several (see processors/routing.py).
+    """
+    provider, model = served or (result_key.provider, result_key.model)
+    stored_result, _ = await StoredResult.objects.aget_or_create(
+        result_key=result_key.store_key,
+        defaults={
+            'task': result_key.task,
+            'text_hash': result_key.content_hash,
+            'params': result_key.params,
+            'result': result,
+            'source': provider,
+            'model_name': model,
+            'prompt_version': result_key.prompt_version,
+        }
+    )
+    return stored_result
+
+
+# History rows are written behind the response (see nlp_services.history_buffer).
+
+async def save_analysis_history(user, text_input, stored_result, source, analysis_type):
+    await history_buffer.aenqueue(
+        'sentiment',
+        user_id=user.pk,
+        text_input=text_input,
+        stored_result_id=stored_result.pk,
+        analysis_source=source,
+        analysis_type=analysis_type
+    )
+
+
+async def save_summarization_history(user, text_input, stored_result, source, max_words):
+    """
+    Saves the text summarization result to history.
+    """
+    await history_buffer.aenqueue(
+        'summarization',
+        user_id=user.pk,
+        text_input=text_input,
+        stored_result_id=stored_result.pk,
+        summarization_source=source,
+        max_words_summarization=max_words
+    )
+
+
+async def save_aggregate_history(user, url, result, source, analysis_type, fingerprint, original_texts, chunk_results=None):
+    """
+    Saves the aggregate analysis result to its dedicated history model.
+    """
+    await history_buffer.aenqueue(
+        'aggregate',
+        user_id=user.pk,
+        url=url, # Use the 'url' field we defined in the model
+        analysis_result=result,
+        analysis_source=source,
+        analysis_type=analysis_type,
+        input_fingerprint=fingerprint,
+        input_texts=original_texts,
+        chunk_results=chunk_results
+    )
+
+
+# --- Sentiment analysis ---
+
+async def analyze_texts_as_completed(texts, analysis_type, concurrency: int = None):
+    """
+    Runs the LLM calls for all cache misses of a request at the same time,
+    limited to NLP_LLM_CONCURRENCY calls in flight (or `concurrency` texts), and
+    yields (position, outcome, served) triples in the order the calls finish, where
+    `served` is the (provider, model) that produced the outcome.
+    A failed call yields its exception so that one bad text does not fail the others.
+    """
+    if concurrency:
+        limit = concurrency
+    elif processor.batches_sentiment:
+        # The batching layer packs the texts into a few upstream calls itself,
+        # so they are all handed over at once.
+        limit = max(len(texts), 1)
+    else:
+        limit = getattr(settings, 'NLP_LLM_CONCURRENCY', 5)
+    semaphore = asyncio.Semaphore(limit)
+
+    async def analyze_one(position, text):
+        async with semaphore:
+            try:
+                result = await processor.analyze_sentiment(text=text, analysis_type=analysis_type)
+            except Exception as e:
+                return position, e, None
+            # Read in this task: the answering backend is recorded per task.
+            return position, result, served_by(processor)
+
+    for next_finished in asyncio.as_completed([analyze_one(position, text) for position, text in enumerate(texts)]):
+        yield await next_finished
+
+
+def build_sentiment_result(normalized_text, llm_result, stale=False):
+    result = {
+        "text_input": normalized_text,
+        "sentiment_type": llm_result.get('sentiment'),
+        "score": llm_result.get('score'),
+        "notes": llm_result.get('notes', '')
+    }
+    if stale:
+        result["stale"] = True
+    return result
+
+
+def build_sentiment_error(normalized_text, error):
+    return {
+        "text_input": normalized_text, "sentiment_type": "ERROR", "score": 0.0,
+        "notes": f"Failed to process: {str(error)}"
+    }
+
+
+async def run_sentiment_analysis(user, texts, analysis_type, on_result=None):
+    """
+    Analyzes a list of texts and returns one result per text, in input order.
+    A text whose analysis failed gets an ERROR result instead of failing the others.
+    `on_result(index, result)` is awaited for every text as soon as its result is known.
+
+    While the provider is unavailable, a text gets a stale result (see get_stale_result())
+    when there is one. When no text sent upstream could be analyzed because the
+    provider is rate limiting or unavailable, ProviderRateLimited or
+    ProviderUnavailable is raised instead, so the caller can ask the client to retry.
+    """
+    results = [None] * len(texts)
+    # Cache misses are collected here (keyed by cache key, so duplicate texts in
+    # the same request are only sent once) and analyzed together after the loop.
+    pending_misses = {}
+    for index, text in enumerate(texts):
+        normalized_text = normalize_text_simple(text)
+
+        # --- Multi-level Caching Logic Starts Here ---
+
+        # 1. Check Redis cache first (L1 Cache)
+        result_key = sentiment_result_key(processor, normalized_text, analysis_type)
+        cache_key = result_key.cache_key
+        cached_result = await result_cache.aget(cache_key)
+
+        if cached_result:
+            print(f"Retrieved sentiment analysis for '{normalized_text[:30]}...' from L1 Cache (Redis).")
+            results[index] = build_sentiment_result(normalized_text, cached_result)
+            if on_result:
+                await on_result(index, results[index])
+            continue
+
+        # 2. If not in Redis, check the shared result store (L2 Cache)
+        # Results are shared by all users, so a text analyzed for anyone is reused.
+        stored_result = await get_stored_result(result_key)
+
+        if stored_result:
+            print(f"Retrieved from L2 Cache (Database) and re-populating Redis.")
+            llm_result = stored_result.result
+            # Re-populate the Redis cache
+            await result_cache.aset(cache_key, llm_result, timeout=RESULT_CACHE_TIMEOUT)
+            # The result may have been produced for another user: this user's history references the shared row.
+            await save_analysis_history(user, normalized_text, stored_result, stored_result.source, analysis_type)
+            results[index] = build_sentiment_result(normalized_text, llm_result)
+            if on_result:
+                await on_result(index, results[index])
+            continue
+
+        # 3. If not in any cache, queue it for the external API
+        pending_misses.setdefault(cache_key, (normalized_text, result_key, []))[2].append(index)
+
+    if pending_misses:
+        miss_keys = list(pending_misses)
+        miss_texts = [pending_misses[key][0] for key in miss_keys]
+        print(f"No cache hit for {len(miss_texts)} text(s). Calling external API concurrently.")
+
+        # Each result is saved and reported as soon as its call finishes,
+        # while the calls for the other texts are still running.
+        retry_later = []
+        async for position, outcome, served in analyze_texts_as_completed(miss_texts, analysis_type):
+            cache_key, normalized_text = miss_keys[position], miss_texts[position]
+            stale_result = None
+            if isinstance(outcome, ProviderUnavailable):
+                stale_result = await get_stale_result(pending_misses[cache_key][1])
+
+            if stale_result:
+                # Not cached: the current configuration answers again once the provider is back.
+                result = build_sentiment_result(normalized_text, stale_result.result, stale=True)
+            elif isinstance(outcome, Exception):
+                if isinstance(outcome, (ProviderRateLimited, ProviderUnavailable)):
+                    retry_later.append(outcome)
+                result = build_sentiment_error(normalized_text, outcome)
+            else:
+                # Save to both caches for future requests
+                await result_cache.aset(cache_key, outcome, timeout=RESULT_CACHE_TIMEOUT)
+                stored_result = await store_result(pending_misses[cache_key][1], outcome, served)
+                await save_analysis_history(user, normalized_text, stored_result, served[0], analysis_type)
+                result = build_sentiment_result(normalized_text, outcome)
+
+            for index in pending_misses[cache_key][2]:
+                results[index] = result
+                if on_result:
+                    await on_result(index, result)
+
+        # Nothing could be analyzed: the caller answers 429 (or 503) rather than a list of errors.
+        if retry_later and len(retry_later) == len(miss_keys):
+            rate_limited = [error for error in retry_later if isinstance(error, ProviderRateLimited)]
+            raise max(rate_limited or retry_later, key=lambda error: error.retry_after or 0)
+
+    return results
+
+
+# --- Summarization ---
+
+async def run_summarization(user, text, max_words):
+    """
+    Summarizes a text and returns {"original_text", "summarized_text"}.
+    Errors of the external API are raised to the caller.
+    """
+    normalized_text = normalize_text_simple(text)
+
+    # --- Multi-level Caching Logic Starts Here ---
+
+    # 1. Check Redis cache first (L1 Cache)
+    result_key = summarization_result_key(processor, normalized_text, max_words)
+    cache_key = result_key.cache_key
+    summarized_text = await result_cache.aget(cache_key)
+
+    if summarized_text:
+        print(f"Retrieved summarization for '{normalized_text[:30]}...' from L1 Cache (Redis).")
+
+    else:
+        # 2. If not in Redis, check the shared result store (L2 Cache)
+        stored_result = await get_stored_result(result_key)
+
+        if stored_result:
+            print(f"Retrieved from L2 Cache (Database) and re-populating Redis.")
+            summarized_text = stored_result.result
+            # Re-populate the Redis cache
+            await result_cache.aset(cache_key, summarized_text, timeout=RESULT_CACHE_TIMEOUT)
+            await save_summarization_history(
+                user, normalized_text, stored_result, stored_result.source, max_words
+            )
+        else:
+            # 3. If not in any cache, call the external API
+            print(f"No cache hit. Calling external API for summarization of '{normalized_text[:30]}...'.")
+            try:
+                summarized_text = await processor.summarize_text(
+                    text=normalized_text,
+                    max_words=max_words
+                )
+            except ProviderUnavailable:
+                stale_result = await get_stale_result(result_key)
+                if stale_result is None:
+                    raise
+                print("The AI provider is unavailable. Serving a stale summarization.")
+                return {
+                    "original_text": normalized_text,
+                    "summarized_text": stale_result.result,
+                    "stale": True
+                }
+            served = served_by(processor)
+
+            # Save to both caches for future requests
+            await result_cache.aset(cache_key, summarized_text, timeout=RESULT_CACHE_TIMEOUT)
+            stored_result = await store_result(result_key, summarized_text, served)
+            await save_summarization_history(
+                user, normalized_text, stored_result, served[0], max_words
+            )
+
+    return {
+        "original_text": normalized_text,
+        "summarized_text": summarized_text
+    }
+
+
+async def stream_summarization(user, text, max_words):
+    """
+    Streams a summary as (event, data) pairs: 'token' events with the pieces of
+    the summary as the model generates them, then one 'done' event with the
+    same body as run_summarization().
+
+    A cached summary is sent as a single token. A new summary is only written to
+    the caches and the history once the stream is complete, so an interrupted
+    stream stores nothing.
+    """
+    normalized_text = normalize_text_simple(text)
+
+    result_key = summarization_result_key(processor, normalized_text, max_words)
+    cache_key = result_key.cache_key
+    summarized_text = await result_cache.aget(cache_key)
+
+    if not summarized_text:
+        stored_result = await get_stored_result(result_key)
+        if stored_result:
+            summarized_text = stored_result.result
+            await result_cache.aset(cache_key, summarized_text, timeout=RESULT_CACHE_TIMEOUT)
+            await save_summarization_history(
+                user, normalized_text, stored_result, stored_result.source, max_words
+            )
+
+    if summarized_text:
+        print(f"Streaming cached summarization for '{normalized_text[:30]}...'.")
+        yield 'token', {"text": summarized_text}
+    else:
+        print(f"No cache hit. Streaming summarization of '{normalized_text[:30]}...' from the external API.")
+        pieces = []
+        try:
+            async for piece in processor.stream_summarize_text(text=normalized_text, max_words=max_words):
+                pieces.append(piece)
+                yield 'token', {"text": piece}
+        except ProviderUnavailable:
+            stale_result = None if pieces else await get_stale_result(result_key)
+            if stale_result is None:
+                raise
+            print("The AI provider is unavailable. Streaming a stale summarization.")
+            yield 'token', {"text": stale_result.result}
+            yield 'done', {
+                "original_text": normalized_text,
+                "summarized_text": stale_result.result,
+                "stale": True
+            }
+            return
+
+        # Same normalization as the non-streaming providers apply to their reply.
+        summarized_text = "".join(pieces).strip()
+        served = served_by(processor)
+        await result_cache.aset(cache_key, summarized_text, timeout=RESULT_CACHE_TIMEOUT)
+        stored_result = await store_result(result_key, summarized_text, served)
+        await save_summarization_history(
+            user, normalized_text, stored_result, served[0], max_words
+        )
+
+    yield 'done', {
+        "original_text": normalized_text,
+        "summarized_text": summarized_text
+    }
+
+
+# --- Aggregate analysis ---
+
+def texts_for_url(url):
+    """
+    Returns the comments found at a URL.
+    """
+    return ["I am completely satisfied with the product quality and the shipping speed.",
+            "Unfortunately, my package arrived very late and damaged.",
+            "I just wanted to ask if this model is also available in another color."
+            ]
+
+
+async def find_url_analysis(user, url):
+    """
+    Returns the latest aggregate analysis of a URL by this user, if any.
+    """
+    return await AggregateAnalysisHistory.objects.filter(user=user, url=url).afirst()
+
+
+def previous_chunk_results(previous_analysis):
+    """
+    Returns the reusable chunk contributions of a previous analysis.
+    Rows saved before chunk results were recorded count as a single chunk.
+    """
+    if previous_analysis is None:
+        return None
+    if previous_analysis.chunk_results:
+        return previous_analysis.chunk_results
+    return [{
+        "fingerprints": [text_fingerprint(normalize_text_simple(t)) for t in previous_analysis.texts],
+        "result": previous_analysis.analysis_result,
+    }]
+
+
+async def run_aggregate_analysis(user, texts_to_analyze, analysis_type, url=None, force_reanalyze=False, on_chunk=None):
+    """
+    Returns the aggregate result for a list of texts. The user is only charged
+    when the result is not already cached or stored in the history.
+    `on_chunk(record, done, total)` is awaited as each chunk of a new analysis finishes.
+    """
+    # --- Multi-level Caching Logic ---
+    normalized_texts = [normalize_text_simple(t) for t in texts_to_analyze]
+    fingerprint = texts_fingerprint(normalized_texts)
+
+    cache_key = aggregate_result_key(processor, fingerprint, analysis_type).cache_key
+    llm_result = await result_cache.aget(cache_key)
+    if llm_result:
+        return llm_result
+
+    history_entry = await AggregateAnalysisHistory.objects.filter(input_fingerprint=fingerprint, analysis_type=analysis_type).afirst()
+    if history_entry:
+        llm_result = history_entry.analysis_result
+        await result_cache.aset(cache_key, llm_result, timeout=RESULT_CACHE_TIMEOUT)
+        return llm_result
+
+    await acheck_and_deduct_usage(user, 1)
+
+    # Incremental mode: a forced re-analysis of a URL only analyzes the texts
+    # that are not covered by the chunks of its latest analysis.
+    previous_chunks = None
+    if url and force_reanalyze:
+        previous_analysis = await AggregateAnalysisHistory.objects.filter(
+            user=user, url=url, analysis_type=analysis_type
+        ).afirst()
+        previous_chunks = previous_chunk_results(previous_analysis)
+
+    try:
+        llm_result, chunk_results = await processor.analyze_aggregate_chunks(
+            normalized_texts, analysis_type, previous_chunks=previous_chunks, on_chunk=on_chunk
+        )
+    except Exception:
+        # Nothing was analyzed, so the charge is given back.
+        await arefund_usage(user, 1)
+        raise
+    provider, _ = served_by(processor)
+    await result_cache.aset(cache_key, llm_result, timeout=RESULT_CACHE_TIMEOUT)
+
+    await save_aggregate_history(
+        user, url, llm_result, provider,
+        analysis_type, fingerprint, texts_to_analyze, chunk_results
+    )
+    return llm_result
@@ -0,0 +1,23 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from nlp_services.quota import usage_quota
+
+
+QUOTA_FIELDS = {'free_analysis_count', 'is_pro'}
+
+
+@receiver(post_save, sender=get_user_model())
+def reset_usage_quota(sender, instance, created, update_fields=None, **kwargs):
+    """
+    Drops the balance cached in Redis when the quota of a user is changed in the
+    database (e.g. in the admin), so the next charge starts from the new value.
+    """
+    if created:
+        return
+    if update_fields is None or QUOTA_FIELDS & set(update_fields):
+        try:
+            usage_quota.reset(instance.pk)
+        except Exception as e:
+            print(f"Could not reset the usage quota of user {instance.pk}: {e}")
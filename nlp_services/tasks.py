@@ -0,0 +1,218 @@
+import time
+
+from asgiref.sync import sync_to_async
+from celery import shared_task
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone
+
+from nlp_services import services, history_buffer, archival
+from nlp_services.job_events import apublish_job_event, publish_job_event
+from nlp_services.models import AnalysisJob
+from nlp_services.processors.errors import ProviderError
+from nlp_services.processors.transport import run_on_worker_loop
+from nlp_services.quota import usage_quota
+
+
+class JobItemsFailed(Exception):
+    """
+    Raised when some texts of a sentiment job failed, so the job is retried.
+    Texts that succeeded are cached by then and are not sent upstream again.
+    """
+
+
+class JobProgress:
+    """
+    Reports the progress of a running job. Every finished item is pushed to the
+    owner's sockets right away, while the counters on the job row are saved at
+    most once per SAVE_INTERVAL seconds.
+    """
+    SAVE_INTERVAL = 1.0
+
+    def __init__(self, job):
+        self.job = job
+        self._last_save = 0.0
+
+    async def start(self, total_items):
+        self.job.total_items = total_items
+        self.job.processed_items = 0
+        await self.job.asave(update_fields=['total_items', 'processed_items'])
+
+    async def item_done(self, event, total_items=None, **data):
+        if total_items is not None:
+            self.job.total_items = total_items
+        self.job.processed_items += 1
+        await apublish_job_event(self.job, event, **data)
+
+        now = time.monotonic()
+        if now - self._last_save >= self.SAVE_INTERVAL:
+            self._last_save = now
+            await self.job.asave(update_fields=['total_items', 'processed_items'])
+
+
+async def run_job(job):
+    """
+    Runs the pipeline of a job and returns the body the synchronous endpoint would return.
+    Per-item results are published while the job runs.
+    """
+    data = job.input_data
+    progress = JobProgress(job)
+
+    if job.job_type == 'sentiment':
+        await progress.start(len(data['texts']))
+
+        async def on_result(index, result):
+            await progress.item_done('item', index=index, result=result)
+
+        return await services.run_sentiment_analysis(job.user, data['texts'], data['analysis_type'], on_result=on_result)
+
+    if job.job_type == 'summarization':
+        return await services.run_summarization(job.user, data['text'], data['max_words'])
+
+    # Aggregate analysis, with the same URL handling as the synchronous endpoint.
+    url = data.get('url')
+    force_reanalyze = data.get('force_reanalyze', False)
+    if url and not force_reanalyze:
+        existing_analysis = await services.find_url_analysis(job.user, url)
+        if existing_analysis:
+            return {
+                "status": "previously_analyzed",
+                "message": "This URL has been analyzed before. To re-analyze, submit the job again with 'force_reanalyze': true.",
+                "previous_result": existing_analysis.analysis_result
+            }
+
+    # Each chunk of a new analysis is published with its partial result.
+    async def on_chunk(record, done, total):
+        await progress.item_done('chunk', total_items=total, texts=len(record['fingerprints']), result=record['result'])
+
+    texts_to_analyze = services.texts_for_url(url) if url else data['texts']
+    return await services.run_aggregate_analysis(
+        job.user, texts_to_analyze, data['analysis_type'], url=url, force_reanalyze=force_reanalyze,
+        on_chunk=on_chunk
+    )
+
+
+async def run_job_on_worker_loop(job):
+    try:
+        return await run_job(job)
+    finally:
+        # The ORM calls of the job ran in the worker loop's database thread, which
+        # Celery's per-task connection cleanup does not reach.
+        await sync_to_async(close_old_connections)()
+
+
+def job_usage(job_type, input_data) -> int:
+    """
+    Returns the quota charged when a job is submitted. Aggregate jobs are
+    charged by the pipeline itself, only when the result is not cached.
+    """
+    return {'sentiment': len(input_data.get('texts', [])), 'summarization': 1}.get(job_type, 0)
+
+
+def _finish_job(job, status, result=None, error=''):
+    job.status = status
+    job.result = result
+    job.error = error
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'result', 'error', 'processed_items', 'total_items', 'finished_at'])
+    publish_job_event(job, 'status', result=result, error=error)
+
+
+# acks_late + reject_on_worker_lost: the message is only acknowledged once the job
+# finished, so a job whose worker crashed is delivered to another worker.
+@shared_task(bind=True, acks_late=True, reject_on_worker_lost=True, ignore_result=True)
+def run_analysis_job(self, job_id):
+    """
+    A Celery task that runs an AnalysisJob and persists its result on the job row.
+    Failures are retried with exponential backoff; a job that runs out of
+    retries or of usage quota is marked as failed.
+    """
+    job = AnalysisJob.objects.select_related('user').filter(pk=job_id).first()
+    if job is None or job.is_finished:
+        # Deleted, or a redelivered message of a job that already finished.
+        return
+
+    job.status = AnalysisJob.STATUS_RUNNING
+    job.attempts += 1
+    job.started_at = job.started_at or timezone.now()
+    job.save(update_fields=['status', 'attempts', 'started_at'])
+    publish_job_event(job, 'status')
+
+    max_retries = getattr(settings, 'NLP_JOB_MAX_RETRIES', 3)
+    retries_left = self.request.retries < max_retries
+
+    try:
+        # Run on the long-lived worker loop, so the upstream connection pools survive between jobs.
+        result = run_on_worker_loop(run_job_on_worker_loop(job))
+
+        if job.job_type == 'sentiment' and retries_left:
+            failed = services.count_failed(result)
+            if failed:
+                raise JobItemsFailed(f"{failed} of {len(result)} texts failed.")
+
+    except services.UsageLimitExceeded as e:
+        _finish_job(job, AnalysisJob.STATUS_FAILED, error=str(e))
+        return
+
+    except Exception as e:
+        if not retries_left:
+            # Nothing was delivered, so the quota charged on submission is given back.
+            services.refund_usage(job.user, job_usage(job.job_type, job.input_data))
+            _finish_job(job, AnalysisJob.STATUS_FAILED, error=str(e))
+            return
+
+        print(f"Analysis job {job.id} failed on attempt {job.attempts}: {e}. Retrying.")
+        job.status = AnalysisJob.STATUS_PENDING
+        job.error = str(e)
+        job.save(update_fields=['status', 'error'])
+        publish_job_event(job, 'status', error=job.error)
+        countdown = getattr(settings, 'NLP_JOB_RETRY_BACKOFF', 5) * 2 ** self.request.retries
+        if isinstance(e, ProviderError) and e.retry_after:
+            # Not before the provider accepts calls again (rate limit or open circuit).
+            countdown = max(countdown, e.retry_after)
+        raise self.retry(exc=e, countdown=countdown, max_retries=max_retries)
+
+    # On the last attempt a sentiment job succeeds with the failed texts marked as ERROR,
+    # which are not charged.
+    if job.job_type == 'sentiment':
+        services.refund_usage(job.user, services.count_failed(result))
+    _finish_job(job, AnalysisJob.STATUS_SUCCEEDED, result=result)
+
+
+def enqueue_analysis_job(job):
+    """
+    Sends a job to the Celery queue of its priority.
+    """
+    queues = getattr(settings, 'NLP_JOB_QUEUES', {})
+    queue = queues.get(job.priority) or queues.get('default')
+    run_analysis_job.apply_async(args=[str(job.id)], queue=queue)
+
+
+@shared_task(ignore_result=True)
+def flush_usage_quota():
+    """
+    A periodic Celery task that writes the usage counted in Redis back to the users' free_analysis_count.
+    """
+    flushed = usage_quota.flush_usage()
+    if flushed:
+        print(f"Flushed the usage quota of {flushed} user(s).")
+
+
+@shared_task(ignore_result=True)
+def flush_history_buffer():
+    """
+    A periodic Celery task that saves the history rows queued by the write-behind buffer.
+    """
+    written = history_buffer.flush()
+    if written:
+        print(f"Saved {written} queued history row(s).")
+
+
+@shared_task(ignore_result=True)
+def archive_history():
+    """
+    A periodic Celery task that moves the history rows past their retention period to the archives.
+    """
+    archived = archival.archive_history()
+    if any(archived.values()):
+        print(f"Archived history rows: {archived}.")
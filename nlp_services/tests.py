@@ -1,3 +1,2536 @@
-from django.test import TestCase
+import asyncio
+import base64
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+import uuid
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from core.asgi import application
+from core.celery import app as celery_app
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.http import urlencode
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from nlp_services import archival, blob_store, bulk, tasks, cache_codec, history_buffer, quota, services
+from nlp_services.job_events import apublish_job_event
+from nlp_services.cache_keys import (
+    CACHE_KEY_VERSION, processor_identity, result_key, sentiment_result_key, summarization_result_key,
+    text_fingerprint, texts_fingerprint,
+)
+from nlp_services.cache_codec import BinaryResultCodec, get_cache_codec
+from nlp_services.models import (
+    AggregateAnalysisHistory, AnalysisHistory, AnalysisJob, StoredResult, SummarizationHistory, TextBlob,
+)
+from nlp_services.processors import rate_limit
+from nlp_services.processors.errors import (
+    CircuitOpen, ProviderBadRequest, ProviderRateLimited, ProviderResponseError, ProviderTimeout,
+    ProviderUnavailable, UnsupportedTask, classify_error,
+)
+from nlp_services.processors.internal_model import InternalSentimentModel, normalize_persian, np
+from nlp_services.processors.llm_processor import (
+    BaseLLMProcessor, ChunkedAggregationProcessor, FlakyMockProcessor, GeminiProcessor, InternalProcessor,
+    MicroBatchingProcessor, MockProcessor, OutageMockProcessor, RateLimitedProcessor, RoutingProcessor,
+    SingleFlightProcessor, SlowMockProcessor,
+)
+from nlp_services.processors.rate_limit import UpstreamLimiter
+from nlp_services.processors.stub_provider import StubGeminiServer
+from nlp_services.processors.transport import PooledTransport, run_on_worker_loop
+from nlp_services.processors.resilience import CircuitBreaker, ResiliencePolicy, backoff_delay
+from nlp_services.processors.routing import Backend, preferred_tier, served_by
+from nlp_services.quota import UsageLimitExceeded, UsageQuota
+from nlp_services.result_cache import LocalLRUCache, TieredResultCache, result_cache
+from nlp_services.serializers import AggregateAnalysisHistorySerializer, SummarizationHistorySerializer
+
+try:
+    import fakeredis
+except ImportError:
+    # Optional: the Redis paths are tested against fakeredis (fakeredis[lua] for the Lua scripts).
+    fakeredis = None
+
+
+def create_user(email="user@example.com", **fields):
+    fields.setdefault('username', email.split('@')[0])
+    fields.setdefault('is_email_verified', True)
+    return get_user_model().objects.create_user(email=email, password="password", **fields)
+
+
+def fake_redis(test, *modules):
+    """
+    Points get_redis_connection() of the given modules to a new fake Redis server for one test.
+    """
+    connection = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    for module in modules:
+        patcher = mock.patch.object(module, 'get_redis_connection', return_value=connection)
+        patcher.start()
+        test.addCleanup(patcher.stop)
+    return connection
+
+
+def clear_result_cache():
+    """
+    Empties the in-process (L0) and shared (L1) result caches, which outlive a test.
+    """
+    result_cache.local.clear()
+    result_cache.backend.clear()
+
+
+def auth_headers(user):
+    return {'Authorization': f"Bearer {AccessToken.for_user(user)}"}
+
+
+def ndjson(*records) -> bytes:
+    return "\n".join(json.dumps(record, ensure_ascii=False) for record in records).encode()
+
+
+def fake_redis_caches():
+    """
+    Returns CACHES settings for a django-redis cache on a new fake Redis server.
+    The location is unique because django-redis keeps its connection pools per location.
+    """
+    return {'default': {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': f'redis://fake-{uuid.uuid4().hex}:6379/0',
+        'OPTIONS': {'CONNECTION_POOL_KWARGS': {
+            'connection_class': fakeredis.FakeConnection, 'server': fakeredis.FakeServer(),
+        }},
+    }}
+
+
+def fault_mock(processor_class, **options):
+    """
+    Returns the (singleton) fault-injecting mock with fresh counters and the given options.
+    """
+    processor = processor_class()
+    processor.calls = processor.faults = 0
+    for name, value in options.items():
+        setattr(processor, name, value)
+    return processor
+
+
+class ScriptedRandom:
+    """
+    Stands in for the random.Random of a fault mock: random() returns the given values in turn.
+    """
+
+    def __init__(self, *values):
+        self.values = list(values)
+
+    def random(self):
+        return self.values.pop(0) if self.values else 1.0
+
+    def uniform(self, low, high):
+        return low
+
+    def choice(self, options):
+        return options[0]
+
+
+# Keeps the tests off Redis: the shared state falls back to per-process state.
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+# Fast retries for the tests.
+FAST_RETRIES = {'backoff_base': 0.001, 'backoff_cap': 0.002, 'max_retries': 2}
+
+
+class CacheKeyTests(SimpleTestCase):
+    """
+    The keys address Redis entries and StoredResult rows written by other
+    processes and releases: a change to any value pinned here orphans them.
+    """
+
+    def setUp(self):
+        self.processor = MockProcessor()
+
+    def test_keys_are_pinned(self):
+        gemini = mock.Mock(provider_name='gemini', default_model='gemini-1.5-pro-latest', prompt_version='v1')
+        key = sentiment_result_key(gemini, "سلام دنیا", 'general_sentiment')
+        self.assertEqual(key.content_hash, 'a5243b50dac2e60ee8f7756fcb7c7cf282e485bea5f91db3ea621a786c0c554e')
+        self.assertEqual(
+            key.cache_key,
+            f'sentiment_cache:v{CACHE_KEY_VERSION}:gemini:gemini-1.5-pro-latest:v1:analysis_type=general_sentiment:'
+            'a5243b50dac2e60ee8f7756fcb7c7cf282e485bea5f91db3ea621a786c0c554e',
+        )
+        self.assertEqual(key.store_key, '322d1cc569c3ad9ddf9a2cbe35bf20739ac4b6e1d3c884247d3322fa68f7ebc8')
+
+    def test_params_order_does_not_change_the_key(self):
+        first = result_key('aggregate', 'f' * 64, {'analysis_type': 'x', 'chunk': 1}, self.processor)
+        second = result_key('aggregate', 'f' * 64, {'chunk': 1, 'analysis_type': 'x'}, self.processor)
+        self.assertEqual(first.cache_key, second.cache_key)
+        self.assertEqual(first.store_key, second.store_key)
+
+    def test_texts_fingerprint_does_not_depend_on_order(self):
+        self.assertEqual(texts_fingerprint(["ب", "الف"]), texts_fingerprint(["الف", "ب"]))
+        self.assertNotEqual(texts_fingerprint(["الف", "ب"]), texts_fingerprint(["الف"]))
+
+    def test_equivalent_texts_share_a_key(self):
+        composed = "آب"
+        decomposed = "\u0627\u0653ب"
+        self.assertNotEqual(composed, decomposed)
+        self.assertEqual(text_fingerprint(composed), text_fingerprint(decomposed))
+        keys = {
+            sentiment_result_key(self.processor, services.normalize_text_simple(text), 'general_sentiment').cache_key
+            for text in ("خوب بود", "  خوب   بود.. ", "خوب\nبود")
+        }
+        self.assertEqual(len(keys), 1)
+
+    def test_every_part_of_the_identity_changes_the_key(self):
+        base = sentiment_result_key(self.processor, "خوب", 'general_sentiment')
+        others = [
+            sentiment_result_key(self.processor, "بد", 'general_sentiment'),
+            sentiment_result_key(self.processor, "خوب", 'business_intent'),
+            summarization_result_key(self.processor, "خوب", 50),
+            base._replace(provider='gemini'),
+            base._replace(model='other-model'),
+        ]
+        with mock.patch.object(BaseLLMProcessor, 'prompt_version', 'v-next'):
+            others.append(sentiment_result_key(self.processor, "خوب", 'general_sentiment'))
+        self.assertEqual(others[-1].prompt_version, 'v-next')
+        for other in others:
+            with self.subTest(other=other):
+                self.assertNotEqual(other.cache_key, base.cache_key)
+                self.assertNotEqual(other.store_key, base.store_key)
+
+    def test_store_key_does_not_depend_on_the_cache_layout_version(self):
+        key = summarization_result_key(self.processor, "متن", 50)
+        self.assertEqual(key.content_hash, text_fingerprint("متن"))
+        cache_key, store_key = key.cache_key, key.store_key
+        with mock.patch('nlp_services.cache_keys.CACHE_KEY_VERSION', CACHE_KEY_VERSION + 1):
+            self.assertNotEqual(key.cache_key, cache_key)
+            self.assertEqual(key.store_key, store_key)
+
+
+class CacheCodecTests(SimpleTestCase):
+
+    RESULT = {'sentiment': 'POSITIVE', 'score': 0.91, 'business_insights': ["ارسال سریع", "کیفیت خوب"]}
+
+    def codecs(self):
+        serializers = ['json'] + (['msgpack'] if cache_codec.msgpack is not None else [])
+        return [BinaryResultCodec(serializer, compress_min_size=64, compression_codec='zlib') for serializer in serializers]
+
+    def test_round_trip(self):
+        for codec in self.codecs():
+            for value in (self.RESULT, "خلاصه متن", ["a"] * 500, {'aggregate': [self.RESULT] * 50}):
+                with self.subTest(serializer=codec.serializer, value=str(value)[:20]):
+                    self.assertEqual(codec.decode(codec.encode(value)), value)
+
+    def test_header(self):
+        for codec in self.codecs():
+            serializer_id = cache_codec.SERIALIZER_IDS[codec.serializer]
+            with self.subTest(serializer=codec.serializer):
+                small = codec.encode("کوتاه")
+                self.assertEqual(small[:3], bytes([cache_codec.FORMAT_VERSION]) + serializer_id + b'-')
+                large = codec.encode(["متن تکراری"] * 100)
+                self.assertEqual(large[:3], bytes([cache_codec.FORMAT_VERSION]) + serializer_id + b'z')
+                self.assertLess(len(large), len(codec._serialize(["متن تکراری"] * 100)))
+
+    def test_data_that_does_not_shrink_is_not_compressed(self):
+        codec = BinaryResultCodec('json', compress_min_size=0, compression_codec='zlib')
+        self.assertEqual(codec.encode("x")[2:3], b'-')
+
+    def test_another_format_version_is_a_miss(self):
+        codec = BinaryResultCodec('json')
+        data = codec.encode(self.RESULT)
+        self.assertIsNone(codec.decode(bytes([cache_codec.FORMAT_VERSION + 1]) + data[1:]))
+        with mock.patch.object(cache_codec, 'FORMAT_VERSION', cache_codec.FORMAT_VERSION + 1):
+            self.assertIsNone(codec.decode(data))
+
+    def test_unknown_header_bytes_are_a_miss(self):
+        codec = BinaryResultCodec('json')
+        payload = codec.encode(self.RESULT)[3:]
+        version = bytes([cache_codec.FORMAT_VERSION])
+        self.assertIsNone(codec.decode(version + b'?-' + payload))
+        self.assertIsNone(codec.decode(version + b'j?' + payload))
+
+    def test_unreadable_entries_are_a_miss(self):
+        codec = BinaryResultCodec('json', compress_min_size=0, compression_codec='zlib')
+        data = codec.encode(["متن تکراری"] * 100)
+        version = bytes([cache_codec.FORMAT_VERSION])
+        for entry in (b'', version + b'j', data[:-10], version + b'js' + data[3:], self.RESULT, "a string"):
+            with self.subTest(entry=repr(entry)[:30]):
+                self.assertIsNone(codec.decode(entry))
+
+    @unittest.skipIf(cache_codec.msgpack is None, "msgpack is not installed.")
+    def test_msgpack_entries_are_a_miss_without_msgpack(self):
+        data = BinaryResultCodec('msgpack').encode(self.RESULT)
+        with mock.patch.object(cache_codec, 'msgpack', None):
+            self.assertIsNone(BinaryResultCodec('json').decode(data))
+
+    @override_settings(
+        NLP_CACHE_CODEC='nlp_services.cache_codec.BinaryResultCodec',
+        NLP_CACHE_CODEC_OPTIONS={'serializer': 'json', 'compress_min_size': None},
+    )
+    def test_codec_from_settings(self):
+        codec = get_cache_codec()
+        self.assertEqual(codec.serializer, 'json')
+        self.assertEqual(codec.encode(["a"] * 1000)[:3], bytes([cache_codec.FORMAT_VERSION]) + b'j-')
+
+
+@unittest.skipIf(np is None, "numpy is not installed.")
+class InternalSentimentModelTests(SimpleTestCase):
+
+    def setUp(self):
+        self.model = InternalSentimentModel()
+
+    def label(self, text, analysis_type='general_sentiment'):
+        result, confidence = self.model.predict([text], analysis_type)[0]
+        return result['sentiment'], confidence
+
+    def test_plain_sentiment_words(self):
+        self.assertEqual(self.label("خوب")[0], 'POSITIVE')
+        self.assertEqual(self.label("افتضاح بود")[0], 'NEGATIVE')
+        self.assertEqual(self.label("good")[0], 'POSITIVE')
+
+    def test_persian_negation_flips_the_words_before_it(self):
+        self.assertEqual(self.label("خوب نیست")[0], 'NEGATIVE')
+        self.assertEqual(self.label("دوست ندارم")[0], 'NEGATIVE')
+        self.assertEqual(self.label("این را نمی‌پسندم ولی خوب")[0], 'POSITIVE')
+
+    def test_persian_negation_flips_the_words_after_it(self):
+        self.assertEqual(self.label("بدون مشکل")[0], 'POSITIVE')
+        self.assertEqual(self.label("نه خوب")[0], 'NEGATIVE')
+
+    def test_english_negation_flips_the_words_after_it(self):
+        for text in ("not good", "nothing good", "isn't good", "I don't like it", "not very good"):
+            with self.subTest(text=text):
+                self.assertEqual(self.label(text)[0], 'NEGATIVE')
+        self.assertEqual(self.label("not bad at all")[0], 'POSITIVE')
+
+    def test_negation_does_not_cross_texts(self):
+        results = self.model.predict(["خوب", "نیست"])
+        self.assertEqual(results[0][0]['sentiment'], 'POSITIVE')
+        self.assertEqual(results[1][0]['sentiment'], 'NEUTRAL')
+
+    def test_intensifiers_raise_the_confidence(self):
+        for plain, intensified in (("خوب", "خیلی خوب"), ("good", "very good")):
+            with self.subTest(text=intensified):
+                self.assertGreater(self.label(intensified)[1], self.label(plain)[1])
+                self.assertEqual(self.label(intensified)[0], 'POSITIVE')
+        self.assertEqual(self.label("خیلی خوب نیست")[0], 'NEGATIVE')
+        self.assertEqual(self.label("not very good")[0], 'NEGATIVE')
+
+    def test_mixed_and_unknown_texts_are_not_confident(self):
+        self.assertEqual(self.label("سفارش را دیروز ثبت کردم"), ('NEUTRAL', 0.0))
+        self.assertLess(self.label("قیمتش گران است ولی کیفیتش خوبه")[1], 0.6)
+        self.assertEqual(self.model.predict([]), [])
+        self.assertEqual(self.label(""), ('NEUTRAL', 0.0))
+
+    def test_normalization(self):
+        # Arabic letter forms, half-spaces and Persian digits.
+        self.assertEqual(normalize_persian("كيفيت فوق‌العاده ۱۲"), "کیفیت فوقالعاده 12")
+        self.assertEqual(self.label("فوق‌العاده")[0], self.label("فوقالعاده")[0])
+
+    def test_business_intent(self):
+        self.assertEqual(self.label("آیا رنگ مشکی دارد؟", 'business_intent')[0], 'INQUIRY')
+        self.assertEqual(self.label("خیلی راضی هستم", 'business_intent')[0], 'SATISFIED')
+        self.assertEqual(self.label("خراب رسید", 'business_intent')[0], 'DISSATISFIED')
+        self.assertEqual(self.label("سلام", 'business_intent')[0], 'OTHER')
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    async def test_summaries_are_left_to_the_next_backend(self):
+        internal = InternalProcessor()
+        with self.assertRaises(UnsupportedTask):
+            await internal.summarize_text("خوب بود", 10)
+        with self.assertRaises(UnsupportedTask):
+            await internal.analyze_aggregate_sentiment(["خوب بود"], 'general_sentiment')
+
+        # Even when a backend is configured for them.
+        router = build_router(
+            Backend('local', internal, tier='fast'), Backend('pro', StubProcessor('gemini', 'pro'), tier='large'),
+        )
+        self.assertEqual(await router.summarize_text("خوب بود", 10), "Summary by pro.")
+        self.assertEqual(served_by(router), ('gemini', 'pro'))
+
+
+class ErrorClassificationTests(SimpleTestCase):
+
+    def test_client_errors_are_classified(self):
+        request = httpx.Request('POST', 'http://provider.test')
+        cases = [
+            (asyncio.TimeoutError(), ProviderTimeout),
+            (ConnectionError(), ProviderUnavailable),
+            (ValueError("not JSON"), ProviderResponseError),
+            (httpx.ConnectTimeout("slow", request=request), ProviderTimeout),
+            (httpx.HTTPStatusError("boom", request=request, response=httpx.Response(500, request=request)), ProviderUnavailable),
+            (httpx.HTTPStatusError("bad", request=request, response=httpx.Response(400, request=request)), ProviderBadRequest),
+        ]
+        for error, expected in cases:
+            with self.subTest(error=repr(error)):
+                self.assertIsInstance(classify_error(error), expected)
+        error = ProviderRateLimited()
+        self.assertIs(classify_error(error), error)
+
+    def test_retryable_errors(self):
+        for error_class in (ProviderUnavailable, ProviderTimeout, ProviderResponseError):
+            self.assertTrue(error_class.retryable, error_class)
+        for error_class in (ProviderBadRequest, ProviderRateLimited, CircuitOpen):
+            self.assertFalse(error_class.retryable, error_class)
+
+    def test_provider_status_codes(self):
+        request = httpx.Request('POST', 'http://provider.test')
+        with self.assertRaises(ProviderRateLimited) as raised:
+            GeminiProcessor._raise_for_status(httpx.Response(429, headers={'retry-after': '7'}, request=request))
+        self.assertEqual(raised.exception.retry_after, 7.0)
+        # An outage must reach the circuit breaker and the stale results, not the rate limiting.
+        with self.assertRaises(ProviderUnavailable) as raised:
+            GeminiProcessor._raise_for_status(httpx.Response(503, headers={'retry-after': '9'}, request=request))
+        self.assertEqual(raised.exception.retry_after, 9.0)
+        with self.assertRaises(httpx.HTTPStatusError):
+            GeminiProcessor._raise_for_status(httpx.Response(400, request=request))
+
+
+class ResiliencePolicyTests(SimpleTestCase):
+
+    async def test_retryable_errors_are_retried_up_to_max_retries(self):
+        processor = fault_mock(FlakyMockProcessor, error_rate=1.0, random=ScriptedRandom(0.0, 0.0))
+        policy = ResiliencePolicy('flaky', {**FAST_RETRIES, 'max_retries': 1})
+        with self.assertRaises(ProviderUnavailable):
+            await policy.call('sentiment', lambda: processor.analyze_sentiment("text"))
+        self.assertEqual(processor.calls, 2)
+        self.assertEqual(policy.counters['retries'], 1)
+        self.assertEqual(policy.counters['failures'], 1)
+
+    async def test_a_retry_recovers_from_a_flaky_failure(self):
+        # The first call fails, the second succeeds.
+        processor = fault_mock(FlakyMockProcessor, error_rate=0.5, random=ScriptedRandom(0.0, 0.9))
+        policy = ResiliencePolicy('flaky', FAST_RETRIES)
+        result = await policy.call('sentiment', lambda: processor.analyze_sentiment("text"))
+        self.assertEqual(result['sentiment'], 'POSITIVE')
+        self.assertEqual((processor.calls, processor.faults, policy.counters['retries']), (2, 1, 1))
+
+    async def test_non_retryable_errors_are_not_retried(self):
+        for error_class in (ProviderBadRequest, ProviderRateLimited):
+            calls = []
+
+            async def call():
+                calls.append(1)
+                raise error_class("rejected")
+
+            policy = ResiliencePolicy('provider', FAST_RETRIES)
+            with self.subTest(error=error_class.__name__), self.assertRaises(error_class):
+                await policy.call('sentiment', call)
+            self.assertEqual(len(calls), 1)
+
+    def test_backoff_is_capped(self):
+        for attempt in range(12):
+            delays = [backoff_delay(attempt, 0.5, 8.0) for _ in range(50)]
+            self.assertTrue(all(0 <= delay <= min(8.0, 0.5 * 2 ** attempt) for delay in delays), attempt)
+
+    async def test_slow_calls_are_hedged_and_the_slower_request_cancelled(self):
+        # The first request stalls, the hedged second one does not.
+        processor = fault_mock(SlowMockProcessor, slow_rate=0.5, slow_delay=30.0, random=ScriptedRandom(0.0, 0.9))
+        policy = ResiliencePolicy('slow', {'hedge': True, 'hedge_min_samples': 1})
+        policy._tracker('sentiment').record(0.01)
+        cancelled = []
+
+        async def call():
+            try:
+                return await processor.analyze_sentiment("text")
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        started = time.monotonic()
+        result = await policy.call('sentiment', call)
+        self.assertEqual(result['sentiment'], 'POSITIVE')
+        self.assertLess(time.monotonic() - started, 5.0)
+        self.assertEqual((policy.counters['hedged'], policy.counters['hedge_wins']), (1, 1))
+        await asyncio.sleep(0)
+        self.assertEqual(cancelled, [True])
+
+
+class CircuitBreakerTests(SimpleTestCase):
+
+    def test_closed_open_half_open_closed(self):
+        breaker = CircuitBreaker('provider', failure_threshold=3, failure_rate=0.5, failure_window=10, reset_timeout=0.05)
+        for _ in range(2):
+            breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpen):
+            breaker.before_call()
+
+        time.sleep(0.06)
+        breaker.before_call()  # The probe.
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        with self.assertRaises(CircuitOpen):
+            breaker.before_call()  # Only one probe at a time.
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.before_call()
+
+    def test_a_failed_probe_opens_the_circuit_again(self):
+        breaker = CircuitBreaker('provider', failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        time.sleep(0.06)
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_occasional_failures_do_not_open_the_circuit(self):
+        breaker = CircuitBreaker('provider', failure_threshold=3, failure_rate=0.5, failure_window=20)
+        for _ in range(4):
+            for _ in range(3):
+                breaker.record_success()
+            breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    async def test_an_outage_opens_the_circuit_and_a_probe_closes_it(self):
+        processor = fault_mock(OutageMockProcessor)
+        processor.start_outage(60)
+        policy = ResiliencePolicy('outage', {
+            **FAST_RETRIES, 'max_retries': 0, 'failure_threshold': 3, 'failure_window': 5, 'reset_timeout': 0.05,
+        })
+        for _ in range(3):
+            with self.assertRaises(ProviderUnavailable):
+                await policy.call('summarization', lambda: processor.summarize_text("text", 10))
+        # Open: calls fail fast without reaching the provider.
+        with self.assertRaises(CircuitOpen):
+            await policy.call('summarization', lambda: processor.summarize_text("text", 10))
+        self.assertEqual(processor.calls, 3)
+
+        processor.outage_until = 0.0
+        await asyncio.sleep(0.06)
+        await policy.call('summarization', lambda: processor.summarize_text("text", 10))
+        self.assertEqual(policy.breaker.state, CircuitBreaker.CLOSED)
+
+
+class StaleResultTests(TestCase):
+    """
+    While the provider is down, a result stored by another configuration is served, marked stale.
+    """
+
+    def setUp(self):
+        self.user = create_user()
+        self.processor = fault_mock(OutageMockProcessor)
+        self.processor.start_outage(60)
+        patcher = mock.patch.object(services, 'processor', self.processor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def store_old_result(self, result_key, result):
+        # Same task, text and parameters; produced by an earlier model.
+        StoredResult.objects.create(
+            result_key='0' * 64, task=result_key.task, text_hash=result_key.content_hash,
+            params=result_key.params, result=result, source='gemini', model_name='old-model', prompt_version='v0',
+        )
+
+    async def test_summarization_serves_a_stale_result(self):
+        text = "A text summarized before the outage"
+        await sync_to_async(self.store_old_result)(summarization_result_key(self.processor, text, 10), "Old summary.")
+        result = await services.run_summarization(self.user, text, 10)
+        self.assertEqual(result, {"original_text": text, "summarized_text": "Old summary.", "stale": True})
+
+    async def test_summarization_without_a_stale_result_fails(self):
+        with self.assertRaises(ProviderUnavailable):
+            await services.run_summarization(self.user, "A text never summarized", 10)
+
+    async def test_sentiment_serves_a_stale_result(self):
+        text = "A text analyzed before the outage"
+        old = {"sentiment": "NEGATIVE", "score": 0.9, "notes": "Earlier answer."}
+        await sync_to_async(self.store_old_result)(sentiment_result_key(self.processor, text, 'general_sentiment'), old)
+        [result] = await services.run_sentiment_analysis(self.user, [text], 'general_sentiment')
+        self.assertEqual(result['sentiment_type'], 'NEGATIVE')
+        self.assertTrue(result['stale'])
+
+    async def test_sentiment_without_a_stale_result_fails(self):
+        with self.assertRaises(ProviderUnavailable):
+            await services.run_sentiment_analysis(self.user, ["A text never analyzed"], 'general_sentiment')
+
+
+class StubProcessor(BaseLLMProcessor):
+    """
+    A backend for the routing and pipeline tests: answers after `delay` seconds,
+    or fails with `error` (streams fail after `fail_after` pieces, sentiment calls
+    only for `failing_texts` when given). The analyzed texts are kept in `texts`.
+    """
+
+    @classmethod
+    def _instance_key(cls, provider, model, *args, **kwargs):
+        return (cls, provider, model)
+
+    def __init__(self, provider, model, error=None, fail_after=0, failing_texts=None, delay=0.0):
+        self.provider_name = provider
+        self.default_model = model
+        self.error = error
+        self.delay = delay
+        self.fail_after = fail_after
+        self.failing_texts = None if failing_texts is None else set(failing_texts)
+        self.calls = 0
+        self.texts = []
+
+    async def _answer(self, result, fails=True):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.error is not None and fails:
+            raise self.error
+        return result
+
+    async def analyze_sentiment(self, text, analysis_type="general_sentiment"):
+        self.texts.append(text)
+        fails = self.failing_texts is None or text in self.failing_texts
+        return await self._answer({"sentiment": "POSITIVE", "score": 0.9, "notes": f"Answered by {self.default_model}."}, fails)
+
+    async def summarize_text(self, text, max_words):
+        return await self._answer(f"Summary by {self.default_model}.")
+
+    async def stream_summarize_text(self, text, max_words):
+        self.calls += 1
+        for position, piece in enumerate(["Summary ", "by ", self.default_model]):
+            if self.error is not None and position == self.fail_after:
+                raise self.error
+            yield piece
+
+    async def analyze_aggregate_sentiment(self, texts, analysis_type):
+        return await self._answer({"overall_sentiment": "POSITIVE", "summary": f"Aggregate by {self.default_model}."})
+
+
+ROUTES = {
+    'sentiment': [(100, 'fast'), (None, 'large')],
+    'summarization': [(100, 'fast'), (None, 'large')],
+    'aggregate': [(100, 'fast'), (None, 'large')],
+}
+
+
+def build_router(*backends, budgets=None):
+    with override_settings(NLP_LLM_ROUTING={'routes': ROUTES, 'budgets': budgets or {}}):
+        return RoutingProcessor(list(backends))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RoutingTests(SimpleTestCase):
+
+    def setUp(self):
+        self.fast = Backend('flash', StubProcessor('gemini', 'flash'), tier='fast', max_chars=1000)
+        self.large = Backend('pro', StubProcessor('gemini', 'pro'), tier='large', cost_per_1k_chars=100.0)
+
+    async def names(self, router, task, size):
+        return [backend.name for backend in await router.candidates(task, size)]
+
+    def test_preferred_tier(self):
+        self.assertEqual(preferred_tier(ROUTES, 'sentiment', 100), 'fast')
+        self.assertEqual(preferred_tier(ROUTES, 'sentiment', 101), 'large')
+        self.assertIsNone(preferred_tier(ROUTES, 'unknown', 10))
+
+    async def test_tier_by_task_and_length(self):
+        router = build_router(self.fast, self.large)
+        self.assertEqual(await self.names(router, 'sentiment', 50), ['flash', 'pro'])
+        self.assertEqual(await self.names(router, 'sentiment', 500), ['pro', 'flash'])
+        # Longer than the fast backend takes.
+        self.assertEqual(await self.names(router, 'aggregate', 5000), ['pro'])
+
+    async def test_tasks_a_backend_does_not_serve(self):
+        local = Backend('local', StubProcessor('internal', 'lexicon'), tier='fast', tasks=['sentiment'])
+        router = build_router(local, self.large)
+        self.assertEqual(await self.names(router, 'summarization', 50), ['pro'])
+
+    async def test_order_by_latency_and_error_rate(self):
+        slow = Backend('slow', StubProcessor('gemini', 'slow'), tier='fast')
+        quick = Backend('quick', StubProcessor('gemini', 'quick'), tier='fast')
+        router = build_router(slow, quick)
+        slow.stats.record(0.5, failed=False)
+        quick.stats.record(0.1, failed=False)
+        self.assertEqual(await self.names(router, 'sentiment', 10), ['quick', 'slow'])
+        # Mostly failing: tried last, however fast.
+        for _ in range(4):
+            quick.stats.record(0.01, failed=True)
+        self.assertGreaterEqual(quick.stats.error_rate, 0.5)
+        self.assertEqual(await self.names(router, 'sentiment', 10), ['slow', 'quick'])
+
+    async def test_a_tier_over_budget_is_skipped(self):
+        router = build_router(self.fast, self.large, budgets={'large': 1.0})
+        long_text = "x" * 200
+        await router.summarize_text(long_text, 10)
+        self.assertEqual(served_by(router), ('gemini', 'pro'))
+        # 200 characters at 100 per 1000: the hour's budget of the large tier is spent.
+        self.assertEqual(await router.budget.exhausted(), {'large'})
+        await router.summarize_text(long_text, 10)
+        self.assertEqual(served_by(router), ('gemini', 'flash'))
+        self.assertEqual(self.large.processor.calls, 1)
+
+    async def test_no_backend_left(self):
+        router = build_router(self.fast)
+        with self.assertRaises(ProviderUnavailable):
+            await router.summarize_text("x" * 5000, 10)
+
+    async def test_a_failed_call_fails_over(self):
+        self.fast.processor.error = ProviderUnavailable("down")
+        router = build_router(self.fast, self.large)
+        result = await router.analyze_sentiment("short text")
+        self.assertEqual(result['notes'], "Answered by pro.")
+        self.assertEqual(served_by(router), ('gemini', 'pro'))
+        self.assertEqual((self.fast.stats.failures, self.large.stats.failures), (1, 0))
+
+    async def test_a_bad_request_does_not_fail_over(self):
+        self.fast.processor.error = ProviderBadRequest("invalid")
+        router = build_router(self.fast, self.large)
+        with self.assertRaises(ProviderBadRequest):
+            await router.analyze_sentiment("short text")
+        self.assertEqual(self.large.processor.calls, 0)
+
+    async def test_the_last_error_is_raised_when_every_backend_fails(self):
+        self.fast.processor.error = ProviderUnavailable("fast down")
+        self.large.processor.error = ProviderTimeout("large timed out")
+        router = build_router(self.fast, self.large)
+        with self.assertRaises(ProviderTimeout):
+            await router.analyze_sentiment("short text")
+
+    async def test_a_stream_fails_over_before_its_first_piece(self):
+        self.fast.processor.error = ProviderUnavailable("down")
+        router = build_router(self.fast, self.large)
+        pieces = [piece async for piece in router.stream_summarize_text("short text", 10)]
+        self.assertEqual("".join(pieces), "Summary by pro")
+        self.assertEqual(served_by(router), ('gemini', 'pro'))
+
+    async def test_a_stream_does_not_fail_over_after_its_first_piece(self):
+        self.fast.processor.error = ProviderUnavailable("down")
+        self.fast.processor.fail_after = 1
+        router = build_router(self.fast, self.large)
+        pieces = []
+        with self.assertRaises(ProviderUnavailable):
+            async for piece in router.stream_summarize_text("short text", 10):
+                pieces.append(piece)
+        self.assertEqual(pieces, ["Summary "])
+        self.assertEqual(self.large.processor.calls, 0)
+
+    def test_a_single_backend_router_keeps_the_backend_identity(self):
+        router = build_router(self.fast)
+        self.assertEqual(processor_identity(router), processor_identity(self.fast.processor))
+        self.assertEqual(
+            sentiment_result_key(router, "text", 'general_sentiment'),
+            sentiment_result_key(self.fast.processor, "text", 'general_sentiment'),
+        )
+
+    def test_several_backends_have_a_router_identity(self):
+        router = build_router(self.fast, self.large)
+        provider, model, _ = processor_identity(router)
+        self.assertEqual(provider, 'router')
+        self.assertTrue(model.startswith('routed-'))
+        self.assertEqual(processor_identity(build_router(self.fast, self.large))[1], model)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RoutedProvenanceTests(TestCase):
+    """
+    The history and the result store record the backend that answered, not the router.
+    """
+
+    def setUp(self):
+        self.user = create_user()
+        failing = Backend('flash', StubProcessor('gemini', 'flash', error=ProviderUnavailable("down")), tier='fast')
+        answering = Backend('mock', StubProcessor('mock', 'mock-model'), tier='large')
+        self.router = build_router(failing, answering)
+        patcher = mock.patch.object(services, 'processor', self.router)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_sentiment_records_the_answering_backend(self):
+        text = "A routed sentiment text"
+        [result] = await services.run_sentiment_analysis(self.user, [text], 'general_sentiment')
+        self.assertEqual(result['notes'], "Answered by mock-model.")
+        stored = await StoredResult.objects.aget(result_key=sentiment_result_key(self.router, text, 'general_sentiment').store_key)
+        self.assertEqual((stored.source, stored.model_name), ('mock', 'mock-model'))
+        history = await AnalysisHistory.objects.aget(user=self.user)
+        self.assertEqual(history.analysis_source, 'mock')
+
+    async def test_summarization_records_the_answering_backend(self):
+        text = "A routed summarization text"
+        await services.run_summarization(self.user, text, 10)
+        stored = await StoredResult.objects.aget(result_key=summarization_result_key(self.router, text, 10).store_key)
+        self.assertEqual((stored.source, stored.model_name), ('mock', 'mock-model'))
+        history = await SummarizationHistory.objects.aget(user=self.user)
+        self.assertEqual(history.summarization_source, 'mock')
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed.")
+class UsageQuotaTests(TestCase):
+
+    def setUp(self):
+        self.redis = fake_redis(self, quota)
+        self.quota = UsageQuota(ttl=3600)
+        self.user = create_user(free_analysis_count=10)
+
+    def balance(self):
+        self.user.refresh_from_db()
+        return self.user.free_analysis_count
+
+    def remaining(self):
+        value = self.redis.get(f'nlp_quota:remaining:{self.user.pk}')
+        return None if value is None else int(value)
+
+    def test_charges_in_redis_and_flushes_to_the_database(self):
+        self.quota.deduct(self.user, 3)
+        self.assertEqual(self.remaining(), 7)
+        self.assertEqual(self.balance(), 10)
+        self.assertEqual(self.quota.flush_usage(), 1)
+        self.assertEqual(self.balance(), 7)
+        # Seeded again from the database by the next charge.
+        self.assertIsNone(self.remaining())
+        self.quota.deduct(self.user, 1)
+        self.assertEqual(self.remaining(), 6)
+        self.assertEqual(self.quota.flush_usage(), 1)
+        self.assertEqual(self.balance(), 6)
+
+    def test_limit(self):
+        with self.assertRaises(UsageLimitExceeded):
+            self.quota.deduct(self.user, 11)
+        self.quota.deduct(self.user, 10)
+        with self.assertRaises(UsageLimitExceeded):
+            self.quota.deduct(self.user, 1)
+        self.quota.flush_usage()
+        self.assertEqual(self.balance(), 0)
+
+    def test_pro_users_are_not_charged(self):
+        self.user.is_pro = True
+        self.quota.deduct(self.user, 100)
+        self.assertIsNone(self.remaining())
+
+    def test_concurrent_charges_never_exceed_the_balance(self):
+        self.quota.deduct(self.user, 1)
+        outcomes = []
+
+        def charge():
+            try:
+                self.quota.deduct(self.user, 1)
+                outcomes.append(True)
+            except UsageLimitExceeded:
+                outcomes.append(False)
+
+        threads = [threading.Thread(target=charge) for _ in range(30)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(outcomes.count(True), 9)
+        self.assertEqual(self.remaining(), 0)
+        self.quota.flush_usage()
+        self.assertEqual(self.balance(), 0)
+
+    def test_refunds(self):
+        self.quota.deduct(self.user, 4)
+        self.quota.refund(self.user, 2)
+        self.assertEqual(self.remaining(), 8)
+        self.quota.flush_usage()
+        self.assertEqual(self.balance(), 8)
+        # A refund without a cached balance is written back by the next flush as well.
+        self.quota.refund(self.user, 1)
+        self.quota.flush_usage()
+        self.assertEqual(self.balance(), 9)
+
+    def test_a_stale_user_row_does_not_seed_the_balance(self):
+        self.user.free_analysis_count = 100
+        with self.assertRaises(UsageLimitExceeded):
+            self.quota.deduct(self.user, 11)
+
+    def test_a_charge_during_a_flush_counts_the_units_being_flushed(self):
+        self.quota.deduct(self.user, 4)
+        write_consumed = self.quota._write_consumed
+
+        def write_with_a_charge_in_between(user_id, consumed):
+            # The cached balance expired: the database still holds 10, 4 of them are being flushed.
+            self.redis.delete(f'nlp_quota:remaining:{self.user.pk}')
+            self.quota.deduct(self.user, 6)
+            with self.assertRaises(UsageLimitExceeded):
+                self.quota.deduct(self.user, 1)
+            write_consumed(user_id, consumed)
+
+        with mock.patch.object(self.quota, '_write_consumed', write_with_a_charge_in_between):
+            self.quota.flush_usage()
+        self.quota.flush_usage()
+        self.assertEqual(self.balance(), 0)
+
+    def test_a_balance_read_before_a_flush_is_read_again(self):
+        self.quota.deduct(self.user, 4)
+        self.redis.delete(f'nlp_quota:remaining:{self.user.pk}')
+        read_balance = self.quota._balance
+        reads = []
+
+        def read_then_flush(user_id):
+            balance = read_balance(user_id)
+            reads.append(balance)
+            if len(reads) == 1:
+                # The flush settles after this read but before the balance is seeded.
+                self.quota.flush_usage()
+            return balance
+
+        with mock.patch.object(self.quota, '_balance', read_then_flush):
+            self.quota.deduct(self.user, 6)
+            with self.assertRaises(UsageLimitExceeded):
+                self.quota.deduct(self.user, 1)
+        self.assertEqual(reads, [10, 6])
+
+    def test_a_failed_flush_keeps_the_count(self):
+        self.quota.deduct(self.user, 4)
+        with mock.patch.object(self.quota, '_write_consumed', side_effect=RuntimeError("database down")):
+            self.assertEqual(self.quota.flush_usage(), 0)
+        self.assertEqual(self.balance(), 10)
+        self.assertEqual(self.remaining(), 6)
+        self.assertEqual(self.quota.flush_usage(), 1)
+        self.assertEqual(self.balance(), 6)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed.")
+class HistoryBufferTests(TestCase):
+
+    def setUp(self):
+        self.redis = fake_redis(self, history_buffer)
+        self.user = create_user()
+
+    def enqueue(self, text="متن", **fields):
+        fields.setdefault('user_id', self.user.pk)
+        history_buffer.enqueue(
+            'sentiment', text_input=text, analysis_result={'sentiment': 'POSITIVE'},
+            analysis_source='mock', **fields,
+        )
+
+    def queued(self, key):
+        return [json.loads(raw)['fields']['text_input'] for raw in self.redis.lrange(key, 0, -1)]
+
+    def test_rows_are_queued_then_flushed_in_bulk(self):
+        self.enqueue("first")
+        self.enqueue("second")
+        self.assertFalse(AnalysisHistory.objects.exists())
+        self.assertEqual(self.queued(history_buffer.PENDING_KEY), ["first", "second"])
+        self.assertEqual(history_buffer.flush(), 2)
+        self.assertCountEqual(AnalysisHistory.objects.values_list('text_input', flat=True), ["first", "second"])
+        self.assertEqual(self.redis.llen(history_buffer.PENDING_KEY), 0)
+        self.assertEqual(self.redis.llen(history_buffer.PROCESSING_KEY), 0)
+
+    def test_a_batch_is_claimed_into_the_processing_list(self):
+        for text in ("a", "b", "c"):
+            self.enqueue(text)
+        batch = history_buffer._claim_batch(self.redis, 2)
+        self.assertEqual([json.loads(raw)['fields']['text_input'] for raw in batch], ["a", "b"])
+        self.assertEqual(self.queued(history_buffer.PROCESSING_KEY), ["a", "b"])
+        self.assertEqual(self.queued(history_buffer.PENDING_KEY), ["c"])
+
+    def test_a_failed_flush_leaves_its_batch_for_the_next_flush(self):
+        self.enqueue("a")
+        self.enqueue("b")
+        with mock.patch.object(history_buffer, '_write_batch', side_effect=RuntimeError("database down")):
+            self.assertEqual(history_buffer.flush(batch_size=1), 0)
+        self.assertEqual(self.queued(history_buffer.PROCESSING_KEY), ["a"])
+        self.assertEqual(self.queued(history_buffer.PENDING_KEY), ["b"])
+        self.assertEqual(history_buffer.flush(batch_size=1), 2)
+        self.assertCountEqual(AnalysisHistory.objects.values_list('text_input', flat=True), ["a", "b"])
+
+    def test_a_batch_written_before_a_crash_is_not_inserted_twice(self):
+        self.enqueue("a")
+        write_batch = history_buffer._write_batch
+
+        def write_then_crash(batch):
+            # The insert committed, but the flush died before the batch was deleted.
+            write_batch(batch)
+            raise RuntimeError("worker lost")
+
+        with mock.patch.object(history_buffer, '_write_batch', write_then_crash):
+            history_buffer.flush()
+        self.assertEqual(self.redis.llen(history_buffer.PROCESSING_KEY), 1)
+        self.assertEqual(history_buffer.flush(), 1)
+        self.assertEqual(AnalysisHistory.objects.count(), 1)
+        self.assertEqual(self.redis.llen(history_buffer.PROCESSING_KEY), 0)
+
+    def test_rows_of_deleted_users_and_results_are_dropped(self):
+        other = create_user("other@example.com")
+        self.enqueue("kept")
+        self.enqueue("deleted user", user_id=other.pk)
+        self.enqueue("deleted result", stored_result_id=12345)
+        other.delete()
+        self.assertEqual(history_buffer.flush(), 3)
+        self.assertEqual(list(AnalysisHistory.objects.values_list('text_input', flat=True)), ["kept"])
+        self.assertEqual(self.redis.llen(history_buffer.PROCESSING_KEY), 0)
+
+    def test_timestamps_are_kept(self):
+        ran_at = timezone.now() - timedelta(minutes=5)
+        self.enqueue(timestamp=ran_at)
+        history_buffer.flush()
+        self.assertEqual(AnalysisHistory.objects.get().timestamp, ran_at)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class HistoryBufferFallbackTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user()
+
+    def enqueue(self, text):
+        history_buffer.enqueue('summarization', user_id=self.user.pk, text_input=text, summarized_text="خلاصه")
+
+    def test_rows_are_saved_directly_when_the_cache_is_not_redis(self):
+        self.enqueue("direct")
+        self.assertEqual(SummarizationHistory.objects.get().text_input, "direct")
+        self.assertEqual(history_buffer.flush(), 0)
+
+    @override_settings(NLP_HISTORY_WRITE_BEHIND=False)
+    def test_rows_are_saved_directly_when_write_behind_is_off(self):
+        connection = mock.Mock()
+        with mock.patch.object(history_buffer, 'get_redis_connection', return_value=connection):
+            self.enqueue("direct")
+        connection.rpush.assert_not_called()
+        self.assertEqual(SummarizationHistory.objects.get().text_input, "direct")
+
+    def test_rows_are_saved_directly_when_the_list_cannot_be_reached(self):
+        connection = mock.Mock(**{'rpush.side_effect': ConnectionError("redis down")})
+        with mock.patch.object(history_buffer, 'get_redis_connection', return_value=connection):
+            self.enqueue("direct")
+        self.assertEqual(SummarizationHistory.objects.get().text_input, "direct")
+
+    @override_settings(NLP_BLOB_MIN_SIZE=16)
+    def test_large_inputs_saved_directly_go_to_the_blob_store(self):
+        self.enqueue("متن طولانی " * 10)
+        history = SummarizationHistory.objects.get()
+        self.assertEqual(history.text_input, "")
+        self.assertEqual(history.input_text, "متن طولانی " * 10)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, NLP_BLOB_MIN_SIZE=16)
+class HistoryPaginationTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        # Rows analyzed in the same instant (e.g. one bulk request) share a timestamp.
+        self.ran_at = timezone.now()
+
+    def stored_result(self, task, result):
+        return StoredResult.objects.create(
+            result_key=text_fingerprint(f"{task}:{result}"), task=task, text_hash='0' * 64,
+            result=result, source='mock', model_name='mock', prompt_version='v1',
+        )
+
+    def pages(self, url, **params):
+        """
+        Follows the next links from the first page and returns the rows of every page.
+        """
+        pages = []
+        response = self.client.get(url, params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.json()['results'])
+            if not response.json()['next']:
+                return pages
+            response = self.client.get(response.json()['next'])
+
+    def test_rows_with_the_same_timestamp_are_listed_once(self):
+        other = create_user("other@example.com")
+        AnalysisHistory.objects.bulk_create(
+            [AnalysisHistory(user=self.user, text_input=f"text {i}", analysis_result={'i': i}, timestamp=self.ran_at)
+             for i in range(15)]
+            + [AnalysisHistory(user=self.user, text_input=f"old {i}", analysis_result={'i': i},
+                               timestamp=self.ran_at - timedelta(days=1)) for i in range(5)]
+            + [AnalysisHistory(user=other, text_input="other", analysis_result={}, timestamp=self.ran_at)]
+        )
+        pages = self.pages(reverse('sentiment_history'), limit=4, include_input='true')
+        texts = [row['text_input'] for page in pages for row in page]
+        self.assertEqual([len(page) for page in pages], [4, 4, 4, 4, 4])
+        # Newest first; rows of the same instant by id, newest first.
+        self.assertEqual(texts, [f"text {i}" for i in reversed(range(15))] + [f"old {i}" for i in reversed(range(5))])
+
+    def test_previous_links_return_the_same_pages(self):
+        AnalysisHistory.objects.bulk_create(
+            AnalysisHistory(user=self.user, text_input=f"text {i}", analysis_result={},
+                            timestamp=self.ran_at - timedelta(seconds=i // 4))
+            for i in range(10)
+        )
+        url = reverse('sentiment_history')
+        forward = [self.client.get(url, {'limit': 3, 'include_input': 'true'}).json()]
+        while forward[-1]['next']:
+            forward.append(self.client.get(forward[-1]['next']).json())
+        backward = [forward[-1]]
+        while backward[-1]['previous']:
+            backward.append(self.client.get(backward[-1]['previous']).json())
+        self.assertEqual(
+            [[row['text_input'] for row in page['results']] for page in reversed(backward)],
+            [[row['text_input'] for row in page['results']] for page in forward],
+        )
+        self.assertIsNone(forward[0]['previous'])
+
+    def test_an_invalid_cursor_is_not_found(self):
+        cursor = base64.b64encode(b'p=yesterday').decode()
+        self.assertEqual(self.client.get(reverse('sentiment_history'), {'cursor': cursor}).status_code, 404)
+
+    def test_rows_added_while_paging_do_not_shift_the_pages(self):
+        AnalysisHistory.objects.bulk_create(
+            AnalysisHistory(user=self.user, text_input=f"text {i}", analysis_result={}, timestamp=self.ran_at)
+            for i in range(6)
+        )
+        url = reverse('sentiment_history')
+        first = self.client.get(url, {'limit': 3, 'include_input': 'true'}).json()
+        AnalysisHistory.objects.create(user=self.user, text_input="new", analysis_result={}, timestamp=timezone.now())
+        second = self.client.get(first['next']).json()
+        self.assertEqual(
+            [row['text_input'] for row in first['results'] + second['results']],
+            [f"text {i}" for i in reversed(range(6))],
+        )
+
+    def test_sentiment_rows_are_serialized_in_one_query(self):
+        result = self.stored_result('sentiment', {'sentiment': 'POSITIVE'})
+        AnalysisHistory.objects.bulk_create(
+            [AnalysisHistory(user=self.user, text_input="shared", stored_result=result, timestamp=self.ran_at)
+             for _ in range(6)]
+            + [AnalysisHistory(user=self.user, text_input="legacy", analysis_result={'sentiment': 'NEGATIVE'},
+                               timestamp=self.ran_at) for _ in range(4)]
+        )
+        for include_input in ('false', 'true'):
+            with self.subTest(include_input=include_input), self.assertNumQueries(1):
+                rows = self.client.get(reverse('sentiment_history'), {'include_input': include_input}).json()['results']
+            self.assertEqual(
+                [row['analysis_result']['sentiment'] for row in rows], ['NEGATIVE'] * 4 + ['POSITIVE'] * 6
+            )
+            self.assertEqual('text_input' in rows[0], include_input == 'true')
+
+    def test_summarization_rows_are_serialized_in_one_query(self):
+        long_text = "متن طولانی برای خلاصه سازی " * 5
+        result = self.stored_result('summarization', "خلاصه")
+        rows = [SummarizationHistory(user=self.user, text_input=long_text, stored_result=result, timestamp=self.ran_at)
+                for _ in range(5)]
+        rows += [SummarizationHistory(user=self.user, text_input="short", summarized_text="legacy",
+                                      timestamp=self.ran_at) for _ in range(5)]
+        blob_store.move_inputs_to_blobs(rows)
+        SummarizationHistory.objects.bulk_create(rows)
+        self.assertEqual(SummarizationHistory.objects.filter(input_blob__isnull=False).count(), 5)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('summarize_history'), {'include_input': 'true'})
+        self.assertEqual(
+            [(row['text_input'], row['summarized_text']) for row in response.json()['results']],
+            [("short", "legacy")] * 5 + [(long_text, "خلاصه")] * 5,
+        )
+
+    def test_aggregate_rows_are_serialized_in_one_query(self):
+        texts = [f"نظر شماره {i}" for i in range(10)]
+        rows = [AggregateAnalysisHistory(
+            user=self.user, input_fingerprint=texts_fingerprint(texts), input_texts=texts,
+            analysis_result={'overall_sentiment': 'POSITIVE'}, analysis_source='mock',
+            analysis_type='business_intent', timestamp=self.ran_at,
+        ) for _ in range(4)]
+        blob_store.move_inputs_to_blobs(rows)
+        AggregateAnalysisHistory.objects.bulk_create(rows)
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('aggregate_history'), {'include_input': 'true'})
+        self.assertEqual([row['input_texts'] for row in response.json()['results']], [texts] * 4)
+
+
+@override_settings(NLP_HISTORY_RETENTION_DAYS={'free': 90, 'pro': 365}, NLP_BLOB_MIN_SIZE=16)
+class ArchivalTests(TestCase):
+
+    def setUp(self):
+        archive_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(archive_dir.cleanup)
+        self.archive_dir = archive_dir.name
+        settings_override = override_settings(NLP_ARCHIVE_DIR=self.archive_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.now = timezone.now()
+        self.free = create_user("free@example.com")
+        self.pro = create_user("pro@example.com", is_pro=True)
+
+    def sentiment(self, user, days_old, text="متن", **fields):
+        fields.setdefault('analysis_result', {'sentiment': 'NEUTRAL'})
+        return AnalysisHistory.objects.create(
+            user=user, text_input=text, timestamp=self.now - timedelta(days=days_old), **fields
+        )
+
+    def summarization(self, user, days_old, text):
+        row = SummarizationHistory(
+            user=user, text_input=text, summarized_text="خلاصه", timestamp=self.now - timedelta(days=days_old)
+        )
+        blob_store.move_inputs_to_blobs([row])
+        row.save()
+        return row
+
+    def archived_files(self, kind):
+        return sorted(
+            os.path.relpath(os.path.join(directory, name), self.archive_dir)
+            for directory, _, names in os.walk(os.path.join(self.archive_dir, kind)) for name in names
+        )
+
+    def test_rows_past_the_retention_of_their_tier_are_archived(self):
+        kept = [self.sentiment(self.free, 89), self.sentiment(self.pro, 91), self.sentiment(self.pro, 364)]
+        self.sentiment(self.free, 91)
+        self.sentiment(self.pro, 366)
+        self.assertEqual(archival.archive_history(now=self.now), {'sentiment': 2, 'summarization': 0, 'aggregate': 0})
+        self.assertCountEqual(AnalysisHistory.objects.values_list('pk', flat=True), [row.pk for row in kept])
+
+    def test_a_tier_without_retention_keeps_its_rows(self):
+        self.sentiment(self.free, 91)
+        self.sentiment(self.pro, 5000)
+        with self.settings(NLP_HISTORY_RETENTION_DAYS={'free': 90, 'pro': None}):
+            self.assertEqual(archival.archive_history(kinds=['sentiment'], now=self.now), {'sentiment': 1})
+        self.assertEqual(list(AnalysisHistory.objects.values_list('user', flat=True)), [self.pro.pk])
+        with self.settings(NLP_HISTORY_RETENTION_DAYS={'free': None, 'pro': None}):
+            self.assertIsNone(archival.cold_rows_filter(self.now))
+            self.assertEqual(archival.archive_history(kinds=['sentiment'], now=self.now), {'sentiment': 0})
+        self.assertEqual(AnalysisHistory.objects.count(), 1)
+
+    def test_dry_run_deletes_nothing(self):
+        self.sentiment(self.free, 91)
+        self.summarization(self.free, 100, "متن طولانی " * 10)
+        self.assertEqual(
+            archival.archive_history(dry_run=True, now=self.now), {'sentiment': 1, 'summarization': 1, 'aggregate': 0}
+        )
+        self.assertEqual(AnalysisHistory.objects.count(), 1)
+        self.assertEqual(SummarizationHistory.objects.count(), 1)
+        self.assertEqual(TextBlob.objects.count(), 1)
+        self.assertEqual(os.listdir(self.archive_dir), [])
+
+    def test_archives_are_written_per_month_and_read_back(self):
+        result = StoredResult.objects.create(
+            result_key='1' * 64, task='sentiment', text_hash='0' * 64, result={'sentiment': 'POSITIVE'},
+            source='mock', model_name='mock', prompt_version='v1',
+        )
+        old = self.sentiment(self.free, 200, text="خوب", stored_result=result, analysis_result=None)
+        older = self.sentiment(self.free, 300, text="بد")
+        long_text = "متن طولانی برای بایگانی " * 10
+        summary = self.summarization(self.free, 200, long_text)
+
+        archival.archive_history(now=self.now)
+
+        sentiment_files = self.archived_files('sentiment')
+        self.assertEqual(sentiment_files, sorted([
+            os.path.join('sentiment', older.timestamp.strftime('%Y-%m'), f"{older.pk}-{older.pk}.jsonl.gz"),
+            os.path.join('sentiment', old.timestamp.strftime('%Y-%m'), f"{old.pk}-{old.pk}.jsonl.gz"),
+        ]))
+        records = {
+            record['id']: record
+            for path in sentiment_files for record in archival.iter_archive(os.path.join(self.archive_dir, path))
+        }
+        self.assertEqual(records[old.pk]['result'], {'sentiment': 'POSITIVE'})
+        self.assertEqual(records[old.pk]['text_input'], "خوب")
+        self.assertEqual(records[older.pk]['analysis_result'], {'sentiment': 'NEUTRAL'})
+        self.assertNotIn('result', records[older.pk])
+
+        [summary_file] = self.archived_files('summarization')
+        self.assertTrue(summary_file.startswith(os.path.join('summarization', summary.timestamp.strftime('%Y-%m'))))
+        [record] = archival.iter_archive(os.path.join(self.archive_dir, summary_file))
+        self.assertEqual(record['text_input'], long_text)
+        self.assertEqual(record['summarized_text'], "خلاصه")
+        self.assertFalse(AnalysisHistory.objects.exists() or SummarizationHistory.objects.exists())
+
+    def test_a_blob_still_referenced_by_a_hot_row_is_kept(self):
+        long_text = "متن مشترک و طولانی " * 10
+        self.summarization(self.free, 100, long_text)
+        hot = self.summarization(self.free, 10, long_text)
+        self.assertEqual(TextBlob.objects.count(), 1)
+
+        archival.archive_history(kinds=['summarization'], now=self.now)
+        self.assertEqual(list(SummarizationHistory.objects.values_list('pk', flat=True)), [hot.pk])
+        self.assertEqual(SummarizationHistory.objects.get().input_text, long_text)
+
+        archival.archive_history(kinds=['summarization'], now=self.now + timedelta(days=90))
+        self.assertFalse(SummarizationHistory.objects.exists())
+        self.assertFalse(TextBlob.objects.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES, NLP_BULK_WINDOW_SIZE=3)
+class BulkUploadTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user(free_analysis_count=100)
+        self.processor = StubProcessor('stub', 'bulk', error=ProviderResponseError("Unreadable answer."), failing_texts=["bad"])
+        patcher = mock.patch.object(services, 'processor', self.processor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def upload(self, body: bytes, **params):
+        url = reverse('sentiment_bulk')
+        if params:
+            url += '?' + urlencode(params)
+        response = await self.async_client.post(
+            url, data=body, content_type='application/x-ndjson', headers=auth_headers(self.user)
+        )
+        self.assertEqual(response.status_code, 200)
+        content = b''.join([chunk async for chunk in response.streaming_content])
+        return [json.loads(line) for line in content.decode().splitlines()]
+
+    def results(self, records):
+        return {record['line']: record for record in records if 'line' in record}
+
+    def checkpoints(self, records):
+        return [record['checkpoint'] for record in records if 'checkpoint' in record]
+
+    async def balance(self):
+        await self.user.arefresh_from_db()
+        return self.user.free_analysis_count
+
+    async def test_gzip_upload(self):
+        records = await self.upload(gzip.compress(ndjson(
+            {"id": "a", "text": "خوب بود"}, {"id": "b", "text": "بد بود"}, "عالی", {"text": "متوسط"},
+        )))
+        results = self.results(records)
+        self.assertEqual(sorted(results), [0, 1, 2, 3])
+        self.assertEqual(results[0]['id'], "a")
+        self.assertEqual(results[2]['id'], None)
+        self.assertEqual(results[1]['sentiment_type'], 'POSITIVE')
+        self.assertEqual(self.checkpoints(records), [3, 4])
+        self.assertEqual(records[-1], {"done": True, "next_cursor": 4, "analyzed": 4, "cached": 0, "errors": 0})
+        self.assertEqual(await self.balance(), 96)
+        self.assertEqual(await AnalysisHistory.objects.filter(user=self.user).acount(), 4)
+
+    async def test_an_invalid_line_does_not_stop_the_upload(self):
+        body = b"\n".join([ndjson("اول"), b"{not json", ndjson({"id": 7}), b"", ndjson([1, 2]), ndjson("دوم")])
+        records = await self.upload(body)
+        results = self.results(records)
+        self.assertEqual(sorted(results), [0, 1, 2, 4, 5])
+        self.assertIn("Invalid JSON", results[1]['error'])
+        self.assertIn("'text'", results[2]['error'])
+        self.assertIn('error', results[4])
+        self.assertEqual(results[5]['text_input'], "دوم")
+        self.assertEqual(records[-1]['errors'], 3)
+        self.assertEqual(records[-1]['analyzed'], 2)
+        # Only the readable texts are charged.
+        self.assertEqual(await self.balance(), 98)
+
+    async def test_duplicate_texts_of_a_window_are_analyzed_once(self):
+        records = await self.upload(ndjson({"id": 1, "text": "تکراری"}, {"id": 2, "text": " تکراری. "}, "دیگر"))
+        self.assertCountEqual(self.processor.texts, ["تکراری", "دیگر"])
+        results = self.results(records)
+        self.assertEqual([results[line]['id'] for line in (0, 1)], [1, 2])
+        self.assertEqual(results[0]['sentiment_type'], results[1]['sentiment_type'])
+        self.assertEqual(records[-1]['analyzed'], 3)
+        self.assertEqual(await StoredResult.objects.acount(), 2)
+
+    async def test_stored_results_are_not_sent_upstream(self):
+        key = sentiment_result_key(self.processor, "قبلا دیده شده", 'general_sentiment')
+        await StoredResult.objects.acreate(
+            result_key=key.store_key, task='sentiment', text_hash=key.content_hash, params=key.params,
+            result={"sentiment": "NEGATIVE", "score": 0.7, "notes": ""}, source='stub', model_name='bulk',
+            prompt_version=key.prompt_version,
+        )
+        records = await self.upload(ndjson("قبلا دیده شده", "جدید"))
+        results = self.results(records)
+        self.assertEqual(self.processor.texts, ["جدید"])
+        self.assertTrue(results[0]['cached'])
+        self.assertEqual(results[0]['sentiment_type'], 'NEGATIVE')
+        self.assertFalse(results[1]['cached'])
+        self.assertEqual((records[-1]['cached'], records[-1]['analyzed']), (1, 1))
+
+    async def test_resuming_from_a_cursor(self):
+        body = ndjson(*(f"متن {i}" for i in range(6)))
+        records = await self.upload(body, cursor=3)
+        self.assertEqual(sorted(self.results(records)), [3, 4, 5])
+        self.assertCountEqual(self.processor.texts, ["متن 3", "متن 4", "متن 5"])
+        self.assertEqual(self.checkpoints(records), [6])
+
+    async def test_running_out_of_quota_stops_with_the_cursor_to_resume_from(self):
+        self.user.free_analysis_count = 4
+        await self.user.asave()
+        body = ndjson(*(f"متن {i}" for i in range(6)))
+
+        records = await self.upload(body, upload_id='reviews-2024')
+        self.assertEqual(sorted(self.results(records)), [0, 1, 2])
+        self.assertEqual(records[-1]['next_cursor'], 3)
+        self.assertEqual(records[-1]['analyzed'], 3)
+        self.assertIn('error', records[-1])
+        self.assertEqual(await self.balance(), 1)
+
+        # The same upload sent again with its upload_id resumes after the last checkpoint.
+        self.user.free_analysis_count = 10
+        await self.user.asave()
+        self.processor.texts.clear()
+        records = await self.upload(body, upload_id='reviews-2024')
+        self.assertEqual(sorted(self.results(records)), [3, 4, 5])
+        self.assertCountEqual(self.processor.texts, ["متن 3", "متن 4", "متن 5"])
+        self.assertEqual(records[-1], {"done": True, "next_cursor": 6, "analyzed": 3, "cached": 0, "errors": 0})
+
+    async def test_failed_texts_are_refunded(self):
+        records = await self.upload(ndjson("خوب", "bad", "عالی"))
+        results = self.results(records)
+        self.assertEqual(results[1]['sentiment_type'], 'ERROR')
+        self.assertEqual(records[-1]['errors'], 1)
+        self.assertEqual(await self.balance(), 98)
+        self.assertFalse(await AnalysisHistory.objects.filter(text_input="bad").aexists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BatchCommandTests(TransactionTestCase):
+    """
+    The command runs its own event loop, whose database calls use another thread
+    and connection: the rows are committed for them to be seen.
+    """
+
+    def setUp(self):
+        self.user = create_user(free_analysis_count=100)
+        self.processor = StubProcessor('stub', 'batch')
+        patcher = mock.patch.object(services, 'processor', self.processor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.output = os.path.join(self.directory, 'scores.jsonl')
+
+    def write_input(self, name, content: bytes):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as input_file:
+            input_file.write(content)
+        return path
+
+    def run_batch(self, input_path, *args):
+        call_command('nlp_batch', input_path, self.output, '--user', self.user.email, '--window-size', '3',
+                     *args, stdout=io.StringIO())
+
+    def output_records(self):
+        with open(self.output, encoding='utf-8') as output_file:
+            return [json.loads(line) for line in output_file]
+
+    def test_a_crashed_run_resumes_without_duplicates(self):
+        input_path = self.write_input('reviews.jsonl', ndjson(*({"id": i, "text": f"نظر {i}"} for i in range(8))))
+        score_window = bulk.score_window
+        windows = []
+
+        async def crash_in_the_second_window(*args, **kwargs):
+            windows.append(args[1])
+            async for record in score_window(*args, **kwargs):
+                yield record
+                if len(windows) == 2:
+                    # Dies after writing one result of the window, before its checkpoint.
+                    raise RuntimeError("worker killed")
+
+        with mock.patch.object(bulk, 'score_window', crash_in_the_second_window):
+            with self.assertRaises(RuntimeError):
+                self.run_batch(input_path)
+        self.assertEqual(len(self.output_records()), 4)
+
+        self.processor.texts.clear()
+        self.run_batch(input_path)
+        records = self.output_records()
+        self.assertEqual(sorted(record['line'] for record in records), list(range(8)))
+        self.assertEqual(sorted(record['id'] for record in records), list(range(8)))
+        # The first window was not scored again.
+        self.assertCountEqual(self.processor.texts, [f"نظر {i}" for i in range(3, 8)])
+        with open(f"{self.output}.checkpoint") as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        self.assertEqual(checkpoint['cursor'], 8)
+        self.assertEqual(checkpoint['output_offset'], os.path.getsize(self.output))
+
+    def test_a_run_stopped_by_the_quota_resumes_at_its_checkpoint(self):
+        self.user.free_analysis_count = 4
+        self.user.save()
+        input_path = self.write_input('reviews.jsonl.gz', gzip.compress(ndjson(*(f"نظر {i}" for i in range(6)))))
+        with self.assertRaisesMessage(CommandError, "Stopped at line 3"):
+            self.run_batch(input_path)
+        self.assertEqual(sorted(record['line'] for record in self.output_records()), [0, 1, 2])
+
+        self.user.free_analysis_count = 10
+        self.user.save()
+        self.run_batch(input_path)
+        self.assertEqual(sorted(record['line'] for record in self.output_records()), list(range(6)))
+
+    def test_csv_input(self):
+        input_path = self.write_input(
+            'reviews.csv', "review,ref\r\n\"خوب بود،\nممنون\",r1\r\nبد بود,r2\r\n,r3\r\n".encode('utf-8-sig')
+        )
+        self.run_batch(input_path, '--text-column', 'review', '--id-column', 'ref')
+        # Lines count the CSV rows, a quoted field spanning several lines included.
+        records = {record['line']: record for record in self.output_records()}
+        self.assertEqual((records[0]['id'], records[0]['text_input']), ('r1', "خوب بود، ممنون"))
+        self.assertEqual((records[1]['id'], records[1]['sentiment_type']), ('r2', 'POSITIVE'))
+        self.assertIn('error', records[2])
+
+    def test_a_csv_without_the_text_column_is_refused(self):
+        input_path = self.write_input('reviews.csv', b"body,id\r\ntext,1\r\n")
+        with self.assertRaisesMessage(CommandError, "no 'text' column"):
+            self.run_batch(input_path)
+
+    def test_a_checkpoint_of_another_input_is_refused(self):
+        first = self.write_input('first.jsonl', ndjson("یک", "دو"))
+        second = self.write_input('second.jsonl', ndjson("سه"))
+        self.run_batch(first)
+        with self.assertRaisesMessage(CommandError, "belongs to another input"):
+            self.run_batch(second)
+        with self.assertRaisesMessage(CommandError, "belongs to another input"):
+            self.run_batch(first, '--analysis-type', 'business_intent')
+        self.run_batch(second, '--restart')
+        self.assertEqual([record['text_input'] for record in self.output_records()], ["سه"])
+
+
+class RecoveringProcessor(StubProcessor):
+    """
+    Fails each of `failing_texts` once, as a provider that recovers between job attempts.
+    """
+
+    async def analyze_sentiment(self, text, analysis_type="general_sentiment"):
+        try:
+            return await super().analyze_sentiment(text, analysis_type)
+        finally:
+            self.failing_texts.discard(text)
+
+
+@override_settings(CACHES=LOCMEM_CACHES, NLP_JOB_MAX_RETRIES=2, NLP_JOB_RETRY_BACKOFF=0)
+class AnalysisJobTests(TransactionTestCase):
+    """
+    Jobs run eagerly: a retry runs right away, in the same call. The pipelines run
+    on the worker loop, whose database connection is another one than the test's.
+    """
+
+    def setUp(self):
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, 'task_always_eager', False)
+        clear_result_cache()
+        self.user = create_user(free_analysis_count=10)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def use_processor(self, processor):
+        patcher = mock.patch.object(services, 'processor', processor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return processor
+
+    def submit(self, job_type, **input_data):
+        return self.client.post(reverse('analysis_jobs'), {'job_type': job_type, **input_data}, format='json')
+
+    def job(self, response):
+        return AnalysisJob.objects.get(pk=response.json()['id'])
+
+    def balance(self):
+        self.user.refresh_from_db()
+        return self.user.free_analysis_count
+
+    def test_a_submitted_job_is_accepted_and_run(self):
+        self.use_processor(StubProcessor('stub', 'jobs'))
+        response = self.submit('sentiment', texts=["خوب", "عالی"], analysis_type='general_sentiment')
+        self.assertEqual(response.status_code, 202)
+        job = self.job(response)
+        self.assertEqual((job.status, job.attempts, job.progress), (AnalysisJob.STATUS_SUCCEEDED, 1, 100))
+        self.assertEqual([item['sentiment_type'] for item in job.result], ['POSITIVE', 'POSITIVE'])
+        self.assertEqual(self.balance(), 8)
+        detail = self.client.get(reverse('analysis_job_detail', args=[job.pk])).json()
+        self.assertEqual(detail['status'], AnalysisJob.STATUS_SUCCEEDED)
+
+    def test_a_job_over_the_quota_is_refused(self):
+        self.use_processor(StubProcessor('stub', 'jobs'))
+        response = self.submit('sentiment', texts=["متن"] * 11, analysis_type='general_sentiment')
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(AnalysisJob.objects.exists())
+        self.assertEqual(self.balance(), 10)
+
+    def test_a_job_that_cannot_be_queued_is_refunded(self):
+        with mock.patch.object(tasks.run_analysis_job, 'apply_async', side_effect=ConnectionError("broker down")):
+            response = self.submit('summarization', text="متن", max_words=20)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(AnalysisJob.objects.get().status, AnalysisJob.STATUS_FAILED)
+        self.assertEqual(self.balance(), 10)
+
+    def test_a_failing_job_is_retried_then_failed_and_refunded(self):
+        processor = self.use_processor(StubProcessor('stub', 'jobs', error=ProviderUnavailable("Provider down.")))
+        job = self.job(self.submit('summarization', text="متن", max_words=20))
+        self.assertEqual((job.status, job.attempts), (AnalysisJob.STATUS_FAILED, 3))
+        self.assertEqual(job.error, "Provider down.")
+        self.assertEqual(processor.calls, 3)
+        self.assertEqual(self.balance(), 10)
+
+    def test_a_job_succeeding_on_a_retry_is_charged(self):
+        processor = self.use_processor(StubProcessor('stub', 'jobs', error=ProviderUnavailable("Provider down.")))
+        calls = []
+
+        async def recover(text, max_words):
+            calls.append(text)
+            if len(calls) == 1:
+                raise ProviderUnavailable("Provider down.")
+            return "خلاصه"
+
+        with mock.patch.object(processor, 'summarize_text', recover):
+            job = self.job(self.submit('summarization', text="متن", max_words=20))
+        self.assertEqual((job.status, job.attempts), (AnalysisJob.STATUS_SUCCEEDED, 2))
+        self.assertEqual(job.result['summarized_text'], "خلاصه")
+        self.assertEqual(self.balance(), 9)
+
+    def test_failed_texts_are_retried_alone(self):
+        processor = self.use_processor(RecoveringProcessor(
+            'stub', 'recovering', error=ProviderResponseError("Unreadable answer."), failing_texts=["بد"]
+        ))
+        job = self.job(self.submit('sentiment', texts=["خوب", "بد"], analysis_type='general_sentiment'))
+        self.assertEqual((job.status, job.attempts), (AnalysisJob.STATUS_SUCCEEDED, 2))
+        self.assertEqual([item['sentiment_type'] for item in job.result], ['POSITIVE', 'POSITIVE'])
+        # The text that succeeded on the first attempt was served from the cache on the second.
+        self.assertCountEqual(processor.texts, ["خوب", "بد", "بد"])
+        self.assertEqual(self.balance(), 8)
+
+    def test_texts_still_failing_after_the_last_retry_are_refunded(self):
+        processor = self.use_processor(StubProcessor(
+            'stub', 'jobs', error=ProviderResponseError("Unreadable answer."), failing_texts=["بد"]
+        ))
+        job = self.job(self.submit('sentiment', texts=["خوب", "بد"], analysis_type='general_sentiment'))
+        self.assertEqual((job.status, job.attempts), (AnalysisJob.STATUS_SUCCEEDED, 3))
+        self.assertEqual([item['sentiment_type'] for item in job.result], ['POSITIVE', 'ERROR'])
+        self.assertEqual(processor.texts.count("بد"), 3)
+        self.assertEqual(self.balance(), 9)
+
+    def test_running_out_of_quota_fails_the_job_without_retrying(self):
+        processor = self.use_processor(StubProcessor('stub', 'jobs'))
+        self.user.free_analysis_count = 0
+        self.user.save()
+        response = self.submit('aggregate', texts=["خوب", "بد"], analysis_type='general_sentiment')
+        self.assertEqual(response.status_code, 202)
+        job = self.job(response)
+        self.assertEqual((job.status, job.attempts), (AnalysisJob.STATUS_FAILED, 1))
+        self.assertTrue(job.error)
+        self.assertEqual(processor.calls, 0)
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed.")
+class SingleFlightTests(SimpleTestCase):
+    """
+    Another worker is played by another event loop: in-flight calls are shared per loop,
+    and across loops through the (fake) Redis cache.
+    """
+
+    def setUp(self):
+        settings_override = override_settings(CACHES=fake_redis_caches())
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def single_flight(self, delay=0.2, error=None, **options):
+        # A new backend per test: the layers are singletons per wrapped processor.
+        self.upstream = StubProcessor('stub', f"single-flight-{uuid.uuid4().hex}", error=error, delay=delay)
+        processor = SingleFlightProcessor(self.upstream)
+        for name, value in options.items():
+            setattr(processor, name, value)
+        return processor
+
+    def keys(self, processor, text):
+        key = sentiment_result_key(processor.processor, text, 'general_sentiment').cache_key
+        return f"single_flight:lock:{key}", f"single_flight:outcome:{key}"
+
+    async def in_another_worker(self, call, delay=0.05):
+        await asyncio.sleep(delay)
+        return await asyncio.to_thread(asyncio.run, call())
+
+    async def test_concurrent_identical_calls_make_one_upstream_call(self):
+        processor = self.single_flight()
+        results = await asyncio.gather(
+            *(processor.analyze_sentiment("همان متن") for _ in range(5)), processor.analyze_sentiment("متن دیگر")
+        )
+        self.assertEqual(self.upstream.calls, 2)
+        self.assertEqual(self.upstream.texts.count("همان متن"), 1)
+        self.assertTrue(all(result == results[0] for result in results))
+
+    async def test_another_worker_waits_for_the_published_result(self):
+        processor = self.single_flight()
+        leader, follower = await asyncio.gather(
+            processor.analyze_sentiment("همان متن"),
+            self.in_another_worker(lambda: processor.analyze_sentiment("همان متن")),
+        )
+        self.assertEqual(leader, follower)
+        self.assertEqual(self.upstream.calls, 1)
+        lock_key, _ = self.keys(processor, "همان متن")
+        self.assertIsNone(await cache.aget(lock_key))
+
+    async def test_errors_reach_the_followers(self):
+        processor = self.single_flight(error=ProviderRateLimited("Slow down.", retry_after=3))
+        outcomes = await asyncio.gather(
+            processor.analyze_sentiment("همان متن"),
+            processor.analyze_sentiment("همان متن"),
+            self.in_another_worker(lambda: processor.analyze_sentiment("همان متن")),
+            return_exceptions=True,
+        )
+        self.assertEqual(self.upstream.calls, 1)
+        for outcome in outcomes:
+            self.assertIsInstance(outcome, ProviderRateLimited)
+            self.assertEqual(outcome.retry_after, 3)
+        self.assertEqual(str(outcomes[2]), "Slow down.")
+
+    async def test_a_follower_takes_over_an_abandoned_lock(self):
+        processor = self.single_flight(delay=0.0, poll_interval=0.05)
+        lock_key, outcome_key = self.keys(processor, "همان متن")
+        # The worker holding the lock died: nothing is published and the lock expires.
+        await cache.aset(lock_key, 'dead-worker', timeout=1)
+        started = time.monotonic()
+        result = await processor.analyze_sentiment("همان متن")
+        self.assertGreaterEqual(time.monotonic() - started, 0.5)
+        self.assertEqual(result['sentiment'], 'POSITIVE')
+        self.assertEqual(self.upstream.calls, 1)
+        self.assertEqual(await cache.aget(outcome_key), {'result': result})
+
+    async def test_a_follower_calls_upstream_itself_after_the_wait_timeout(self):
+        processor = self.single_flight(delay=0.0, poll_interval=0.02, wait_timeout=0.2)
+        lock_key, _ = self.keys(processor, "همان متن")
+        # Another worker holds the lock for longer than this one waits.
+        await cache.aset(lock_key, 'slow-worker', timeout=60)
+        result = await processor.analyze_sentiment("همان متن")
+        self.assertEqual(result['sentiment'], 'POSITIVE')
+        self.assertEqual(self.upstream.calls, 1)
+        # The lock of the other worker is left alone.
+        self.assertEqual(await cache.aget(lock_key), 'slow-worker')
+
+
+class MicroBatchingTests(SimpleTestCase):
+
+    def batching(self, max_batch_size=16, max_wait=0.02, **options):
+        # A new backend per test: the layers are singletons per wrapped processor.
+        self.upstream = StubProcessor('stub', f"batching-{uuid.uuid4().hex}", **options)
+        processor = MicroBatchingProcessor(self.upstream)
+        processor.max_batch_size = max_batch_size
+        processor.max_wait = max_wait
+        patcher = mock.patch.object(self.upstream, 'analyze_sentiment_batch', wraps=self.upstream.analyze_sentiment_batch)
+        self.batch_call = patcher.start()
+        self.addCleanup(patcher.stop)
+        return processor
+
+    def batches(self):
+        return [call.args[0] for call in self.batch_call.call_args_list]
+
+    async def test_a_full_batch_is_sent_without_waiting(self):
+        processor = self.batching(max_batch_size=4, max_wait=10)
+        started = time.monotonic()
+        results = await asyncio.gather(*(processor.analyze_sentiment(f"متن {i}") for i in range(8)))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(self.batches(), [[f"متن {i}" for i in range(4)], [f"متن {i}" for i in range(4, 8)]])
+        self.assertEqual(len(results), 8)
+
+    async def test_a_batch_is_sent_after_the_maximum_wait(self):
+        processor = self.batching(max_batch_size=100, max_wait=0.05)
+        started = time.monotonic()
+        await asyncio.gather(*(processor.analyze_sentiment(f"متن {i}") for i in range(3)))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertEqual(self.batches(), [["متن 0", "متن 1", "متن 2"]])
+
+        # A text arriving alone is sent with a plain call.
+        await processor.analyze_sentiment("تنها")
+        self.assertEqual(len(self.batches()), 1)
+        self.assertEqual(self.upstream.texts[-1], "تنها")
+
+    async def test_analysis_types_are_batched_apart(self):
+        processor = self.batching(max_batch_size=2, max_wait=10)
+        await asyncio.gather(
+            processor.analyze_sentiment("الف", 'general_sentiment'),
+            processor.analyze_sentiment("ب", 'business_intent'),
+            processor.analyze_sentiment("ج", 'general_sentiment'),
+            processor.analyze_sentiment("د", 'business_intent'),
+        )
+        self.assertEqual(
+            [(call.args[0], call.args[1]) for call in self.batch_call.call_args_list],
+            [(["الف", "ج"], 'general_sentiment'), (["ب", "د"], 'business_intent')],
+        )
+
+    async def test_an_item_error_only_reaches_its_caller(self):
+        processor = self.batching(error=ProviderResponseError("Unreadable answer."), failing_texts=["بد"])
+        good, bad, other = await asyncio.gather(
+            processor.analyze_sentiment("خوب"), processor.analyze_sentiment("بد"), processor.analyze_sentiment("عالی"),
+            return_exceptions=True,
+        )
+        self.assertEqual(len(self.batches()), 1)
+        self.assertEqual(good['sentiment'], 'POSITIVE')
+        self.assertEqual(other['sentiment'], 'POSITIVE')
+        self.assertIsInstance(bad, ProviderResponseError)
+
+    async def test_a_failed_batch_reaches_every_caller(self):
+        processor = self.batching()
+        self.batch_call.side_effect = ProviderUnavailable("Provider down.")
+        outcomes = await asyncio.gather(
+            *(processor.analyze_sentiment(f"متن {i}") for i in range(3)), return_exceptions=True
+        )
+        self.assertTrue(all(isinstance(outcome, ProviderUnavailable) for outcome in outcomes))
+
+
+class GeminiBatchTests(SimpleTestCase):
+    """
+    analyze_sentiment_batch() sends one prompt for all texts and falls back to one
+    call per text when the reply is not one result per text.
+    """
+    RESULT = {"sentiment": "POSITIVE", "score": 0.9, "notes": ""}
+
+    def setUp(self):
+        self.processor = GeminiProcessor(api_key='test-key', model_name='gemini-batch-test')
+        self.prompts = []
+        self.batch_reply = None
+
+        async def generate(prompt):
+            self.prompts.append(prompt)
+            if "(JSON array)" in prompt:
+                return self.batch_reply
+            if "بد" in prompt:
+                raise ProviderBadRequest("Blocked.")
+            return json.dumps(self.RESULT)
+
+        patcher = mock.patch.object(self.processor, '_generate', generate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_one_prompt_for_all_texts(self):
+        self.batch_reply = "```json\n" + json.dumps([self.RESULT, dict(self.RESULT, sentiment="NEGATIVE")]) + "\n```"
+        results = await self.processor.analyze_sentiment_batch(["خوب", "افتضاح"])
+        self.assertEqual([result['sentiment'] for result in results], ["POSITIVE", "NEGATIVE"])
+        self.assertEqual(len(self.prompts), 1)
+        self.assertIn(json.dumps(["خوب", "افتضاح"], ensure_ascii=False), self.prompts[0])
+
+    async def test_an_unusable_reply_falls_back_to_one_call_per_text(self):
+        replies = {
+            'malformed': '[{"sentiment": "POSITIVE"',
+            'too short': json.dumps([self.RESULT]),
+            'too long': json.dumps([self.RESULT] * 3),
+            'not an array': json.dumps(self.RESULT),
+            'results without sentiment': json.dumps([{"score": 1}, {"score": 1}]),
+        }
+        for name, reply in replies.items():
+            with self.subTest(name):
+                self.prompts.clear()
+                self.batch_reply = reply
+                results = await self.processor.analyze_sentiment_batch(["خوب", "عالی"])
+                self.assertEqual(results, [self.RESULT, self.RESULT])
+                self.assertEqual(len(self.prompts), 3)
+
+    async def test_a_text_failing_in_the_fallback_only_fails_itself(self):
+        self.batch_reply = "not json"
+        good, bad = await self.processor.analyze_sentiment_batch(["خوب", "بد"])
+        self.assertEqual(good, self.RESULT)
+        self.assertIsInstance(bad, ProviderBadRequest)
+
+
+class SharedLimiterTests(SimpleTestCase):
+    """
+    The admission control with its state in (fake) Redis, shared by all workers.
+    """
+
+    def setUp(self):
+        self.redis = fake_redis(self, rate_limit)
+
+    def limiter(self, provider=None, **limits):
+        """
+        Returns a limiter of a new provider, or another worker's limiter of `provider`.
+        """
+        limits = {**rate_limit.DEFAULT_LIMITS, 'decrease_cooldown': 0, **limits}
+        return UpstreamLimiter(provider or f"provider-{uuid.uuid4().hex}", limits, poll_interval=0.01)
+
+    def deadline(self, seconds=0.1):
+        return time.monotonic() + seconds
+
+    async def test_token_bucket(self):
+        limiter = self.limiter(requests_per_second=2, burst=3)
+        for _ in range(3):
+            await limiter.acquire(self.deadline())
+        with self.assertRaises(ProviderRateLimited) as caught:
+            await limiter.acquire(self.deadline())
+        # About half a second until the next token.
+        self.assertGreater(caught.exception.retry_after, 0.2)
+        self.assertLess(limiter.state()['tokens'], 1)
+
+    async def test_tokens_are_refilled(self):
+        limiter = self.limiter(requests_per_second=50, burst=1)
+        await limiter.acquire(self.deadline())
+        started = time.monotonic()
+        await limiter.acquire(self.deadline(1))
+        self.assertGreater(time.monotonic() - started, 0.01)
+
+    async def test_concurrency_limit(self):
+        limiter = self.limiter(initial_concurrency=2)
+        first = await limiter.acquire(self.deadline())
+        await limiter.acquire(self.deadline())
+        with self.assertRaises(ProviderRateLimited):
+            await limiter.acquire(self.deadline())
+        self.assertEqual(limiter.state()['in_flight'], 2)
+
+        await limiter.release(first)
+        await limiter.acquire(self.deadline())
+
+    async def test_overload_halves_the_limit_and_success_raises_it(self):
+        limiter = self.limiter(initial_concurrency=8, min_concurrency=3)
+        for expected in (4, 3, 3):
+            await limiter.release(await limiter.acquire(self.deadline()), 'overloaded')
+            self.assertEqual(limiter.state()['concurrency_limit'], expected)
+        # 1/limit per success: about one slot per round of calls.
+        for _ in range(4):
+            await limiter.release(await limiter.acquire(self.deadline()), 'ok')
+        self.assertEqual(limiter.state()['concurrency_limit'], 4)
+        # Other failures leave the limit alone.
+        await limiter.release(await limiter.acquire(self.deadline()), 'error')
+        self.assertEqual(limiter.state()['concurrency_limit'], 4)
+
+    async def test_the_limit_is_halved_once_per_cooldown(self):
+        limiter = self.limiter(initial_concurrency=8, decrease_cooldown=60)
+        leases = [await limiter.acquire(self.deadline()) for _ in range(3)]
+        # Calls sent before the limit was lowered fail together and count as one decrease.
+        for lease in leases:
+            await limiter.release(lease, 'overloaded')
+        self.assertEqual(limiter.state()['concurrency_limit'], 4)
+
+    async def test_retry_after_holds_back_every_worker(self):
+        limiter = self.limiter()
+        other_worker = self.limiter(limiter.provider, **limiter.limits)
+        await limiter.release(await limiter.acquire(self.deadline()), 'overloaded', retry_after=0.3)
+        self.assertGreater(other_worker.state()['blocked_for'], 0.1)
+
+        with self.assertRaises(ProviderRateLimited) as caught:
+            await other_worker.acquire(self.deadline())
+        self.assertGreater(caught.exception.retry_after, 0.1)
+        # Admitted again once the Retry-After has passed.
+        await other_worker.acquire(self.deadline(1))
+
+    async def test_workers_share_the_bucket_and_the_queue(self):
+        limiter = self.limiter(requests_per_second=0.5, burst=1)
+        other_worker = self.limiter(limiter.provider, **limiter.limits)
+        await limiter.acquire(self.deadline())
+        waiting = asyncio.ensure_future(other_worker.acquire(self.deadline(0.2)))
+        await asyncio.sleep(0.05)
+        self.assertEqual(limiter.state()['queue_depth'], 1)
+        self.assertEqual(limiter.state()['local_queue_depth'], 0)
+        with self.assertRaises(ProviderRateLimited):
+            await waiting
+        self.assertEqual(limiter.state()['queue_depth'], 0)
+
+
+class LocalLimiterTests(SharedLimiterTests):
+    """
+    The same admission control kept per process, when the cache backend is not Redis.
+    """
+
+    def setUp(self):
+        patcher = mock.patch.object(rate_limit, 'get_redis_connection', side_effect=NotImplementedError)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def test_retry_after_holds_back_every_worker(self):
+        limiter = self.limiter()
+        await limiter.release(await limiter.acquire(self.deadline()), 'overloaded', retry_after=0.3)
+        self.assertFalse(limiter.state()['shared'])
+        with self.assertRaises(ProviderRateLimited):
+            await limiter.acquire(self.deadline())
+        await limiter.acquire(self.deadline(1))
+
+    async def test_workers_share_the_bucket_and_the_queue(self):
+        limiter = self.limiter(requests_per_second=0.5, burst=1)
+        await limiter.acquire(self.deadline())
+        waiting = asyncio.ensure_future(limiter.acquire(self.deadline(0.2)))
+        await asyncio.sleep(0.05)
+        self.assertEqual(limiter.state()['queue_depth'], 1)
+        with self.assertRaises(ProviderRateLimited):
+            await waiting
+        self.assertEqual(limiter.state()['queue_depth'], 0)
+
+
+class RateLimitedProcessorTests(SimpleTestCase):
+
+    def setUp(self):
+        fake_redis(self, rate_limit)
+
+    def rate_limited(self, error=None, retries=2, queue_timeout=1, upstream_class=StubProcessor, **limits):
+        self.upstream = upstream_class('stub', f"rate-limited-{uuid.uuid4().hex}", error=error, failing_texts=["خوب"])
+        processor = RateLimitedProcessor(self.upstream)
+        processor.limiter = UpstreamLimiter(
+            self.upstream.provider_name, {**rate_limit.DEFAULT_LIMITS, **limits}, poll_interval=0.01,
+        )
+        processor.max_retries = retries
+        processor.queue_timeout = queue_timeout
+        return processor
+
+    async def test_a_call_not_admitted_before_the_deadline_fails(self):
+        processor = self.rate_limited(queue_timeout=0.1, initial_concurrency=1)
+        await processor.limiter.acquire(time.monotonic() + 1)
+        with self.assertRaises(ProviderRateLimited) as caught:
+            await processor.analyze_sentiment("خوب")
+        self.assertIsNotNone(caught.exception.retry_after)
+        self.assertEqual(self.upstream.calls, 0)
+
+    async def test_a_rejected_call_is_retried_after_its_retry_after(self):
+        processor = self.rate_limited(ProviderRateLimited(retry_after=0.1), upstream_class=RecoveringProcessor)
+        started = time.monotonic()
+        result = await processor.analyze_sentiment("خوب")
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertEqual(result['sentiment'], 'POSITIVE')
+        self.assertEqual(self.upstream.calls, 2)
+        state = processor.limiter_state()
+        self.assertEqual(state['concurrency_limit'], 4)
+        self.assertEqual(state['in_flight'], 0)
+
+    async def test_rejected_calls_give_up_after_the_retries(self):
+        processor = self.rate_limited(error=ProviderRateLimited(retry_after=0.01), retries=2)
+        with self.assertRaises(ProviderRateLimited):
+            await processor.analyze_sentiment("خوب")
+        self.assertEqual(self.upstream.calls, 3)
+
+    async def test_no_retry_past_the_deadline(self):
+        processor = self.rate_limited(error=ProviderRateLimited(retry_after=5), queue_timeout=1)
+        with self.assertRaises(ProviderRateLimited):
+            await processor.analyze_sentiment("خوب")
+        self.assertEqual(self.upstream.calls, 1)
+
+    async def test_an_unavailable_provider_is_not_retried_but_holds_calls_back(self):
+        processor = self.rate_limited(error=ProviderUnavailable(retry_after=0.3))
+        with self.assertRaises(ProviderUnavailable):
+            await processor.summarize_text("متن", 10)
+        self.assertEqual(self.upstream.calls, 1)
+        state = processor.limiter_state()
+        self.assertEqual(state['concurrency_limit'], 4)
+        self.assertGreater(state['blocked_for'], 0.1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class RetryLaterResponseTests(TestCase):
+    """
+    Calls the provider rejected are answered with 429 (or 503) and Retry-After, and are not charged.
+    """
+
+    def setUp(self):
+        self.user = create_user(free_analysis_count=10)
+
+    def use_processor(self, error):
+        processor = StubProcessor('stub', f"retry-later-{uuid.uuid4().hex}", error=error)
+        patcher = mock.patch.object(services, 'processor', processor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    async def balance(self):
+        await self.user.arefresh_from_db()
+        return self.user.free_analysis_count
+
+    async def post(self, name, data):
+        return await self.async_client.post(
+            reverse(name), data=data, content_type='application/json', headers=auth_headers(self.user)
+        )
+
+    async def test_sentiment_rate_limited(self):
+        self.use_processor(ProviderRateLimited(retry_after=2.4))
+        texts = [f"متن {uuid.uuid4().hex}", f"متن {uuid.uuid4().hex}"]
+        response = await self.post('sentiment_analyze', {"texts": texts, "analysis_type": "general_sentiment"})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '3')
+        self.assertEqual(response.json()['retry_after'], 3)
+        self.assertEqual(await self.balance(), 10)
+
+    async def test_sentiment_unavailable(self):
+        self.use_processor(ProviderUnavailable())
+        response = await self.post('sentiment_analyze', {"texts": [f"متن {uuid.uuid4().hex}"], "analysis_type": "general_sentiment"})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(await self.balance(), 10)
+
+    async def test_summarization_rate_limited(self):
+        self.use_processor(ProviderRateLimited(retry_after=5))
+        response = await self.post('summarize_text', {"text": f"متن {uuid.uuid4().hex}", "max_words": 10})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '5')
+        self.assertEqual(await self.balance(), 10)
+
+
+class ScoringProcessor(StubProcessor):
+    """
+    Scores an aggregate as the share of positive texts, and keeps the texts of every call in `chunks`.
+    """
+
+    def __init__(self, provider, model, **options):
+        super().__init__(provider, model, **options)
+        self.chunks = []
+
+    async def analyze_aggregate_sentiment(self, texts, analysis_type):
+        self.chunks.append(set(texts))
+        score = 100 * sum("مثبت" in text for text in texts) / len(texts)
+        return {
+            "overall_sentiment": "POSITIVE" if score >= 70 else "NEGATIVE" if score <= 40 else "MIXED",
+            "satisfaction_score": score, "key_positives": [], "key_negatives": [], "summary": "",
+        }
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class IncrementalAggregateTests(TestCase):
+    """
+    A forced re-analysis of a URL only sends the chunks whose texts changed.
+    """
+    URL = "https://shop.example/product/1"
+
+    def setUp(self):
+        clear_result_cache()
+        self.user = create_user(free_analysis_count=10)
+        self.upstream = ScoringProcessor('stub', f"aggregate-{uuid.uuid4().hex}")
+        processor = ChunkedAggregationProcessor(self.upstream)
+        processor.target_chunk_texts = 4
+        patcher = mock.patch.object(services, 'processor', processor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.positive = [f"نظر مثبت شماره {i}" for i in range(12)]
+        self.negative = [f"نظر منفی شماره {i}" for i in range(6)]
+
+    async def analyze(self, texts, force_reanalyze=True):
+        self.upstream.chunks.clear()
+        return await services.run_aggregate_analysis(
+            self.user, texts, 'general_sentiment', url=self.URL, force_reanalyze=force_reanalyze,
+        )
+
+    async def latest_chunks(self):
+        analysis = await services.find_url_analysis(self.user, self.URL)
+        return [set(record['fingerprints']) for record in analysis.chunk_results]
+
+    def fingerprints(self, texts):
+        return {text_fingerprint(services.normalize_text_simple(text)) for text in texts}
+
+    def analyzed(self):
+        return set().union(*self.upstream.chunks)
+
+    async def test_added_texts_are_analyzed_alone(self):
+        result = await self.analyze(self.positive, force_reanalyze=False)
+        self.assertEqual(result['satisfaction_score'], 100)
+        self.assertGreater(len(await self.latest_chunks()), 1)
+
+        result = await self.analyze(self.positive + self.negative)
+        self.assertEqual(self.analyzed(), set(self.negative))
+        # 12 of 18 texts are positive.
+        self.assertEqual(result['satisfaction_score'], 67)
+        self.assertEqual(result['overall_sentiment'], 'MIXED')
+        self.assertEqual(set().union(*await self.latest_chunks()), self.fingerprints(self.positive + self.negative))
+
+    async def test_only_the_chunk_of_a_removed_text_is_analyzed_again(self):
+        texts = self.positive + self.negative
+        await self.analyze(texts, force_reanalyze=False)
+        removed = self.positive[0]
+        [changed_chunk] = [chunk for chunk in await self.latest_chunks() if self.fingerprints([removed]) <= chunk]
+
+        remaining = texts[1:]
+        result = await self.analyze(remaining)
+        self.assertEqual(self.fingerprints(self.analyzed()), changed_chunk - self.fingerprints([removed]))
+        self.assertLess(len(self.analyzed()), len(remaining))
+        # 11 of 17 texts are positive.
+        self.assertEqual(result['satisfaction_score'], 65)
+        self.assertEqual(set().union(*await self.latest_chunks()), self.fingerprints(remaining))
+
+    async def test_without_force_the_stored_analysis_is_returned(self):
+        first = await self.analyze(self.positive, force_reanalyze=False)
+        self.assertEqual(await self.analyze(self.positive), first)
+        self.assertEqual(self.upstream.chunks, [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SummarizationStreamTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user(free_analysis_count=10)
+        self.text = f"متنی برای خلاصه کردن {uuid.uuid4().hex}"
+
+    def use_processor(self, processor):
+        patcher = mock.patch.object(services, 'processor', processor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return processor
+
+    async def stream(self, max_words=20):
+        response = await self.async_client.post(
+            reverse('summarize_text_stream'), data={"text": self.text, "max_words": max_words},
+            content_type='application/json', headers=auth_headers(self.user),
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(response['Cache-Control'], 'no-cache')
+        content = b''.join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertTrue(content.endswith("\n\n"))
+        events = []
+        for block in content[:-2].split("\n\n"):
+            event, data = block.split("\n")
+            self.assertTrue(event.startswith("event: ") and data.startswith("data: "))
+            events.append((event[len("event: "):], json.loads(data[len("data: "):])))
+        return events
+
+    async def balance(self):
+        await self.user.arefresh_from_db()
+        return self.user.free_analysis_count
+
+    async def test_tokens_then_the_full_result(self):
+        processor = self.use_processor(MockProcessor())
+        events = await self.stream()
+        tokens = [data['text'] for event, data in events if event == 'token']
+        self.assertGreater(len(tokens), 1)
+        summary = "This is a mock summary for the input text with a length of about 20 words."
+        self.assertEqual("".join(tokens), summary)
+        self.assertEqual(events[-1], ('done', {"original_text": self.text, "summarized_text": summary}))
+        self.assertEqual(await self.balance(), 9)
+
+        # The assembled summary is cached, stored and written to the history once the stream ended.
+        key = summarization_result_key(processor, self.text, 20)
+        self.assertEqual(await result_cache.aget(key.cache_key), summary)
+        history = await SummarizationHistory.objects.select_related('stored_result').aget(user=self.user)
+        self.assertEqual(history.stored_result.result, summary)
+        self.assertEqual(history.stored_result.result_key, key.store_key)
+
+    async def test_a_cached_summary_is_one_token(self):
+        processor = self.use_processor(StubProcessor('stub', f"stream-{uuid.uuid4().hex}"))
+        first = await self.stream()
+        second = await self.stream()
+        self.assertEqual(processor.calls, 1)
+        self.assertEqual(second, [('token', {"text": first[-1][1]['summarized_text']}), first[-1]])
+        self.assertEqual(await SummarizationHistory.objects.filter(user=self.user).acount(), 1)
+
+    async def test_a_failure_mid_stream_is_refunded_and_stores_nothing(self):
+        processor = self.use_processor(StubProcessor(
+            'stub', f"stream-{uuid.uuid4().hex}", error=ProviderResponseError("Unreadable answer."), fail_after=1,
+        ))
+        events = await self.stream()
+        self.assertEqual(events[0], ('token', {"text": "Summary "}))
+        self.assertEqual(events[-1][0], 'error')
+        self.assertEqual(events[-1][1]['error'], "Unreadable answer.")
+        self.assertEqual(await self.balance(), 10)
+        key = summarization_result_key(processor, self.text, 20)
+        self.assertIsNone(await result_cache.aget(key.cache_key))
+        self.assertFalse(await StoredResult.objects.filter(result_key=key.store_key).aexists())
+        self.assertFalse(await SummarizationHistory.objects.filter(user=self.user).aexists())
+
+    async def test_a_rate_limited_stream_asks_to_retry(self):
+        self.use_processor(StubProcessor('stub', f"stream-{uuid.uuid4().hex}", error=ProviderRateLimited(retry_after=4)))
+        events = await self.stream()
+        self.assertEqual(events, [('error', {"detail": str(ProviderRateLimited()), "retry_after": 4})])
+        self.assertEqual(await self.balance(), 10)
+
+
+class LocalLRUCacheTests(SimpleTestCase):
+
+    def test_least_recently_used_entries_are_evicted(self):
+        local = LocalLRUCache(max_entries=2)
+        local.set('a', 1)
+        local.set('b', 2)
+        self.assertEqual(local.get('a'), 1)
+        local.set('c', 3)
+        self.assertIsNone(local.get('b'))
+        self.assertEqual((local.get('a'), local.get('c')), (1, 3))
+        self.assertEqual(local.stats()['entries'], 2)
+        self.assertEqual(local.stats()['evictions'], 1)
+
+    def test_entries_expire(self):
+        local = LocalLRUCache(ttl=60)
+        with mock.patch('nlp_services.result_cache.time.monotonic', return_value=1000.0):
+            local.set('a', 1)
+            # Never kept longer than the L0 TTL, even when L1 keeps it longer.
+            local.set('b', 2, ttl=3600)
+            local.set('c', 3, ttl=5)
+        with mock.patch('nlp_services.result_cache.time.monotonic', return_value=1030.0):
+            self.assertEqual((local.get('a'), local.get('b'), local.get('c')), (1, 2, None))
+        with mock.patch('nlp_services.result_cache.time.monotonic', return_value=1060.0):
+            self.assertEqual((local.get('a'), local.get('b')), (None, None))
+        self.assertEqual(local.stats()['entries'], 0)
+
+    def test_counters(self):
+        local = LocalLRUCache()
+        local.get('a')
+        local.set('a', 1)
+        local.get('a')
+        local.get('a')
+        stats = local.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate']), (2, 1, 0.6667))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TieredResultCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.key = f"result:{uuid.uuid4().hex}"
+
+    def test_lookups_go_through_both_tiers(self):
+        tiered = TieredResultCache(ttl=60)
+        self.assertIsNone(tiered.get(self.key))
+        tiered.set(self.key, {"sentiment": "POSITIVE"})
+        self.assertEqual(tiered.get(self.key), {"sentiment": "POSITIVE"})
+
+        # Another worker finds it in L1 and keeps it in its L0.
+        other_worker = TieredResultCache(ttl=60)
+        self.assertEqual(other_worker.get(self.key), {"sentiment": "POSITIVE"})
+        self.assertEqual(other_worker.get(self.key), {"sentiment": "POSITIVE"})
+        stats = other_worker.stats()
+        self.assertEqual((stats['local']['hits'], stats['local']['misses']), (1, 1))
+        self.assertEqual((stats['remote']['hits'], stats['remote']['misses']), (1, 0))
+        stats = tiered.stats()
+        self.assertEqual((stats['local']['hits'], stats['remote']['misses']), (1, 1))
+
+    def test_an_expired_local_entry_is_read_again_from_l1(self):
+        tiered = TieredResultCache(ttl=60)
+        with mock.patch('nlp_services.result_cache.time.monotonic', return_value=1000.0):
+            tiered.set(self.key, "خلاصه")
+        with mock.patch('nlp_services.result_cache.time.monotonic', return_value=1100.0):
+            self.assertEqual(tiered.get(self.key), "خلاصه")
+        self.assertEqual(tiered.stats()['remote']['hits'], 1)
+
+    def test_delete(self):
+        tiered = TieredResultCache()
+        tiered.set(self.key, "خلاصه")
+        tiered.delete(self.key)
+        self.assertIsNone(tiered.get(self.key))
+        self.assertIsNone(cache.get(self.key))
+
+
+@unittest.skipIf(fakeredis is None, "fakeredis is not installed.")
+@override_settings(CACHES=LOCMEM_CACHES)
+class CacheInvalidationTests(SimpleTestCase):
+    """
+    Writes are broadcast over (fake) Redis pub/sub, so other workers drop their L0 copy.
+    """
+
+    def setUp(self):
+        self.redis = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+        patcher = mock.patch('nlp_services.result_cache.get_redis_connection', return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.channel = f"invalidate:{uuid.uuid4().hex}"
+        self.key = f"result:{uuid.uuid4().hex}"
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 2
+        while not condition():
+            self.assertLess(time.monotonic(), deadline, "Timed out.")
+            time.sleep(0.01)
+
+    def subscribers(self):
+        return dict(self.redis.pubsub_numsub(self.channel)).get(self.channel.encode(), 0)
+
+    def test_a_write_drops_the_copy_of_other_workers(self):
+        worker, other_worker = TieredResultCache(channel=self.channel), TieredResultCache(channel=self.channel)
+        worker.set(self.key, "old")
+        self.assertEqual(other_worker.get(self.key), "old")
+        self.wait_for(lambda: self.subscribers() == 2)
+
+        worker.set(self.key, "new")
+        self.wait_for(lambda: other_worker.local.get(self.key) is None)
+        self.assertEqual(other_worker.get(self.key), "new")
+        # The writer ignores its own message and keeps its copy.
+        self.assertEqual(worker.local.get(self.key), "new")
+
+        worker.delete(self.key)
+        self.wait_for(lambda: other_worker.local.get(self.key) is None)
+        self.assertIsNone(other_worker.get(self.key))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SharedResultTests(TestCase):
+    """
+    Results are stored once per content and shared by all users.
+    """
+
+    def setUp(self):
+        clear_result_cache()
+        self.first_user = create_user("first@example.com")
+        self.second_user = create_user("second@example.com")
+        self.processor = StubProcessor('stub', f"shared-{uuid.uuid4().hex}")
+        patcher = mock.patch.object(services, 'processor', self.processor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.text = f"کیفیت عالی بود {uuid.uuid4().hex}"
+
+    async def test_sentiment_of_another_user_is_reused(self):
+        first = await services.run_sentiment_analysis(self.first_user, [self.text], 'general_sentiment')
+        # Only the shared store (L2) is left.
+        clear_result_cache()
+        second = await services.run_sentiment_analysis(self.second_user, [self.text], 'general_sentiment')
+        self.assertEqual(self.processor.calls, 1)
+        self.assertEqual(second, first)
+
+        stored_result = await StoredResult.objects.aget()
+        histories = [history async for history in AnalysisHistory.objects.order_by('timestamp')]
+        self.assertEqual([history.user_id for history in histories], [self.first_user.pk, self.second_user.pk])
+        self.assertEqual({history.stored_result_id for history in histories}, {stored_result.pk})
+
+    async def test_summary_of_another_user_is_reused(self):
+        first = await services.run_summarization(self.first_user, self.text, 20)
+        clear_result_cache()
+        second = await services.run_summarization(self.second_user, self.text, 20)
+        self.assertEqual(self.processor.calls, 1)
+        self.assertEqual(second, first)
+
+        stored_result = await StoredResult.objects.aget()
+        histories = [history async for history in SummarizationHistory.objects.all()]
+        self.assertEqual({history.user_id for history in histories}, {self.first_user.pk, self.second_user.pk})
+        self.assertEqual({history.stored_result_id for history in histories}, {stored_result.pk})
+
+    async def test_other_parameters_are_not_shared(self):
+        await services.run_summarization(self.first_user, self.text, 20)
+        await services.run_summarization(self.second_user, self.text, 30)
+        self.assertEqual(self.processor.calls, 2)
+        self.assertEqual(await StoredResult.objects.acount(), 2)
+
+
+@override_settings(NLP_BLOB_MIN_SIZE=64)
+class BlobStoreTests(TestCase):
+
+    def setUp(self):
+        self.user = create_user()
+        self.long_text = "این یک متن طولانی برای خلاصه سازی است. " * 20
+        self.texts = [f"نظر شماره {i} درباره کیفیت محصول" for i in range(10)]
+
+    def summarization(self, text):
+        return SummarizationHistory(user=self.user, text_input=text, summarized_text="خلاصه")
+
+    def aggregate(self, texts):
+        return AggregateAnalysisHistory(
+            user=self.user, input_fingerprint=texts_fingerprint(texts), input_texts=texts,
+            analysis_result={'overall_sentiment': 'POSITIVE'}, analysis_source='mock', analysis_type='business_intent',
+        )
+
+    def save(self, *rows):
+        blob_store.move_inputs_to_blobs(rows)
+        for row in rows:
+            row.save()
+        return rows
+
+    def test_identical_inputs_share_one_compressed_blob(self):
+        first, second = self.save(self.summarization(self.long_text), self.summarization(self.long_text))
+        blob = TextBlob.objects.get()
+        self.assertEqual((first.input_blob_id, second.input_blob_id), (blob.pk, blob.pk))
+        self.assertEqual((first.text_input, second.text_input), ("", ""))
+        self.assertEqual(blob.size, len(blob_store.encode_value(self.long_text)))
+        self.assertLess(len(blob.data), blob.size)
+
+        # A later row references the stored blob.
+        [third] = self.save(self.summarization(self.long_text))
+        self.assertEqual(third.input_blob_id, blob.pk)
+        self.assertEqual(TextBlob.objects.count(), 1)
+
+    def test_aggregate_inputs(self):
+        first, second = self.save(self.aggregate(self.texts), self.aggregate(self.texts))
+        self.assertEqual(first.input_blob_id, second.input_blob_id)
+        self.assertIsNone(first.input_texts)
+        self.assertEqual(AggregateAnalysisHistory.objects.get(pk=first.pk).texts, self.texts)
+
+    def test_small_inputs_stay_inline(self):
+        summarization, aggregate = self.save(self.summarization("متن کوتاه"), self.aggregate(["خوب"]))
+        self.assertIsNone(summarization.input_blob_id)
+        self.assertIsNone(aggregate.input_blob_id)
+        self.assertEqual(SummarizationHistory.objects.get().text_input, "متن کوتاه")
+        self.assertEqual(AggregateAnalysisHistory.objects.get().input_texts, ["خوب"])
+        self.assertFalse(TextBlob.objects.exists())
+
+    def test_serializers_return_the_decompressed_input(self):
+        self.save(self.summarization(self.long_text), self.aggregate(self.texts))
+        summarization = SummarizationHistorySerializer(SummarizationHistory.objects.get()).data
+        self.assertEqual(summarization['text_input'], self.long_text)
+        aggregate = AggregateAnalysisHistorySerializer(AggregateAnalysisHistory.objects.get()).data
+        self.assertEqual(aggregate['input_texts'], self.texts)
+
+    def test_blobs_are_read_with_the_codec_they_were_written_with(self):
+        with override_settings(NLP_COMPRESSION_CODEC='zlib'):
+            self.save(self.summarization(self.long_text))
+        self.assertEqual(TextBlob.objects.get().codec, 'zlib')
+        with override_settings(NLP_COMPRESSION_CODEC='zstd'):
+            self.assertEqual(SummarizationHistory.objects.get().input_text, self.long_text)
+
+
+@override_settings(CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class JobProgressSocketTests(TransactionTestCase):
+    """
+    The job progress socket through the project's ASGI stack (JWT in the query string).
+    A TransactionTestCase: the middleware looks the user up in a thread of its own.
+    """
+
+    def setUp(self):
+        self.owner = create_user("owner@example.com")
+        self.other = create_user("other@example.com")
+
+    async def connect(self, query=""):
+        communicator = WebsocketCommunicator(application, f"/ws/nlp/jobs/{query}")
+        connected, _ = await communicator.connect()
+        return connected, communicator
+
+    async def create_job(self, user):
+        return await AnalysisJob.objects.acreate(user=user, job_type='sentiment', input_data={"texts": ["خوب"]})
+
+    async def test_sockets_without_a_valid_token_are_rejected(self):
+        unverified = await sync_to_async(create_user)("unverified@example.com", is_email_verified=False)
+        expired = AccessToken.for_user(self.owner)
+        expired.set_exp(lifetime=-timedelta(minutes=1))
+        for query in ("", "?token=not-a-token", f"?token={expired}", f"?token={AccessToken.for_user(unverified)}"):
+            with self.subTest(query=query[:20]):
+                connected, _ = await self.connect(query)
+                self.assertFalse(connected)
+
+    async def test_only_the_owners_events_are_delivered(self):
+        connected, communicator = await self.connect(f"?token={AccessToken.for_user(self.owner)}")
+        self.assertTrue(connected)
+        own_job, other_job = await self.create_job(self.owner), await self.create_job(self.other)
+
+        await apublish_job_event(other_job, 'item', index=0)
+        await apublish_job_event(own_job, 'item', index=0, result={"sentiment_type": "POSITIVE"})
+        await apublish_job_event(own_job, 'status')
+
+        item = await communicator.receive_json_from()
+        self.assertEqual(item['event'], 'item')
+        self.assertEqual(item['job_id'], str(own_job.id))
+        self.assertEqual(item['result'], {"sentiment_type": "POSITIVE"})
+        status = await communicator.receive_json_from()
+        self.assertEqual((status['event'], status['job_id'], status['status']), ('status', str(own_job.id), 'pending'))
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+class PooledTransportTests(SimpleTestCase):
+    """
+    Connection reuse against the local stub of the Gemini API.
+    """
+    BODY = {"contents": [{"role": "user", "parts": [{"text": "Text to analyze: \"خوب\""}]}]}
+
+    def url(self, server):
+        return f"{server.url}/v1beta/models/stub:generateContent"
+
+    async def test_calls_of_a_loop_share_one_client(self):
+        server = StubGeminiServer(latency=0.01)
+        await server.start()
+        transport = PooledTransport(max_connections=4, max_keepalive_connections=4)
+        try:
+            for _ in range(5):
+                response = await transport.request("POST", self.url(server), json=self.BODY)
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(server.connections, 1)
+
+            await asyncio.gather(*(transport.request("POST", self.url(server), json=self.BODY) for _ in range(10)))
+            self.assertLessEqual(server.connections, 4)
+            metrics = transport.metrics()
+            self.assertEqual((metrics['requests'], metrics['failures']), (15, 0))
+            self.assertEqual(metrics['connections_opened'], server.connections)
+            self.assertEqual(metrics['reuse_ratio'], 1 - server.connections / 15)
+            self.assertEqual(metrics['clients'], 1)
+            self.assertEqual(metrics['open_connections'], server.connections)
+            self.assertEqual(metrics['idle_connections'], server.connections)
+        finally:
+            await transport.aclose()
+            await server.close()
+
+    async def test_gemini_calls_reuse_the_connection(self):
+        server = StubGeminiServer(latency=0.01)
+        await server.start()
+        with override_settings(GEMINI_API_BASE_URL=server.url):
+            processor = GeminiProcessor(api_key='test-key', model_name=f"gemini-pooled-{uuid.uuid4().hex}")
+        transport = processor.transport = PooledTransport()
+        try:
+            self.assertEqual((await processor.analyze_sentiment("خوب"))['sentiment'], 'POSITIVE')
+            results = await processor.analyze_sentiment_batch(["خوب", "عالی", "بد"])
+            self.assertEqual([result['sentiment'] for result in results], ['POSITIVE'] * 3)
+            self.assertEqual(await processor.summarize_text("متن", 10), "This is a stub summary of the input text.")
+            self.assertEqual((server.requests, server.connections), (3, 1))
+            self.assertEqual(transport.metrics()['connections_opened'], 1)
+        finally:
+            await transport.aclose()
+            await server.close()
+
+    def test_the_worker_loop_keeps_its_client_between_calls(self):
+        server = StubGeminiServer(latency=0.01)
+        run_on_worker_loop(server.start())
+        self.addCleanup(run_on_worker_loop, server.close())
+        transport = PooledTransport()
+        self.addCleanup(run_on_worker_loop, transport.aclose())
+
+        async def call():
+            response = await transport.request("POST", self.url(server), json=self.BODY)
+            return response.status_code
+
+        # Like the Celery tasks: every call runs on the same long-lived loop.
+        self.assertEqual([run_on_worker_loop(call()) for _ in range(3)], [200] * 3)
+        self.assertEqual(server.connections, 1)
+
+        # A loop of its own gets a client (and a connection) of its own.
+        async def call_and_close():
+            await call()
+            await transport.aclose()
+
+        asyncio.run(call_and_close())
+        self.assertEqual(server.connections, 2)
+        self.assertEqual(transport.metrics()['connections_opened'], 2)
@@ -1,23 +1,37 @@
 from django.urls import path
 from .views import (
     SentimentAnalysisAPIView,
+    SentimentBulkAPIView,
     AnalysisHistoryListView,
     SummarizationAPIView,          
+    SummarizationStreamAPIView,
     SummarizationHistoryListView,
     AggregateSentimentAPIView,
     AggregateAnalysisHistoryListView,
+    AnalysisJobListCreateView,
+    AnalysisJobDetailView,
+    UpstreamStatusAPIView,
 )
 
 urlpatterns = [
     path('sentiment/analyze/', SentimentAnalysisAPIView.as_view(), name='sentiment_analyze'),
+    path('sentiment/bulk/', SentimentBulkAPIView.as_view(), name='sentiment_bulk'),
 
     path('history/sentiment/', AnalysisHistoryListView.as_view(), name='sentiment_history'),
 
     # Summarization URLs (NEW)
     path('summarize/', SummarizationAPIView.as_view(), name='summarize_text'),
+    path('summarize/stream/', SummarizationStreamAPIView.as_view(), name='summarize_text_stream'),
     path('history/summarize/', SummarizationHistoryListView.as_view(), name='summarize_history'),
 
     # AggregateAnalysis
     path('sentiment/aggregate/', AggregateSentimentAPIView.as_view(), name='sentiment_aggregate'),
     path('history/aggregate/', AggregateAnalysisHistoryListView.as_view(), name='aggregate_history'),
+
+    # Asynchronous analysis jobs
+    path('jobs/', AnalysisJobListCreateView.as_view(), name='analysis_jobs'),
+    path('jobs/<uuid:pk>/', AnalysisJobDetailView.as_view(), name='analysis_job_detail'),
+
+    # Admission limits and connection pool of the AI provider (staff only)
+    path('upstream/status/', UpstreamStatusAPIView.as_view(), name='upstream_status'),
 ]
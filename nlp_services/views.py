@@ -1,22 +1,22 @@
 import json
-import asyncio
+import math
+from django.http import StreamingHttpResponse
 from rest_framework import status
 from rest_framework.response import Response
-from rest_framework.views import APIView
-from rest_framework.permissions import IsAuthenticated
-from django.core.cache import cache
-from django.db import transaction
-from django.core.cache import caches
-import hashlib
+from adrf.views import APIView
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework import generics
-from drf_spectacular.utils import extend_schema
+from drf_spectacular.utils import extend_schema, OpenApiParameter, OpenApiResponse
+from drf_spectacular.types import OpenApiTypes
 
 # Import the processor instance
 from nlp_services.processors.llm_processor import processor_instance
+from nlp_services import services, bulk
 
 from nlp_services.serializers import (
     SentimentAnalysisRequestSerializer,
     SentimentAnalysisResultSerializer,
+    SentimentBulkRequestSerializer,
     AnalysisHistorySerializer,
     SummarizationRequestSerializer,
     SummarizationResultSerializer,
@@ -24,95 +24,84 @@ from nlp_services.serializers import (
     AggregateAnalysisRequestSerializer, 
     AggregateAnalysisResultSerializer,
     AggregateAnalysisHistorySerializer,
+    AnalysisJobRequestSerializer,
+    AnalysisJobSerializer,
 )
-from nlp_services.pagination import StandardLimitOffsetPagination
-from nlp_services.models import AnalysisHistory, SummarizationHistory, AggregateAnalysisHistory
+from nlp_services.pagination import StandardLimitOffsetPagination, HistoryCursorPagination
+from nlp_services.models import AnalysisHistory, SummarizationHistory, AggregateAnalysisHistory, AnalysisJob
+from nlp_services.tasks import enqueue_analysis_job, job_usage
 from django.contrib.auth import get_user_model
 
 User = get_user_model()
 processor = processor_instance
 
 
-def normalize_text_simple(text: str) -> str:
-    """
-    A simple normalization function for Persian text.
-    It removes extra whitespace and trailing periods.
-    """
-    if not isinstance(text, str):
-        return ""
-
-    # 1. Remove leading/trailing whitespace
-    text = text.strip()
-    
-    # 2. Collapse multiple spaces/tabs/newlines in the middle of the text into a single space
-    text = ' '.join(text.split())
-    
-    # 3. Remove all trailing periods from the end of the string
-    text = text.strip('.')
-    
-    return text
-
-
 class BaseNLPView:
     """
     A base view for NLP tasks that handles shared logic like
     authentication and usage deduction.
-    This version is synchronous.
+    The analysis pipelines themselves live in nlp_services.services,
+    so the Celery job tasks run exactly the same code.
     """
 
+    async def _acheck_and_deduct_usage(self, user, num_items: int = 1):
+        await services.acheck_and_deduct_usage(user, num_items)
 
-    # This is a synchronous method
-    def _check_and_deduct_usage(self, user, num_items: int = 1):
-        with transaction.atomic():
-            user_instance = User.objects.select_for_update().get(pk=user.pk)
-            if not user_instance.is_pro:
-                if user_instance.free_analysis_count >= num_items:
-                    user_instance.free_analysis_count -= num_items
-                    user_instance.save(update_fields=['free_analysis_count'])
-                else:
-                    raise Exception("Free usage limit exceeded. Please upgrade your plan.")
-
-    # This is also a synchronous method
-    def _save_analysis_history(self, user, text_input, result, source, analysis_type):
-        AnalysisHistory.objects.create(
-            user=user,
-            text_input=text_input,
-            analysis_result=result,
-            analysis_source=source,
-            analysis_type=analysis_type
-        )
-
-    def _save_summarization_history(self, user, text_input, summarized_text, source, max_words):
+    def _retry_later_response(self, error):
         """
-        Saves the text summarization result to history.
+        Answers a request whose upstream calls were rejected by the provider's rate
+        limit (429) or failed because the provider is unavailable (503).
         """
-        history_entry = SummarizationHistory.objects.create(
-            user=user,
-            text_input=text_input,
-            summarized_text=summarized_text,
-            summarization_source=source,
-            max_words_summarization=max_words
+        retry_after = math.ceil(error.retry_after or 1)
+        if isinstance(error, services.ProviderRateLimited):
+            status_code = status.HTTP_429_TOO_MANY_REQUESTS
+        else:
+            status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return Response(
+            {"detail": str(error), "retry_after": retry_after},
+            status=status_code,
+            headers={'Retry-After': str(retry_after)}
         )
 
-    def _save_aggregate_history(self, user, url, result, source, analysis_type, fingerprint, original_texts):
-        """
-        Saves the aggregate analysis result to its dedicated history model.
-        """
-        AggregateAnalysisHistory.objects.create(
-            user=user,
-            url=url, # Use the 'url' field we defined in the model
-            analysis_result=result,
-            analysis_source=source,
-            analysis_type=analysis_type,
-            input_fingerprint=fingerprint,
-            input_texts=original_texts
-        )
+
+class HistoryListMixin:
+    """
+    Shared logic of the history list endpoints: the rows of the logged-in user,
+    paginated with a keyset cursor and loaded with only the columns the
+    response needs. The input texts are only loaded and returned with ?include_input=true.
+    """
+    pagination_class = HistoryCursorPagination
+    history_model = None
+    # Columns loaded for every row, and the input columns loaded on request.
+    list_fields = ()
+    input_fields = ()
+
+    def include_input(self):
+        return self.request.query_params.get('include_input', '').lower() in ('1', 'true', 'yes')
+
+    def get_queryset(self):
+        fields = self.list_fields + (self.input_fields if self.include_input() else ())
+        queryset = self.history_model.objects.filter(user=self.request.user).only('timestamp', *fields)
+        # Related columns (e.g. the blob of a compressed input) are loaded in the same query.
+        related = {field.split('__')[0] for field in fields if '__' in field}
+        return queryset.select_related(*related)
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context['include_input'] = self.include_input()
+        return context
+
+    @extend_schema(parameters=[
+        OpenApiParameter('include_input', OpenApiTypes.BOOL, description="Also return the input texts of each row."),
+    ])
+    def get(self, request, *args, **kwargs):
+        return super().get(request, *args, **kwargs)
 
 
-# This view now inherits from the synchronous BaseNLPView
 class SentimentAnalysisAPIView(BaseNLPView, APIView):
     """
-    API endpoint for sentiment analysis. Inherits from the sync BaseNLPView.
+    Async API endpoint for sentiment analysis.
+    Cache, database and LLM calls are awaited, so no worker thread is held while they run.
     """
     @extend_schema(
         summary='Submit Text for Single Sentiment Analysis',
@@ -126,9 +115,11 @@ class SentimentAnalysisAPIView(BaseNLPView, APIView):
         responses={
             status.HTTP_200_OK: SentimentAnalysisResultSerializer, # Success response body
             status.HTTP_400_BAD_REQUEST: None,                     # Auto-generated error structure
+            status.HTTP_429_TOO_MANY_REQUESTS: None,               # The AI provider is rate limiting; see Retry-After
+            status.HTTP_503_SERVICE_UNAVAILABLE: None,             # The AI provider is down; see Retry-After
         }
     )
-    def post(self, request):
+    async def post(self, request):
         if not processor:
             return Response({"detail": "AI service not available."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
@@ -141,69 +132,70 @@ class SentimentAnalysisAPIView(BaseNLPView, APIView):
 
         try:
             
-            self._check_and_deduct_usage(request.user, len(originalـtexts))
+            await self._acheck_and_deduct_usage(request.user, len(originalـtexts))
 
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_403_FORBIDDEN)
 
-        results = []
-        for text in originalـtexts:
-            llm_result = None
+        try:
+            results = await services.run_sentiment_analysis(request.user, originalـtexts, analysis_type)
+        except (services.ProviderRateLimited, services.ProviderUnavailable) as e:
+            await services.arefund_usage(request.user, len(originalـtexts))
+            return self._retry_later_response(e)
+        # Texts whose analysis failed are not charged.
+        await services.arefund_usage(request.user, services.count_failed(results))
 
-            normalized_text = normalize_text_simple(text)
+        response_serializer = SentimentAnalysisResultSerializer(instance=results, many=True)
+        return Response(response_serializer.data, status=status.HTTP_200_OK)
 
-            # --- Multi-level Caching Logic Starts Here ---
 
-            # 1. Check Redis cache first (L1 Cache)
-            cache_key = f"sentiment_cache:{analysis_type}:{hash(normalized_text)}"
-            cached_result = cache.get(cache_key)
+class SentimentBulkAPIView(BaseNLPView, APIView):
+    """
+    Async API endpoint for scoring large corpora: the body is an NDJSON upload
+    (optionally gzip-compressed) and the results are streamed back as NDJSON.
+    See nlp_services.bulk for the processing and resumption details.
+    """
+    @extend_schema(
+        summary='Bulk Sentiment Analysis of an NDJSON Upload',
+        description="The body holds one JSON object per line ({\"id\": ..., \"text\": ...}) or one JSON string per line, \
+        optionally gzip-compressed. Every line is answered with a result line carrying its line number, in completion order. \
+        After each window of lines a {\"checkpoint\": <cursor>} line is sent; an interrupted upload is resumed by sending it \
+        again with ?cursor=<last checkpoint> (or with the same ?upload_id=). Usage is deducted per text, once per window.",
+        parameters=[SentimentBulkRequestSerializer],
+        request={'application/x-ndjson': OpenApiTypes.BINARY},
+        responses={
+            (status.HTTP_200_OK, 'application/x-ndjson'): OpenApiResponse(description="One result per line, checkpoints and a final summary."),
+            status.HTTP_400_BAD_REQUEST: None,
+        }
+    )
+    async def post(self, request):
+        if not processor:
+            return Response({"detail": "AI service not available."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-            if cached_result:
-                print(f"Retrieved sentiment analysis for '{normalized_text[:30]}...' from L1 Cache (Redis).")
-                llm_result = json.loads(cached_result)
-            else:
-                # 2. If not in Redis, check the database (L2 Cache)
-                # We search for an existing analysis of the same text by the same user.
-                history_entry = AnalysisHistory.objects.filter(user=request.user, text_input=normalized_text, analysis_type=analysis_type).first()
-                
-                if history_entry:
-                    print(f"Retrieved from L2 Cache (Database) and re-populating Redis.")
-                    llm_result = history_entry.analysis_result
-                    # Re-populate the Redis cache for the next 24 hours
-                    cache.set(cache_key, json.dumps(llm_result), timeout=60*60*24)
-                else:
-                    # 3. If not in any cache, call the external API
-                    try:
-                        print(f"No cache hit. Calling external API for '{normalized_text[:30]}...'.")
-                        llm_result = asyncio.run(processor.analyze_sentiment(
-                            text=normalized_text,
-                            analysis_type=analysis_type
-                        ))
-                        # Save to both caches for future requests
-                        cache.set(cache_key, json.dumps(llm_result), timeout=60*60*24)
-                        self._save_analysis_history(request.user, normalized_text, llm_result, processor.provider_name, analysis_type)
-
-                    except Exception as e:
-                        results.append({
-                            "text_input": normalized_text, "sentiment_type": "ERROR", "score": 0.0,
-                            "notes": f"Failed to process: {str(e)}"
-                        })
-                        continue
-            
-            # This part runs for all successful outcomes (from any cache or API)
-            results.append({
-                "text_input": normalized_text,
-                "sentiment_type": llm_result.get('sentiment'),
-                "score": llm_result.get('score'),
-                "notes": llm_result.get('notes', '')
-            })
-    
-        response_serializer = SentimentAnalysisResultSerializer(instance=results, many=True)
-        return Response(response_serializer.data, status=status.HTTP_200_OK)
+        params = SentimentBulkRequestSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
 
+        analysis_type = params.validated_data['analysis_type']
+        upload_id = params.validated_data.get('upload_id')
+        cursor = params.validated_data.get('cursor')
+        if cursor is None:
+            cursor = await bulk.get_saved_cursor(request.user, upload_id) if upload_id else 0
 
+        user = request.user
+        # The body is read from the Django request itself: request.data would parse it all at once.
+        body_stream = request._request
 
-class AnalysisHistoryListView(BaseNLPView, generics.ListAPIView):
+        async def ndjson_stream():
+            async for record in bulk.score_upload(user, body_stream, analysis_type, cursor=cursor, upload_id=upload_id):
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+
+        response = StreamingHttpResponse(ndjson_stream(), content_type='application/x-ndjson')
+        # Stop proxies such as nginx from buffering the results.
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class AnalysisHistoryListView(BaseNLPView, HistoryListMixin, generics.ListAPIView):
     """
     API endpoint to retrieve the sentiment analysis history for the logged-in user.
     
@@ -214,16 +206,17 @@ class AnalysisHistoryListView(BaseNLPView, generics.ListAPIView):
     # 1. Define the Serializer Class: This is crucial for drf-spectacular 
     serializer_class = AnalysisHistorySerializer 
     
-    # 2. Define the QuerySet Filter: Overriding get_queryset ensures only the 
-    def get_queryset(self):
-        return AnalysisHistory.objects.filter(user=self.request.user).order_by('-timestamp')
+    # 2. The rows of the logged-in user, with the result read from the shared store in the same query.
+    history_model = AnalysisHistory
+    list_fields = ('analysis_source', 'analysis_result', 'stored_result__result')
+    input_fields = ('text_input',)
 
 
 # -- Summarization -- 
 
 class SummarizationAPIView(BaseNLPView, APIView):
     """
-    API endpoint for text summarization with multi-level caching.
+    Async API endpoint for text summarization with multi-level caching.
     """
     @extend_schema(
         summary='Submit Text for Summarization',
@@ -236,9 +229,11 @@ class SummarizationAPIView(BaseNLPView, APIView):
         responses={
             status.HTTP_200_OK: SummarizationResultSerializer, # Success response body
             status.HTTP_400_BAD_REQUEST: None,                     # Auto-generated error structure
+            status.HTTP_429_TOO_MANY_REQUESTS: None,               # The AI provider is rate limiting; see Retry-After
+            status.HTTP_503_SERVICE_UNAVAILABLE: None,             # The AI provider is down; see Retry-After
         }
     )
-    def post(self, request):
+    async def post(self, request):
         if not processor:
             return Response({"detail": "AI service not available."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
@@ -249,82 +244,101 @@ class SummarizationAPIView(BaseNLPView, APIView):
         text = serializer.validated_data['text']
         max_words = serializer.validated_data['max_words']
 
-        normalized_text = normalize_text_simple(text)
-
         try:
-            self._check_and_deduct_usage(request.user, 1)
+            await self._acheck_and_deduct_usage(request.user, 1)
         except Exception as e:
             return Response({"detail": str(e)}, status=status.HTTP_403_FORBIDDEN)
 
-        summarized_text = None
-        # --- Multi-level Caching Logic Starts Here ---
+        try:
+            response_data = await services.run_summarization(request.user, text, max_words)
+        except (services.ProviderRateLimited, services.ProviderUnavailable) as e:
+            await services.arefund_usage(request.user, 1)
+            return self._retry_later_response(e)
+        except Exception as e:
+            await services.arefund_usage(request.user, 1)
+            return Response(
+                {"detail": "Failed to summarize text.", "error": str(e)},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+        response_serializer = SummarizationResultSerializer(instance=response_data)
+        return Response(response_serializer.data, status=status.HTTP_200_OK)
 
-        # 1. Check Redis cache first (L1 Cache)
-        cache_key = f"summarization_cache:{max_words}:{hash(normalized_text)}"
-        cached_summary = cache.get(cache_key)
 
-        if cached_summary:
-            print(f"Retrieved summarization for '{normalized_text[:30]}...' from L1 Cache (Redis).")
-            summarized_text = cached_summary
+def sse_event(event: str, data: dict) -> str:
+    """
+    Formats one Server-Sent Event.
+    """
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-        else:
-            # 2. If not in Redis, check the database (L2 Cache)
-            history_entry = SummarizationHistory.objects.filter(user=request.user, text_input=normalized_text, max_words_summarization=max_words).first()
-
-            if history_entry:
-                print(f"Retrieved from L2 Cache (Database) and re-populating Redis.")
-                summarized_text = history_entry.summarized_text
-                # Re-populate the Redis cache for the next 24 hours
-                cache.set(cache_key, summarized_text, timeout=60*60*24)
-            else:
-                # 3. If not in any cache, call the external API
-                try:
-                    print(f"No cache hit. Calling external API for summarization of '{normalized_text[:30]}...'.")
-                    summarized_text = asyncio.run(processor.summarize_text(
-                        text=normalized_text,
-                        max_words=max_words
-                    ))
-                    
-                    # Save to both caches for future requests
-                    cache.set(cache_key, summarized_text, timeout=60*60*24)
-                    self._save_summarization_history(
-                        request.user, normalized_text, summarized_text, processor.provider_name, max_words
-                    )
-                except Exception as e:
-                    return Response(
-                        {"detail": "Failed to summarize text.", "error": str(e)},
-                        status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                    )
-
-        # Prepare and return the response
-        response_data = {
-            "original_text": normalized_text,
-            "summarized_text": summarized_text
+
+class SummarizationStreamAPIView(BaseNLPView, APIView):
+    """
+    Async API endpoint that streams a summary as Server-Sent Events while the model generates it.
+    """
+    @extend_schema(
+        summary='Stream the Summarization of a Text',
+        description="Same input, usage deduction and caching as the summarization endpoint, but the summary is \
+        streamed as Server-Sent Events: 'token' events carry pieces of the summary as they are generated, \
+        followed by one 'done' event with the full result (or an 'error' event).",
+        request=SummarizationRequestSerializer,
+        responses={
+            (status.HTTP_200_OK, 'text/event-stream'): OpenApiResponse(description="A stream of 'token' events, then 'done' or 'error'."),
+            status.HTTP_400_BAD_REQUEST: None,
         }
+    )
+    async def post(self, request):
+        if not processor:
+            return Response({"detail": "AI service not available."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
-        response_serializer = SummarizationResultSerializer(instance=response_data)
-        return Response(response_serializer.data, status=status.HTTP_200_OK)
+        serializer = SummarizationRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        text = serializer.validated_data['text']
+        max_words = serializer.validated_data['max_words']
+
+        try:
+            await self._acheck_and_deduct_usage(request.user, 1)
+        except Exception as e:
+            return Response({"detail": str(e)}, status=status.HTTP_403_FORBIDDEN)
+
+        user = request.user
 
+        async def event_stream():
+            try:
+                async for event, data in services.stream_summarization(user, text, max_words):
+                    yield sse_event(event, data)
+            except (services.ProviderRateLimited, services.ProviderUnavailable) as e:
+                await services.arefund_usage(user, 1)
+                yield sse_event('error', {"detail": str(e), "retry_after": math.ceil(e.retry_after or 1)})
+            except Exception as e:
+                await services.arefund_usage(user, 1)
+                # The status line has already been sent, so failures are reported in the stream.
+                yield sse_event('error', {"detail": "Failed to summarize text.", "error": str(e)})
 
-class SummarizationHistoryListView(BaseNLPView, generics.ListAPIView):
+        response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Stop proxies such as nginx from buffering the events.
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class SummarizationHistoryListView(BaseNLPView, HistoryListMixin, generics.ListAPIView):
     """
     API endpoint to retrieve the summarization history for the logged-in user.
     """
     # to infer and document the correct GET response structure in Swagger.
     serializer_class = SummarizationHistorySerializer 
     
-    # 2. Apply the custom pagination class for infinite scrolling (Limit/Offset).
-    pagination_class = StandardLimitOffsetPagination 
-    
-    # 3. Override get_queryset to filter the history by the currently logged-in user.
-    def get_queryset(self):
-        # The records are ordered by descending creation date (newest first).
-        return SummarizationHistory.objects.filter(user=self.request.user).order_by('-timestamp')
+    # 2. The rows of the logged-in user, newest first (see HistoryCursorPagination).
+    history_model = SummarizationHistory
+    list_fields = ('summarization_source', 'summarized_text', 'stored_result__result')
+    input_fields = ('text_input', 'input_blob__codec', 'input_blob__data')
 
 
 class AggregateSentimentAPIView(BaseNLPView, APIView):
     """
-    API endpoint for aggregate sentiment analysis with smart URL and content caching.
+    Async API endpoint for aggregate sentiment analysis with smart URL and content caching.
     """
     @extend_schema(
         summary='Submit Multiple Texts for Aggregate Analysis',
@@ -338,9 +352,11 @@ class AggregateSentimentAPIView(BaseNLPView, APIView):
         responses={
             status.HTTP_200_OK: AggregateAnalysisResultSerializer, # Success response body
             status.HTTP_400_BAD_REQUEST: None,                     # Auto-generated error structure
+            status.HTTP_429_TOO_MANY_REQUESTS: None,               # The AI provider is rate limiting; see Retry-After
+            status.HTTP_503_SERVICE_UNAVAILABLE: None,             # The AI provider is down; see Retry-After
         }
     )
-    def post(self, request):
+    async def post(self, request):
         if not processor:
             return Response({"detail": "AI service not available."}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
 
@@ -356,7 +372,7 @@ class AggregateSentimentAPIView(BaseNLPView, APIView):
         # --- Smart URL Handling Logic ---
         if url and not force_reanalyze:
             # Check if this URL has been analyzed before
-            existing_analysis = AggregateAnalysisHistory.objects.filter(user=request.user, url=url).first()
+            existing_analysis = await services.find_url_analysis(request.user, url)
             if existing_analysis:
                 return Response({
                     "status": "previously_analyzed",
@@ -367,43 +383,23 @@ class AggregateSentimentAPIView(BaseNLPView, APIView):
         try:
             # --- Get the list of texts to analyze ---
             if url:
-                texts_to_analyze = ["I am completely satisfied with the product quality and the shipping speed.",
-                                        "Unfortunately, my package arrived very late and damaged.",
-                                        "I just wanted to ask if this model is also available in another color."
-                                    ]
+                texts_to_analyze = services.texts_for_url(url)
             else:
                 texts_to_analyze = validated_data['texts']
 
             if not texts_to_analyze:
                 return Response({"detail": "No texts found to analyze."}, status=status.HTTP_400_BAD_REQUEST)
 
-            # --- Multi-level Caching Logic ---
-            normalized_texts = sorted([normalize_text_simple(t) for t in texts_to_analyze])
-            content_string = "".join(normalized_texts)
-            fingerprint = hashlib.sha256(content_string.encode('utf-8')).hexdigest()
-
-            cache_key = f"aggregate_cache:{analysis_type}:{fingerprint}"
-            llm_result = cache.get(cache_key)
-
-            if not llm_result:
-                history_entry = AggregateAnalysisHistory.objects.filter(input_fingerprint=fingerprint, analysis_type=analysis_type).first()
-                if history_entry:
-                    llm_result = history_entry.analysis_result
-                    cache.set(cache_key, llm_result, timeout=60*60*24)
-                else:
-                    self._check_and_deduct_usage(request.user, 1)
-
-                    llm_result = asyncio.run(processor.analyze_aggregate_sentiment(texts_to_analyze, analysis_type))
-                    cache.set(cache_key, llm_result, timeout=60*60*24)
-                    
-                    self._save_aggregate_history(
-                        request.user, url, llm_result, processor.provider_name, 
-                        analysis_type, fingerprint, texts_to_analyze
-                    )
+            llm_result = await services.run_aggregate_analysis(
+                request.user, texts_to_analyze, analysis_type, url=url, force_reanalyze=force_reanalyze
+            )
             
             response_serializer = AggregateAnalysisResultSerializer(instance=llm_result)
             return Response(response_serializer.data, status=status.HTTP_200_OK)
 
+        except (services.ProviderRateLimited, services.ProviderUnavailable) as e:
+            return self._retry_later_response(e)
+
         except Exception as e:
             return Response(
                 {"detail": "Failed to perform aggregate analysis.", "error": str(e)},
@@ -411,7 +407,7 @@ class AggregateSentimentAPIView(BaseNLPView, APIView):
             )
 
 
-class AggregateAnalysisHistoryListView(BaseNLPView, generics.ListAPIView):
+class AggregateAnalysisHistoryListView(BaseNLPView, HistoryListMixin, generics.ListAPIView):
     """
     API endpoint to retrieve the aggregate analysis history for the logged-in user.
     Uses generics.ListAPIView for automatic GET handling and Swagger documentation.
@@ -420,6 +416,110 @@ class AggregateAnalysisHistoryListView(BaseNLPView, generics.ListAPIView):
     # 1. Explicitly define the serializer class. This is CRITICAL for drf-spectacular 
     serializer_class = AggregateAnalysisHistorySerializer 
     
-    # 2. Override get_queryset to filter the history by the currently logged-in user.
+    # 2. The rows of the logged-in user; input_texts is only loaded on request.
+    history_model = AggregateAnalysisHistory
+    list_fields = ('url', 'analysis_result', 'analysis_source', 'analysis_type')
+    input_fields = ('input_texts', 'input_blob__codec', 'input_blob__data')
+
+
+# -- Analysis Jobs --
+
+class AnalysisJobListCreateView(BaseNLPView, generics.ListCreateAPIView):
+    """
+    API endpoint to submit analysis jobs and list the jobs of the logged-in user.
+    A job is queued for a Celery worker, so the request returns as soon as it is stored.
+    """
+    serializer_class = AnalysisJobSerializer
+    pagination_class = StandardLimitOffsetPagination
+
     def get_queryset(self):
-        return AggregateAnalysisHistory.objects.filter(user=self.request.user).order_by('-timestamp')
+        return AnalysisJob.objects.filter(user=self.request.user).order_by('-created_at')
+
+    @extend_schema(
+        summary='Submit an Analysis Job',
+        description="Queues a sentiment, summarization or aggregate analysis and returns the job immediately. \
+        The request holds 'job_type', an optional 'priority' (high, default or low) and the same fields as the \
+        synchronous endpoint of that job type. Poll the job (or its WebSocket channel) for the result.",
+        request=AnalysisJobRequestSerializer,
+        responses={
+            status.HTTP_202_ACCEPTED: AnalysisJobSerializer,
+            status.HTTP_400_BAD_REQUEST: None,
+            status.HTTP_403_FORBIDDEN: None,
+        }
+    )
+    def post(self, request):
+        serializer = AnalysisJobRequestSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        job_type = serializer.validated_data['job_type']
+        input_data = serializer.validated_data['input_data']
+
+        # Sentiment and summarization are charged up front like their synchronous endpoints;
+        # aggregate jobs are charged by the worker, only when the result is not cached.
+        usage = job_usage(job_type, input_data)
+        try:
+            if usage:
+                services.check_and_deduct_usage(request.user, usage)
+        except services.UsageLimitExceeded as e:
+            return Response({"detail": str(e)}, status=status.HTTP_403_FORBIDDEN)
+
+        job = AnalysisJob.objects.create(
+            user=request.user,
+            job_type=job_type,
+            priority=serializer.validated_data['priority'],
+            input_data=input_data,
+        )
+
+        try:
+            enqueue_analysis_job(job)
+        except Exception as e:
+            job.status = AnalysisJob.STATUS_FAILED
+            job.error = f"Could not queue the job: {e}"
+            job.save(update_fields=['status', 'error'])
+            services.refund_usage(request.user, usage)
+            return Response(
+                {"detail": "The job queue is not available.", "error": str(e)},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+
+        return Response(AnalysisJobSerializer(instance=job).data, status=status.HTTP_202_ACCEPTED)
+
+
+class AnalysisJobDetailView(BaseNLPView, generics.RetrieveAPIView):
+    """
+    API endpoint to retrieve the status and result of one job of the logged-in user.
+    """
+    serializer_class = AnalysisJobSerializer
+
+    def get_queryset(self):
+        return AnalysisJob.objects.filter(user=self.request.user)
+
+
+# -- Upstream status --
+
+class UpstreamStatusAPIView(APIView):
+    """
+    API endpoint for staff: for every AI backend the calls are routed to, its latency
+    and error rate, admission limits, calls in flight and queue depth, circuit breaker
+    and retry counters; the cost spent per tier, and the connection pool metrics.
+    """
+    permission_classes = [IsAdminUser]
+
+    @extend_schema(
+        summary='Upstream Backends, Limits and Connection Pool',
+        description="Per AI backend: the latency and error rate the router observed, the concurrency limit, token \
+        bucket, calls in flight and queue depth (shared by all workers when Redis is available) and the circuit \
+        breaker, retry and hedging counters. Also the cost spent per tier this hour and the connection pool metrics \
+        of this process.",
+        responses={status.HTTP_200_OK: OpenApiTypes.OBJECT},
+    )
+    def get(self, request):
+        # The Gemini backends share one pooled transport.
+        transport = next((
+            backend.processor.transport for backend in processor.backends
+            if getattr(backend.processor, 'transport', None) is not None
+        ), None)
+        return Response({
+            **processor.routing_state(),
+            "transport": transport.metrics() if transport is not None else None,
+        }, status=status.HTTP_200_OK)
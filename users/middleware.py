@@ -0,0 +1,45 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from django.contrib.auth import get_user_model
+from rest_framework_simplejwt.exceptions import TokenError
+from rest_framework_simplejwt.settings import api_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+
+User = get_user_model()
+
+
+@database_sync_to_async
+def get_user_from_token(raw_token):
+    """
+    Returns the active user an access token belongs to, or None if the token is invalid.
+    """
+    try:
+        token = AccessToken(raw_token)
+    except TokenError:
+        return None
+    user_id = token.get(api_settings.USER_ID_CLAIM)
+    return User.objects.filter(**{api_settings.USER_ID_FIELD: user_id}, is_active=True).first()
+
+
+class JWTAuthMiddleware:
+    """
+    Authenticates WebSocket connections with a JWT access token.
+
+    Browsers cannot set headers on a WebSocket handshake, so the token is sent
+    in the query string: ws://<host>/ws/nlp/jobs/?token=<access token>.
+    Without a valid token the user set by the session middleware is kept.
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        query = parse_qs(scope.get('query_string', b'').decode())
+        raw_token = query.get('token', [None])[0]
+        if raw_token:
+            user = await get_user_from_token(raw_token)
+            if user is not None:
+                scope = dict(scope, user=user)
+        return await self.inner(scope, receive, send)